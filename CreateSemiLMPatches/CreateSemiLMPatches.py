@@ -7,6 +7,10 @@ import fnmatch
 import  numpy as np
 import random
 import math
+import time
+import hashlib
+from vtk.util.numpy_support import vtk_to_numpy
+from CreateSemiLMPatchesLib import patch_engine
 
 
 #
@@ -64,6 +68,8 @@ class CreateSemiLMPatchesWidget(ScriptedLoadableModuleWidget):
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
+    # kept for the widget, so that patches and merges of the same mesh reuse its patch engine
+    self.logic = CreateSemiLMPatchesLogic()
 
     # Instantiate and connect widgets ...
 
@@ -224,7 +230,7 @@ class CreateSemiLMPatchesWidget(ScriptedLoadableModuleWidget):
     pass
 
   def onApplyButton(self):
-    logic = CreateSemiLMPatchesLogic()
+    logic = self.logic
     enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
     gridLandmarks = [int(self.landmarkGridPoint1.value), int(self.landmarkGridPoint2.value), int(self.landmarkGridPoint3.value)]
     smoothingIterations =  int(self.smoothingSlider.value)
@@ -232,9 +238,10 @@ class CreateSemiLMPatchesWidget(ScriptedLoadableModuleWidget):
     logic.run(self.meshSelect.currentNode(), self.LMSelect.currentNode(), gridLandmarks, int(self.gridSamplingRate.value)+1, smoothingIterations, projectionRayTolerance)
 
   def onMergeButton(self):
-    logic = CreateSemiLMPatchesLogic()
+    logic = self.logic
     enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
-    logic.mergeTree(self.fiducialView, self.LMSelect.currentNode(), self.meshSelect.currentNode(),int(self.gridSamplingRate.value))
+    smoothingIterations =  int(self.smoothingSlider.value)
+    logic.mergeTree(self.fiducialView, self.LMSelect.currentNode(), self.meshSelect.currentNode(),int(self.gridSamplingRate.value), smoothingIterations)
 
   def updateMergeButton(self):
     nodes=self.fiducialView.selectedIndexes()
@@ -253,13 +260,25 @@ class CreateSemiLMPatchesLogic(ScriptedLoadableModuleLogic):
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.patchEngines = {}
+
   def run(self, meshNode, LMNode, gridLandmarks, sampleRate, smoothingIterations, maximumProjectionDistance=.25):
+    normalArray = self.getNormals(meshNode, smoothingIterations)
+    semiLandmarks = self.applyPatch(meshNode, LMNode, gridLandmarks, sampleRate, normalArray, maximumProjectionDistance)
+
+
+    return True
+
+  def getNormals(self, meshNode, smoothingIterations=0):
     if(smoothingIterations == 0):
       surfacePolydata = meshNode.GetPolyData()
       normalArray = surfacePolydata.GetPointData().GetArray("Normals")
       if(not normalArray):
         normalFilter=vtk.vtkPolyDataNormals()
         normalFilter.ComputePointNormalsOn()
+        normalFilter.SplittingOff()
         normalFilter.SetInputData(surfacePolydata)
         normalFilter.Update()
         normalArray = normalFilter.GetOutput().GetPointData().GetArray("Normals")
@@ -268,184 +287,49 @@ class CreateSemiLMPatchesLogic(ScriptedLoadableModuleLogic):
     else:
       print('smoothing normals')
       normalArray = self.getSmoothNormals(meshNode,smoothingIterations)
-    semiLandmarks = self.applyPatch(meshNode, LMNode, gridLandmarks, sampleRate, normalArray, maximumProjectionDistance)
-
-
-    return True
+    return normalArray
 
-  def applyPatch(self, meshNode, LMNode, gridLandmarks, sampleRate, polydataNormalArray, maximumProjectionDistance=.25):
+  def getPatchEngine(self, meshNode, polydataNormalArray):
+    """
+    Patch engine of a mesh and normals, built once and reused until the mesh changes, see
+    patch_engine.SemiLandmarkPatchEngine
+    """
     surfacePolydata = meshNode.GetPolyData()
+    # normals are recomputed for each run, the engine is reused when their values are the same
+    normalsDigest = hashlib.sha1(np.ascontiguousarray(vtk_to_numpy(polydataNormalArray)).tobytes()).hexdigest()
+    key = (meshNode.GetID(), surfacePolydata.GetMTime(), normalsDigest)
+    if key not in self.patchEngines:
+      # only the engine of the last mesh is kept
+      self.patchEngines = {key: patch_engine.SemiLandmarkPatchEngine(surfacePolydata, polydataNormalArray)}
+    return self.patchEngines[key]
 
-    gridPoints = vtk.vtkPoints()
-
-    gridPoints.InsertNextPoint(0,0,0)
-    gridPoints.InsertNextPoint(0,sampleRate-1,0)
-    gridPoints.InsertNextPoint(sampleRate-1,0,0)
-    for row in range(1,sampleRate-1):
-      for col in range(1,sampleRate-1):
-        if (row+col)<(sampleRate-1):
-          gridPoints.InsertNextPoint(row,col,0)
-
-    gridPolydata=vtk.vtkPolyData()
-    gridPolydata.SetPoints(gridPoints)
-
-    sourcePoints = vtk.vtkPoints()
-    targetPoints = vtk.vtkPoints()
-
-    sourcePoints.InsertNextPoint(gridPoints.GetPoint(0))
-    sourcePoints.InsertNextPoint(gridPoints.GetPoint(1))
-    sourcePoints.InsertNextPoint(gridPoints.GetPoint(2))
-
-    for gridVertex in gridLandmarks:
-      point = LMNode.GetNthControlPointPosition(int(gridVertex-1))
-      targetPoints.InsertNextPoint(point)
-
-    #transform grid to triangle
-    transform = vtk.vtkThinPlateSplineTransform()
-    transform.SetSourceLandmarks( sourcePoints )
-    transform.SetTargetLandmarks( targetPoints )
-    transform.SetBasisToR()
-
-    transformNode=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode","TPS")
-    transformNode.SetAndObserveTransformToParent(transform)
-
-    model=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "mesh_resampled")
-    model.SetAndObservePolyData(gridPolydata)
-    model.SetAndObserveTransformNodeID(transformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(model)
-
-    resampledPolydata = model.GetPolyData()
-
-    pointLocator = vtk.vtkPointLocator()
-    pointLocator.SetDataSet(surfacePolydata)
-    pointLocator.BuildLocator()
-
-    #get surface normal from each landmark point
-    rayDirection=[0,0,0]
-
-    for gridVertex in gridLandmarks:
-      point = LMNode.GetNthControlPointPosition(int(gridVertex-1))
-      closestPointId = pointLocator.FindClosestPoint(point)
-      tempNormal = polydataNormalArray.GetTuple(closestPointId)
-      rayDirection[0] += tempNormal[0]
-      rayDirection[1] += tempNormal[1]
-      rayDirection[2] += tempNormal[2]
-
-    #normalize
-    vtk.vtkMath().Normalize(rayDirection)
-
-    # # get normal at each grid point
-    # gridNormals = np.zeros((3,3))
-    # gridIndex=0
-    # for gridVertex in gridLandmarks:
-      # print(gridVertex)
-      # point = LMNode.GetNthControlPointPosition(int(gridVertex-1))
-      # closestPointId = pointLocator.FindClosestPoint(point)
-      # tempNormal = polydataNormalArray.GetTuple(closestPointId)
-      # print(tempNormal)
-      # gridNormals[gridIndex] = tempNormal
-      # gridIndex+=1
-    # print(gridNormals)
-
-    #set up locater for intersection with normal vector rays
-    obbTree = vtk.vtkOBBTree()
-    obbTree.SetDataSet(surfacePolydata)
-    obbTree.BuildLocator()
+  def applyPatch(self, meshNode, LMNode, gridLandmarks, sampleRate, polydataNormalArray, maximumProjectionDistance=.25):
+    engine = self.getPatchEngine(meshNode, polydataNormalArray)
+    landmarkPoints = slicer.util.arrayFromMarkupsControlPoints(LMNode)
+    triangle = [int(gridVertex-1) for gridVertex in gridLandmarks]
+    patchPoints = engine.patches(landmarkPoints[triangle], sampleRate, maximumProjectionDistance)[0]
 
     #define new landmark sets
     semilandmarkNodeName = "semiLM_" + str(gridLandmarks[0]) + "_" + str(gridLandmarks[1]) + "_" + str(gridLandmarks[2])
     semilandmarkPoints=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", semilandmarkNodeName)
-
-    #get a sample distance for quality control
-    m1 = model.GetPolyData().GetPoint(0)
-    m2 = model.GetPolyData().GetPoint(1)
-    m3 = model.GetPolyData().GetPoint(2)
-    d1 = math.sqrt(vtk.vtkMath().Distance2BetweenPoints(m1, m2))
-    d2 = math.sqrt(vtk.vtkMath().Distance2BetweenPoints(m2, m3))
-    d3 = math.sqrt(vtk.vtkMath().Distance2BetweenPoints(m1, m3))
-    sampleDistance = (d1 + d2 + d3)
-
-    # set initial three grid points
+    slicer.util.updateMarkupsControlPointsFromArray(semilandmarkPoints, patchPoints)
+    # initial three grid points are labeled with their landmark numbers
     for index in range(0,3):
-      origLMPoint=resampledPolydata.GetPoint(index)
-      #landmarkLabel = LMNode.GetNthControlPointLabel(gridLandmarks[index]-1)
-      landmarkLabel = str(gridLandmarks[index])
-      semilandmarkPoints.AddControlPoint(origLMPoint, landmarkLabel)
-
-    # calculate maximum projection distance
-    projectionTolerance = maximumProjectionDistance/.25
-    #boundingBox = vtk.vtkBoundingBox()
-    #boundingBox.AddBounds(surfacePolydata.GetBounds())
-    #diagonalDistance = boundingBox.GetDiagonalLength()
-    #rayLength = math.sqrt(diagonalDistance) * projectionTolerance
-    rayLength = sampleDistance * projectionTolerance
-
-    # get normal projection intersections for remaining semi-landmarks
-    for index in range(3,resampledPolydata.GetNumberOfPoints()):
-      modelPoint=resampledPolydata.GetPoint(index)
-
-      # ## get estimated normal vector
-      # rayDirection = [0,0,0]
-      # distance1=math.sqrt(vtk.vtkMath().Distance2BetweenPoints(modelPoint,resampledPolydata.GetPoint(0)))
-      # distance2=math.sqrt(vtk.vtkMath().Distance2BetweenPoints(modelPoint,resampledPolydata.GetPoint(1)))
-      # distance3=math.sqrt(vtk.vtkMath().Distance2BetweenPoints(modelPoint,resampledPolydata.GetPoint(2)))
-      # distanceTotal = distance1 + distance2 + distance3
-      # weights=[(distance3+distance2)/distanceTotal, (distance1+distance3)/distanceTotal,(distance1+distance2)/distanceTotal]
-
-      # for gridIndex in range(0,3):
-        # rayDirection+=(weights[gridIndex]*gridNormals[gridIndex])
-      # vtk.vtkMath().Normalize(rayDirection)
-      # ##
-
-      rayEndPoint=[0,0,0]
-      for dim in range(len(rayEndPoint)):
-        rayEndPoint[dim] = modelPoint[dim] + rayDirection[dim]* rayLength
-      intersectionIds=vtk.vtkIdList()
-      intersectionPoints=vtk.vtkPoints()
-      obbTree.IntersectWithLine(modelPoint,rayEndPoint,intersectionPoints,intersectionIds)
-      #if there are intersections, update the point to most external one.
-      if intersectionPoints.GetNumberOfPoints()>0:
-        exteriorPoint = intersectionPoints.GetPoint(intersectionPoints.GetNumberOfPoints()-1)
-        semilandmarkPoints.AddControlPoint(exteriorPoint)
-      #if there are no intersections, reverse the normal vector
-      else:
-        for dim in range(len(rayEndPoint)):
-          rayEndPoint[dim] = modelPoint[dim] + rayDirection[dim]* -rayLength
-        obbTree.IntersectWithLine(modelPoint,rayEndPoint,intersectionPoints,intersectionIds)
-        if intersectionPoints.GetNumberOfPoints()>0:
-          exteriorPoint = intersectionPoints.GetPoint(0)
-          semilandmarkPoints.AddControlPoint(exteriorPoint)
-        else:
-          print("No intersection, using closest point")
-          closestPointId = pointLocator.FindClosestPoint(modelPoint)
-          rayOrigin = surfacePolydata.GetPoint(closestPointId)
-          semilandmarkPoints.AddControlPoint(rayOrigin)
+      semilandmarkPoints.SetNthControlPointLabel(index, str(gridLandmarks[index]))
 
     # update lock status and color
-    semilandmarkPoints.SetLocked(True)
-    semilandmarkPoints.GetDisplayNode().SetColor(random.random(), random.random(), random.random())
-    semilandmarkPoints.GetDisplayNode().SetSelectedColor(random.random(), random.random(), random.random())
-    semilandmarkPoints.GetDisplayNode().PointLabelsVisibilityOff()
-    #clean up
-    slicer.mrmlScene.RemoveNode(transformNode)
-    slicer.mrmlScene.RemoveNode(model)
+    self.setPatchDisplay(semilandmarkPoints)
     print("Total points:", semilandmarkPoints.GetNumberOfControlPoints() )
     return semilandmarkPoints
 
+  def setPatchDisplay(self, semilandmarkNode):
+    semilandmarkNode.SetLocked(True)
+    semilandmarkNode.GetDisplayNode().SetColor(random.random(), random.random(), random.random())
+    semilandmarkNode.GetDisplayNode().SetSelectedColor(random.random(), random.random(), random.random())
+    semilandmarkNode.GetDisplayNode().PointLabelsVisibilityOff()
+
   def getSmoothNormals(self, surfaceNode,iterations):
-    smoothFilter = vtk.vtkSmoothPolyDataFilter()
-    smoothFilter.SetInputData(surfaceNode.GetPolyData())
-    smoothFilter.FeatureEdgeSmoothingOff()
-    smoothFilter.BoundarySmoothingOn()
-    smoothFilter.SetNumberOfIterations(iterations)
-    smoothFilter.SetRelaxationFactor(1)
-    smoothFilter.Update()
-    normalGenerator = vtk.vtkPolyDataNormals()
-    normalGenerator.ComputePointNormalsOn()
-    normalGenerator.SetInputData(smoothFilter.GetOutput())
-    normalGenerator.Update()
-    normalArray = normalGenerator.GetOutput().GetPointData().GetArray("Normals")
-    return normalArray
+    return patch_engine.smoothNormals(surfaceNode.GetPolyData(), iterations)
 
   def getLandmarks(self, landmarkDirectory):
     files_to_open=[]
@@ -489,10 +373,12 @@ class CreateSemiLMPatchesLogic(ScriptedLoadableModuleLogic):
     landmarkDescription = "Semi"
     if setToSemiType is False:
       landmarkDescription = "Fixed"
+    wasModifying = landmarkNode.StartModify()
     for controlPointIndex in range(landmarkNode.GetNumberOfControlPoints()):
       landmarkNode.SetNthControlPointDescription(controlPointIndex, landmarkDescription)
+    landmarkNode.EndModify(wasModifying)
 
-  def mergeTree(self, treeWidget, landmarkNode, modelNode,rowColNumber):
+  def mergeTree(self, treeWidget, landmarkNode, modelNode,rowColNumber, smoothingIterations=0):
     nodeIDs=treeWidget.selectedIndexes()
     nodeList = vtk.vtkCollection()
     for id in nodeIDs:
@@ -501,90 +387,47 @@ class CreateSemiLMPatchesLogic(ScriptedLoadableModuleLogic):
         nodeList.AddItem(currentNode)
     mergedNodeName = landmarkNode.GetName() + "_mergedNode"
     mergedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', mergedNodeName)
-    self.mergeList(nodeList, landmarkNode, modelNode,rowColNumber,mergedNode)
+    self.mergeList(nodeList, landmarkNode, modelNode,rowColNumber,mergedNode, smoothingIterations)
     return True
 
-  def mergeList(self, nodeList, landmarkNode, modelNode,rowColNumber,mergedNode):
-    pt=[0,0,0]
+  def mergeList(self, nodeList, landmarkNode, modelNode,rowColNumber,mergedNode, smoothingIterations=0):
     triangleList=[]
-    lineSegmentList=[]
-    pointList=[]
+    interiorPoints=[np.zeros((0, 3))]
+    interiorLabels=[]
 
-    # Add semi-landmark points within triangle patches
+    # semi-landmark points within triangle patches
     for currentNode in nodeList:
       if currentNode != landmarkNode:
-        for index in range(3,currentNode.GetNumberOfControlPoints()):
-          pt = currentNode.GetNthControlPointPosition(index)
-          fiducialLabel = currentNode.GetNthControlPointLabel(index)
-          mergedNode.AddControlPoint(pt,fiducialLabel)
+        interiorPoints.append(slicer.util.arrayFromMarkupsControlPoints(currentNode)[3:])
+        interiorLabels += [currentNode.GetNthControlPointLabel(index) for index in range(3,currentNode.GetNumberOfControlPoints())]
         p1=currentNode.GetNthControlPointLabel(0)
         p2=currentNode.GetNthControlPointLabel(1)
         p3=currentNode.GetNthControlPointLabel(2)
         landmarkVector = [p1,p2,p3]
         triangleList.append(landmarkVector)
-        lineSegmentList.append(sorted([p1,p2]))
-        lineSegmentList.append(sorted([p2,p3]))
-        lineSegmentList.append(sorted([p3,p1]))
-        pointList.append(p1)
-        pointList.append(p2)
-        pointList.append(p3)
-
-    # Add semilandmark points on curves between landmark points
-    seenVertices=set()
-    lineSegmentList_edit=[]
-    # Remove duplicate line segments
-    for segment in lineSegmentList:
-      segmentTuple = tuple(segment)
-      if segmentTuple not in seenVertices:
-        lineSegmentList_edit.append(segment)
-        seenVertices.add(segmentTuple)
 
-    seenPoints=set()
-    pointList_edit=[]
-    # Remove duplicate points
-    for originalLandmarkPoint in pointList:
-      lmTuple = tuple(originalLandmarkPoint)
-      if lmTuple not in seenPoints:
-        pointList_edit.append(originalLandmarkPoint)
-        seenPoints.add(lmTuple)
-
-    # add line segments between triangles
-    controlPoint=vtk.vtkVector3d()
-    edgePoints=vtk.vtkPoints()
-    tempCurve = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsCurveNode', 'temporaryCurve')
-    for segment in lineSegmentList_edit:
-      landmarkIndex = int(segment[0])
-      landmarkNode.GetNthControlPointPosition(int(landmarkIndex-1),controlPoint)
-      tempCurve.AddControlPoint(controlPoint)
-      landmarkIndex = int(segment[1])
-      landmarkNode.GetNthControlPointPosition(int(landmarkIndex-1),controlPoint)
-      tempCurve.AddControlPoint(controlPoint)
-      sampleDist = tempCurve.GetCurveLengthWorld() / (rowColNumber - 1);
-      tempCurve.SetAndObserveSurfaceConstraintNode(modelNode)
-      tempCurve.ResampleCurveWorld(sampleDist)
-      tempCurve.GetControlPointPositionsWorld(edgePoints)
-      for i in range(1,edgePoints.GetNumberOfPoints()-1):
-        mergedNode.AddControlPoint(edgePoints.GetPoint(i))
-      tempCurve.RemoveAllControlPoints()
-
-    # ------ removing manual points from SL set, leaving this as a placeholder while testing
-    # add original landmark points
-    #for originalLandmarkPoint in pointList_edit:
-    #  landmarkIndex = int(originalLandmarkPoint)
-    #  landmarkNode.GetNthControlPointPosition(int(landmarkIndex-1),controlPoint)
-    #  mergedNode.AddControlPoint(controlPoint)
+    # semilandmark points on the edges between landmark points, each shared edge once, sampled by the patch
+    # engine of the mesh and normals of applyPatch
+    engine = self.getPatchEngine(modelNode, self.getNormals(modelNode, smoothingIterations))
+    engine.resetTimings()
+    landmarkPoints = slicer.util.arrayFromMarkupsControlPoints(landmarkNode)
+    triangles = np.array(triangleList, dtype=int).reshape(-1, 3) - 1
+    edgePoints, edges = engine.sharedEdgePoints(landmarkPoints, triangles, rowColNumber)
+
+    startTime = time.perf_counter()
+    wasModifying = mergedNode.StartModify()
+    slicer.util.updateMarkupsControlPointsFromArray(mergedNode, np.vstack(interiorPoints + [edgePoints]))
+    for index, fiducialLabel in enumerate(interiorLabels):
+      mergedNode.SetNthControlPointLabel(index, fiducialLabel)
+    mergedNode.EndModify(wasModifying)
+    engine.timings["merge"] += time.perf_counter() - startTime
+    logging.info(f"{len(triangles)} patches, {mergedNode.GetNumberOfControlPoints()} semi-landmarks: {engine.timingsText()}")
 
     # update lock status and color of merged node
-    mergedNode.SetLocked(True)
-    mergedNode.GetDisplayNode().SetColor(random.random(), random.random(), random.random())
-    mergedNode.GetDisplayNode().SetSelectedColor(random.random(), random.random(), random.random())
-    mergedNode.GetDisplayNode().PointLabelsVisibilityOff()
+    self.setPatchDisplay(mergedNode)
     landmarkTypeSemi=True
     self.setAllLandmarksType(mergedNode, landmarkTypeSemi)
 
-    # clean up
-    slicer.mrmlScene.RemoveNode(tempCurve)
-
     # write selected triangles to table
     tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Semi-landmark Grid')
     col1=tableNode.AddColumn()
@@ -851,6 +694,10 @@ class CreateSemiLMPatchesTest(ScriptedLoadableModuleTest):
       """
     self.setUp()
     self.test_CreateSemiLMPatches1()
+    self.setUp()
+    self.test_CreateSemiLMPatchesEngine()
+    self.setUp()
+    self.test_CreateSemiLMPatchesMergeList()
 
   def test_CreateSemiLMPatches1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -897,3 +744,300 @@ class CreateSemiLMPatchesTest(ScriptedLoadableModuleTest):
     self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
     self.delayDisplay('Test passed')
+
+  def referencePatch(self, surfacePolydata, normalArray, landmarkPoints, sampleRate, maximumProjectionDistance):
+    """Patch computed point by point as applyPatch did: thin plate spline warp, then one locator ray per point"""
+    grid = patch_engine.patchGridCoordinates(sampleRate)
+    gridPoints = vtk.vtkPoints()
+    for row, column in grid:
+      gridPoints.InsertNextPoint(row, column, 0)
+    sourcePoints = vtk.vtkPoints()
+    targetPoints = vtk.vtkPoints()
+    for index in range(3):
+      sourcePoints.InsertNextPoint(gridPoints.GetPoint(index))
+      targetPoints.InsertNextPoint(landmarkPoints[index])
+    transform = vtk.vtkThinPlateSplineTransform()
+    transform.SetSourceLandmarks(sourcePoints)
+    transform.SetTargetLandmarks(targetPoints)
+    transform.SetBasisToR()
+    warpedPoints = vtk.vtkPoints()
+    transform.TransformPoints(gridPoints, warpedPoints)
+
+    pointLocator = vtk.vtkPointLocator()
+    pointLocator.SetDataSet(surfacePolydata)
+    pointLocator.BuildLocator()
+    rayDirection = [0,0,0]
+    for point in landmarkPoints:
+      normal = normalArray.GetTuple(pointLocator.FindClosestPoint(point))
+      rayDirection = [rayDirection[dim] + normal[dim] for dim in range(3)]
+    vtk.vtkMath().Normalize(rayDirection)
+    cellLocator = vtk.vtkCellLocator()
+    cellLocator.SetDataSet(surfacePolydata)
+    cellLocator.BuildLocator()
+    cell = vtk.vtkGenericCell()
+    sampleDistance = sum(math.sqrt(vtk.vtkMath().Distance2BetweenPoints(warpedPoints.GetPoint(first), warpedPoints.GetPoint(second)))
+      for first, second in ((0, 1), (1, 2), (0, 2)))
+    rayLength = sampleDistance * maximumProjectionDistance/.25
+
+    patch = [warpedPoints.GetPoint(index) for index in range(3)]
+    for index in range(3, warpedPoints.GetNumberOfPoints()):
+      modelPoint = warpedPoints.GetPoint(index)
+      intersectionPoints = vtk.vtkPoints()
+      rayEndPoint = [modelPoint[dim] + rayDirection[dim] * rayLength for dim in range(3)]
+      cellLocator.IntersectWithLine(modelPoint, rayEndPoint, 0.0, intersectionPoints, None, cell)
+      if intersectionPoints.GetNumberOfPoints() > 0:
+        patch.append(intersectionPoints.GetPoint(intersectionPoints.GetNumberOfPoints()-1))
+        continue
+      rayEndPoint = [modelPoint[dim] - rayDirection[dim] * rayLength for dim in range(3)]
+      cellLocator.IntersectWithLine(modelPoint, rayEndPoint, 0.0, intersectionPoints, None, cell)
+      if intersectionPoints.GetNumberOfPoints() > 0:
+        patch.append(intersectionPoints.GetPoint(0))
+      else:
+        patch.append(surfacePolydata.GetPoint(pointLocator.FindClosestPoint(modelPoint)))
+    return np.array(patch)
+
+  def icosahedronLandmarks(self, surfacePolydata):
+    """Vertices of an icosahedron moved to the closest points of a mesh centered on the origin, and its faces"""
+    golden = (1 + math.sqrt(5)) / 2
+    vertices = np.array([[-1, golden, 0], [1, golden, 0], [-1, -golden, 0], [1, -golden, 0],
+      [0, -1, golden], [0, 1, golden], [0, -1, -golden], [0, 1, -golden],
+      [golden, 0, -1], [golden, 0, 1], [-golden, 0, -1], [-golden, 0, 1]]) * 10 / math.sqrt(1 + golden**2)
+    # turned so that no ray runs along the seam of the sphere
+    rotation = vtk.vtkTransform()
+    rotation.RotateWXYZ(20, 1, 2, 3)
+    vertices = np.array([rotation.TransformPoint(vertex) for vertex in vertices])
+    locator = vtk.vtkPointLocator()
+    locator.SetDataSet(surfacePolydata)
+    locator.BuildLocator()
+    landmarkPoints = np.array([surfacePolydata.GetPoint(locator.FindClosestPoint(vertex)) for vertex in vertices])
+    triangles = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4],
+      [11, 10, 2], [10, 7, 6], [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9], [4, 9, 5],
+      [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+    return landmarkPoints, triangles
+
+  def referenceMergeList(self, logic, nodeList, landmarkNode, modelNode,rowColNumber,mergedNode):
+    """mergeList as it was before the patch engine, point by point with a temporary curve for each edge"""
+    pt=[0,0,0]
+    triangleList=[]
+    lineSegmentList=[]
+    pointList=[]
+
+    # Add semi-landmark points within triangle patches
+    for currentNode in nodeList:
+      if currentNode != landmarkNode:
+        for index in range(3,currentNode.GetNumberOfControlPoints()):
+          pt = currentNode.GetNthControlPointPosition(index)
+          fiducialLabel = currentNode.GetNthControlPointLabel(index)
+          mergedNode.AddControlPoint(pt,fiducialLabel)
+        p1=currentNode.GetNthControlPointLabel(0)
+        p2=currentNode.GetNthControlPointLabel(1)
+        p3=currentNode.GetNthControlPointLabel(2)
+        landmarkVector = [p1,p2,p3]
+        triangleList.append(landmarkVector)
+        lineSegmentList.append(sorted([p1,p2]))
+        lineSegmentList.append(sorted([p2,p3]))
+        lineSegmentList.append(sorted([p3,p1]))
+        pointList.append(p1)
+        pointList.append(p2)
+        pointList.append(p3)
+
+    # Add semilandmark points on curves between landmark points
+    seenVertices=set()
+    lineSegmentList_edit=[]
+    # Remove duplicate line segments
+    for segment in lineSegmentList:
+      segmentTuple = tuple(segment)
+      if segmentTuple not in seenVertices:
+        lineSegmentList_edit.append(segment)
+        seenVertices.add(segmentTuple)
+
+    seenPoints=set()
+    pointList_edit=[]
+    # Remove duplicate points
+    for originalLandmarkPoint in pointList:
+      lmTuple = tuple(originalLandmarkPoint)
+      if lmTuple not in seenPoints:
+        pointList_edit.append(originalLandmarkPoint)
+        seenPoints.add(lmTuple)
+
+    # add line segments between triangles
+    controlPoint=vtk.vtkVector3d()
+    edgePoints=vtk.vtkPoints()
+    tempCurve = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsCurveNode', 'temporaryCurve')
+    for segment in lineSegmentList_edit:
+      landmarkIndex = int(segment[0])
+      landmarkNode.GetNthControlPointPosition(int(landmarkIndex-1),controlPoint)
+      tempCurve.AddControlPoint(controlPoint)
+      landmarkIndex = int(segment[1])
+      landmarkNode.GetNthControlPointPosition(int(landmarkIndex-1),controlPoint)
+      tempCurve.AddControlPoint(controlPoint)
+      sampleDist = tempCurve.GetCurveLengthWorld() / (rowColNumber - 1);
+      tempCurve.SetAndObserveSurfaceConstraintNode(modelNode)
+      tempCurve.ResampleCurveWorld(sampleDist)
+      tempCurve.GetControlPointPositionsWorld(edgePoints)
+      for i in range(1,edgePoints.GetNumberOfPoints()-1):
+        mergedNode.AddControlPoint(edgePoints.GetPoint(i))
+      tempCurve.RemoveAllControlPoints()
+
+    # ------ removing manual points from SL set, leaving this as a placeholder while testing
+    # add original landmark points
+    #for originalLandmarkPoint in pointList_edit:
+    #  landmarkIndex = int(originalLandmarkPoint)
+    #  landmarkNode.GetNthControlPointPosition(int(landmarkIndex-1),controlPoint)
+    #  mergedNode.AddControlPoint(controlPoint)
+
+    # update lock status and color of merged node
+    mergedNode.SetLocked(True)
+    mergedNode.GetDisplayNode().SetColor(random.random(), random.random(), random.random())
+    mergedNode.GetDisplayNode().SetSelectedColor(random.random(), random.random(), random.random())
+    mergedNode.GetDisplayNode().PointLabelsVisibilityOff()
+    landmarkTypeSemi=True
+    logic.setAllLandmarksType(mergedNode, landmarkTypeSemi)
+
+    # clean up
+    slicer.mrmlScene.RemoveNode(tempCurve)
+
+    # write selected triangles to table
+    tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Semi-landmark Grid')
+    col1=tableNode.AddColumn()
+    col1.SetName('Vertice 1')
+    col2=tableNode.AddColumn()
+    col2.SetName('Vertice 2')
+    col3=tableNode.AddColumn()
+    col3.SetName('Vertice 3')
+    tableNode.SetColumnType('Vertice 1',vtk.VTK_STRING)
+    tableNode.SetColumnType('Vertice 2',vtk.VTK_STRING)
+    tableNode.SetColumnType('Vertice 3',vtk.VTK_STRING)
+
+    for i in range(len(triangleList)):
+      tableNode.AddEmptyRow()
+      triangle=triangleList[i]
+      tableNode.SetCellText(i,0,str(triangle[0]))
+      tableNode.SetCellText(i,1,str(triangle[1]))
+      tableNode.SetCellText(i,2,str(triangle[2]))
+
+  def test_CreateSemiLMPatchesMergeList(self):
+    """ Patches of the faces of an icosahedron of landmarks on a sphere model merged by mergeList with the patch
+    engine, compared with the merge of referenceMergeList with temporary curves constrained to the model.
+    """
+    self.delayDisplay("Starting the merge test")
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(10)
+    sphere.SetThetaResolution(60)
+    sphere.SetPhiResolution(60)
+    sphere.Update()
+    modelNode = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+    landmarkPoints, triangles = self.icosahedronLandmarks(modelNode.GetPolyData())
+    landmarkNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "landmarks")
+    slicer.util.updateMarkupsControlPointsFromArray(landmarkNode, landmarkPoints)
+    # labels 10 to 12 come before 2 as strings, so some edges start at their larger landmark
+    for index in range(landmarkNode.GetNumberOfControlPoints()):
+      landmarkNode.SetNthControlPointLabel(index, str(index + 1))
+    sampleRate = 7
+
+    logic = CreateSemiLMPatchesLogic()
+    normalArray = logic.getNormals(modelNode)
+    nodeList = vtk.vtkCollection()
+    for triangle in triangles:
+      nodeList.AddItem(logic.applyPatch(modelNode, landmarkNode, triangle + 1, sampleRate, normalArray))
+    # a patch from the other normals of the same mesh reuses its engine
+    self.assertIs(logic.getPatchEngine(modelNode, logic.getNormals(modelNode)), logic.getPatchEngine(modelNode, normalArray))
+
+    mergedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', "landmarks_mergedNode")
+    logic.mergeList(nodeList, landmarkNode, modelNode, sampleRate, mergedNode)
+    referenceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', "landmarks_mergedNode")
+    self.referenceMergeList(logic, nodeList, landmarkNode, modelNode, sampleRate, referenceNode)
+
+    # same points as the temporary curves constrained to the model, up to the tolerance of the ray intersections
+    mergedPoints = slicer.util.arrayFromMarkupsControlPoints(mergedNode)
+    referencePoints = slicer.util.arrayFromMarkupsControlPoints(referenceNode)
+    self.assertEqual(mergedPoints.shape, referencePoints.shape)
+    np.testing.assert_allclose(mergedPoints, referencePoints, atol=1e-3)
+
+    # the interior points keep the labels of their patches
+    interiorCount = len(triangles) * (nodeList.GetItemAsObject(0).GetNumberOfControlPoints() - 3)
+    self.assertEqual([mergedNode.GetNthControlPointLabel(index) for index in range(interiorCount)],
+      [referenceNode.GetNthControlPointLabel(index) for index in range(interiorCount)])
+    self.assertEqual(mergedNode.GetNthControlPointLabel(0), nodeList.GetItemAsObject(0).GetNthControlPointLabel(3))
+
+    # the merge used the engine of the patches
+    engine = logic.getPatchEngine(modelNode, normalArray)
+    self.assertGreater(engine.timings["merge"], 0)
+    edgePoints, edges = engine.sharedEdgePoints(landmarkPoints, triangles, sampleRate)
+    self.assertEqual(len(edges), 30)
+    np.testing.assert_array_equal(edgePoints, mergedPoints[interiorCount:])
+
+    self.delayDisplay('Test passed')
+
+  def test_CreateSemiLMPatchesEngine(self):
+    """ Patches of the faces of an icosahedron of landmarks on a bumpy sphere, computed by the patch engine
+    and point by point as applyPatch did, and merged with each shared edge sampled once.
+    """
+    self.delayDisplay("Starting the patch engine test")
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(10)
+    sphere.SetThetaResolution(300)
+    sphere.SetPhiResolution(300)
+    sphere.Update()
+    surfacePolydata = sphere.GetOutput()
+    # bumps, so that rays do not all hit the surface at the same distance
+    points = vtk.util.numpy_support.vtk_to_numpy(surfacePolydata.GetPoints().GetData())
+    points *= (1 + 0.05 * np.sin(3 * points[:, [0]]) * np.cos(2 * points[:, [1]]))[:, :]
+    surfacePolydata.GetPoints().Modified()
+    normalFilter = vtk.vtkPolyDataNormals()
+    normalFilter.ComputePointNormalsOn()
+    normalFilter.SplittingOff()
+    normalFilter.SetInputData(surfacePolydata)
+    normalFilter.Update()
+    normalArray = normalFilter.GetOutput().GetPointData().GetArray("Normals")
+
+    landmarkPoints, triangles = self.icosahedronLandmarks(surfacePolydata)
+    locator = vtk.vtkPointLocator()
+    locator.SetDataSet(surfacePolydata)
+    locator.BuildLocator()
+    sampleRate = 11
+    maximumProjectionDistance = .25
+
+    startTime = time.perf_counter()
+    reference = np.array([self.referencePatch(surfacePolydata, normalArray, landmarkPoints[triangle], sampleRate,
+      maximumProjectionDistance) for triangle in triangles])
+    referenceTime = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    engine = patch_engine.SemiLandmarkPatchEngine(surfacePolydata, normalArray)
+    patches = engine.patches(landmarkPoints[triangles], sampleRate, maximumProjectionDistance)
+    engineTime = time.perf_counter() - startTime
+    logging.info(f"{len(triangles)} patches of {patches.shape[1]} points on {surfacePolydata.GetNumberOfCells()} triangles: "
+      f"point by point {referenceTime:.2f} s, patch engine {engineTime:.2f} s ({engine.timingsText()})")
+    self.assertEqual(patches.shape, reference.shape)
+    self.assertLess(np.abs(patches - reference).max(), 1e-4)
+
+    engine.resetTimings()
+    merged, edges = engine.mergedPatches(landmarkPoints, triangles, sampleRate, maximumProjectionDistance)
+    logging.info(f"Merged {len(merged)} semi-landmarks: {engine.timingsText()}")
+    self.assertEqual(len(edges), 30)
+    edgePoints, sharedEdges = engine.sharedEdgePoints(landmarkPoints, triangles, sampleRate)
+    np.testing.assert_array_equal(edges, sharedEdges)
+    # each edge is sampled about sampleRate - 2 times, depending on the length of its curve on the mesh
+    self.assertGreaterEqual(len(edgePoints), len(edges) * (sampleRate - 3))
+    self.assertLessEqual(len(edgePoints), len(edges) * (sampleRate - 1))
+    self.assertEqual(len(merged), len(triangles) * (patches.shape[1] - 3) + len(edgePoints))
+    np.testing.assert_allclose(merged[:len(triangles) * (patches.shape[1] - 3)], reference[:, 3:].reshape(-1, 3), atol=1e-4)
+    np.testing.assert_array_equal(merged[len(triangles) * (patches.shape[1] - 3):], edgePoints)
+    # edge points are resampled along the curve points projected onto the mesh, so they are on the chords
+    # between surface points about a tenth of an edge apart: near the mesh, within the sag of the bumps
+    closestPoints = np.array([surfacePolydata.GetPoint(locator.FindClosestPoint(point)) for point in edgePoints])
+    self.assertLess(np.linalg.norm(edgePoints - closestPoints, axis=1).max(), 0.5)
+    # the curve points themselves are on the mesh surface
+    edge = landmarkPoints[edges[1]]
+    curvePoints = engine.constrainPointsToSurface(edge[0] + np.linspace(0, 1, 11)[:, np.newaxis] * (edge[1] - edge[0]))
+    cellLocator = vtk.vtkCellLocator()
+    cellLocator.SetDataSet(surfacePolydata)
+    cellLocator.BuildLocator()
+    for point in curvePoints:
+      closestPoint = [0.0, 0.0, 0.0]
+      squaredDistance = vtk.reference(0.0)
+      cellLocator.FindClosestPoint(point, closestPoint, vtk.reference(0), vtk.reference(0), squaredDistance)
+      self.assertLess(squaredDistance, 1e-8)
+
+    self.delayDisplay('Test passed')
@@ -0,0 +1,339 @@
+import time
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+
+def patchGridCoordinates(sampleRate):
+  """
+  Grid of a triangular patch as an array of (row, column) coordinates: the three corners (0,0), (0,sampleRate-1)
+  and (sampleRate-1,0) first, then the points inside the triangle row by row.
+  """
+  rows, columns = np.mgrid[1:sampleRate-1, 1:sampleRate-1]
+  inside = (rows + columns) < (sampleRate - 1)
+  interior = np.column_stack((rows[inside], columns[inside]))
+  corners = np.array([[0, 0], [0, sampleRate-1], [sampleRate-1, 0]])
+  return np.vstack((corners, interior)).astype(float)
+
+
+# markups curves interpolate this many points between two control points
+CURVE_POINTS_PER_SEGMENT = 10
+# search radius of the projection of curves onto a surface, relative to the diagonal of the surface bounds
+SURFACE_CONSTRAINT_MAXIMUM_SEARCH_RADIUS_TOLERANCE = .25
+
+
+def resamplePoints(points, samplingDistance):
+  """
+  Points every samplingDistance along a polyline, as vtkMRMLMarkupsCurveNode.ResamplePoints samples an open curve:
+  the last point of the polyline replaces the last sample if it is closer than half samplingDistance to it,
+  otherwise it is added.
+  """
+  points = np.asarray(points, dtype=float)
+  sampled = [points[0]]
+  distanceFromLastSample = 0.0
+  for previous, current in zip(points[:-1], points[1:]):
+    segmentLength = np.linalg.norm(current - previous)
+    if segmentLength <= 0.0:
+      continue
+    remainingLength = distanceFromLastSample + segmentLength
+    if remainingLength >= samplingDistance:
+      direction = (current - previous) / segmentLength
+      distanceFromPrevious = samplingDistance - distanceFromLastSample
+      while remainingLength >= samplingDistance:
+        sampled.append(previous + direction * distanceFromPrevious)
+        distanceFromPrevious += samplingDistance
+        remainingLength -= samplingDistance
+      distanceFromLastSample = remainingLength
+    else:
+      distanceFromLastSample += segmentLength
+  if distanceFromLastSample > samplingDistance * 0.5:
+    sampled.append(points[-1])
+  else:
+    sampled[-1] = points[-1]
+  return np.array(sampled)
+
+
+def smoothNormals(surfacePolydata, iterations):
+  """Point normals of the mesh smoothed by iterations of Laplacian smoothing, one per mesh point"""
+  smoothFilter = vtk.vtkSmoothPolyDataFilter()
+  smoothFilter.SetInputData(surfacePolydata)
+  smoothFilter.FeatureEdgeSmoothingOff()
+  smoothFilter.BoundarySmoothingOn()
+  smoothFilter.SetNumberOfIterations(iterations)
+  smoothFilter.SetRelaxationFactor(1)
+  smoothFilter.Update()
+  normalGenerator = vtk.vtkPolyDataNormals()
+  normalGenerator.ComputePointNormalsOn()
+  normalGenerator.SplittingOff()
+  normalGenerator.SetInputData(smoothFilter.GetOutput())
+  normalGenerator.Update()
+  return normalGenerator.GetOutput().GetPointData().GetArray("Normals")
+
+
+class SemiLandmarkPatchEngine:
+  """
+  Semi-landmark patches of a mesh computed from arrays. The mesh arrays and its point locator are built once,
+  then patches of any number of landmark triangles are generated together:
+
+  - grids: the triangular grid of sampleRate points per side, shared by all patches
+  - warp: the grid is mapped onto each landmark triangle. The thin plate spline of applyPatch with the three
+    grid corners as source landmarks reduces to this affine map, as the corners fix its linear part exactly.
+  - project: each grid point is moved to the last mesh intersection of a ray along the mean normal of the three
+    landmarks, or to the first intersection in the reverse direction, or to the closest mesh point otherwise.
+    All the rays of a patch are along the same direction, so they are intersected at once, each with the few
+    triangles that it meets when seen along this direction.
+  - merge: the interior points of the patches and the points of their edges, each shared edge sampled once
+    along the straight segment between its landmarks projected onto the mesh, as a markups curve constrained
+    to the mesh surface.
+
+  The time spent in each stage is accumulated in timings. Methods do not use the scene, so engines of
+  different meshes can run on different threads.
+  """
+  def __init__(self, surfacePolydata, normalArray):
+    self.timings = {"locator": 0.0, "grids": 0.0, "warp": 0.0, "project": 0.0, "merge": 0.0}
+    startTime = time.perf_counter()
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(surfacePolydata)
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.Update()
+    triangulated = triangleFilter.GetOutput()
+    self.points = numpy_support.vtk_to_numpy(surfacePolydata.GetPoints().GetData()).astype(float)
+    self.normals = numpy_support.vtk_to_numpy(normalArray).astype(float)
+    self.triangles = numpy_support.vtk_to_numpy(triangulated.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    self.triangulatedPoints = numpy_support.vtk_to_numpy(triangulated.GetPoints().GetData()).astype(float)
+    vertices = self.triangulatedPoints[self.triangles]
+    self.triangleOrigins = vertices[:, 0]
+    self.triangleEdges1 = vertices[:, 1] - vertices[:, 0]
+    self.triangleEdges2 = vertices[:, 2] - vertices[:, 0]
+    self.pointLocator = vtk.vtkPointLocator()
+    self.pointLocator.SetDataSet(surfacePolydata)
+    self.pointLocator.BuildLocator()
+    # projection of edges onto the surface, built on first use
+    self.surfacePolydata = surfacePolydata
+    self.surfaceCellLocator = None
+    self.surfaceNormals = None
+    self.timings["locator"] += time.perf_counter() - startTime
+
+  def resetTimings(self):
+    for stage in self.timings:
+      self.timings[stage] = 0.0
+
+  def timingsText(self):
+    return ", ".join(f"{stage} {seconds:.3f} s" for stage, seconds in self.timings.items())
+
+  def closestPointIds(self, points):
+    return np.array([self.pointLocator.FindClosestPoint(point) for point in points], dtype=np.int64)
+
+  def rayDirections(self, landmarkPoints):
+    """Normalized sum of the normals at the mesh points closest to the three landmarks of each triangle"""
+    shape = landmarkPoints.shape
+    closestIds = self.closestPointIds(landmarkPoints.reshape(-1, 3)).reshape(shape[:-1])
+    directions = self.normals[closestIds].sum(axis=-2)
+    lengths = np.linalg.norm(directions, axis=-1, keepdims=True)
+    return directions / np.where(lengths > 0, lengths, 1.0)
+
+  def warpGrids(self, landmarkPoints, sampleRate):
+    """Grid points of each patch, an array (number of triangles, number of grid points, 3)"""
+    startTime = time.perf_counter()
+    grid = patchGridCoordinates(sampleRate) / (sampleRate - 1)
+    self.timings["grids"] += time.perf_counter() - startTime
+    startTime = time.perf_counter()
+    origins = landmarkPoints[:, 0, np.newaxis, :]
+    columnAxes = (landmarkPoints[:, 1] - landmarkPoints[:, 0])[:, np.newaxis, :]
+    rowAxes = (landmarkPoints[:, 2] - landmarkPoints[:, 0])[:, np.newaxis, :]
+    warped = origins + grid[np.newaxis, :, 0, np.newaxis] * rowAxes + grid[np.newaxis, :, 1, np.newaxis] * columnAxes
+    self.timings["warp"] += time.perf_counter() - startTime
+    return warped
+
+  def intersectSegments(self, starts, ends, direction):
+    """
+    Largest parameter t in [0,1] of the intersections of the segments from starts to ends, all along direction,
+    with the mesh, NaN for segments without intersection. Seen along direction, segments are points: each is
+    only tested against the triangles whose bounding box contains it.
+    """
+    axis1 = np.cross(direction, [1.0, 0.0, 0.0] if abs(direction[0]) < 0.9 else [0.0, 1.0, 0.0])
+    axis1 /= np.linalg.norm(axis1)
+    axis2 = np.cross(direction, axis1)
+    basis = np.array([axis1, axis2]).T
+    projectedPoints = self.triangulatedPoints @ basis
+    segmentCoordinates = starts @ basis
+    margin = 1e-6 * (1.0 + np.abs(segmentCoordinates).max())
+    segmentMinimums = segmentCoordinates.min(axis=0) - margin
+    segmentMaximums = segmentCoordinates.max(axis=0) + margin
+    # bounding boxes of the triangles seen along direction, first of those near the segments
+    nearby = np.ones(len(self.triangles), dtype=bool)
+    triangleMinimums = []
+    triangleMaximums = []
+    for dimension in range(2):
+      vertexCoordinates = [projectedPoints[:, dimension][self.triangles[:, vertex]] for vertex in range(3)]
+      minimums = np.minimum(np.minimum(vertexCoordinates[0], vertexCoordinates[1]), vertexCoordinates[2])
+      maximums = np.maximum(np.maximum(vertexCoordinates[0], vertexCoordinates[1]), vertexCoordinates[2])
+      nearby &= (minimums <= segmentMaximums[dimension]) & (maximums >= segmentMinimums[dimension])
+      triangleMinimums.append(minimums)
+      triangleMaximums.append(maximums)
+    nearby = np.flatnonzero(nearby)
+    contained = np.ones((len(starts), len(nearby)), dtype=bool)
+    for dimension in range(2):
+      coordinates = segmentCoordinates[:, dimension, np.newaxis]
+      contained &= triangleMinimums[dimension][nearby] <= coordinates + margin
+      contained &= triangleMaximums[dimension][nearby] >= coordinates - margin
+    segmentIndices, nearbyIndices = np.nonzero(contained)
+    triangles = nearby[nearbyIndices]
+
+    # Moller-Trumbore on the pairs of segments and triangles
+    directions = (ends - starts)[segmentIndices]
+    edges1 = self.triangleEdges1[triangles]
+    edges2 = self.triangleEdges2[triangles]
+    pvec = np.cross(directions, edges2)
+    determinants = np.einsum("ij,ij->i", edges1, pvec)
+    valid = np.abs(determinants) > 1e-12
+    inverse = np.divide(1.0, determinants, out=np.zeros_like(determinants), where=valid)
+    tvec = starts[segmentIndices] - self.triangleOrigins[triangles]
+    u = np.einsum("ij,ij->i", tvec, pvec) * inverse
+    qvec = np.cross(tvec, edges1)
+    v = np.einsum("ij,ij->i", directions, qvec) * inverse
+    t = np.einsum("ij,ij->i", edges2, qvec) * inverse
+    tolerance = 1e-9
+    hit = valid & (u >= -tolerance) & (v >= -tolerance) & (u + v <= 1 + tolerance) & (t >= -tolerance) & (t <= 1 + tolerance)
+    result = np.full(len(starts), -np.inf)
+    np.maximum.at(result, segmentIndices[hit], t[hit])
+    return np.where(np.isfinite(result), result, np.nan)
+
+  def projectPoints(self, points, direction, rayLength):
+    """
+    Points moved along direction onto the mesh: to the last intersection of the ray from the point to
+    point + direction * rayLength, else to the first intersection of the reverse ray, else to the closest
+    mesh point. With a single segment from point - direction * rayLength to point + direction * rayLength,
+    both cases are the intersection with the largest parameter.
+    """
+    if len(points) == 0:
+      return points
+    startTime = time.perf_counter()
+    offset = direction * rayLength
+    starts = points - offset
+    ends = points + offset
+    t = self.intersectSegments(starts, ends, direction)
+    projected = starts + t[:, np.newaxis] * (ends - starts)
+    missed = np.isnan(t)
+    if missed.any():
+      print("No intersection, using closest point")
+      projected[missed] = self.points[self.closestPointIds(points[missed])]
+    self.timings["project"] += time.perf_counter() - startTime
+    return projected
+
+  def patches(self, landmarkPoints, sampleRate, maximumProjectionDistance=.25):
+    """
+    Semi-landmark patches of the landmark triangles, an array (number of triangles, number of grid points, 3),
+    an array (number of triangles, 3, 3) of landmark positions. As in applyPatch, the first three points of
+    each patch are the landmarks and the others are projected on the mesh.
+    """
+    landmarkPoints = np.asarray(landmarkPoints, dtype=float).reshape(-1, 3, 3)
+    warped = self.warpGrids(landmarkPoints, sampleRate)
+    startTime = time.perf_counter()
+    directions = self.rayDirections(landmarkPoints)
+    perimeters = np.linalg.norm(landmarkPoints - np.roll(landmarkPoints, -1, axis=1), axis=2).sum(axis=1)
+    rayLengths = perimeters * maximumProjectionDistance / .25
+    self.timings["project"] += time.perf_counter() - startTime
+    for index in range(len(landmarkPoints)):
+      warped[index, 3:] = self.projectPoints(warped[index, 3:], directions[index], rayLengths[index])
+    return warped
+
+  def buildSurfaceLocator(self):
+    """Cell locator and point normals of the mesh used to constrain points to its surface, built once"""
+    if self.surfaceCellLocator is not None:
+      return
+    startTime = time.perf_counter()
+    self.surfaceCellLocator = vtk.vtkCellLocator()
+    self.surfaceCellLocator.SetDataSet(self.surfacePolydata)
+    self.surfaceCellLocator.BuildLocator()
+    normalArray = self.surfacePolydata.GetPointData().GetNormals()
+    if normalArray is None:
+      normalGenerator = vtk.vtkPolyDataNormals()
+      normalGenerator.ComputePointNormalsOn()
+      normalGenerator.SplittingOff()
+      normalGenerator.SetInputData(self.surfacePolydata)
+      normalGenerator.Update()
+      normalArray = normalGenerator.GetOutput().GetPointData().GetNormals()
+    self.surfaceNormals = numpy_support.vtk_to_numpy(normalArray).astype(float)
+    self.timings["locator"] += time.perf_counter() - startTime
+
+  def constrainPointsToSurface(self, points):
+    """
+    Points moved onto the mesh as the points of a markups curve constrained to a surface: along the mesh normal
+    at the closest mesh point, outward from points inside the mesh and inward from points outside, to the first
+    intersection within the maximum search radius, else to the closest mesh point. A point is inside when it is
+    behind the closest mesh point along its normal.
+    """
+    self.buildSurfaceLocator()
+    maximumSearchRadius = SURFACE_CONSTRAINT_MAXIMUM_SEARCH_RADIUS_TOLERANCE * self.surfacePolydata.GetLength()
+    closestIds = self.closestPointIds(points)
+    constrained = self.points[closestIds]
+    intersectionPoints = vtk.vtkPoints()
+    for index, (point, normal) in enumerate(zip(points, self.surfaceNormals[closestIds])):
+      if np.dot(point - constrained[index], normal) >= 0:
+        normal = -normal
+      self.surfaceCellLocator.IntersectWithLine(point, point + normal * maximumSearchRadius, intersectionPoints, None)
+      if intersectionPoints.GetNumberOfPoints() > 0:
+        constrained[index] = intersectionPoints.GetPoint(0)
+    return constrained
+
+  def edgePoints(self, landmarkPoints, edges, sampleRate):
+    """
+    Points of the edges between landmarks, sampled as mergeList sampled a markups curve of each edge constrained
+    to the mesh: the straight segment between the landmarks, interpolated at CURVE_POINTS_PER_SEGMENT points,
+    is projected onto the mesh (see constrainPointsToSurface), resampled at its length divided by
+    sampleRate - 1, and the points between the landmarks are kept. mergeList measured its first curve before
+    constraining it to the mesh, so the first edge is sampled at its straight length divided by sampleRate - 1.
+    """
+    self.buildSurfaceLocator()
+    startTime = time.perf_counter()
+    steps = np.linspace(0.0, 1.0, CURVE_POINTS_PER_SEGMENT + 1)[:, np.newaxis]
+    points = [np.zeros((0, 3))]
+    for index, (first, second) in enumerate(edges):
+      start = landmarkPoints[first]
+      end = landmarkPoints[second]
+      curve = self.constrainPointsToSurface(start + steps * (end - start))
+      if index == 0:
+        length = np.linalg.norm(end - start)
+      else:
+        length = np.linalg.norm(np.diff(curve, axis=0), axis=1).sum()
+      if length <= 0:
+        continue
+      points.append(resamplePoints(curve, length / (sampleRate - 1))[1:-1])
+    self.timings["merge"] += time.perf_counter() - startTime
+    return np.concatenate(points)
+
+  def sharedEdgePoints(self, landmarkPoints, triangles, sampleRate):
+    """
+    Points of the edges of triangles of landmark indices (numbered from 0 in landmarkPoints), in order of first
+    appearance, once even if an edge is shared by several triangles (see edgePoints). Returns the array of points
+    and the array of unique edges. As in mergeList, each edge starts at the landmark whose label (its index + 1)
+    comes first as a string.
+    """
+    startTime = time.perf_counter()
+    landmarkPoints = np.asarray(landmarkPoints, dtype=float)
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    edges = {}
+    for triangle in triangles.tolist():
+      for first, second in ((triangle[0], triangle[1]), (triangle[1], triangle[2]), (triangle[2], triangle[0])):
+        edges.setdefault(tuple(sorted((first, second), key=lambda index: str(index + 1))), None)
+    edges = np.array(list(edges), dtype=np.int64).reshape(-1, 2)
+    self.timings["merge"] += time.perf_counter() - startTime
+    return self.edgePoints(landmarkPoints, edges, sampleRate), edges
+
+  def mergedPatches(self, landmarkPoints, triangles, sampleRate, maximumProjectionDistance=.25):
+    """
+    Merged semi-landmarks of the patches of triangles of landmark indices (numbered from 0 in landmarkPoints):
+    the interior points of each patch followed by the points of the shared edges (see sharedEdgePoints).
+    Returns the array of points and the array of unique edges.
+    """
+    landmarkPoints = np.asarray(landmarkPoints, dtype=float)
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    patches = self.patches(landmarkPoints[triangles], sampleRate, maximumProjectionDistance)
+    edgePoints, edges = self.sharedEdgePoints(landmarkPoints, triangles, sampleRate)
+    startTime = time.perf_counter()
+    merged = np.vstack((patches[:, 3:].reshape(-1, 3), edgePoints))
+    self.timings["merge"] += time.perf_counter() - startTime
+    return merged, edges
@@ -1,260 +1,617 @@
-import os
-import unittest
-import logging
-import vtk, qt, ctk, slicer
-from slicer.ScriptedLoadableModule import *
-from slicer.util import VTKObservationMixin
-
-
-
-class GEVolImport(ScriptedLoadableModule):
-  """Uses ScriptedLoadableModule base class, available at:
-  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
-  """
-
-  def __init__(self, parent):
-    ScriptedLoadableModule.__init__(self, parent)
-    self.parent.title = "GEVolImport"
-    self.parent.categories = ["SlicerMorph.Input and Output"]
-    self.parent.dependencies = []
-    self.parent.contributors = ["Chi Zhang (SCRI), Murat Maga (UW)"]
-    # TODO: update with short description of the module and a link to online module documentation
-    self.parent.helpText = """
-This module imports VOL files output by the GE tome microCT scanner into 3D Slicer. It parses the PCR file to obtain the 3D image dimensions, voxel spacing, data format and other relevant metadata about the VOL file and generate a NHDR file to load the VOL file into Slicer.
-"""
-    self.parent.acknowledgementText = """
-This module was developed by Chi Zhang and Murat Maga, through a NSF ABI Development grant, "An Integrated Platform for Retrieval, Visualization and Analysis of
-3D Morphology From Digital Biological Collections" (Award Numbers: 1759883 (Murat Maga), 1759637 (Adam Summers), 1759839 (Douglas Boyer)).
-https://nsf.gov/awardsearch/showAward?AWD_ID=1759883&HistoricalAwards=false
-"""
-
-class GEVolImportWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
-  """Uses ScriptedLoadableModuleWidget base class, available at:
-  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
-  """
-
-  def __init__(self, parent=None):
-    ScriptedLoadableModuleWidget.__init__(self, parent)
-    VTKObservationMixin.__init__(self)  # needed for parameter node observation
-    self.logic = None
-    self._parameterNode = None
-    self._updatingGUIFromParameterNode = False
-
-  def setup(self):
-    ScriptedLoadableModuleWidget.setup(self)
-    parametersCollapsibleButton = ctk.ctkCollapsibleButton()
-    parametersCollapsibleButton.text = "Parameters"
-    self.layout.addWidget(parametersCollapsibleButton)
-    # Layout within the dummy collapsible button
-    parametersFormLayout = qt.QFormLayout(parametersCollapsibleButton)
-
-    # File dialog to select a file template for series
-    self.inputFileSelector = ctk.ctkPathLineEdit()
-    self.inputFileSelector.filters  = ctk.ctkPathLineEdit().Files
-    self.inputFileSelector.nameFilters = ("*.pcr", )
-    self.inputFileSelector.setToolTip( "Select .pcr file from a directory of a .vol file." )
-    parametersFormLayout.addRow("Select .pcr file:", self.inputFileSelector)
-
-    self.applyButton = qt.QPushButton("Generate NHDR file")
-    self.applyButton.toolTip = "Run the algorithm."
-    self.applyButton.enabled = False
-    parametersFormLayout.addRow(self.applyButton)
-
-    # connections
-    self.applyButton.connect('clicked(bool)', self.onApplyButton)
-    self.inputFileSelector.connect("currentPathChanged(const QString &)", self.onSelect)
-
-    # Add vertical spacer
-    self.layout.addStretch(1)
-
-    # Refresh Apply button state
-    self.onSelect()
-
-  def cleanup(self):
-    pass
-
-  def onSelect(self):
-    self.applyButton.enabled = bool(self.inputFileSelector.currentPath)
-
-  def onApplyButton(self):
-      with slicer.util.tryWithErrorDisplay(("Failed to compute results."), waitCursor=True):
-          logic = GEVolImportLogic()
-          nhdrPathName = logic.generateNHDRHeader(self.inputFileSelector.currentPath)
-          slicer.util.loadVolume(nhdrPathName)
-
-
-class PCRDataObject:
-    """Import .pcr file pointing to a .vol file"""
-    def __init__(self):
-        self.clear()
-
-    def clear(self):
-        self.dimensions  = [None, None, None]
-        self.spacing = None
-        self.scalarType = None
-
-    def load(self, filePath):
-        """Import and parse .vol or .pcr file."""
-
-        fileName, fileExtension = os.path.splitext(filePath)
-        if fileExtension.lower() == ".vol":
-            filePath = fileName + ".pcr"
-            if not os.path.isfile(filePath):
-                # pcr file is not found
-                raise FileNotFoundError(f"PCR file {filePath} was not found for VOL file")
-
-
-        # Verify that a vol file exists there
-        volPathName = fileName + ".vol"
-        if not os.path.exists(volPathName):
-            raise FileNotFoundError(f"VOL file {volPathName} was not found for PCR file")
-
-        # Parse
-        self.clear()
-        lines = []
-        with open (filePath) as in_file:
-            for line in in_file:
-                lines.append(line.strip("\n"))
-        for element in lines:
-            if(element.find("Volume_SizeX=")>=0):
-                self.dimensions[0] = int(element.split('=', 1)[1])
-            if(element.find("Volume_SizeY=")>=0):
-                self.dimensions[1] = int(element.split('=', 1)[1])
-            if(element.find("Volume_SizeZ")>=0):
-                self.dimensions[2] = int(element.split('=', 1)[1])
-            if(element.find("VoxelSizeRec=")>=0):
-                self.spacing = float(element.split('=', 1)[1])
-            if(element.find("Format=")>=0):
-                scalarTypeCode = int(element.split('=')[1])
-                if scalarTypeCode == 5:
-                    self.scalarType = vtk.VTK_UNSIGNED_SHORT
-                elif scalarTypeCode == 10:
-                    self.scalarType = vtk.VTK_FLOAT
-                elif scalarTypeCode == 1:
-                    self.scalarType = vtk.VTK_UNSIGNED_CHAR
-                else:
-                    raise RuntimeError(f"Unknown Format code: {scalarTypeCode}")
-
-        # Validate parsing results
-        if self.dimensions[0] is None:
-            raise RuntimeError("Volume_SizeX field is not found in file")
-        if self.dimensions[1] is None:
-            raise RuntimeError("Volume_SizeY field is not found in file")
-        if self.dimensions[2] is None:
-            raise RuntimeError("Volume_SizeZ field is not found in file")
-        if self.spacing is None:
-           pcaFilePath = fileName + ".pca"
-           vgiFilePath = fileName + ".vgi"
-           if os.path.isfile(pcaFilePath):
-               with open (pcaFilePath) as in_file:
-                   for line in in_file:
-                       lines.append(line.strip("\n"))
-               for element in lines:
-                   if(element.find("VoxelSizeX=")>=0):
-                       self.spacing = float(element.split('=')[1])
-           elif os.path.isfile(vgiFilePath):
-               with open (vgiFilePath) as in_file:
-                   for line in in_file:
-                       lines.append(line.strip("\n"))
-               for element in lines:
-                   if(element.find("resolution")>=0):
-                       self.spacing = float(element.split(' ')[2])
-           else:
-               raise RuntimeError("VoxelSizeRec field is not found in file")
-        if self.scalarType is None:
-            raise RuntimeError("Format field is not found in file")
-
-
-class GEVolImportLogic(ScriptedLoadableModuleLogic):
-
-  def generateNHDRHeader(self, inputFile):
-    """
-    Generate entry of .nhdr file from the .pcr file.Information from .pcr file
-    Information from .pcr file: x, y, z, voxel size, .vol file name.
-    Parameter "inputfile" is the file path specified by the input file selector wideget
-    """
-
-    logging.info('Processing started')
-
-    # Parse PCR file
-    imagePCRFile = PCRDataObject()
-    imagePCRFile.load(inputFile)
-
-    # Create NRRD header
-    filePathName, fileExtension = os.path.splitext(inputFile)
-    nhdrPathName = filePathName + ".nhdr"
-    with open(nhdrPathName, "w") as headerFile:
-        headerFile.write("NRRD0004\n")
-        headerFile.write("# Complete NRRD file format specification at:\n")
-        headerFile.write("# http://teem.sourceforge.net/nrrd/format.html\n")
-        if imagePCRFile.scalarType == vtk.VTK_UNSIGNED_SHORT:
-          headerFile.write("type: ushort\n")
-        elif imagePCRFile.scalarType == vtk.VTK_FLOAT:
-          headerFile.write("type: float\n")
-        elif imagePCRFile.scalarType == vtk.VTK_UNSIGNED_CHAR:
-          headerFile.write("type: uchar\n")
-        headerFile.write("dimension: 3\n")
-        headerFile.write("space: left-posterior-superior\n")
-        headerFile.write(f"sizes: {imagePCRFile.dimensions[0]} {imagePCRFile.dimensions[1]} {imagePCRFile.dimensions[2]}\n")
-        volSpace = imagePCRFile.spacing
-        headerFile.write(f"space directions: ({volSpace},0.0,0.0) (0.0,{volSpace},0.0) (0.0,0.0,{volSpace})\n")
-        headerFile.write("kinds: domain domain domain\n")
-        headerFile.write("endian: little\n")
-        headerFile.write("encoding: raw\n")
-        headerFile.write("space origin: (0.0, 0.0, 0.0)\n")
-        volPathName = filePathName + ".vol"
-        volPathSplit = []
-        volPathSplit = volPathName.split('/')
-        volFileName = volPathSplit[len(volPathSplit)-1]
-        headerFile.write(f"data file: {volFileName}\n")
-
-        logging.debug(f".nhdr file path is: {nhdrPathName}")
-
-    return nhdrPathName
-
-#
-# Reader plugin
-# (identified by its special name <moduleName>FileReader)
-#
-
-class GEVolImportFileReader:
-
-    def __init__(self, parent):
-        self.parent = parent
-
-    def description(self):
-        return 'GE tome microCT image'
-
-    def fileType(self):
-        return 'GeVolMicroCT'
-
-    def extensions(self):
-        return ['GE tome microCT image (*.vol)', 'GE tome microCT image (*.pcr)']
-
-    def canLoadFileConfidence(self, filePath):
-        if not self.parent.supportedNameFilters(filePath):
-            return 0.0
-        try:
-            imagePCRFile = PCRDataObject()
-            imagePCRFile.load(filePath)
-        except Exception as e:
-            return 0.0
-
-        # This is recognized as a GE microCT file, so we return higher confidence than the default 0.5
-        return 0.9
-
-    def load(self, properties):
-        try:
-            filePath = properties['fileName']
-            logic = GEVolImportLogic()
-            nhdrPathName = logic.generateNHDRHeader(filePath)
-            loadedVolume = slicer.util.loadVolume(nhdrPathName)
-
-        except Exception as e:
-            logging.error('Failed to load file: ' + str(e))
-            import traceback
-            traceback.print_exc()
-            return False
-
-        self.parent.loadedNodes = [loadedVolume.GetID()]
-        return True
+import os
+import unittest
+import logging
+import numpy
+import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+from slicer.util import VTKObservationMixin
+from GEVolImportLib import vol_volume
+
+
+
+class GEVolImport(ScriptedLoadableModule):
+  """Uses ScriptedLoadableModule base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def __init__(self, parent):
+    ScriptedLoadableModule.__init__(self, parent)
+    self.parent.title = "GEVolImport"
+    self.parent.categories = ["SlicerMorph.Input and Output"]
+    self.parent.dependencies = []
+    self.parent.contributors = ["Chi Zhang (SCRI), Murat Maga (UW)"]
+    # TODO: update with short description of the module and a link to online module documentation
+    self.parent.helpText = """
+This module imports VOL files output by the GE tome microCT scanner into 3D Slicer. It parses the PCR file to obtain the 3D image dimensions, voxel spacing, data format and other relevant metadata about the VOL file and generate a NHDR file to load the VOL file into Slicer.
+Large VOL files can be cropped to a region of interest and downsampled while they are read, and several VOL files can be downsampled and saved as NRRD files in batch.
+"""
+    self.parent.acknowledgementText = """
+This module was developed by Chi Zhang and Murat Maga, through a NSF ABI Development grant, "An Integrated Platform for Retrieval, Visualization and Analysis of
+3D Morphology From Digital Biological Collections" (Award Numbers: 1759883 (Murat Maga), 1759637 (Adam Summers), 1759839 (Douglas Boyer)).
+https://nsf.gov/awardsearch/showAward?AWD_ID=1759883&HistoricalAwards=false
+"""
+
+class GEVolImportWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
+  """Uses ScriptedLoadableModuleWidget base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleWidget.__init__(self, parent)
+    VTKObservationMixin.__init__(self)  # needed for parameter node observation
+    self.logic = None
+    self._parameterNode = None
+    self._updatingGUIFromParameterNode = False
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+    parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    parametersCollapsibleButton.text = "Parameters"
+    self.layout.addWidget(parametersCollapsibleButton)
+    # Layout within the dummy collapsible button
+    parametersFormLayout = qt.QFormLayout(parametersCollapsibleButton)
+
+    # File dialog to select a file template for series
+    self.inputFileSelector = ctk.ctkPathLineEdit()
+    self.inputFileSelector.filters  = ctk.ctkPathLineEdit().Files
+    self.inputFileSelector.nameFilters = ("*.pcr", )
+    self.inputFileSelector.setToolTip( "Select .pcr file from a directory of a .vol file." )
+    parametersFormLayout.addRow("Select .pcr file:", self.inputFileSelector)
+
+    self.applyButton = qt.QPushButton("Generate NHDR file")
+    self.applyButton.toolTip = "Run the algorithm."
+    self.applyButton.enabled = False
+    parametersFormLayout.addRow(self.applyButton)
+
+    # Region of interest and downsampling applied while the VOL file is read
+    self.roiSelector = slicer.qMRMLNodeComboBox()
+    self.roiSelector.nodeTypes = ["vtkMRMLMarkupsROINode"]
+    self.roiSelector.noneEnabled = True
+    self.roiSelector.addEnabled = False
+    self.roiSelector.removeEnabled = False
+    self.roiSelector.noneDisplay = "(Full volume)"
+    self.roiSelector.setMRMLScene(slicer.mrmlScene)
+    self.roiSelector.setToolTip("Region of the volume that will be loaded")
+    parametersFormLayout.addRow("Region of interest:", self.roiSelector)
+
+    self.downsamplingFactorSpinBox = qt.QSpinBox()
+    self.downsamplingFactorSpinBox.minimum = 1
+    self.downsamplingFactorSpinBox.maximum = 8
+    self.downsamplingFactorSpinBox.value = 1
+    self.downsamplingFactorSpinBox.setToolTip("Each output voxel is the average of a block of factor x factor x factor voxels."
+                                              " 2 reduces the memory needed by 8, 4 by 64.")
+    parametersFormLayout.addRow("Downsampling factor:", self.downsamplingFactorSpinBox)
+
+    self.loadButton = qt.QPushButton("Load cropped/downsampled volume")
+    self.loadButton.toolTip = "Read the region of interest of the VOL file, downsampled, without loading the whole volume in memory."
+    self.loadButton.enabled = False
+    parametersFormLayout.addRow(self.loadButton)
+
+    # Batch downsampling of the VOL files of a folder
+    batchCollapsibleButton = ctk.ctkCollapsibleButton()
+    batchCollapsibleButton.text = "Batch"
+    batchCollapsibleButton.collapsed = True
+    self.layout.addWidget(batchCollapsibleButton)
+    batchFormLayout = qt.QFormLayout(batchCollapsibleButton)
+
+    self.batchInputSelector = ctk.ctkPathLineEdit()
+    self.batchInputSelector.filters = ctk.ctkPathLineEdit.Dirs
+    self.batchInputSelector.setToolTip("Folder searched (with its subfolders) for .pcr files.")
+    batchFormLayout.addRow("Input folder:", self.batchInputSelector)
+
+    self.batchOutputSelector = ctk.ctkPathLineEdit()
+    self.batchOutputSelector.filters = ctk.ctkPathLineEdit.Dirs
+    self.batchOutputSelector.setToolTip("Folder the NRRD files are written to.")
+    batchFormLayout.addRow("Output folder:", self.batchOutputSelector)
+
+    self.parallelVolumesSpinBox = qt.QSpinBox()
+    self.parallelVolumesSpinBox.minimum = 1
+    self.parallelVolumesSpinBox.maximum = 16
+    self.parallelVolumesSpinBox.value = 2
+    self.parallelVolumesSpinBox.setToolTip("Number of VOL files read at the same time. Each holds its downsampled volume"
+                                           " and one slab of the VOL file in memory.")
+    batchFormLayout.addRow("Files at a time:", self.parallelVolumesSpinBox)
+
+    self.batchButton = qt.QPushButton("Export downsampled volumes")
+    self.batchButton.toolTip = "Downsample the VOL file of each .pcr file by the downsampling factor and save it as NRRD."
+    batchFormLayout.addRow(self.batchButton)
+
+    # connections
+    self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.loadButton.connect('clicked(bool)', self.onLoadButton)
+    self.batchButton.connect('clicked(bool)', self.onBatchButton)
+    self.inputFileSelector.connect("currentPathChanged(const QString &)", self.onSelect)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+    # Refresh Apply button state
+    self.onSelect()
+
+  def cleanup(self):
+    pass
+
+  def onSelect(self):
+    self.applyButton.enabled = bool(self.inputFileSelector.currentPath)
+    self.loadButton.enabled = bool(self.inputFileSelector.currentPath)
+
+  def onApplyButton(self):
+      with slicer.util.tryWithErrorDisplay(("Failed to compute results."), waitCursor=True):
+          logic = GEVolImportLogic()
+          nhdrPathName = logic.generateNHDRHeader(self.inputFileSelector.currentPath)
+          slicer.util.loadVolume(nhdrPathName)
+
+  def onLoadButton(self):
+    progress = slicer.util.createProgressDialog(windowTitle="Loading VOL file", labelText="Reading slabs...", maximum=100)
+
+    def updateProgress(slabsDone, numberOfSlabs):
+      progress.setValue(int(100 * slabsDone / numberOfSlabs))
+      slicer.app.processEvents()
+      return not progress.wasCanceled
+
+    with slicer.util.tryWithErrorDisplay(("Failed to load the volume."), waitCursor=True):
+      try:
+        logic = GEVolImportLogic()
+        logic.loadVolume(self.inputFileSelector.currentPath, self.roiSelector.currentNode(),
+                         self.downsamplingFactorSpinBox.value, updateProgress)
+      finally:
+        progress.close()
+
+  def onBatchButton(self):
+    logic = GEVolImportLogic()
+    pcrFilePaths = logic.findPCRFiles(self.batchInputSelector.currentPath)
+    outputDirectory = self.batchOutputSelector.currentPath.strip()
+    if not pcrFilePaths or not outputDirectory:
+      slicer.util.errorDisplay("Select an input folder containing .pcr files and an output folder.")
+      return
+    progress = slicer.util.createProgressDialog(windowTitle="Batch export", labelText="Exporting volumes...", maximum=len(pcrFilePaths))
+
+    def updateProgress(numberOfVolumesDone, numberOfVolumes):
+      progress.setValue(numberOfVolumesDone)
+      slicer.app.processEvents()
+      return not progress.wasCanceled
+
+    with slicer.util.tryWithErrorDisplay(("Batch export failed."), waitCursor=True):
+      try:
+        errors = logic.batchExport(pcrFilePaths, outputDirectory, self.downsamplingFactorSpinBox.value,
+                                   self.parallelVolumesSpinBox.value, progressCallback=updateProgress)
+      finally:
+        progress.close()
+      failed = [f"{os.path.basename(pcrFilePath)}: {error}" for pcrFilePath, error in zip(pcrFilePaths, errors) if error]
+      message = f"{len(pcrFilePaths) - len(failed)} of {len(pcrFilePaths)} volumes exported to {outputDirectory}"
+      if failed:
+        slicer.util.warningDisplay(message, detailedText="\n".join(failed))
+      else:
+        slicer.util.infoDisplay(message)
+
+
+class PCRDataObject:
+    """Import .pcr file pointing to a .vol file"""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.dimensions  = [None, None, None]
+        self.spacing = None
+        self.scalarType = None
+        self.volFilePath = None
+
+    @property
+    def dtype(self):
+        """numpy voxel type of the VOL file"""
+        return {vtk.VTK_UNSIGNED_SHORT: '<u2', vtk.VTK_FLOAT: '<f4', vtk.VTK_UNSIGNED_CHAR: 'u1'}[self.scalarType]
+
+    def load(self, filePath):
+        """Import and parse .vol or .pcr file."""
+
+        fileName, fileExtension = os.path.splitext(filePath)
+        if fileExtension.lower() == ".vol":
+            filePath = fileName + ".pcr"
+            if not os.path.isfile(filePath):
+                # pcr file is not found
+                raise FileNotFoundError(f"PCR file {filePath} was not found for VOL file")
+
+
+        # Verify that a vol file exists there
+        volPathName = fileName + ".vol"
+        if not os.path.exists(volPathName):
+            raise FileNotFoundError(f"VOL file {volPathName} was not found for PCR file")
+
+        # Parse
+        self.clear()
+        self.volFilePath = volPathName
+        lines = []
+        with open (filePath) as in_file:
+            for line in in_file:
+                lines.append(line.strip("\n"))
+        for element in lines:
+            if(element.find("Volume_SizeX=")>=0):
+                self.dimensions[0] = int(element.split('=', 1)[1])
+            if(element.find("Volume_SizeY=")>=0):
+                self.dimensions[1] = int(element.split('=', 1)[1])
+            if(element.find("Volume_SizeZ")>=0):
+                self.dimensions[2] = int(element.split('=', 1)[1])
+            if(element.find("VoxelSizeRec=")>=0):
+                self.spacing = float(element.split('=', 1)[1])
+            if(element.find("Format=")>=0):
+                scalarTypeCode = int(element.split('=')[1])
+                if scalarTypeCode == 5:
+                    self.scalarType = vtk.VTK_UNSIGNED_SHORT
+                elif scalarTypeCode == 10:
+                    self.scalarType = vtk.VTK_FLOAT
+                elif scalarTypeCode == 1:
+                    self.scalarType = vtk.VTK_UNSIGNED_CHAR
+                else:
+                    raise RuntimeError(f"Unknown Format code: {scalarTypeCode}")
+
+        # Validate parsing results
+        if self.dimensions[0] is None:
+            raise RuntimeError("Volume_SizeX field is not found in file")
+        if self.dimensions[1] is None:
+            raise RuntimeError("Volume_SizeY field is not found in file")
+        if self.dimensions[2] is None:
+            raise RuntimeError("Volume_SizeZ field is not found in file")
+        if self.spacing is None:
+           pcaFilePath = fileName + ".pca"
+           vgiFilePath = fileName + ".vgi"
+           if os.path.isfile(pcaFilePath):
+               with open (pcaFilePath) as in_file:
+                   for line in in_file:
+                       lines.append(line.strip("\n"))
+               for element in lines:
+                   if(element.find("VoxelSizeX=")>=0):
+                       self.spacing = float(element.split('=')[1])
+           elif os.path.isfile(vgiFilePath):
+               with open (vgiFilePath) as in_file:
+                   for line in in_file:
+                       lines.append(line.strip("\n"))
+               for element in lines:
+                   if(element.find("resolution")>=0):
+                       self.spacing = float(element.split(' ')[2])
+           else:
+               raise RuntimeError("VoxelSizeRec field is not found in file")
+        if self.scalarType is None:
+            raise RuntimeError("Format field is not found in file")
+
+
+class GEVolImportLogic(ScriptedLoadableModuleLogic):
+
+  def generateNHDRHeader(self, inputFile):
+    """
+    Generate entry of .nhdr file from the .pcr file.Information from .pcr file
+    Information from .pcr file: x, y, z, voxel size, .vol file name.
+    Parameter "inputfile" is the file path specified by the input file selector wideget
+    """
+
+    logging.info('Processing started')
+
+    # Parse PCR file
+    imagePCRFile = PCRDataObject()
+    imagePCRFile.load(inputFile)
+
+    # Create NRRD header
+    filePathName, fileExtension = os.path.splitext(inputFile)
+    nhdrPathName = filePathName + ".nhdr"
+    with open(nhdrPathName, "w") as headerFile:
+        headerFile.write("NRRD0004\n")
+        headerFile.write("# Complete NRRD file format specification at:\n")
+        headerFile.write("# http://teem.sourceforge.net/nrrd/format.html\n")
+        if imagePCRFile.scalarType == vtk.VTK_UNSIGNED_SHORT:
+          headerFile.write("type: ushort\n")
+        elif imagePCRFile.scalarType == vtk.VTK_FLOAT:
+          headerFile.write("type: float\n")
+        elif imagePCRFile.scalarType == vtk.VTK_UNSIGNED_CHAR:
+          headerFile.write("type: uchar\n")
+        headerFile.write("dimension: 3\n")
+        headerFile.write("space: left-posterior-superior\n")
+        headerFile.write(f"sizes: {imagePCRFile.dimensions[0]} {imagePCRFile.dimensions[1]} {imagePCRFile.dimensions[2]}\n")
+        volSpace = imagePCRFile.spacing
+        headerFile.write(f"space directions: ({volSpace},0.0,0.0) (0.0,{volSpace},0.0) (0.0,0.0,{volSpace})\n")
+        headerFile.write("kinds: domain domain domain\n")
+        headerFile.write("endian: little\n")
+        headerFile.write("encoding: raw\n")
+        headerFile.write("space origin: (0.0, 0.0, 0.0)\n")
+        volPathName = filePathName + ".vol"
+        volPathSplit = []
+        volPathSplit = volPathName.split('/')
+        volFileName = volPathSplit[len(volPathSplit)-1]
+        headerFile.write(f"data file: {volFileName}\n")
+
+        logging.debug(f".nhdr file path is: {nhdrPathName}")
+
+    return nhdrPathName
+
+  @staticmethod
+  def findPCRFiles(folderPath):
+    """.pcr files in a folder and its subfolders, in alphabetical order"""
+    pcrFilePaths = []
+    for root, dirs, files in os.walk(folderPath):
+      dirs.sort()
+      pcrFilePaths.extend(os.path.join(root, fileName) for fileName in sorted(files) if fileName.lower().endswith(".pcr"))
+    return pcrFilePaths
+
+  def openVolume(self, inputFile):
+    """Memory-mapped VOL file of a .pcr (or .vol) file, as a vol_volume.VolVolume"""
+    imagePCRFile = PCRDataObject()
+    imagePCRFile.load(inputFile)
+    return vol_volume.VolVolume(imagePCRFile.volFilePath, imagePCRFile.dimensions, imagePCRFile.spacing, imagePCRFile.dtype)
+
+  @staticmethod
+  def roiBounds(roiNode):
+    """RAS bounds (xmin, xmax, ymin, ymax, zmin, zmax) of a markups ROI node"""
+    center = [0.0, 0.0, 0.0]
+    radius = [0.0, 0.0, 0.0]
+    roiNode.GetXYZ(center)
+    roiNode.GetRadiusXYZ(radius)
+    return [center[0]-radius[0], center[0]+radius[0], center[1]-radius[1], center[1]+radius[1], center[2]-radius[2], center[2]+radius[2]]
+
+  def loadVolume(self, inputFile, roiNode=None, factor=1, progressCallback=None):
+    """
+    Load the region of a VOL file inside roiNode (the whole volume if None), averaged over blocks of
+    factor^3 voxels, into a new scalar volume node. The VOL file is memory-mapped and read slab by slab
+    (see vol_volume.VolVolume.extract), so volumes larger than the available memory can be loaded cropped
+    or downsampled. progressCallback(slabsDone, numberOfSlabs) can return False to cancel.
+    """
+    volume = self.openVolume(inputFile)
+    try:
+      ijkMin, ijkMax = volume.ijkRangeFromBounds(self.roiBounds(roiNode)) if roiNode else (None, None)
+      volumeArray, ijkToRAS = volume.extract(ijkMin, ijkMax, factor, progressCallback=progressCallback)
+    finally:
+      volume.close()
+    name = os.path.splitext(os.path.basename(inputFile))[0]
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", name if factor == 1 else f"{name}-ds{factor}")
+    volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ijkToRAS))
+    slicer.util.updateVolumeFromArray(volumeNode, volumeArray)
+    volumeNode.CreateDefaultDisplayNodes()
+    slicer.util.setSliceViewerLayers(background=volumeNode, fit=True)
+    return volumeNode
+
+  def batchExport(self, inputFiles, outputDirectory, factor=1, maximumParallelVolumes=2, useCompression=False, progressCallback=None):
+    """
+    Downsample the VOL file of each .pcr file by factor and save it to outputDirectory as a NRRD file named after
+    the .pcr file (with a -ds<factor> suffix if downsampled), several files at a time (see vol_volume.exportVolumes).
+    Files that cannot be read are skipped. progressCallback(numberOfVolumesDone, numberOfVolumes) can return False to cancel.
+    Returns the error message of each file, None for the files exported.
+    """
+    errors = [None] * len(inputFiles)
+    volumes = []
+    outputFilePaths = []
+    for index, inputFile in enumerate(inputFiles):
+      try:
+        volumes.append(self.openVolume(inputFile))
+      except Exception as e:
+        errors[index] = str(e)
+        logging.error(f"Failed to open {inputFile}: {e}")
+        continue
+      name = os.path.splitext(os.path.basename(inputFile))[0]
+      outputFilePaths.append(os.path.join(outputDirectory, (name if factor == 1 else f"{name}-ds{factor}") + ".nrrd"))
+    try:
+      exportErrors = vol_volume.exportVolumes(volumes, outputFilePaths, factor, maximumParallelVolumes,
+                                              useCompression=useCompression, progressCallback=progressCallback)
+    finally:
+      for volume in volumes:
+        volume.close()
+    exportErrors = iter(exportErrors)
+    for index in range(len(inputFiles)):
+      if errors[index] is None:
+        errors[index] = next(exportErrors)
+        if errors[index]:
+          logging.error(f"Failed to export {inputFiles[index]}: {errors[index]}")
+    return errors
+
+class GEVolImportTest(ScriptedLoadableModuleTest):
+  """
+  This is the test case for your scripted module.
+  Uses ScriptedLoadableModuleTest base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def setUp(self):
+    """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+    """
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_GEVolImportRegionExtraction()
+    self.setUp()
+    self.test_GEVolImportLoadVolume()
+
+  def writeTestVolume(self, folderPath, name, volumeArray, formatCode, spacing=0.02):
+    """Write a synthetic .vol file and its .pcr file, returns the .pcr file path"""
+    volumeArray.tofile(os.path.join(folderPath, name + ".vol"))
+    pcrFilePath = os.path.join(folderPath, name + ".pcr")
+    with open(pcrFilePath, "w") as pcrFile:
+      pcrFile.write("[VolumeData]\n")
+      pcrFile.write(f"Volume_SizeX={volumeArray.shape[2]}\nVolume_SizeY={volumeArray.shape[1]}\nVolume_SizeZ={volumeArray.shape[0]}\n")
+      pcrFile.write(f"VoxelSizeRec={spacing}\nFormat={formatCode}\n")
+    return pcrFilePath
+
+  def test_GEVolImportRegionExtraction(self):
+    """ Cropped and downsampled regions read slab by slab from the memory-mapped VOL file, and batch export
+    """
+    import tempfile
+    import SimpleITK as sitk
+    self.delayDisplay("Starting the region extraction test")
+
+    shape = (23, 30, 35)
+    rng = numpy.random.default_rng(0)
+    volumeArray = rng.integers(0, 65535, size=shape, dtype=numpy.uint16)
+    floatArray = rng.random(shape, dtype=numpy.float32)
+
+    def blockMean(array, ijkMin, ijkMax, factor):
+      cropped = array[ijkMin[2]:ijkMax[2], ijkMin[1]:ijkMax[1], ijkMin[0]:ijkMax[0]]
+      outputShape = [size // factor for size in cropped.shape]
+      cropped = cropped[:outputShape[0] * factor, :outputShape[1] * factor, :outputShape[2] * factor]
+      mean = cropped.reshape(outputShape[0], factor, outputShape[1], factor, outputShape[2], factor).mean(axis=(1, 3, 5), dtype=numpy.float64)
+      return numpy.rint(mean).astype(array.dtype) if array.dtype.kind == 'u' else mean.astype(array.dtype)
+
+    with tempfile.TemporaryDirectory() as folderPath:
+      pcrFilePath = self.writeTestVolume(folderPath, "specimen", volumeArray, 5)
+      floatPCRFilePath = self.writeTestVolume(folderPath, "floatSpecimen", floatArray, 10)
+      logic = GEVolImportLogic()
+      volume = logic.openVolume(pcrFilePath)
+      try:
+        extracted, ijkToRAS = volume.extract()
+        numpy.testing.assert_array_equal(extracted, volumeArray)
+        numpy.testing.assert_allclose(ijkToRAS, numpy.diag([-0.02, -0.02, 0.02, 1.0]))
+
+        # small slabs give the same result as a single slab
+        for factor in [1, 2, 3]:
+          for maximumSlabBytes in [1, 10000, vol_volume.DEFAULT_MAXIMUM_SLAB_BYTES]:
+            extracted, ijkToRAS = volume.extract([3, 4, 5], [33, 29, 22], factor, maximumSlabBytes)
+            numpy.testing.assert_array_equal(extracted, blockMean(volumeArray, [3, 4, 5], [33, 29, 22], factor))
+          # the first output voxel is centered on the first block
+          numpy.testing.assert_allclose(ijkToRAS[0:3, 3], numpy.array([-0.02, -0.02, 0.02]) * (numpy.array([3, 4, 5]) + (factor - 1) / 2))
+          numpy.testing.assert_allclose(numpy.diag(ijkToRAS)[0:3], numpy.array([-0.02, -0.02, 0.02]) * factor)
+
+        # region of interest bounds in RAS
+        bounds = [-0.02 * 20.2, -0.02 * 10.3, -0.02 * 15.0, -0.02 * 4.6, 0.02 * 2.0, 0.02 * 30.0]
+        ijkMin, ijkMax = volume.ijkRangeFromBounds(bounds)
+        self.assertEqual(ijkMin, [10, 5, 2])
+        self.assertEqual(ijkMax, [21, 16, 23])
+        with self.assertRaises(ValueError):
+          volume.ijkRangeFromBounds([10.0, 11.0, 10.0, 11.0, 10.0, 11.0])
+
+        slabCounts = []
+        volume.extract(factor=2, maximumSlabBytes=1, progressCallback=lambda done, total: slabCounts.append(total))
+        self.assertEqual(len(slabCounts), 11)
+        with self.assertRaises(ValueError):
+          volume.extract(maximumSlabBytes=1, progressCallback=lambda done, total: False)
+      finally:
+        volume.close()
+
+      floatVolume = logic.openVolume(floatPCRFilePath)
+      numpy.testing.assert_allclose(floatVolume.extract(factor=2)[0], blockMean(floatArray, [0, 0, 0], shape[::-1], 2), rtol=1e-6)
+      floatVolume.close()
+
+      # VOL files shorter than the .pcr dimensions are rejected
+      truncatedPCRFilePath = self.writeTestVolume(folderPath, "truncated", volumeArray[:10], 5)
+      with open(truncatedPCRFilePath, "a") as pcrFile:
+        pcrFile.write(f"Volume_SizeZ={shape[0]}\n")
+      with self.assertRaises(ValueError):
+        logic.openVolume(truncatedPCRFilePath)
+
+      # batch export of several files at a time; files that cannot be read are reported
+      outputFolderPath = os.path.join(folderPath, "output")
+      os.makedirs(outputFolderPath)
+      pcrFilePaths = logic.findPCRFiles(folderPath)
+      self.assertEqual([os.path.basename(path) for path in pcrFilePaths], ["floatSpecimen.pcr", "specimen.pcr", "truncated.pcr"])
+      progress = []
+      errors = logic.batchExport(pcrFilePaths, outputFolderPath, 2, maximumParallelVolumes=2,
+                                 progressCallback=lambda done, total: progress.append(done))
+      self.assertEqual(errors[0:2], [None, None])
+      self.assertIn("truncated.vol", errors[2])
+      self.assertEqual(progress[-1], 2)
+      image = sitk.ReadImage(os.path.join(outputFolderPath, "specimen-ds2.nrrd"))
+      numpy.testing.assert_array_equal(sitk.GetArrayFromImage(image), blockMean(volumeArray, [0, 0, 0], shape[::-1], 2))
+      numpy.testing.assert_allclose(image.GetSpacing(), [0.04] * 3)
+      numpy.testing.assert_allclose(image.GetOrigin(), [0.01] * 3)
+
+      # exported volumes are streamed slab by slab: an export of one slice slabs holds much less than the volume
+      # (the compressor has a fixed state of a few hundred kB), and a cancelled export leaves no file
+      import tracemalloc
+      volume = logic.openVolume(os.path.join(folderPath, "specimen.pcr"))
+      try:
+        for useCompression in [False, True]:
+          streamedFilePath = os.path.join(outputFolderPath, f"specimen-streamed-{'gzip' if useCompression else 'raw'}.nrrd")
+          tracemalloc.start()
+          try:
+            vol_volume.writeSlabs(volume, streamedFilePath, maximumSlabBytes=1, useCompression=useCompression)
+            peakBytes = tracemalloc.get_traced_memory()[1]
+          finally:
+            tracemalloc.stop()
+          if not useCompression:
+            self.assertLess(peakBytes, volumeArray.nbytes / 2)
+          image = sitk.ReadImage(streamedFilePath)
+          numpy.testing.assert_array_equal(sitk.GetArrayFromImage(image), volumeArray)
+          numpy.testing.assert_allclose(image.GetSpacing(), [0.02] * 3)
+        cancelledFilePath = os.path.join(outputFolderPath, "specimen-cancelled.nrrd")
+        with self.assertRaises(ValueError):
+          vol_volume.writeSlabs(volume, cancelledFilePath, maximumSlabBytes=1, progressCallback=lambda done, total: False)
+      finally:
+        volume.close()
+      self.assertFalse(os.path.exists(cancelledFilePath))
+
+    self.delayDisplay('Test passed')
+
+  def test_GEVolImportLoadVolume(self):
+    """ Volumes loaded from the memory-mapped VOL file match the volume loaded through the NHDR header
+    """
+    import tempfile
+    self.delayDisplay("Starting the load volume test")
+
+    rng = numpy.random.default_rng(1)
+    volumeArray = rng.integers(0, 255, size=(16, 20, 24), dtype=numpy.uint8)
+    with tempfile.TemporaryDirectory() as folderPath:
+      pcrFilePath = self.writeTestVolume(folderPath, "specimen", volumeArray, 1)
+      logic = GEVolImportLogic()
+      nhdrNode = slicer.util.loadVolume(logic.generateNHDRHeader(pcrFilePath))
+      volumeNode = logic.loadVolume(pcrFilePath)
+      numpy.testing.assert_array_equal(slicer.util.arrayFromVolume(volumeNode), slicer.util.arrayFromVolume(nhdrNode))
+      nhdrIJKToRAS = vtk.vtkMatrix4x4()
+      nhdrNode.GetIJKToRASMatrix(nhdrIJKToRAS)
+      ijkToRAS = vtk.vtkMatrix4x4()
+      volumeNode.GetIJKToRASMatrix(ijkToRAS)
+      numpy.testing.assert_allclose(slicer.util.arrayFromVTKMatrix(ijkToRAS), slicer.util.arrayFromVTKMatrix(nhdrIJKToRAS), atol=1e-6)
+
+      # a region of interest placed on the loaded volume crops the volume read from the VOL file
+      roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
+      roiNode.SetXYZ(-0.02 * 11.5, -0.02 * 9.5, 0.02 * 7.5)
+      roiNode.SetRadiusXYZ(0.02 * 4, 0.02 * 5, 0.02 * 6)
+      croppedNode = logic.loadVolume(pcrFilePath, roiNode, factor=2)
+      croppedArray = slicer.util.arrayFromVolume(croppedNode)
+      self.assertEqual(croppedArray.shape, (6, 5, 4))
+      expected = volumeArray[2:14, 5:15, 8:16].reshape(6, 2, 5, 2, 4, 2).mean(axis=(1, 3, 5))
+      numpy.testing.assert_array_equal(croppedArray, numpy.rint(expected).astype(numpy.uint8))
+
+    self.delayDisplay('Test passed')
+
+#
+# Reader plugin
+# (identified by its special name <moduleName>FileReader)
+#
+
+class GEVolImportFileReader:
+
+    def __init__(self, parent):
+        self.parent = parent
+
+    def description(self):
+        return 'GE tome microCT image'
+
+    def fileType(self):
+        return 'GeVolMicroCT'
+
+    def extensions(self):
+        return ['GE tome microCT image (*.vol)', 'GE tome microCT image (*.pcr)']
+
+    def canLoadFileConfidence(self, filePath):
+        if not self.parent.supportedNameFilters(filePath):
+            return 0.0
+        try:
+            imagePCRFile = PCRDataObject()
+            imagePCRFile.load(filePath)
+        except Exception as e:
+            return 0.0
+
+        # This is recognized as a GE microCT file, so we return higher confidence than the default 0.5
+        return 0.9
+
+    def load(self, properties):
+        try:
+            filePath = properties['fileName']
+            logic = GEVolImportLogic()
+            nhdrPathName = logic.generateNHDRHeader(filePath)
+            loadedVolume = slicer.util.loadVolume(nhdrPathName)
+
+        except Exception as e:
+            logging.error('Failed to load file: ' + str(e))
+            import traceback
+            traceback.print_exc()
+            return False
+
+        self.parent.loadedNodes = [loadedVolume.GetID()]
+        return True
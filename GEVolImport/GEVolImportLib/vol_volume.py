@@ -0,0 +1,238 @@
+import concurrent.futures
+import math
+import os
+import threading
+import zlib
+
+import numpy
+
+# Slabs of the raw volume are read and reduced one at a time, within this many bytes by default
+# (slabs that fit in the processor caches are also reduced faster)
+DEFAULT_MAXIMUM_SLAB_BYTES = 64 * 1024**2
+
+# NRRD names of the voxel types that can be written
+NRRD_TYPES = {
+  'int8': 'int8', 'uint8': 'uint8', 'int16': 'int16', 'uint16': 'uint16',
+  'int32': 'int32', 'uint32': 'uint32', 'float32': 'float', 'float64': 'double',
+}
+
+def accumulatorType(dtype):
+  """Block sums of integer voxels are exact in int64, float voxels are summed in float64"""
+  return numpy.int64 if numpy.dtype(dtype).kind in 'iub' else numpy.float64
+
+class VolVolume:
+  """
+  Raw GE .vol volume (columns varying fastest, then rows, then slices), memory-mapped so that
+  only the voxels of the regions that are extracted are read from disk.
+  The volume is in LPS with its origin at 0, as in the .nhdr header written for it.
+  """
+  def __init__(self, volFilePath, dimensions, spacing, dtype):
+    """
+    dimensions: number of columns, rows and slices (Volume_SizeX, Y and Z of the .pcr file)
+    spacing: voxel size in mm
+    dtype: numpy voxel type, little endian
+    """
+    self.filePath = volFilePath
+    self.dimensions = tuple(int(size) for size in dimensions)
+    self.spacing = float(spacing)
+    self.dtype = numpy.dtype(dtype)
+    expectedBytes = self.dimensions[0] * self.dimensions[1] * self.dimensions[2] * self.dtype.itemsize
+    fileBytes = os.path.getsize(volFilePath)
+    if fileBytes < expectedBytes:
+      raise ValueError(f"{os.path.basename(volFilePath)} has {fileBytes} bytes, {self.dimensions[0]} x {self.dimensions[1]} x"
+                       f" {self.dimensions[2]} voxels of {self.dtype} need {expectedBytes}")
+    self.array = numpy.memmap(volFilePath, dtype=self.dtype, mode='r', shape=self.dimensions[::-1])
+
+  def close(self):
+    """Release the file mapping (the file cannot be removed on Windows while it is mapped)"""
+    self.array = None
+
+  def ijkToRAS(self):
+    # Volume is in LPS, therefore we invert the first two axes
+    return numpy.diag([-self.spacing, -self.spacing, self.spacing, 1.0])
+
+  def ijkRangeFromBounds(self, bounds):
+    """
+    Smallest voxel range [ijkMin, ijkMax) that contains the RAS bounds (xmin, xmax, ymin, ymax, zmin, zmax)
+    of a region of interest, clipped to the volume
+    """
+    rasToIJK = numpy.linalg.inv(self.ijkToRAS())
+    corners = numpy.array([[r, a, s, 1.0] for r in bounds[0:2] for a in bounds[2:4] for s in bounds[4:6]])
+    # rounded so that bounds on voxel boundaries are not moved to the next voxel by floating point errors
+    cornersIJK = numpy.dot(rasToIJK, corners.T)[0:3].round(6)
+    ijkMin = [max(0, int(math.floor(value + 0.5))) for value in cornersIJK.min(axis=1)]
+    ijkMax = [min(size, int(math.ceil(value + 0.5))) for value, size in zip(cornersIJK.max(axis=1), self.dimensions)]
+    if any(high <= low for low, high in zip(ijkMin, ijkMax)):
+      raise ValueError("The region of interest does not overlap the volume")
+    return ijkMin, ijkMax
+
+  def outputGeometry(self, ijkMin=None, ijkMax=None, factor=1):
+    """
+    Shape (slices, rows, columns) and IJK to RAS matrix of the region [ijkMin, ijkMax) downsampled by factor.
+    Incomplete blocks at the far edges of the region are dropped; the first output voxel is centered on the first block.
+    """
+    ijkMin = list(ijkMin) if ijkMin is not None else [0, 0, 0]
+    ijkMax = list(ijkMax) if ijkMax is not None else list(self.dimensions)
+    shape = tuple((ijkMax[axis] - ijkMin[axis]) // factor for axis in [2, 1, 0])
+    if min(shape) <= 0:
+      raise ValueError(f"The region is too small to be downsampled by {factor}")
+    blockToVoxel = numpy.diag([float(factor), float(factor), float(factor), 1.0])
+    blockToVoxel[0:3, 3] = numpy.array(ijkMin) + (factor - 1) / 2.0
+    return shape, numpy.dot(self.ijkToRAS(), blockToVoxel)
+
+  def extractSlabs(self, ijkMin=None, ijkMax=None, factor=1, maximumSlabBytes=DEFAULT_MAXIMUM_SLAB_BYTES, progressCallback=None):
+    """
+    Slabs of whole output slices of the region [ijkMin, ijkMax) (full volume by default), averaged over blocks of
+    factor^3 voxels, in slice order. Each slab is copied from the mapped file and reduced to its block means.
+    A slab and its block sums take at most maximumSlabBytes (or one output slice if that is larger).
+    For factor 1 the slabs are views of the mapped file.
+    progressCallback(slabsDone, numberOfSlabs) is called after each slab is used; if it returns False, extraction stops.
+    Yields the index of the first output slice of each slab and the (slices, rows, columns) slab.
+    """
+    ijkMin = list(ijkMin) if ijkMin is not None else [0, 0, 0]
+    shape, ijkToRAS = self.outputGeometry(ijkMin, ijkMax, factor)
+    rowsRange = slice(ijkMin[1], ijkMin[1] + shape[1] * factor)
+    columnsRange = slice(ijkMin[0], ijkMin[0] + shape[2] * factor)
+    # bytes per output slice: the input slices of its blocks, their sums and means (8 bytes per output voxel each)
+    slabSliceBytes = shape[1] * shape[2] * (factor**3 * self.dtype.itemsize + (16 if factor > 1 else 0))
+    outputSlicesPerSlab = max(1, min(shape[0], maximumSlabBytes // slabSliceBytes))
+    numberOfSlabs = -(-shape[0] // outputSlicesPerSlab)
+    for slabIndex in range(numberOfSlabs):
+      outputStart = slabIndex * outputSlicesPerSlab
+      outputStop = min(shape[0], outputStart + outputSlicesPerSlab)
+      firstSlice = ijkMin[2] + outputStart * factor
+      # copying the slab reads the file sequentially, row by row of the region
+      slabRange = slice(firstSlice, firstSlice + (outputStop - outputStart) * factor)
+      if factor == 1:
+        yield outputStart, self.array[slabRange, rowsRange, columnsRange]
+      else:
+        slab = numpy.array(self.array[slabRange, rowsRange, columnsRange])
+        # adding the factor^3 strided views is several times faster than summing a reshaped slab
+        sums = numpy.zeros((outputStop - outputStart,) + shape[1:], dtype=accumulatorType(self.dtype))
+        for sliceOffset in range(factor):
+          for rowOffset in range(factor):
+            for columnOffset in range(factor):
+              sums += slab[sliceOffset::factor, rowOffset::factor, columnOffset::factor]
+        del slab
+        mean = sums / factor**3
+        del sums
+        if self.dtype.kind in 'iub':
+          numpy.rint(mean, out=mean)
+        yield outputStart, mean.astype(self.dtype)
+        del mean
+      if progressCallback and progressCallback(slabIndex + 1, numberOfSlabs) is False:
+        raise ValueError("User requested cancel")
+
+  def extract(self, ijkMin=None, ijkMax=None, factor=1, maximumSlabBytes=DEFAULT_MAXIMUM_SLAB_BYTES, progressCallback=None):
+    """
+    Voxels of the region [ijkMin, ijkMax) (full volume by default), averaged over blocks of factor^3 voxels,
+    assembled from the slabs of extractSlabs, so the memory used is the output volume plus one slab, whatever
+    the size of the .vol file.
+    progressCallback(slabsDone, numberOfSlabs) is called after each slab; if it returns False, extraction stops.
+    Returns the (slices, rows, columns) array and its IJK to RAS matrix.
+    """
+    shape, ijkToRAS = self.outputGeometry(ijkMin, ijkMax, factor)
+    output = numpy.empty(shape, dtype=self.dtype)
+    for outputStart, slab in self.extractSlabs(ijkMin, ijkMax, factor, maximumSlabBytes, progressCallback):
+      output[outputStart:outputStart + len(slab)] = slab
+    return output, ijkToRAS
+
+class NrrdSlabWriter:
+  """
+  Writes a (slices, rows, columns) volume to a NRRD file one slab of slices at a time, raw or gzip compressed,
+  so that only the slab being written is held in memory. The IJK axes are assumed to be aligned with the RAS axes.
+  """
+  def __init__(self, filePath, shape, dtype, ijkToRAS, useCompression=False):
+    self.filePath = filePath
+    self.shape = tuple(shape)
+    self.dtype = numpy.dtype(dtype).newbyteorder('<')
+    if self.dtype.name not in NRRD_TYPES:
+      raise ValueError(f"Voxel type {self.dtype} cannot be written to NRRD")
+    self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16) if useCompression else None
+    self.writtenSlices = 0
+    # NRRD files written by Slicer use LPS coordinates
+    ijkToLPS = numpy.dot(numpy.diag([-1.0, -1.0, 1.0, 1.0]), ijkToRAS)
+    lines = [
+      "NRRD0004",
+      "# Complete NRRD file format specification at:",
+      "# http://teem.sourceforge.net/nrrd/format.html",
+      f"type: {NRRD_TYPES[self.dtype.name]}",
+      "dimension: 3",
+      "space: left-posterior-superior",
+      f"sizes: {self.shape[2]} {self.shape[1]} {self.shape[0]}",
+      "space directions: " + " ".join("({:.17g},{:.17g},{:.17g})".format(*ijkToLPS[0:3, axis]) for axis in range(3)),
+      "kinds: domain domain domain",
+      "endian: little",
+      f"encoding: {'gzip' if self.compressor else 'raw'}",
+      "space origin: ({:.17g},{:.17g},{:.17g})".format(*ijkToLPS[0:3, 3]),
+    ]
+    self.file = open(filePath, 'wb')
+    self.file.write(("\n".join(lines) + "\n\n").encode("ascii"))
+
+  def writeSlab(self, slab):
+    if tuple(slab.shape[1:]) != self.shape[1:] or self.writtenSlices + len(slab) > self.shape[0]:
+      raise ValueError(f"Slab of shape {slab.shape} does not fit a volume of shape {self.shape}")
+    data = numpy.ascontiguousarray(slab, dtype=self.dtype).data
+    self.file.write(self.compressor.compress(data) if self.compressor else data)
+    self.writtenSlices += len(slab)
+
+  def close(self):
+    """Finish the file, returns False if it is incomplete"""
+    if self.file is None:
+      return self.writtenSlices == self.shape[0]
+    if self.compressor:
+      self.file.write(self.compressor.flush())
+    self.file.close()
+    self.file = None
+    return self.writtenSlices == self.shape[0]
+
+def writeSlabs(volume, filePath, factor=1, maximumSlabBytes=DEFAULT_MAXIMUM_SLAB_BYTES, useCompression=False, progressCallback=None):
+  """
+  Write a VolVolume downsampled by factor to a NRRD file slab by slab (see VolVolume.extractSlabs), so the memory
+  used is one slab whatever the size of the volume. An incomplete file is removed.
+  """
+  shape, ijkToRAS = volume.outputGeometry(factor=factor)
+  writer = NrrdSlabWriter(filePath, shape, volume.dtype, ijkToRAS, useCompression)
+  complete = False
+  try:
+    for outputStart, slab in volume.extractSlabs(factor=factor, maximumSlabBytes=maximumSlabBytes, progressCallback=progressCallback):
+      writer.writeSlab(slab)
+    complete = writer.close()
+  finally:
+    writer.close()
+    if not complete and os.path.exists(filePath):
+      os.remove(filePath)
+
+def exportVolumes(volumes, outputFilePaths, factor=1, maximumParallelVolumes=2, maximumSlabBytes=DEFAULT_MAXIMUM_SLAB_BYTES,
+                  useCompression=False, progressCallback=None, pollInterval=0.1):
+  """
+  Downsample each VolVolume by factor and write it to the matching output NRRD file, on up to
+  maximumParallelVolumes worker threads (reading the mapped files and computing the block means release the GIL).
+  Each volume is written slab by slab (see writeSlabs), so each worker holds a single slab at a time.
+  progressCallback(numberOfVolumesDone, numberOfVolumes) is called from the calling thread every pollInterval
+  seconds; if it returns False, the volumes not started yet are skipped and the running ones stop after their current slab.
+  Returns the error message of each volume, None for the volumes written.
+  """
+  cancelEvent = threading.Event()
+
+  def export(volume, outputFilePath):
+    writeSlabs(volume, outputFilePath, factor, maximumSlabBytes, useCompression,
+      progressCallback=lambda slabsDone, numberOfSlabs: not cancelEvent.is_set())
+
+  errors = [None] * len(volumes)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, maximumParallelVolumes), thread_name_prefix="VolExport") as executor:
+    futures = {executor.submit(export, volume, outputFilePath): index
+               for index, (volume, outputFilePath) in enumerate(zip(volumes, outputFilePaths))}
+    remaining = set(futures)
+    while remaining:
+      finished, remaining = concurrent.futures.wait(remaining, timeout=pollInterval)
+      for future in finished:
+        if future.cancelled():
+          errors[futures[future]] = "User requested cancel"
+        elif future.exception() is not None:
+          errors[futures[future]] = str(future.exception()) or future.exception().__class__.__name__
+      if progressCallback and progressCallback(len(volumes) - len(remaining), len(volumes)) is False and not cancelEvent.is_set():
+        cancelEvent.set()
+        for future in remaining:
+          future.cancel()
+  return errors
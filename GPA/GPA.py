@@ -13,6 +13,9 @@ import json
 
 import Support.vtk_lib as vtk_lib
 import Support.gpa_lib as gpa_lib
+import Support.results_lib as results_lib
+import Support.warp_lib as warp_lib
+import Support.render_lib as render_lib
 import  numpy as np
 from datetime import datetime
 import scipy.linalg as sp
@@ -264,16 +267,30 @@ class LMData:
       self.procdist = outputData.proc_dist.to_numpy()
       self.procdist=self.procdist.reshape(-1,1)
       return 1
-    except:
-      print("Error loading results")
-      self.GPALogTextbox.insertPlainText("Error loading results: Failed to initialize from file \n")
+    except Exception as e:
+      logging.debug(f"Error loading results: {e}")
+      return 0
+
+  def initializeFromResultsStore(self, store):
+    try:
+      self.lm = store['alignedCoordinates']
+      self.lmOrig = self.lm
+      self.mShape = store['meanShape']
+      self.val = store['eigenvalues']
+      self.vec = store['eigenvectors']
+      self.sortedEig = gpa_lib.pairEig(self.val, self.vec)
+      self.procdist = store['procrustesDistances'].reshape(-1,1)
+      self.centriodSize = store['centroidSizes'].reshape(-1,1)
+      return 1
+    except (KeyError, ValueError) as e:
+      logging.debug(f"Error loading results: {e}")
       return 0
 
   def calcLMVariation(self, SampleScaleFactor, BoasOption):
-    i,j,k=self.lmOrig.shape
+    i,j,k=self.lm.shape
     varianceMat=np.zeros((i,j))
     for subject in range(k):
-      tmp=pow((self.lmOrig[:,:,subject]-self.mShape),2)
+      tmp=pow((self.lm[:,:,subject]-self.mShape),2)
       varianceMat=varianceMat+tmp
     # if GPA scaling has been skipped, don't apply image size scaling factor
     if(BoasOption):
@@ -287,12 +304,65 @@ class LMData:
     self.centriodSize=np.zeros(k)
     for subjectNum in range(k):
       self.centriodSize[subjectNum]=np.linalg.norm(self.lmOrig[:,:,subjectNum]-self.lmOrig[:,:,subjectNum].mean(axis=0))
+    # align a copy, lmOrig keeps the raw landmarks
     if not BoasOption:
-      self.lm, self.mShape=gpa_lib.runGPA(self.lmOrig)
+      self.lm, self.mShape=gpa_lib.runGPA(np.array(self.lmOrig, dtype=float))
     else:
-      self.lm, self.mShape=gpa_lib.runGPANoScale(self.lmOrig)
+      self.lm, self.mShape=gpa_lib.runGPANoScale(np.array(self.lmOrig, dtype=float))
     self.procdist = gpa_lib.procDist(self.lm, self.mShape)
 
+  def addSpecimens(self, newLandmarks, BoasOption, numberOfPCs=10):
+    """
+    Add specimens to a finished analysis without recomputing it from scratch. The new specimens are aligned
+    to the current mean shape, all specimens are re-converged and the PCA is rank-updated. The raw landmarks
+    of the new specimens are appended to lmOrig.
+    Returns the drift of the update: relative displacement of the previously aligned specimens, change of
+    the mean shape and the eigenpair residual of the updated PCA against the re-aligned data.
+    """
+    i, j, k = self.lm.shape
+    oldMean = gpa_lib.flattenShapes(self.lm).mean(axis=1)
+    oldMeanShape = np.array(self.mShape)
+    newCentroidSize = [np.linalg.norm(newLandmarks[:,:,x]-newLandmarks[:,:,x].mean(axis=0)) for x in range(newLandmarks.shape[2])]
+    self.centriodSize = np.concatenate((np.reshape(self.centriodSize, -1), newCentroidSize))
+    # results loaded from a file have no raw landmarks, lmOrig is the aligned data there
+    rawLandmarksKnown = self.lmOrig is not self.lm
+    self.lm, self.mShape, alignmentDrift = gpa_lib.runGPAIncremental(self.lm, self.mShape, newLandmarks, not BoasOption)
+    if rawLandmarksKnown:
+      self.lmOrig = np.concatenate((self.lmOrig, newLandmarks), axis=2)
+    else:
+      self.lmOrig = self.lm
+    newData = gpa_lib.flattenShapes(self.lm[:,:,k:])
+    self.val, self.vec, _ = gpa_lib.updatePCA(self.val, self.vec, oldMean, k, newData)
+    self.sortedEig = gpa_lib.pairEig(self.val, self.vec)
+    self.procdist = gpa_lib.procDist(self.lm, self.mShape).reshape(-1,1)
+    drift = {
+      'alignment': alignmentDrift,
+      'meanShape': np.linalg.norm(self.mShape-oldMeanShape)/np.linalg.norm(oldMeanShape),
+      'pca': gpa_lib.eigenResidual(gpa_lib.makeTwoDim(self.lm), self.val, self.vec, numberOfPCs),
+    }
+    return drift
+
+  def compareToFullGPA(self, fullLM, numberOfPCs=10):
+    """
+    Drift between this analysis and fullLM, a full recomputation on the same specimens. The full result
+    is rotated onto this mean shape first, since GPA is only defined up to a global rotation.
+    """
+    i, j, k = self.lm.shape
+    u, s, v = sp.svd(np.dot(np.transpose(self.mShape), fullLM.mShape))
+    rotation = np.dot(np.transpose(v), np.transpose(u))
+    fullLMRotated = np.einsum('ijk,jl->ilk', fullLM.lm, rotation)
+    numberOfPCs = min(numberOfPCs, self.vec.shape[1], fullLM.vec.shape[1])
+    fullVectors = np.real(fullLM.vec[:,:numberOfPCs]).reshape(i, j, numberOfPCs, order='F')
+    fullVectors = np.einsum('ijp,jl->ilp', fullVectors, rotation).reshape(i*j, numberOfPCs, order='F')
+    cosines = np.abs(np.sum(np.real(self.vec[:,:numberOfPCs])*fullVectors, axis=0))
+    fullValues = np.real(fullLM.val[:numberOfPCs])
+    return {
+      'meanShape': np.linalg.norm(self.mShape-np.dot(fullLM.mShape, rotation))/np.linalg.norm(self.mShape),
+      'coordinates': np.sqrt(np.mean(np.sum((self.lm-fullLMRotated)**2, axis=(0,1)))/np.mean(np.sum(self.lm**2, axis=(0,1)))),
+      'eigenvalues': np.max(np.abs(np.real(self.val[:numberOfPCs])-fullValues))/fullValues[0],
+      'eigenvectors': np.max(1-np.clip(cosines, 0, 1)),
+    }
+
   def calcEigen(self):
     i, j, k = self.lmOrig.shape
     twoDim=gpa_lib.makeTwoDim(self.lm)
@@ -320,6 +390,12 @@ class LMData:
         tmp[:,2]=tmp[:,2]+float(scaleFactor[y])*self.vec[2*i:3*i,pcComponent]*SampleScaleFactor/3
     self.shift=tmp
 
+  def pcShifts(self, numberOfPCs, SampleScaleFactor):
+    """Landmark displacements for a unit score on each of the first numberOfPCs PCs, as a numberOfPCs x i x 3 array."""
+    i,j,k=self.lm.shape
+    vectors=np.real(self.vec[:,:numberOfPCs])
+    return vectors.reshape(i, j, -1, order='F').transpose(2, 0, 1)*SampleScaleFactor/3
+
   def ExpandAlongSinglePC(self,pcNumber,pcRange,SampleScaleFactor):
     b=0
     i,j,k=self.lm.shape
@@ -334,7 +410,31 @@ class LMData:
     shift[:,2]=shift[:,2]+float(pcRange)*self.vec[2*i:3*i,pcComponent]*SampleScaleFactor/3
     return shift
 
-  def writeOutData(self, outputFolder, files):
+  def calcPCScores(self):
+    twoDcoors = gpa_lib.makeTwoDim(self.lm)
+    return np.real(np.dot(np.transpose(twoDcoors), self.vec))
+
+  def writeResultsStore(self, outputFolder, files, metadata=None):
+    k = self.lm.shape[2]
+    arrays = {
+      'sampleNames': np.array(files, dtype=str),
+      'alignedCoordinates': self.lm,
+      'meanShape': self.mShape,
+      'eigenvalues': np.real(self.val),
+      'eigenvectors': np.real(self.vec),
+      'procrustesDistances': np.reshape(self.procdist, k),
+      'centroidSizes': np.reshape(self.centriodSize, k),
+      'pcScores': self.calcPCScores(),
+    }
+    filePath = os.path.join(outputFolder, results_lib.RESULTS_FILE_NAME)
+    return results_lib.writeResults(filePath, arrays, metadata)
+
+  def writeOutData(self, outputFolder, files, writeCSV=True):
+    self.writeResultsStore(outputFolder, files)
+    if writeCSV:
+      self.writeOutCSV(outputFolder, files)
+
+  def writeOutCSV(self, outputFolder, files):
     # make headers for eigenvector matrix
     headerPC = []
     headerLM = [""]
@@ -396,9 +496,7 @@ class LMData:
     np.savetxt(outputFolder + os.sep + "outputData.csv", tmp1, fmt="%s", delimiter=",")
 
     # calc PC scores
-    twoDcoors = gpa_lib.makeTwoDim(self.lm)
-    scores = np.dot(np.transpose(twoDcoors), self.vec)
-    scores = np.real(scores)
+    scores = self.calcPCScores()
     headerPC.insert(0, "Sample_name")
     temp = np.column_stack((files.reshape(i, 1), scores))
     temp = np.vstack((headerPC, temp))
@@ -516,6 +614,12 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.BoasOptionCheckBox.setToolTip("If checked, GPA will skip scaling.")
     inputLayout.addWidget(self.BoasOptionCheckBox,5,2)
 
+    self.exportCSVCheckBox = qt.QCheckBox()
+    self.exportCSVCheckBox.setText("Export results as CSV tables")
+    self.exportCSVCheckBox.checked = 1
+    self.exportCSVCheckBox.setToolTip("Results are always saved to a binary results file. If checked, CSV tables are also written.")
+    inputLayout.addWidget(self.exportCSVCheckBox,5,3)
+
     # Load covariates options
     loadCovariatesCollapsibleButton = ctk.ctkCollapsibleGroupBox()
     loadCovariatesLayout = qt.QGridLayout(loadCovariatesCollapsibleButton)
@@ -590,6 +694,20 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.loadResultsButton.enabled = False
     self.loadResultsButton.connect('clicked(bool)', self.onLoadFromFile)
 
+    #Add specimens option
+    addSpecimensCollapsibleButton = ctk.ctkCollapsibleButton()
+    addSpecimensLayout = qt.QGridLayout(addSpecimensCollapsibleButton)
+    addSpecimensCollapsibleButton.text = "Add specimens to current analysis"
+    addSpecimensCollapsibleButton.collapsed = True
+    setupTabLayout.addRow(addSpecimensCollapsibleButton)
+
+    self.addSpecimensButton = qt.QPushButton("Select Landmark Files and Update Analysis")
+    self.addSpecimensButton.checkable = False
+    self.addSpecimensButton.toolTip = "Align new specimens to the current analysis and update the PCA without a full rerun. An estimate of the drift of the update (displacement of the aligned specimens, change of the mean shape and PCA residual) is reported in the log."
+    self.addSpecimensButton.enabled = False
+    addSpecimensLayout.addWidget(self.addSpecimensButton,1,1,1,3)
+    self.addSpecimensButton.connect('clicked(bool)', self.onAddSpecimens)
+
     # GPA Log Textbox
     GPALogTextboxCollapsibleButton = ctk.ctkCollapsibleButton()
     GPALogTextboxLayout = qt.QGridLayout(GPALogTextboxCollapsibleButton)
@@ -809,60 +927,41 @@ class GPAWidget(ScriptedLoadableModuleWidget):
         self.pcMax = np.max(self.scatterDataAll, axis=0)[self.currentPC - 1]
         self.pcMin = np.min(self.scatterDataAll, axis=0)[self.currentPC - 1]
         self.pcScoreAbsMax = max(abs(self.pcMin), abs(self.pcMax))  # Maximum absolute deviation
-        self.displacementGridData = getGridTransform(self.currentPC)
 
         needNewNode = not hasattr(self, 'gridTransformNode') or not slicer.mrmlScene.IsNodePresent(self.gridTransformNode)
         if needNewNode:
           self.gridTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLGridTransformNode", "GridTransform")
           GPANodeCollection.AddItem(self.gridTransformNode)
+        if self.pcWarpBasis is None or needNewNode:
+          setupPCWarpBasis()
 
-        self.gridTransformNode.GetTransformFromParent().SetDisplacementGridData(self.displacementGridData)
         self.cloneLandmarkNode.SetAndObserveTransformNodeID(self.gridTransformNode.GetID())
         if hasattr(self, 'cloneModelNode') and self.modelVisualizationType.checked:
           self.cloneModelNode.SetAndObserveTransformNodeID(self.gridTransformNode.GetID())
 
         self.slider1.setRange(self.pcMin, self.pcMax)  # Dynamic range displayed
-        self.slider1.spinBox.setValue(0)
+        self.slider1.spinBox.setValue(self.pcWarpScores[self.currentPC - 1])  # restore the score of this PC
         updatePCScaling()
 
-    def getGridTransform(pcValue):
-      logic = GPALogic()
-      magnification = self.spinMagnification.value
-
-      shiftMax = self.LM.ExpandAlongSinglePC(pcValue, self.pcScoreAbsMax * magnification, self.sampleSizeScaleFactor)
-      target = self.rawMeanLandmarks + shiftMax
-      targetLMVTK = logic.convertNumpyToVTK(target)
-      sourceLMVTK = logic.convertNumpyToVTK(self.rawMeanLandmarks)
-
-      VTKTPS = vtk.vtkThinPlateSplineTransform()
-      VTKTPS.SetSourceLandmarks(targetLMVTK)
-      VTKTPS.SetTargetLandmarks(sourceLMVTK)
-      VTKTPS.SetBasisToR()
-
-      modelBounds = [0] * 6
+    def setupPCWarpBasis():
+      # Sample the warp of each PC once, slider changes only recombine the cached grids
+      import time
+      startTime = time.time()
       if hasattr(self, 'cloneModelNode') and self.cloneModelNode is not None and self.modelVisualizationType.checked:
-          modelBounds = getExpandedBounds(self.cloneModelNode)
+        modelBounds = getExpandedBounds(self.cloneModelNode)
       else:
-          modelBounds = getExpandedBounds(self.cloneLandmarkNode)
-      origin = (modelBounds[0], modelBounds[2], modelBounds[4])
-      size = (modelBounds[1] - modelBounds[0], modelBounds[3] - modelBounds[2], modelBounds[5] - modelBounds[4])
-      dimension = 50
-      extent = [0] * 6
-      extent[1::2] = [dimension - 1] * 3
-      spacing = (size[0]/dimension, size[1]/dimension, size[2]/dimension)
-
-      transformToGrid = vtk.vtkTransformToGrid()
-      transformToGrid.SetInput(VTKTPS)
-      transformToGrid.SetGridOrigin(origin)
-      transformToGrid.SetGridSpacing(spacing)
-      transformToGrid.SetGridExtent(extent)
-      transformToGrid.Update()
-
-      return transformToGrid.GetOutput()
+        modelBounds = getExpandedBounds(self.cloneLandmarkNode)
+      pcShifts = self.LM.pcShifts(self.pcNumber, self.sampleSizeScaleFactor)
+      self.pcWarpBasis = warp_lib.PCWarpBasis(self.rawMeanLandmarks, pcShifts, modelBounds)
+      self.displacementGridData = self.pcWarpBasis.createGridImage()
+      gridTransform = slicer.vtkOrientedGridTransform()
+      gridTransform.SetDisplacementGridData(self.displacementGridData)
+      self.gridTransformNode.SetAndObserveTransformToParent(gridTransform)
+      logging.info(f"PC warp grids computed for {self.pcNumber} PCs in {time.time()-startTime:.2f} seconds")
 
     def getExpandedBounds(node, paddingFactor=0.1):
         bounds = [0] * 6
-        node.GetRASBounds(bounds)
+        node.GetBounds(bounds)  # bounds without the PC warp applied
         # Expand bounds by paddingFactor
         xRange = bounds[1] - bounds[0]
         yRange = bounds[3] - bounds[2]
@@ -875,19 +974,30 @@ class GPAWidget(ScriptedLoadableModuleWidget):
         bounds[5] += zRange * paddingFactor
 
         return bounds
+
     def updatePCScaling():
-      if hasattr(self, 'gridTransformNode'):
-        dynamic_value = self.slider1.sliderValue()  # Mapped PC score from spinbox
-        if self.pcScoreAbsMax > 1e-6:  # Avoid division by zero
-          sf = dynamic_value / self.pcScoreAbsMax
-        else:
-          sf = 0.0
-        # Clamp scaling factor
-        sf = max(min(sf, 1.0), -1.0)
-        self.gridTransformNode.GetTransformFromParent().SetDisplacementScale(sf)
+      if self.pcWarpBasis is not None and hasattr(self, 'currentPC'):
+        self.pcWarpScores[self.currentPC - 1] = self.slider1.sliderValue()  # Mapped PC score from spinbox
+        applyPCWarp()
+
+    def applyPCWarp():
+      # Combine the cached grids of all PCs with a nonzero score into the displayed warp
+      import time
+      startTime = time.time()
+      magnification = self.spinMagnification.value
+      self.pcWarpBasis.updateGridImage(self.displacementGridData, self.pcWarpScores * magnification)
+      self.gridTransformNode.GetTransformToParent().Modified()
+      logging.debug(f"PC warp updated in {1000*(time.time()-startTime):.1f} ms")
 
     def onUpdateMagnificationClicked():
-      setupPCTransform()
+      if self.pcWarpBasis is not None:
+        applyPCWarp()
+
+    def onResetPCWarpClicked():
+      self.pcWarpScores[:] = 0
+      if self.pcWarpBasis is not None:
+        self.slider1.spinBox.setValue(0)
+        applyPCWarp()
 
     # PC warping
     vis = ctk.ctkCollapsibleButton()
@@ -926,10 +1036,17 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     visLayout.addWidget(magnificationWidget, 3, 1, 1, 3)  # row 4, column 0, span across 3 columns
 
     self.PCList=[]
+    self.pcWarpBasis = None
+    self.pcWarpScores = np.zeros(0)
     self.slider1=sliderGroup(onSliderChanged = updatePCScaling, onComboBoxChanged = setupPCTransform)
     self.slider1.connectList(self.PCList)
     visLayout.addWidget(self.slider1,4,1,1,3)
 
+    resetPCWarpButton = qt.QPushButton("Reset all PCs")
+    resetPCWarpButton.toolTip = "Set the score of every PC to zero. The scores set for different PCs are combined in the warp."
+    resetPCWarpButton.clicked.connect(onResetPCWarpClicked)
+    visLayout.addWidget(resetPCWarpButton,5,1,1,3)
+
     # Create Animations
     animate=ctk.ctkCollapsibleButton()
     animate.text='Create animation of PC Warping'
@@ -1068,25 +1185,13 @@ class GPAWidget(ScriptedLoadableModuleWidget):
       self.generateCovariatesTableButton.enabled = False
 
   def populateDistanceTable(self, files):
-    sortedArray = np.zeros(len(files), dtype={'names':('filename', 'procdist'),'formats':('U50','f8')})
-    sortedArray['filename']=files
-    sortedArray['procdist']=self.LM.procdist[:,0]
-    sortedArray.sort(order='procdist')
-
+    logic = GPALogic()
+    table, outliers = logic.createDistanceTable(files, self.LM.procdist)
     tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', 'Procrustes Distance Table')
     GPANodeCollection.AddItem(tableNode)
-    col1=tableNode.AddColumn()
-    col1.SetName('ID')
-
-    col2=tableNode.AddColumn()
-    col2.SetName('Procrustes Distance')
-    tableNode.SetColumnType('ID',vtk.VTK_STRING)
-    tableNode.SetColumnType('Procrustes Distance',vtk.VTK_FLOAT)
-
-    for i in range(len(files)):
-      tableNode.AddEmptyRow()
-      tableNode.SetCellText(i,0,sortedArray['filename'][i])
-      tableNode.SetCellText(i,1,str(sortedArray['procdist'][i]))
+    tableNode.SetAndObserveTable(table)
+    if outliers:
+      self.GPALogTextbox.insertPlainText(f"Possible outliers by Procrustes distance (robust z-score > 3.5): {', '.join(outliers)}\n")
 
     barPlot = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLPlotSeriesNode', 'Distances')
     GPANodeCollection.AddItem(barPlot)
@@ -1150,6 +1255,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.plotMeanButton3D.enabled = False
     self.showMeanLabelsButton.enabled = False
     self.loadButton.enabled = False
+    self.addSpecimensButton.enabled = False
     self.landmarkVisualizationType.enabled = False
     self.modelVisualizationType.enabled = False
     self.selectorButton.enabled = False
@@ -1201,19 +1307,93 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.loadButton.enabled = bool (filePathsExist and hasattr(self, 'outputDirectory'))
     if filePathsExist:
       self.LM_dir_name = os.path.dirname(self.inputFilePaths[0])
-      basename, self.extension = os.path.splitext(self.inputFilePaths[0])
-      if self.extension == '.json':
-        basename, secondExtension = os.path.splitext(basename)
-        if secondExtension == '.mrk':
-          self.extension =  secondExtension + self.extension
-      self.files=[]
-      for path in self.inputFilePaths:
-        basename, ext = os.path.splitext(os.path.basename(path))
-        if self.extension == '.mrk.json':
-          basename, ext = os.path.splitext(basename)
-        self.files.append(basename)
+      self.extension = self.landmarkFileExtension(self.inputFilePaths[0])
+      self.files = self.landmarkFileNames(self.inputFilePaths, self.extension)
       self.factorStringChanged()
 
+  def landmarkFileExtension(self, path):
+    basename, extension = os.path.splitext(path)
+    if extension == '.json':
+      basename, secondExtension = os.path.splitext(basename)
+      if secondExtension == '.mrk':
+        extension =  secondExtension + extension
+    return extension
+
+  def landmarkFileNames(self, filePaths, extension):
+    files=[]
+    for path in filePaths:
+      basename, ext = os.path.splitext(os.path.basename(path))
+      if extension == '.mrk.json':
+        basename, ext = os.path.splitext(basename)
+      files.append(basename)
+    return files
+
+  def onAddSpecimens(self):
+    filter = "Landmarks (*.json *.mrk.json *.fcsv )"
+    newFilePaths = sorted(qt.QFileDialog().getOpenFileNames(None, "Window name", "", filter))
+    if not newFilePaths:
+      return
+    logic = GPALogic()
+    extension = self.landmarkFileExtension(newFilePaths[0])
+    if self.extension and extension != self.extension:
+      self.GPALogTextbox.insertPlainText(f"Add specimens failed: New files are {extension} files, the analysis uses {self.extension} files\n")
+      return
+    newFiles = self.landmarkFileNames(newFilePaths, extension)
+    try:
+      newLandmarks, landmarkTypeArray = logic.loadLandmarks(newFilePaths, self.LMExclusionList, extension)
+    except:
+      logging.debug('Load landmark data failed: Could not create an array from landmark files')
+      self.GPALogTextbox.insertPlainText("Load landmark data failed: Could not create an array from landmark files\n")
+      return
+    if newLandmarks.shape[0] != self.LM.lm.shape[0]:
+      self.GPALogTextbox.insertPlainText(f"Add specimens failed: New files have {newLandmarks.shape[0]} landmarks, the analysis has {self.LM.lm.shape[0]}\n")
+      return
+
+    import time
+    startTime = time.time()
+    drift = self.LM.addSpecimens(newLandmarks, self.BoasOption, self.pcNumber)
+    self.files = self.files + newFiles
+    self.GPALogTextbox.insertPlainText(f"Added {len(newFiles)} subjects in {time.time()-startTime:.2f} seconds, analysis now has {len(self.files)} subjects.\n")
+    self.GPALogTextbox.insertPlainText(f"Estimated drift of the update: alignment {drift['alignment']:.2e}, mean shape {drift['meanShape']:.2e}, PCA residual {drift['pca']:.2e}\n")
+    if max(drift['alignment'], drift['pca']) > 0.01:
+      self.GPALogTextbox.insertPlainText("Estimated drift exceeds 1%: running the full GPA + PCA again is recommended.\n")
+    if hasattr(self, 'factorTableNode'):
+      self.GPALogTextbox.insertPlainText("Covariate table does not include the added subjects and was removed from the analysis.\n")
+      del self.factorTableNode
+      self.selectFactor.clear()
+      self.selectFactor.addItem("No factor data")
+
+    # Refresh mean shape, distance table and scatter plot data
+    self.rawMeanLandmarks = self.LM.lm.mean(2)
+    for landmarkNumber in range(self.rawMeanLandmarks.shape[0]):
+      self.meanLandmarkNode.SetNthControlPointPosition(landmarkNumber, *self.rawMeanLandmarks[landmarkNumber,:])
+      self.copyLandmarkNode.SetNthControlPointPosition(landmarkNumber, *self.rawMeanLandmarks[landmarkNumber,:])
+    self.updateList()
+    self.scatterDataAll = self.LM.calcPCScores()[:,:self.pcNumber]
+    self.pcWarpBasis = None
+    self.pcWarpScores = np.zeros(self.pcNumber)
+    for nodeName in ['Procrustes Distance Table', 'Distances', 'Procrustes Distance Chart']:
+      node = slicer.mrmlScene.GetFirstNodeByName(nodeName)
+      if node:
+        GPANodeCollection.RemoveItem(node)
+        slicer.mrmlScene.RemoveNode(node)
+    self.populateDistanceTable(self.files)
+
+    # Save updated results next to the previous ones
+    if hasattr(self, 'outputDirectory') and self.outputDirectory:
+      dateTimeStamp = datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
+      self.outputFolder = os.path.join(self.outputDirectory, dateTimeStamp)
+      try:
+        os.makedirs(self.outputFolder)
+        self.LM.writeOutData(self.outputFolder, self.files, self.exportCSVCheckBox.checked)
+        self.extension = extension
+        self.writeAnalysisLogFile(self.LM_dir_name, self.outputFolder, self.files)
+        self.openResultsButton.enabled = True
+        self.GPALogTextbox.insertPlainText(f"Updated results written to {self.outputFolder}\n")
+      except:
+        logging.debug('Result directory failed: Could not access output folder')
+        self.GPALogTextbox.insertPlainText("Result directory failed: Could not access output folder\n")
+
   def onSelectOutputDirectory(self):
     self.outputDirectory=qt.QFileDialog().getExistingDirectory()
     self.outText.setText(self.outputDirectory)
@@ -1360,44 +1540,69 @@ class GPAWidget(ScriptedLoadableModuleWidget):
   def onLoadFromFile(self):
     self.initializeOnLoad() #clean up module from previous runs
     logic = GPALogic()
-    import pandas
 
-    # Load data
-    outputDataPath = os.path.join(self.resultsDirectory, 'outputData.csv')
-    meanShapePath = os.path.join(self.resultsDirectory, 'meanShape.csv')
-    eigenVectorPath = os.path.join(self.resultsDirectory, 'eigenvector.csv')
-    eigenValuePath = os.path.join(self.resultsDirectory, 'eigenvalues.csv')
-    eigenValueNames = ['Index', 'Scores']
-    try:
-      eigenValues = pandas.read_csv(eigenValuePath, names=eigenValueNames)
-      eigenVector = pandas.read_csv(eigenVectorPath)
-      meanShape = pandas.read_csv(meanShapePath)
-      outputData = pandas.read_csv(outputDataPath)
-    except:
-      logging.debug('Result import failed: Missing file')
-      self.GPALogTextbox.insertPlainText(f"Result import failed: Missing file in output folder\n")
-      return
+    # Load data, preferring the binary results file over the CSV tables of older analyses
+    resultsStore = None
+    resultsStorePath = os.path.join(self.resultsDirectory, results_lib.RESULTS_FILE_NAME)
+    if os.path.isfile(resultsStorePath):
+      try:
+        resultsStore = results_lib.ResultsStore(resultsStorePath)
+      except Exception as e:
+        logging.debug(f'Result import failed: Could not read {resultsStorePath}: {e}')
+        self.GPALogTextbox.insertPlainText(f"Could not read {results_lib.RESULTS_FILE_NAME}, trying CSV tables\n")
+    if resultsStore is None:
+      import pandas
+      outputDataPath = os.path.join(self.resultsDirectory, 'outputData.csv')
+      meanShapePath = os.path.join(self.resultsDirectory, 'meanShape.csv')
+      eigenVectorPath = os.path.join(self.resultsDirectory, 'eigenvector.csv')
+      eigenValuePath = os.path.join(self.resultsDirectory, 'eigenvalues.csv')
+      eigenValueNames = ['Index', 'Scores']
+      try:
+        eigenValues = pandas.read_csv(eigenValuePath, names=eigenValueNames)
+        eigenVector = pandas.read_csv(eigenVectorPath)
+        meanShape = pandas.read_csv(meanShapePath)
+        outputData = pandas.read_csv(outputDataPath)
+      except:
+        logging.debug('Result import failed: Missing file')
+        self.GPALogTextbox.insertPlainText(f"Result import failed: Missing file in output folder\n")
+        return
 
     # Try to load skip scaling and skip LM options from log file, if present
     self.BoasOption = False
     self.LMExclusionList=[]
+    self.LM_dir_name = self.resultsDirectory
+    self.extension = ""
+    self.landmarkTypeArray = []
     logFilePath = os.path.join(self.resultsDirectory, 'analysis.json')
     try:
       with open(logFilePath) as json_file:
         logData = json.load(json_file)
       self.BoasOption = logData['GPALog'][0]['Boas']
       self.LMExclusionList = logData['GPALog'][0]['ExcludedLM']
+      # input description, written again in the log of added specimens
+      self.LM_dir_name = logData['GPALog'][0].get('InputPath', self.LM_dir_name)
+      self.extension = logData['GPALog'][0].get('LMFormat', "")
+      self.landmarkTypeArray = logData['GPALog'][0].get('SemiLandmarks', [])
     except:
       logging.debug('Log import failed: Cannot read the log file')
       self.GPALogTextbox.insertPlainText("logging.debug('Log import failed: Cannot read the log file\n")
 
     # Initialize variables
     self.LM=LMData()
-    success = self.LM.initializeFromDataFrame(outputData, meanShape, eigenVector, eigenValues)
+    if resultsStore is not None:
+      success = self.LM.initializeFromResultsStore(resultsStore)
+      if success:
+        self.files = resultsStore['sampleNames'].tolist()
+    else:
+      success = self.LM.initializeFromDataFrame(outputData, meanShape, eigenVector, eigenValues)
+      if success:
+        self.files = outputData.Sample_name.tolist()
     if not success:
+      self.GPALogTextbox.insertPlainText("Error loading results: Failed to initialize from file \n")
+      if resultsStore is not None:
+        resultsStore.close()
       return
 
-    self.files = outputData.Sample_name.tolist()
     shape = self.LM.lmOrig.shape
     print('Loaded ' + str(shape[2]) + ' subjects with ' + str(shape[0]) + ' landmark points.')
     self.GPALogTextbox.insertPlainText(f"Loaded {shape[2]} subjects with {shape[0]} landmark points.\n")
@@ -1453,11 +1658,16 @@ class GPAWidget(ScriptedLoadableModuleWidget):
 
     #Setup for scatter plots
     shape = self.LM.lm.shape
-    self.LM.calcEigen()
-    self.scatterDataAll= np.zeros(shape=(shape[2],self.pcNumber))
-    for i in range(self.pcNumber):
-      data=gpa_lib.plotTanProj(self.LM.lm,self.LM.sortedEig,i,1)
-      self.scatterDataAll[:,i] = data[:,0]
+    if resultsStore is not None:
+      # PC scores are stored with the analysis, no need to recompute the decomposition
+      self.scatterDataAll = np.array(resultsStore['pcScores'][:,:self.pcNumber])
+      resultsStore.close()
+    else:
+      self.LM.calcEigen()
+      self.scatterDataAll= np.zeros(shape=(shape[2],self.pcNumber))
+      for i in range(self.pcNumber):
+        data=gpa_lib.plotTanProj(self.LM.lm,self.LM.sortedEig,i,1)
+        self.scatterDataAll[:,i] = data[:,0]
 
     # Set up layout
     self.assignLayoutDescription()
@@ -1481,6 +1691,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.selectorButton.enabled = True
     self.landmarkVisualizationType.enabled = True
     self.modelVisualizationType.enabled = True
+    self.addSpecimensButton.enabled = True
 
   def onLoad(self):
     self.initializeOnLoad() #clean up module from previous runs
@@ -1523,7 +1734,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
       print("Using Boas coordinates")
 
     #set scaling factor using mean of landmarks
-    self.rawMeanLandmarks = self.LM.lmOrig.mean(2)
+    self.rawMeanLandmarks = self.LM.lm.mean(2)
     logic = GPALogic()
     if self.BoasOption:
       self.sampleSizeScaleFactor = 1.0
@@ -1565,7 +1776,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.outputFolder = os.path.join(self.outputDirectory, dateTimeStamp)
     try:
       os.makedirs(self.outputFolder)
-      self.LM.writeOutData(self.outputFolder, self.files)
+      self.LM.writeOutData(self.outputFolder, self.files, self.exportCSVCheckBox.checked)
       # covariate table
       if hasattr(self, 'factorTableNode'):
         try:
@@ -1616,6 +1827,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.selectorButton.enabled = True
     self.landmarkVisualizationType.enabled = True
     self.modelVisualizationType.enabled = True
+    self.addSpecimensButton.enabled = True
 
 
   def initializeOnLoad(self):
@@ -1627,6 +1839,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.landmarkVisualizationType.setChecked(True)
 
     self.slider1.clear()
+    self.pcWarpBasis = None
 
     self.vectorOne.clear()
     self.vectorTwo.clear()
@@ -1654,6 +1867,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
       covariatePath = "covariateTable.csv"
     else:
       covariatePath = ""
+    csvExported = bool(self.exportCSVCheckBox.checked)
     logData = {
       "@schema": "https://raw.githubusercontent.com/slicermorph/slicermorph/master/GPA/Resources/Schema/GPALog-schema-v1.0.0.json#",
       "GPALog" : [
@@ -1667,11 +1881,12 @@ class GPAWidget(ScriptedLoadableModuleWidget):
         "NumberLM": pointNumber + len(self.LMExclusionList),
         "ExcludedLM": self.LMExclusionList,
         "Boas": bool(self.BoasOption),
-        "MeanShape": "meanShape.csv",
-        "Eigenvalues": "eigenvalues.csv",
-        "Eigenvectors": "eigenvectors.csv",
-        "OutputData": "outputData.csv",
-        "PCScores": "pcScores.csv",
+        "ResultsStore": results_lib.RESULTS_FILE_NAME,
+        "MeanShape": "meanShape.csv" if csvExported else "",
+        "Eigenvalues": "eigenvalues.csv" if csvExported else "",
+        "Eigenvectors": "eigenvectors.csv" if csvExported else "",
+        "OutputData": "outputData.csv" if csvExported else "",
+        "PCScores": "pcScores.csv" if csvExported else "",
         "SemiLandmarks": self.landmarkTypeArray,
         "CovariatesFile": covariatePath
         }
@@ -1798,35 +2013,26 @@ class GPAWidget(ScriptedLoadableModuleWidget):
 
   def plotDistributionCloud(self):
     self.unplotDistributions()
-    i,j,k=self.LM.lmOrig.shape
-    pt=[0,0,0]
-    #set up vtk point array for each landmark point
-    points = vtk.vtkPoints()
-    points.SetNumberOfPoints(i*k)
-    indexes = vtk.vtkDoubleArray()
-    indexes.SetName('LM Index')
-    pointCounter = 0
-
-    for subject in range(0,k):
-      for landmark in range(0,i):
-        pt=self.LM.lmOrig[landmark,:,subject]
-        points.SetPoint(pointCounter,pt)
-        indexes.InsertNextValue(landmark+1)
-        pointCounter+=1
-
-    #add points to polydata
-    polydata=vtk.vtkPolyData()
-    polydata.SetPoints(points)
-    polydata.GetPointData().SetScalars(indexes)
-
-    #set up glyph for visualizing point cloud
-    sphereSource = vtk.vtkSphereSource()
-    sphereSource.SetRadius(self.sampleSizeScaleFactor/300)
-    glyph = vtk.vtkGlyph3D()
-    glyph.SetSourceConnection(sphereSource.GetOutputPort())
-    glyph.SetInputData(polydata)
-    glyph.ScalingOff()
-    glyph.Update()
+    i,j,k=self.LM.lm.shape
+    # color by the selected covariate factor if there is one, otherwise by landmark number
+    perSubjectArrays = {}
+    activeScalarName = 'LM Index'
+    if (self.selectFactor.currentIndex > 0) and hasattr(self, 'factorTableNode'):
+      factorCol = self.factorTableNode.GetTable().GetColumnByName(self.selectFactor.currentText)
+      factorArray = [factorCol.GetValue(subject).rstrip() for subject in range(factorCol.GetNumberOfTuples())]
+      if len(factorArray) == k:
+        uniqueFactors, factorCodes = np.unique(factorArray, return_inverse=True)
+        perSubjectArrays['Factor'] = factorCodes.astype(np.float64) + 1
+        activeScalarName = 'Factor'
+    polydata = render_lib.landmarkCloudPolyData(self.LM.lm, perSubjectArrays=perSubjectArrays)
+    polydata.GetPointData().SetActiveScalars(activeScalarName)
+
+    # set up one glyph filter for the whole point cloud, very large clouds are drawn as points
+    useGlyphs = polydata.GetNumberOfPoints() <= render_lib.MAX_GLYPH_POINTS
+    if useGlyphs:
+      cloudPolyData = render_lib.sphereGlyphs(polydata, self.sampleSizeScaleFactor/300)
+    else:
+      cloudPolyData = polydata
 
     #display
     modelNode=slicer.mrmlScene.GetFirstNodeByName('Landmark Point Cloud')
@@ -1843,47 +2049,28 @@ class GPAWidget(ScriptedLoadableModuleWidget):
 
     modelDisplayNode = modelNode.GetDisplayNode()
     modelDisplayNode.SetScalarVisibility(True)
-    modelDisplayNode.SetActiveScalarName('LM Index')
+    modelDisplayNode.SetActiveScalarName(activeScalarName)
     modelDisplayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeLabels.txt')
+    if useGlyphs:
+      modelDisplayNode.SetRepresentation(slicer.vtkMRMLDisplayNode.SurfaceRepresentation)
+    else:
+      modelDisplayNode.SetRepresentation(slicer.vtkMRMLDisplayNode.PointsRepresentation)
+      modelDisplayNode.SetPointSize(3)
 
-    modelNode.SetAndObservePolyData(glyph.GetOutput())
+    modelNode.SetAndObservePolyData(cloudPolyData)
 
   def plotDistributionGlyph(self, sliderScale):
     self.unplotDistributions()
     varianceMat = self.LM.calcLMVariation(self.sampleSizeScaleFactor, self.BoasOption)
-    i,j,k=self.LM.lmOrig.shape
-    pt=[0,0,0]
-    #set up vtk point array for each landmark point
-    points = vtk.vtkPoints()
-    points.SetNumberOfPoints(i)
-    scales = vtk.vtkDoubleArray()
-    scales.SetName("Scales")
-    index = vtk.vtkDoubleArray()
-    index.SetName("Index")
-
-    #set up tensor array to scale ellipses
-    tensors = vtk.vtkDoubleArray()
-    tensors.SetNumberOfTuples(i)
-    tensors.SetNumberOfComponents(9)
-    tensors.SetName("Tensors")
 
     # get fiducial node for mean landmarks, make just labels visible
     self.meanLandmarkNode.SetDisplayVisibility(1)
     self.scaleMeanShapeSlider.value=0
-    for landmark in range(i):
-      pt=self.rawMeanLandmarks[landmark,:]
-      points.SetPoint(landmark,pt)
-      scales.InsertNextValue(sliderScale*(varianceMat[landmark,0]+varianceMat[landmark,1]+varianceMat[landmark,2])/3)
-      tensors.InsertTuple9(landmark,sliderScale*varianceMat[landmark,0],0,0,0,sliderScale*varianceMat[landmark,1],0,0,0,sliderScale*varianceMat[landmark,2])
-      index.InsertNextValue(landmark+1)
-
-    polydata=vtk.vtkPolyData()
-    polydata.SetPoints(points)
-    polydata.GetPointData().AddArray(index)
+    polydata = render_lib.varianceGlyphPolyData(self.rawMeanLandmarks, varianceMat, sliderScale)
 
     if self.EllipseType.isChecked():
-      polydata.GetPointData().SetScalars(index)
-      polydata.GetPointData().SetTensors(tensors)
+      polydata.GetPointData().SetActiveScalars('Index')
+      polydata.GetPointData().SetActiveTensors('Tensors')
       glyph = vtk.vtkTensorGlyph()
       glyph.ExtractEigenvaluesOff()
       modelNode=slicer.mrmlScene.GetFirstNodeByName('Landmark Variance Ellipse')
@@ -1899,8 +2086,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
         GPANodeCollection.AddItem(modelDisplayNode)
 
     else:
-      polydata.GetPointData().SetScalars(scales)
-      polydata.GetPointData().AddArray(index)
+      polydata.GetPointData().SetActiveScalars('Scales')
       glyph = vtk.vtkGlyph3D()
       modelNode=slicer.mrmlScene.GetFirstNodeByName('Landmark Variance Sphere')
       if modelNode is None:
@@ -1975,12 +2161,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
       GPANodeCollection.AddItem(self.sourceLMNode)
 
       # set up transform
-      targetLMVTK=logic.convertNumpyToVTK(self.rawMeanLandmarks)
-      sourceLMVTK=logic.convertNumpyToVTK(self.sourceLMnumpy)
-      VTKTPSMean = vtk.vtkThinPlateSplineTransform()
-      VTKTPSMean.SetSourceLandmarks( sourceLMVTK )
-      VTKTPSMean.SetTargetLandmarks( targetLMVTK )
-      VTKTPSMean.SetBasisToR()  # for 3D transform
+      VTKTPSMean = vtk_lib.createTPS(self.sourceLMnumpy, self.rawMeanLandmarks)
 
       # transform from selected to mean
       self.transformMeanNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', 'Mean TPS Transform')
@@ -2079,6 +2260,9 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.startRecordButton.enabled = True
 
   def initializeOnSelect(self):
+    # PC warp grids depend on the template, recompute them on the next PC selection
+    self.pcWarpBasis = None
+    self.pcWarpScores = np.zeros(self.pcNumber)
     #remove nodes from previous runs
     temporaryNode=slicer.mrmlScene.GetFirstNodeByName('Mean TPS Transform')
     if(temporaryNode):
@@ -2270,12 +2454,33 @@ class GPALogic(ScriptedLoadableModuleLogic):
     Computes the euclidean distance matrix for n points in a 3D space
     Returns a nXn matrix
      """
-    id,jd=a.shape
-    fnx = lambda q : q - np.reshape(q, (id, 1))
-    dx=fnx(a[:,0])
-    dy=fnx(a[:,1])
-    dz=fnx(a[:,2])
-    return (dx**2.0+dy**2.0+dz**2.0)**0.5
+    return gpa_lib.euclideanDistanceMatrix(a)
+
+  def createDistanceTable(self, files, procdist, outlierThreshold=3.5):
+    """
+    Builds a table of subjects sorted by Procrustes distance to the mean, with the robust z-score of each
+    distance and a flag for outliers. Columns are filled from arrays rather than cell by cell.
+    Returns the vtkTable and the names of the outlier subjects.
+    """
+    procdist = np.reshape(procdist, -1)
+    isOutlier, zScores = gpa_lib.findOutliers(procdist, outlierThreshold)
+    order = np.argsort(procdist, kind='stable')
+    table = vtk.vtkTable()
+    ids = vtk.vtkStringArray()
+    ids.SetName('ID')
+    ids.SetNumberOfValues(len(order))
+    for row, index in enumerate(order):
+      ids.SetValue(row, str(files[index]))
+    table.AddColumn(ids)
+    columns = [('Procrustes Distance', procdist[order].astype(np.float32)),
+               ('Robust Z-score', zScores[order].astype(np.float32)),
+               ('Outlier', isOutlier[order].astype(np.int32))]
+    for name, values in columns:
+      column = numpy_support.numpy_to_vtk(values, deep=True)
+      column.SetName(name)
+      table.AddColumn(column)
+    outliers = [str(files[index]) for index in order if isOutlier[index]]
+    return table, outliers
 
   #plotting functions
 
@@ -2431,30 +2636,7 @@ class GPALogic(ScriptedLoadableModuleLogic):
     if pc != 0:
       pc=pc-1 # get current component
       endpoints=self.calcEndpoints(LMObj,LM,pc,scaleFactor)
-      i,j=LM.shape
-
-      # declare arrays for polydata
-      points = vtk.vtkPoints()
-      points.SetNumberOfPoints(i*2)
-      lines = vtk.vtkCellArray()
-      magnitude = vtk.vtkFloatArray()
-      magnitude.SetName('Magnitude');
-      magnitude.SetNumberOfComponents(1);
-      magnitude.SetNumberOfValues(i);
-
-      for x in range(i): #populate vtkPoints and vtkLines
-        points.SetPoint(x,LM[x,:])
-        points.SetPoint(x+i,endpoints[x,:])
-        line = vtk.vtkLine()
-        line.GetPointIds().SetId(0,x)
-        line.GetPointIds().SetId(1,x+i)
-        lines.InsertNextCell(line)
-        magnitude.InsertValue(x,abs(LM[x,0]-endpoints[x,0]) + abs(LM[x,1]-endpoints[x,1]) + abs(LM[x,2]-endpoints[x,2]))
-
-      polydata=vtk.vtkPolyData()
-      polydata.SetPoints(points)
-      polydata.SetLines(lines)
-      polydata.GetCellData().AddArray(magnitude)
+      polydata = render_lib.lollipopPolyData(LM, endpoints)
 
       tubeFilter = vtk.vtkTubeFilter()
       tubeFilter.SetInputData(polydata)
@@ -2507,16 +2689,7 @@ class GPALogic(ScriptedLoadableModuleLogic):
     return LM+tmp*scaleFactor/3.0
 
   def convertFudicialToVTKPoint(self, fnode):
-    import numpy as np
-    numberOfLM=fnode.GetNumberOfControlPoints()
-    lmData=np.zeros((numberOfLM,3))
-    for i in range(numberOfLM):
-      loc = fnode.GetNthControlPointPosition(i)
-      lmData[i,:]=np.asarray(loc)
-    points=vtk.vtkPoints()
-    for i in range(numberOfLM):
-      points.InsertNextPoint(lmData[i,0], lmData[i,1], lmData[i,2])
-    return points
+    return vtk_lib.convertFudicialToVTKPoint(fnode)
 
   def convertFudicialToNP(self, fnode):
     import numpy as np
@@ -2529,11 +2702,7 @@ class GPALogic(ScriptedLoadableModuleLogic):
     return lmData
 
   def convertNumpyToVTK(self, A):
-    x,y=A.shape
-    points=vtk.vtkPoints()
-    for i in range(x):
-      points.InsertNextPoint(A[i,0], A[i,1], A[i,2])
-    return points
+    return vtk_lib.numpyToVTKPoints(A)
 
   def convertNumpyToVTKmatrix44(self, A):
     x,y=A.shape
@@ -2613,6 +2782,18 @@ class GPATest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_GPA1()
+    self.setUp()
+    self.test_GPAResultsStore()
+    self.setUp()
+    self.test_GPAIncrementalUpdate()
+    self.setUp()
+    self.test_GPAPCWarpBasis()
+    self.setUp()
+    self.test_GPADistances()
+    self.setUp()
+    self.test_GPARenderData()
+    self.setUp()
+    self.test_GPAVTKConversion()
 
   def test_GPA1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -2659,3 +2840,322 @@ class GPATest(ScriptedLoadableModuleTest):
     self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
     self.delayDisplay('Test passed')
+
+  def test_GPAResultsStore(self):
+    """ Round trip a synthetic analysis through the binary results file and compare
+    its size and load time against the CSV tables.
+    """
+    import tempfile
+    import time
+    import pandas
+    self.delayDisplay("Starting the results store test")
+
+    landmarkNumber, subjectNumber = 200, 500
+    rng = np.random.default_rng(0)
+    base = rng.normal(size=(landmarkNumber, 3, 1))
+    LM = LMData()
+    LM.lmOrig = base + 0.05 * rng.normal(size=(landmarkNumber, 3, subjectNumber))
+    LM.doGpa(False)
+    LM.calcEigen()
+    files = [f"subject_{i}" for i in range(subjectNumber)]
+
+    with tempfile.TemporaryDirectory() as outputFolder:
+      LM.writeOutData(outputFolder, files, writeCSV=True)
+      csvNames = ['outputData.csv', 'meanShape.csv', 'eigenvector.csv', 'eigenvalues.csv', 'pcScores.csv']
+      csvSize = sum(os.path.getsize(os.path.join(outputFolder, name)) for name in csvNames)
+      storePath = os.path.join(outputFolder, results_lib.RESULTS_FILE_NAME)
+      storeSize = os.path.getsize(storePath)
+
+      startTime = time.time()
+      pandas.read_csv(os.path.join(outputFolder, 'eigenvalues.csv'), names=['Index', 'Scores'])
+      pandas.read_csv(os.path.join(outputFolder, 'eigenvector.csv'))
+      pandas.read_csv(os.path.join(outputFolder, 'meanShape.csv'))
+      outputData = pandas.read_csv(os.path.join(outputFolder, 'outputData.csv'))
+      csvLoadTime = time.time() - startTime
+      # incomplete CSV tables are reported to the caller, which logs the error
+      self.assertEqual(LMData().initializeFromDataFrame(outputData, pandas.DataFrame(), pandas.DataFrame(), pandas.DataFrame()), 0)
+
+      startTime = time.time()
+      restored = LMData()
+      with results_lib.ResultsStore(storePath) as store:
+        self.assertFalse(store.isLoaded('pcScores'))
+        self.assertEqual(store.shape('alignedCoordinates'), LM.lm.shape)
+        self.assertTrue(restored.initializeFromResultsStore(store))
+        self.assertFalse(store.isLoaded('pcScores'))
+        restoredFiles = store['sampleNames'].tolist()
+        pcScores = np.array(store['pcScores'])
+      storeLoadTime = time.time() - startTime
+
+    logging.info(f"CSV tables: {csvSize/1e6:.2f} MB, loaded in {csvLoadTime:.3f} s")
+    logging.info(f"Results store: {storeSize/1e6:.2f} MB, loaded in {storeLoadTime:.3f} s")
+    self.assertLess(storeSize, csvSize)
+    self.assertEqual(restoredFiles, files)
+    np.testing.assert_array_equal(restored.lm, LM.lm)
+    np.testing.assert_array_equal(restored.mShape, LM.mShape)
+    np.testing.assert_array_equal(restored.vec, np.real(LM.vec))
+    np.testing.assert_allclose(pcScores, LM.calcPCScores())
+
+    self.delayDisplay('Test passed')
+
+  def test_GPAIncrementalUpdate(self):
+    """ Add specimens to a finished analysis and compare against a full recomputation.
+    """
+    import time
+    self.delayDisplay("Starting the incremental update test")
+
+    landmarkNumber, subjectNumber, newSubjectNumber = 60, 300, 10
+    rng = np.random.default_rng(1)
+    base = rng.normal(size=(landmarkNumber, 3, 1))
+    modes = rng.normal(size=(landmarkNumber, 3, 3))
+    def sampleSpecimens(number):
+      scores = rng.normal(size=(3, number)) * np.array([[.2], [.1], [.05]])
+      specimens = base + np.einsum('ijm,mn->ijn', modes, scores) + 0.005 * rng.normal(size=(landmarkNumber, 3, number))
+      for x in range(number):
+        rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+        specimens[:,:,x] = rng.uniform(1, 3) * specimens[:,:,x] @ rotation + rng.normal(size=3)
+      return specimens
+    oldSpecimens = sampleSpecimens(subjectNumber)
+    newSpecimens = sampleSpecimens(newSubjectNumber)
+
+    for BoasOption in [False, True]:
+      LM = LMData()
+      LM.lmOrig = oldSpecimens.copy()
+      LM.doGpa(BoasOption)
+      LM.calcEigen()
+      startTime = time.time()
+      drift = LM.addSpecimens(newSpecimens.copy(), BoasOption)
+      incrementalTime = time.time() - startTime
+
+      fullLM = LMData()
+      fullLM.lmOrig = np.concatenate((oldSpecimens, newSpecimens), axis=2)
+      startTime = time.time()
+      fullLM.doGpa(BoasOption)
+      fullLM.calcEigen()
+      fullTime = time.time() - startTime
+      fullDrift = LM.compareToFullGPA(fullLM)
+      logging.info(f"Boas {BoasOption}: incremental {incrementalTime:.3f} s, full {fullTime:.3f} s")
+      logging.info(f"Reported drift {drift}, drift from full recomputation {fullDrift}")
+
+      self.assertEqual(LM.lm.shape, fullLM.lm.shape)
+      self.assertEqual(LM.centriodSize.shape[0], subjectNumber + newSubjectNumber)
+      # raw landmarks of the new specimens are appended to lmOrig, not replaced by the aligned ones
+      self.assertEqual(LM.lmOrig.shape, LM.lm.shape)
+      np.testing.assert_array_equal(LM.lmOrig[:,:,subjectNumber:], newSpecimens)
+      np.testing.assert_allclose(LM.centriodSize, fullLM.centriodSize)
+      self.assertLess(drift['alignment'], 0.01)
+      self.assertLess(drift['pca'], 0.01)
+      for value in fullDrift.values():
+        self.assertLess(value, 1e-3)
+
+    self.delayDisplay('Test passed')
+
+  def test_GPAPCWarpBasis(self):
+    """ Check the cached PC warp grids against a thin plate spline sampled by VTK, and compare
+    the time to update the warp after a slider change.
+    """
+    import time
+    self.delayDisplay("Starting the PC warp cache test")
+
+    landmarkNumber, numberOfPCs = 200, 10
+    rng = np.random.default_rng(2)
+    LM = LMData()
+    LM.lm = np.zeros((landmarkNumber, 3, 50))
+    LM.vec, _ = np.linalg.qr(rng.normal(size=(3*landmarkNumber, numberOfPCs)))
+    meanLandmarks = rng.normal(size=(landmarkNumber, 3))
+    sampleScaleFactor = 3.0
+    bounds = [-3, 3, -3, 3, -3, 3]
+    scores = np.zeros(numberOfPCs)
+    scores[[0, 2]] = [0.5, -1.2]
+
+    startTime = time.time()
+    basis = warp_lib.PCWarpBasis(meanLandmarks, LM.pcShifts(numberOfPCs, sampleScaleFactor), bounds)
+    gridData = basis.createGridImage()
+    basisTime = time.time() - startTime
+    scalars = gridData.GetPointData().GetScalars()
+    startTime = time.time()
+    basis.updateGridImage(gridData, scores)
+    updateTime = time.time() - startTime
+    # slider changes write into the same grid, without sampling a spline
+    self.assertIs(gridData.GetPointData().GetScalars(), scalars)
+
+    # Previous approach: sample a new spline on the grid for each slider change
+    logic = GPALogic()
+    startTime = time.time()
+    LM.ExpandAlongPCs([1, 3], scores[[0, 2]], sampleScaleFactor)
+    shift = LM.shift
+    tps = vtk.vtkThinPlateSplineTransform()
+    tps.SetSourceLandmarks(logic.convertNumpyToVTK(meanLandmarks))
+    tps.SetTargetLandmarks(logic.convertNumpyToVTK(meanLandmarks + shift))
+    tps.SetBasisToR()
+    transformToGrid = vtk.vtkTransformToGrid()
+    transformToGrid.SetInput(tps)
+    transformToGrid.SetGridOrigin(basis.origin)
+    transformToGrid.SetGridSpacing(basis.spacing)
+    transformToGrid.SetGridExtent(0, 49, 0, 49, 0, 49)
+    transformToGrid.SetGridScalarType(vtk.VTK_DOUBLE)
+    transformToGrid.Update()
+    samplingTime = time.time() - startTime
+    logging.info(f"Warp grids for {numberOfPCs} PCs computed in {basisTime:.3f} s")
+    logging.info(f"Slider update: sampled spline {1000*samplingTime:.1f} ms, cached grids {1000*updateTime:.1f} ms")
+
+    expected = numpy_support.vtk_to_numpy(transformToGrid.GetOutput().GetPointData().GetScalars())
+    actual = numpy_support.vtk_to_numpy(gridData.GetPointData().GetScalars())
+    np.testing.assert_allclose(actual, expected, atol=1e-5 * np.abs(expected).max())
+
+    self.delayDisplay('Test passed')
+
+  def test_GPADistances(self):
+    """ Check the blocked distance matrices and the outlier flags, and time the distance table
+    for 5000 subjects.
+    """
+    import time
+    self.delayDisplay("Starting the distance test")
+
+    landmarkNumber, subjectNumber = 50, 5000
+    rng = np.random.default_rng(3)
+    aligned = rng.normal(size=(landmarkNumber, 3, 1)) + 0.01 * rng.normal(size=(landmarkNumber, 3, subjectNumber))
+    outlierIndices = [10, 4000]
+    aligned[:,:,outlierIndices] += 0.2 * rng.normal(size=(landmarkNumber, 3, len(outlierIndices)))
+    meanShape = aligned.mean(axis=2)
+
+    procdist = gpa_lib.procDist(aligned, meanShape)
+    expected = [np.linalg.norm(aligned[:,:,x] - meanShape) for x in range(subjectNumber)]
+    np.testing.assert_allclose(procdist, expected)
+
+    # Procrustes distances between specimens are the euclidean distances of their flattened coordinates
+    startTime = time.time()
+    distances = gpa_lib.euclideanDistanceMatrix(gpa_lib.flattenShapes(aligned).T, blockSize=512)
+    matrixTime = time.time() - startTime
+    for x, y in [(0, 1), (10, 4000), (4999, 123)]:
+      self.assertAlmostEqual(distances[x, y], np.linalg.norm(aligned[:,:,x] - aligned[:,:,y]), places=6)
+    np.testing.assert_allclose(distances, distances.T)
+    points = meanShape
+    np.testing.assert_allclose(GPALogic().dist2(points), np.linalg.norm(points[:,None,:] - points[None,:,:], axis=2), atol=1e-7)
+
+    files = [f"subject_{x}" for x in range(subjectNumber)]
+    startTime = time.time()
+    table, outliers = GPALogic().createDistanceTable(files, procdist)
+    tableTime = time.time() - startTime
+    logging.info(f"{subjectNumber} x {subjectNumber} Procrustes distance matrix in {matrixTime:.2f} s, distance table in {tableTime:.3f} s")
+
+    self.assertEqual(table.GetNumberOfRows(), subjectNumber)
+    self.assertEqual(sorted(outliers[-len(outlierIndices):]), [files[x] for x in outlierIndices])
+    self.assertLess(len(outliers), 0.01 * subjectNumber)
+    self.assertEqual(table.GetValue(subjectNumber - 1, 0).ToString(), files[int(np.argmax(procdist))])
+    self.assertEqual(table.GetValue(0, 0).ToString(), files[int(np.argmin(procdist))])
+
+    # subject names are kept as they are in the ID column
+    names = ['a,b', ' leading space', 'back\\slash', 'quote"d', 'line\nbreak\r', '']
+    table, outliers = GPALogic().createDistanceTable(names, np.arange(len(names), dtype=float))
+    self.assertEqual(table.GetColumnName(0), 'ID')
+    self.assertEqual([table.GetValue(row, 0).ToString() for row in range(table.GetNumberOfRows())], names)
+
+    self.delayDisplay('Test passed')
+
+  def test_GPARenderData(self):
+    """ Build the landmark point cloud for 1M points and compare against filling the
+    VTK arrays point by point.
+    """
+    import time
+    self.delayDisplay("Starting the render data test")
+
+    landmarkNumber, subjectNumber = 1000, 1000
+    rng = np.random.default_rng(4)
+    landmarkSets = rng.normal(size=(landmarkNumber, 3, subjectNumber))
+    factors = rng.integers(0, 3, subjectNumber)
+
+    startTime = time.time()
+    points = vtk.vtkPoints()
+    points.SetNumberOfPoints(landmarkNumber*subjectNumber)
+    indexes = vtk.vtkDoubleArray()
+    indexes.SetName('LM Index')
+    pointCounter = 0
+    for subject in range(subjectNumber):
+      for landmark in range(landmarkNumber):
+        points.SetPoint(pointCounter, landmarkSets[landmark,:,subject])
+        indexes.InsertNextValue(landmark+1)
+        pointCounter += 1
+    loopTime = time.time() - startTime
+
+    startTime = time.time()
+    polydata = render_lib.landmarkCloudPolyData(landmarkSets, perSubjectArrays={'Factor': factors + 1.0})
+    bulkTime = time.time() - startTime
+    logging.info(f"{landmarkNumber*subjectNumber} points: point by point {loopTime:.2f} s, from arrays {bulkTime:.3f} s")
+
+    self.assertEqual(polydata.GetNumberOfPoints(), landmarkNumber*subjectNumber)
+    self.assertEqual(polydata.GetNumberOfVerts(), landmarkNumber*subjectNumber)
+    for pointId in [0, 1234, landmarkNumber*subjectNumber-1]:
+      subject, landmark = divmod(pointId, landmarkNumber)
+      np.testing.assert_allclose(polydata.GetPoint(pointId), points.GetPoint(pointId))
+      self.assertEqual(polydata.GetPointData().GetArray('LM Index').GetValue(pointId), landmark+1)
+      self.assertEqual(polydata.GetPointData().GetArray('Factor').GetValue(pointId), factors[subject]+1)
+
+    # lollipop lines
+    start = landmarkSets[:5,:,0]
+    end = landmarkSets[:5,:,1]
+    lines = render_lib.lollipopPolyData(start, end)
+    self.assertEqual(lines.GetNumberOfLines(), 5)
+    lineIds = vtk.vtkIdList()
+    lines.GetCellPoints(2, lineIds)
+    self.assertEqual((lineIds.GetId(0), lineIds.GetId(1)), (2, 7))
+    self.assertAlmostEqual(lines.GetCellData().GetArray('Magnitude').GetValue(2), np.abs(start[2]-end[2]).sum(), places=5)
+
+    self.delayDisplay('Test passed')
+
+  def test_GPAVTKConversion(self):
+    """ Check that points, cells and scalars converted from numpy share memory and survive the
+    numpy arrays, and time the conversion from 10k to 10M points against inserting point by point.
+    """
+    import time
+    import gc
+    self.delayDisplay("Starting the numpy to VTK conversion test")
+
+    rng = np.random.default_rng(5)
+    for pointNumber in [10**4, 10**5, 10**6, 10**7]:
+      coordinates = rng.normal(size=(pointNumber, 3))
+      startTime = time.time()
+      points = vtk_lib.numpyToVTKPoints(coordinates)
+      cells = vtk_lib.numpyToVTKCells(np.arange(pointNumber), 1)
+      scalars = vtk_lib.numpyToVTKArray(coordinates[:,0].copy(), 'Scalars')
+      bulkTime = time.time() - startTime
+      message = f"{pointNumber} points: from arrays {1000*bulkTime:.1f} ms"
+      if pointNumber <= 10**6:
+        startTime = time.time()
+        loopPoints = vtk.vtkPoints()
+        for x in range(pointNumber):
+          loopPoints.InsertNextPoint(coordinates[x,0], coordinates[x,1], coordinates[x,2])
+        loopTime = time.time() - startTime
+        message += f", point by point {1000*loopTime:.1f} ms"
+      logging.info(message)
+      self.assertEqual(points.GetNumberOfPoints(), pointNumber)
+      self.assertEqual(cells.GetNumberOfCells(), pointNumber)
+      self.assertEqual(scalars.GetNumberOfTuples(), pointNumber)
+      # no copy for contiguous float64 coordinates
+      self.assertTrue(np.shares_memory(vtk_lib.vtkPointsToNumpy(points), coordinates))
+
+    # buffers stay valid after the numpy arrays are released, and are freed with the VTK objects
+    registered = len(vtk_lib._sharedBuffers)
+    coordinates = rng.normal(size=(1000, 3))
+    expected = coordinates.copy()
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_lib.numpyToVTKPoints(coordinates))
+    polydata.SetLines(vtk_lib.numpyToVTKCells(np.column_stack((np.arange(500), np.arange(500, 1000))), 2))
+    polydata.GetPointData().AddArray(vtk_lib.numpyToVTKArray(np.arange(1000) % 2 == 0, 'Even'))
+    del coordinates
+    gc.collect()
+    np.testing.assert_array_equal(vtk_lib.vtkPointsToNumpy(polydata.GetPoints()), expected)
+    offsets, connectivity = vtk_lib.vtkCellsToNumpy(polydata.GetLines())
+    np.testing.assert_array_equal(offsets, np.arange(0, 1001, 2))
+    self.assertEqual((connectivity[4], connectivity[5]), (2, 502))
+    self.assertEqual(polydata.GetPointData().GetArray('Even').GetValue(2), 1)
+    self.assertGreater(len(vtk_lib._sharedBuffers), registered)
+    del polydata, offsets, connectivity
+    gc.collect()
+    self.assertEqual(len(vtk_lib._sharedBuffers), registered)
+
+    # transforms from numpy landmarks
+    source = rng.normal(size=(20, 3))
+    tps = vtk_lib.createTPS(source, source + 0.1)
+    np.testing.assert_allclose(tps.TransformPoint(source[3]), source[3] + 0.1, atol=1e-6)
+
+    self.delayDisplay('Test passed')
@@ -109,12 +109,53 @@ def meanShape(monsters):
     return monsters.mean(axis=2)
 
 def procDist(monsters,mshape):
-    i,j,k=monsters.shape
-    procDists=np.zeros(k)
-    for x in range(k):
-      tmp=monsters[:,:,x]-mshape
-      procDists[x]=np.linalg.norm(tmp,'fro')
-    return procDists
+    return np.sqrt(np.sum((monsters-mshape[:,:,None])**2, axis=(0,1)))
+
+############## Distances and outliers
+def distanceBlocks(a, b=None, blockSize=1024):
+    """
+    Yield (rowStart, colStart, block) of the euclidean distance matrix between the rows of a and b
+    (a with itself if b is None), computed blockSize rows and columns at a time so memory stays bounded.
+    """
+    a = np.asarray(a, dtype=float)
+    b = a if b is None else np.asarray(b, dtype=float)
+    aNorms = np.sum(a**2, axis=1)
+    bNorms = np.sum(b**2, axis=1)
+    for rowStart in range(0, a.shape[0], blockSize):
+      rows = slice(rowStart, rowStart+blockSize)
+      for colStart in range(0, b.shape[0], blockSize):
+        cols = slice(colStart, colStart+blockSize)
+        squared = aNorms[rows,None] + bNorms[None,cols] - 2*np.dot(a[rows], b[cols].T)
+        yield rowStart, colStart, np.sqrt(np.clip(squared, 0, None))
+
+def euclideanDistanceMatrix(a, b=None, blockSize=1024):
+    """Euclidean distance matrix between the rows of a and b (a with itself if b is None)."""
+    rowCount = a.shape[0]
+    colCount = rowCount if b is None else b.shape[0]
+    distances = np.empty((rowCount, colCount))
+    for rowStart, colStart, block in distanceBlocks(a, b, blockSize):
+      distances[rowStart:rowStart+block.shape[0], colStart:colStart+block.shape[1]] = block
+    if b is None:
+      np.fill_diagonal(distances, 0)
+    return distances
+
+def robustZScores(values):
+    """Modified z-scores (Iglewicz and Hoaglin) based on the median and the median absolute deviation."""
+    values = np.asarray(values, dtype=float).reshape(-1)
+    median = np.median(values)
+    mad = np.median(np.abs(values-median))
+    if mad > 0:
+      return 0.6745*(values-median)/mad
+    # more than half the values are equal, fall back to the mean absolute deviation
+    meanAbsoluteDeviation = np.mean(np.abs(values-median))
+    if meanAbsoluteDeviation > 0:
+      return (values-median)/(1.253314*meanAbsoluteDeviation)
+    return np.zeros_like(values)
+
+def findOutliers(values, threshold=3.5):
+    """Flag values whose modified z-score exceeds threshold, returns the flags and the scores."""
+    scores = robustZScores(values)
+    return scores > threshold, scores
 
 ################# GPA update
 def runGPA(allLandmarkSets):
@@ -182,3 +223,92 @@ def procrustesAlignNoScale(mean, allLandmarkSets):
 def applyCenter(landmarkSet):
   landmarkSet=centerShape(landmarkSet)
   return landmarkSet
+
+################# Incremental GPA
+def flattenShapes(allLandmarkSets):
+    """Stack each landmark set as a column, using the same coordinate order as makeTwoDim, without centering."""
+    i,j,k = allLandmarkSets.shape
+    return np.reshape(allLandmarkSets, (i*j, k), order='F')
+
+def runGPAIncremental(alignedSets, previousMeanShape, newLandmarkSets, scale=True):
+    """
+    Add new specimens to a finished GPA. The new specimens are centered (and scaled) and aligned to the
+    previous mean shape, then all specimens are re-converged starting from that mean.
+    Returns the aligned sets, the mean shape and the RMS displacement of the previously aligned specimens
+    relative to their RMS size, which measures how far the old alignment drifted.
+    """
+    i,j,k = alignedSets.shape
+    newSets = np.array(newLandmarkSets, dtype=float)
+    for index in range(newSets.shape[2]):
+      if scale:
+        newSets[:,:,index] = applyCenterScale(newSets[:,:,index])
+      else:
+        newSets[:,:,index] = applyCenter(newSets[:,:,index])
+    allLandmarkSets = np.concatenate((alignedSets, newSets), axis=2)
+    if scale:
+      procrustesAlign(previousMeanShape, allLandmarkSets[:,:,k:])
+      initialMeanShape = scaleShape(meanShape(allLandmarkSets))
+    else:
+      procrustesAlignNoScale(previousMeanShape, allLandmarkSets[:,:,k:])
+      initialMeanShape = centerShape(meanShape(allLandmarkSets))
+    currentMeanShape = initialMeanShape
+    diff = 1
+    tries = 0
+    while diff > 0.0001 and tries < 5:
+      if scale:
+        allLandmarkSets = procrustesAlign(initialMeanShape, allLandmarkSets)
+        currentMeanShape = meanShape(allLandmarkSets)
+      else:
+        allLandmarkSets = procrustesAlignNoScale(initialMeanShape, allLandmarkSets)
+        currentMeanShape = centerShape(meanShape(allLandmarkSets))
+      diff = np.linalg.norm(initialMeanShape-currentMeanShape)
+      initialMeanShape = currentMeanShape
+      tries += 1
+    displacement = np.sum((allLandmarkSets[:,:,:k]-alignedSets)**2, axis=(0,1))
+    size = np.sum(alignedSets**2, axis=(0,1))
+    alignmentDrift = np.sqrt(displacement.mean()/size.mean())
+    return allLandmarkSets, currentMeanShape, alignmentDrift
+
+def updatePCA(eigenValues, eigenVectors, oldMean, oldCount, newData):
+    """
+    Rank-update the PCA of oldCount specimens with the new columns of newData (coordinates x specimens).
+    eigenValues and eigenVectors are those of the population covariance of the old specimens and oldMean
+    their mean vector. The thin SVD of the old centered data is extended with the new centered columns
+    and a column accounting for the shift of the mean (Ross et al. 2008), so the old data is not needed.
+    Returns the eigenvalues, eigenvectors and mean vector of the combined set, sorted by decreasing eigenvalue.
+    """
+    p, m = newData.shape
+    total = oldCount + m
+    newMean = newData.mean(axis=1)
+    combinedMean = (oldCount*oldMean + m*newMean)/total
+    singularValues = np.sqrt(np.clip(np.real(eigenValues), 0, None)*oldCount)
+    vectors = np.real(eigenVectors)
+    augmented = np.column_stack((newData - newMean[:,None], np.sqrt(oldCount*m/total)*(newMean-oldMean)))
+    projection = np.dot(vectors.T, augmented)
+    residual = augmented - np.dot(vectors, projection)
+    q, r = np.linalg.qr(residual)
+    rank = len(singularValues)
+    columns = augmented.shape[1]
+    middle = np.zeros((rank+columns, rank+columns))
+    middle[:rank,:rank] = np.diag(singularValues)
+    middle[:rank,rank:] = projection
+    middle[rank:,rank:] = r
+    u, s, vt = sp.svd(middle, full_matrices=False)
+    keep = min(total, p)
+    updatedVectors = np.dot(np.column_stack((vectors, q)), u[:,:keep])
+    updatedValues = s[:keep]**2/total
+    return updatedValues, updatedVectors, combinedMean
+
+def eigenResidual(twoDim, eigenValues, eigenVectors, numberOfPCs):
+    """
+    Largest relative residual |Cv - lv| / l1 over the first numberOfPCs eigenpairs, where C is the population
+    covariance of the centered data twoDim. The covariance is applied implicitly, so this is cheap even for
+    many landmarks. A value near zero means the eigenpairs match an exact decomposition of the data.
+    """
+    k = twoDim.shape[1]
+    numberOfPCs = min(numberOfPCs, eigenVectors.shape[1])
+    vectors = np.real(eigenVectors[:,:numberOfPCs])
+    values = np.real(eigenValues[:numberOfPCs])
+    covTimesVectors = np.dot(twoDim, np.dot(twoDim.T, vectors))/k
+    residual = np.linalg.norm(covTimesVectors - vectors*values, axis=0)
+    return residual.max()/max(values[0], np.finfo(float).tiny)
@@ -0,0 +1,61 @@
+import numpy as np
+import vtk
+from . import vtk_lib
+
+# Landmark clouds larger than this are drawn as points instead of sphere glyphs
+MAX_GLYPH_POINTS = 100000
+
+def landmarkCloudPolyData(landmarkSets, pointArrays=None, perSubjectArrays=None):
+    """
+    Polydata with one vertex per landmark of each subject, ordered subject by subject, from an
+    i x 3 x k landmark array. An 'LM Index' point array (starting at 1) is always attached.
+    pointArrays: name -> values for every point (length i*k)
+    perSubjectArrays: name -> values for every subject (length k), repeated for each of its landmarks
+    """
+    i, j, k = landmarkSets.shape
+    coordinates = np.transpose(landmarkSets, (2, 0, 1)).reshape(i*k, j)
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_lib.numpyToVTKPoints(coordinates))
+    polydata.SetVerts(vtk_lib.numpyToVTKCells(np.arange(i*k), 1))
+    pointData = polydata.GetPointData()
+    pointData.AddArray(vtk_lib.numpyToVTKArray(np.tile(np.arange(1, i+1, dtype=np.float64), k), 'LM Index'))
+    for name, values in (pointArrays or {}).items():
+        pointData.AddArray(vtk_lib.numpyToVTKArray(values, name))
+    for name, values in (perSubjectArrays or {}).items():
+        pointData.AddArray(vtk_lib.numpyToVTKArray(np.repeat(np.asarray(values), i), name))
+    return polydata
+
+def varianceGlyphPolyData(meanLandmarks, varianceMat, scale):
+    """Points at the mean landmarks with per-landmark 'Index', 'Scales' and diagonal 'Tensors' arrays."""
+    i = meanLandmarks.shape[0]
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_lib.numpyToVTKPoints(meanLandmarks))
+    tensors = np.zeros((i, 9))
+    tensors[:, [0, 4, 8]] = scale*varianceMat
+    pointData = polydata.GetPointData()
+    pointData.AddArray(vtk_lib.numpyToVTKArray(np.arange(1, i+1, dtype=np.float64), 'Index'))
+    pointData.AddArray(vtk_lib.numpyToVTKArray(scale*varianceMat.mean(axis=1), 'Scales'))
+    pointData.AddArray(vtk_lib.numpyToVTKArray(tensors, 'Tensors'))
+    return polydata
+
+def lollipopPolyData(startPoints, endPoints):
+    """One line per landmark from startPoints to endPoints, with the L1 length as 'Magnitude' cell data."""
+    i = startPoints.shape[0]
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_lib.numpyToVTKPoints(np.vstack((startPoints, endPoints))))
+    polydata.SetLines(vtk_lib.numpyToVTKCells(np.column_stack((np.arange(i), np.arange(i, 2*i))), 2))
+    magnitude = np.abs(startPoints-endPoints).sum(axis=1).astype(np.float32)
+    polydata.GetCellData().AddArray(vtk_lib.numpyToVTKArray(magnitude, 'Magnitude'))
+    return polydata
+
+def sphereGlyphs(polydata, radius, scaling=False):
+    """Sphere glyphs for every point of polydata, generated by one vtkGlyph3D filter."""
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(radius)
+    glyph = vtk.vtkGlyph3D()
+    glyph.SetSourceConnection(sphereSource.GetOutputPort())
+    glyph.SetInputData(polydata)
+    if not scaling:
+        glyph.ScalingOff()
+    glyph.Update()
+    return glyph.GetOutput()
@@ -0,0 +1,77 @@
+import json
+import numpy as np
+
+# Binary results container written next to the CSV tables of a GPA run.
+# Each array is stored as its own member of an uncompressed .npz archive, so
+# a member is only read from disk when it is first requested.
+RESULTS_FILE_NAME = "gpaResults.npz"
+RESULTS_FORMAT_VERSION = 1
+METADATA_KEY = "metadata"
+
+def writeResults(filePath, arrays, metadata=None):
+    """
+    Write a dictionary of numpy arrays and a JSON-serializable metadata
+    dictionary to a single results container at filePath.
+    """
+    if METADATA_KEY in arrays:
+        raise ValueError(f"'{METADATA_KEY}' is reserved for the results metadata")
+    header = {"formatVersion": RESULTS_FORMAT_VERSION, "arrays": {}}
+    members = {}
+    for name, value in arrays.items():
+        value = np.ascontiguousarray(value)
+        if value.dtype == object:
+            value = value.astype(str)
+        members[name] = value
+        header["arrays"][name] = {"shape": list(value.shape), "dtype": value.dtype.str}
+    if metadata:
+        header.update(metadata)
+    members[METADATA_KEY] = np.array(json.dumps(header))
+    with open(filePath, 'wb') as outputFile:
+        np.savez(outputFile, **members)
+    return filePath
+
+class ResultsStore:
+    """
+    Read-only view of a results container. Arrays are loaded on first access
+    and cached, so restoring a session only pays for the arrays it uses.
+    """
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self._archive = np.load(filePath, allow_pickle=False)
+        self._cache = {}
+        self.metadata = json.loads(str(self._archive[METADATA_KEY]))
+        version = self.metadata.get("formatVersion", 0)
+        if version > RESULTS_FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported GPA results format version {version}")
+
+    def keys(self):
+        return [name for name in self._archive.files if name != METADATA_KEY]
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            if name not in self:
+                raise KeyError(name)
+            self._cache[name] = self._archive[name]
+        return self._cache[name]
+
+    def shape(self, name):
+        """Shape of a stored array, read from the metadata without loading the array."""
+        return tuple(self.metadata["arrays"][name]["shape"])
+
+    def isLoaded(self, name):
+        return name in self._cache
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
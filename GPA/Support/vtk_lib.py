@@ -1,4 +1,71 @@
-from __main__ import vtk
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+############## numpy <-> VTK conversion
+# VTK arrays created here share memory with numpy buffers. Each buffer is kept in this registry until
+# the VTK array that uses it is deleted, so it stays valid however long the array lives in the pipeline.
+_sharedBuffers = {}
+ID_TYPE = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+
+def _shareBuffer(vtkArray, buffer):
+    # the caller is no longer wrapped when DeleteEvent fires, so the observer keeps its own key
+    key = vtkArray.__this__
+    if key not in _sharedBuffers:
+        vtkArray.AddObserver(vtk.vtkCommand.DeleteEvent, lambda caller, event: _sharedBuffers.pop(key, None))
+    _sharedBuffers[key] = buffer
+    return vtkArray
+
+def numpyToVTKArray(array, name=None, arrayType=None):
+    """
+    VTK data array that uses the memory of a numpy array, one row per tuple. The data is only copied
+    if the array is not C-contiguous or has a type VTK cannot use directly (e.g. bool).
+    Changes to the numpy array are seen by VTK, call Modified() on the VTK array afterwards.
+    """
+    array = np.asarray(array)
+    if array.dtype == bool:
+        array = array.astype(np.uint8)
+    if arrayType is not None:
+        array = array.astype(numpy_support.get_vtk_to_numpy_typemap()[arrayType], copy=False)
+    array = np.ascontiguousarray(array)
+    vtkArray = numpy_support.numpy_to_vtk(array, deep=False, array_type=arrayType)
+    if name is not None:
+        vtkArray.SetName(name)
+    return _shareBuffer(vtkArray, array)
+
+def numpyToVTKPoints(coordinates):
+    """vtkPoints that use the memory of an n x 3 coordinate array (copied only if not contiguous float64)."""
+    coordinates = np.ascontiguousarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    points = vtk.vtkPoints()
+    points.SetData(numpyToVTKArray(coordinates))
+    return points
+
+def numpyToVTKCells(connectivity, cellSize=None, offsets=None):
+    """
+    vtkCellArray from a flat array of point ids, without a loop over cells. Cells either all have
+    cellSize points, or cell c uses connectivity[offsets[c]:offsets[c+1]].
+    """
+    connectivity = np.ascontiguousarray(connectivity, dtype=ID_TYPE).reshape(-1)
+    if offsets is None:
+        offsets = np.arange(0, len(connectivity)+1, cellSize, dtype=ID_TYPE)
+    offsets = np.ascontiguousarray(offsets, dtype=ID_TYPE)
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpyToVTKArray(offsets), numpyToVTKArray(connectivity))
+    return cells
+
+def vtkToNumpy(vtkArray):
+    """numpy view of a VTK data array, multi-component arrays are returned as tuples x components."""
+    return numpy_support.vtk_to_numpy(vtkArray)
+
+def vtkPointsToNumpy(points):
+    """n x 3 numpy view of the coordinates of vtkPoints."""
+    return vtkToNumpy(points.GetData())
+
+def vtkCellsToNumpy(cells):
+    """Offsets and connectivity of a vtkCellArray as numpy views."""
+    return vtkToNumpy(cells.GetOffsetsArray()), vtkToNumpy(cells.GetConnectivityArray())
+
+############## Transforms
 
 def resliceThroughTransform( sourceNode, transform, referenceNode, targetNode):
     """
@@ -43,8 +110,13 @@ transform: vtkAbstractTransform
 
 
 def createTPS( sourceLM, targetLM):
-    """Perform the thin plate transform using the vtkThinPlateSplineTransform class"""
+    """Perform the thin plate transform using the vtkThinPlateSplineTransform class.
+    Landmarks can be vtkPoints or n x 3 numpy arrays."""
 #
+    if isinstance(sourceLM, np.ndarray):
+        sourceLM = numpyToVTKPoints(sourceLM)
+    if isinstance(targetLM, np.ndarray):
+        targetLM = numpyToVTKPoints(targetLM)
     thinPlateTransform = vtk.vtkThinPlateSplineTransform()
     thinPlateTransform.SetBasisToR() # for 3D transform
 #
@@ -56,30 +128,16 @@ def createTPS( sourceLM, targetLM):
 
 
 def convertFudicialToVTKPoint(fnode):
-    import numpy as np
-    numberOfLM=fnode.GetNumberOfFiducials()
-    x=y=z=0
-    loc=[x,y,z]
+    numberOfLM=fnode.GetNumberOfControlPoints()
     lmData=np.zeros((numberOfLM,3))
     #
     for i in range(numberOfLM):
-        fnode.GetNthFiducialPosition(i,loc)
-        lmData[i,:]=np.asarray(loc)
-    #return lmData
-    #
-    points=vtk.vtkPoints()
-    for i in range(numberOfLM):
-        points.InsertNextPoint(lmData[i,0], lmData[i,1], lmData[i,2])
+        lmData[i,:]=fnode.GetNthControlPointPosition(i)
 #
-    return points
+    return numpyToVTKPoints(lmData)
 
 def convertNumpyToVTK(A):
-    x,y=A.shape
-    points=vtk.vtkPoints()
-    for i in range(x):
-        points.InsertNextPoint(A[i,0], A[i,1], A[i,2])
-#
-    return points
+    return numpyToVTKPoints(A)
 
 
 # def test():
@@ -0,0 +1,86 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+class PCWarpBasis:
+    """
+    Displacement grids of the thin plate spline warp along each PC, sampled once per analysis.
+    The spline maps the mean landmarks to the mean plus a PC shift. With the source landmarks fixed,
+    its displacement field is linear in the landmark shifts, so the warp for any combination of PC
+    scores is the same combination of the per-PC grids.
+    """
+    def __init__(self, meanLandmarks, pcShifts, bounds, dimension=50):
+        """
+        meanLandmarks: n x 3 array of source landmarks
+        pcShifts: numberOfPCs x n x 3 array of landmark displacements for a unit score on each PC
+        bounds: (xmin, xmax, ymin, ymax, zmin, zmax) region covered by the grid
+        """
+        self.dimensions = (dimension, dimension, dimension)
+        self.origin = (bounds[0], bounds[2], bounds[4])
+        self.spacing = tuple((bounds[2*axis+1]-bounds[2*axis])/dimension for axis in range(3))
+        meanLandmarks = np.asarray(meanLandmarks, dtype=float)
+        pcShifts = np.asarray(pcShifts, dtype=float)
+        self.numberOfPCs = pcShifts.shape[0]
+        coefficients = self.solveTPS(meanLandmarks, pcShifts)
+        basis = self.evaluateTPS(meanLandmarks, coefficients, self.gridPoints())
+        # numberOfPCs x (number of grid points * 3), each row is one flattened displacement grid
+        self.basis = np.ascontiguousarray(basis.reshape(-1, self.numberOfPCs, 3).transpose(1, 0, 2).reshape(self.numberOfPCs, -1))
+
+    @staticmethod
+    def solveTPS(sourceLandmarks, shifts):
+        """Thin plate spline (r basis) coefficients interpolating each set of landmark shifts."""
+        n = sourceLandmarks.shape[0]
+        system = np.zeros((n+4, n+4))
+        system[:n,:n] = np.linalg.norm(sourceLandmarks[:,None,:]-sourceLandmarks[None,:,:], axis=2)
+        system[:n,n] = 1
+        system[:n,n+1:] = sourceLandmarks
+        system[n:,:n] = system[:n,n:].T
+        rightHandSide = np.zeros((n+4, shifts.shape[0]*3))
+        rightHandSide[:n] = shifts.transpose(1, 0, 2).reshape(n, -1)
+        try:
+            return np.linalg.solve(system, rightHandSide)
+        except np.linalg.LinAlgError:
+            return np.linalg.lstsq(system, rightHandSide, rcond=None)[0]
+
+    @staticmethod
+    def evaluateTPS(sourceLandmarks, coefficients, points, maxBlockEntries=2**22):
+        """Evaluate the splines at points (m x 3), in blocks to bound the size of the kernel matrix."""
+        n = sourceLandmarks.shape[0]
+        values = np.empty((points.shape[0], coefficients.shape[1]))
+        blockSize = max(1, maxBlockEntries // n)
+        sourceNorms = np.sum(sourceLandmarks**2, axis=1)
+        for start in range(0, points.shape[0], blockSize):
+            block = points[start:start+blockSize]
+            squared = np.sum(block**2, axis=1)[:,None] + sourceNorms[None,:] - 2*np.dot(block, sourceLandmarks.T)
+            kernel = np.sqrt(np.clip(squared, 0, None))
+            values[start:start+blockSize] = np.dot(kernel, coefficients[:n]) + coefficients[n] + np.dot(block, coefficients[n+1:])
+        return values
+
+    def gridPoints(self):
+        """Grid point coordinates in vtkImageData order (x varies fastest)."""
+        axes = [self.origin[axis] + self.spacing[axis]*np.arange(self.dimensions[axis]) for axis in range(3)]
+        z, y, x = np.meshgrid(axes[2], axes[1], axes[0], indexing='ij')
+        return np.column_stack((x.ravel(), y.ravel(), z.ravel()))
+
+    def createGridImage(self):
+        """Displacement grid image with zero displacement, to be updated in place with updateGridImage."""
+        imageData = vtk.vtkImageData()
+        imageData.SetOrigin(self.origin)
+        imageData.SetSpacing(self.spacing)
+        imageData.SetDimensions(self.dimensions)
+        imageData.AllocateScalars(vtk.VTK_DOUBLE, 3)
+        imageData.GetPointData().GetScalars().Fill(0)
+        return imageData
+
+    def updateGridImage(self, imageData, scores):
+        """Write the displacement for the given PC scores into the grid image, without reallocating it."""
+        displacements = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(-1)
+        scores = np.asarray(scores, dtype=float)[:self.numberOfPCs]
+        active = np.flatnonzero(scores)
+        if len(active) == 0:
+            displacements[:] = 0
+        elif len(active) == 1:
+            np.multiply(self.basis[active[0]], scores[active[0]], out=displacements)
+        else:
+            np.dot(scores[active], self.basis[active], out=displacements)
+        imageData.Modified()
@@ -7,6 +7,7 @@ import SimpleITK as sitk
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import logging
+from ImageStacksLib import downsample, intensity, region_reader, slice_reader, stack_discovery, volume_file
 
 #
 # ImageStacks
@@ -115,6 +116,12 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.originalVolumeSizeLabel = qt.QLabel()
     filesFormLayout.addRow("Size: ", self.originalVolumeSizeLabel)
 
+    # gaps in the slice numbering and slices that do not match the first one
+    self.stackProblemsLabel = qt.QLabel()
+    self.stackProblemsLabel.wordWrap = True
+    self.stackProblemsLabel.toolTip = "Problems found in the file list: missing or duplicate slice numbers, slices of a different size or type"
+    filesFormLayout.addRow("Warnings: ", self.stackProblemsLabel)
+
     # reverse slice order
     self.reverseCheckBox = qt.QCheckBox()
     self.reverseCheckBox.toolTip = "Read the images in reverse order (flips loaded volume along IS axis)"
@@ -224,6 +231,13 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.qualityPreviewRadioButton.setChecked(True)
     outputFormLayout.addRow("Quality: ", qualityLayout)
 
+    self.downsamplingComboBox = qt.QComboBox()
+    self.downsamplingComboBox.addItem("block average")
+    self.downsamplingComboBox.addItem("nearest neighbor")
+    self.downsamplingComboBox.toolTip = ("How half resolution and preview voxels are computed. Block average uses the mean of all voxels"
+      " it replaces, which preserves thin structures. Nearest neighbor only reads every other slice, which is faster but can alias.")
+    outputFormLayout.addRow("Downsampling: ", self.downsamplingComboBox)
+
     self.sliceSkipSpinBox = qt.QSpinBox()
     self.sliceSkipSpinBox.toolTip = "Skips the selected number of slices between each pair of output volume slices (use, for example, on long thin samples with more slices than in-plane resolution)"
     outputFormLayout.addRow("Slice skip: ", self.sliceSkipSpinBox)
@@ -252,12 +266,63 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.outputSpacingWidget.toolTip = "Slice spacing of the volume that will be loaded"
     outputFormLayout.addRow("Output spacing: ", self.outputSpacingWidget)
 
-    # 8-bit conversion section (uses VTK AutoRange for optimal thresholds)
+    # Streaming import to a file, for volumes that do not fit in memory
+    fileOutputLayout = qt.QHBoxLayout()
+    self.writeToFileCheckBox = qt.QCheckBox()
+    self.writeToFileCheckBox.toolTip = ("Write the output volume slice by slice to a NRRD file instead of building it in memory."
+      " Use it for volumes larger than the available memory.")
+    fileOutputLayout.addWidget(self.writeToFileCheckBox)
+    self.outputFilePathEdit = ctk.ctkPathLineEdit()
+    self.outputFilePathEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+    self.outputFilePathEdit.nameFilters = ["NRRD (*.nrrd)"]
+    self.outputFilePathEdit.settingKey = "ImageStacksOutputFilePath"
+    self.outputFilePathEdit.toolTip = "NRRD file the output volume is written to"
+    self.outputFilePathEdit.enabled = False
+    fileOutputLayout.addWidget(self.outputFilePathEdit)
+    outputFormLayout.addRow("Write to file: ", fileOutputLayout)
+
+    self.fileLoadComboBox = qt.QComboBox()
+    self.fileLoadComboBox.addItem("full volume")
+    self.fileLoadComboBox.addItem("half resolution proxy")
+    self.fileLoadComboBox.addItem("quarter resolution proxy")
+    self.fileLoadComboBox.addItem("do not load")
+    self.fileLoadComboBox.currentIndex = 2
+    self.fileLoadComboBox.toolTip = ("What to load into the scene once the file is written. Proxies are block averages computed while writing,"
+      " the file keeps the volume at the selected quality.")
+    self.fileLoadComboBox.enabled = False
+    outputFormLayout.addRow("Load from file: ", self.fileLoadComboBox)
+
+    self.sliceWindowSpinBox = qt.QSpinBox()
+    self.sliceWindowSpinBox.minimum = 1
+    self.sliceWindowSpinBox.maximum = 4096
+    self.sliceWindowSpinBox.value = self.logic.sliceWindowSize
+    self.sliceWindowSpinBox.suffix = " slices"
+    self.sliceWindowSpinBox.toolTip = "Number of output slices held in memory while writing to file. Memory use is about twice this many slices."
+    self.sliceWindowSpinBox.enabled = False
+    outputFormLayout.addRow("Slice window: ", self.sliceWindowSpinBox)
+
+    # 8-bit conversion section (percentile window, the defaults match VTK AutoRange)
     self.convert8bitCheckBox = qt.QCheckBox()
     self.convert8bitCheckBox.checked = False
     self.convert8bitCheckBox.toolTip = "Convert output volume to grayscale (8bit) using percentile-based intensity rescaling"
     outputFormLayout.addRow("8-bit intensity: ", self.convert8bitCheckBox)
 
+    percentileLayout = qt.QHBoxLayout()
+    self.lowerPercentileSpinBox = qt.QDoubleSpinBox()
+    self.upperPercentileSpinBox = qt.QDoubleSpinBox()
+    for spinBox, value in [(self.lowerPercentileSpinBox, self.logic.lowerPercentile), (self.upperPercentileSpinBox, self.logic.upperPercentile)]:
+      spinBox.minimum = 0.0
+      spinBox.maximum = 100.0
+      spinBox.decimals = 2
+      spinBox.singleStep = 0.1
+      spinBox.suffix = " %"
+      spinBox.value = value
+      spinBox.enabled = False
+      percentileLayout.addWidget(spinBox)
+    self.lowerPercentileSpinBox.toolTip = "Percentile of the voxel intensities mapped near 0 in the 8-bit volume (the window is widened by 10% on both sides)"
+    self.upperPercentileSpinBox.toolTip = "Percentile of the voxel intensities mapped near 255 in the 8-bit volume (the window is widened by 10% on both sides)"
+    outputFormLayout.addRow("8-bit percentiles: ", percentileLayout)
+
     self.loadButton = qt.QPushButton("Load files")
     self.loadButton.toolTip = "Load files as a 3D volume"
     self.loadButton.enabled = False
@@ -279,6 +344,13 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.qualityHalfRadioButton.connect("toggled(bool)", lambda toggled, widget=self.qualityHalfRadioButton: self.onQualityToggled(toggled, widget))
     self.qualityFullRadioButton.connect("toggled(bool)", lambda toggled, widget=self.qualityFullRadioButton: self.onQualityToggled(toggled, widget))
     self.grayscaleCheckBox.connect('toggled(bool)', self.updateLogicFromWidget)
+    self.downsamplingComboBox.connect("currentIndexChanged(int)", self.updateLogicFromWidget)
+    self.writeToFileCheckBox.connect('toggled(bool)', self.onWriteToFileToggled)
+    self.sliceWindowSpinBox.connect("valueChanged(int)", self.updateLogicFromWidget)
+    self.convert8bitCheckBox.connect('toggled(bool)', self.lowerPercentileSpinBox, 'setEnabled(bool)')
+    self.convert8bitCheckBox.connect('toggled(bool)', self.upperPercentileSpinBox, 'setEnabled(bool)')
+    self.lowerPercentileSpinBox.connect("valueChanged(double)", self.updateLogicFromWidget)
+    self.upperPercentileSpinBox.connect("valueChanged(double)", self.updateLogicFromWidget)
     self.outputROISelector.connect("currentNodeChanged(vtkMRMLNode*)", self.setOutputROINode)
     self.addByBrowsingButton.connect('clicked()', self.addByBrowsing)
     self.addFromArchetype.connect('clicked()', self.selectArchetype)
@@ -296,6 +368,8 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.removeObservers()
 
   def updateWidgetFromLogic(self):
+    self.stackProblemsLabel.text = "\n".join(self.logic.stackProblems) if self.logic.stackProblems else "none"
+
     # Original volume size
     if (self.logic.originalVolumeDimensions[0] == 0
       and self.logic.originalVolumeDimensions[1] == 0
@@ -320,6 +394,10 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.logic.reverseSliceOrder = self.reverseCheckBox.checked
     self.logic.outputGrayscale = self.grayscaleCheckBox.checked
     self.logic.sliceSkip = self.sliceSkipSpinBox.value
+    self.logic.downsamplingMethod = downsample.NEAREST if self.downsamplingComboBox.currentIndex == 1 else downsample.AVERAGE
+    self.logic.sliceWindowSize = self.sliceWindowSpinBox.value
+    self.logic.lowerPercentile = self.lowerPercentileSpinBox.value
+    self.logic.upperPercentile = self.upperPercentileSpinBox.value
     if self.isotropicSpacingButton.checked:
       # isotropic spacing
       spacing = [self.isotropicSpacingWidget.value, self.isotropicSpacingWidget.value, self.isotropicSpacingWidget.value]
@@ -342,6 +420,12 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.logic.outputQuality = quality
     self.updateWidgetFromLogic()
 
+  def onWriteToFileToggled(self, checked):
+    self.outputFilePathEdit.enabled = checked
+    self.fileLoadComboBox.enabled = checked
+    self.sliceWindowSpinBox.enabled = checked
+    self.outputSelector.enabled = not checked
+
   def onClear(self):
     self.fileTable.clear()
     self.outputSelector.currentNodeID = ""
@@ -351,7 +435,7 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   def addByBrowsing(self):
     self.onClear()
     filePaths = qt.QFileDialog().getOpenFileNames()
-    self.setFilePaths(filePaths)
+    self.setFilePaths(sorted(filePaths, key=stack_discovery.naturalSortKey))
 
   def setFilePaths(self, filePaths):
     self.fileTable.plainText = '\n'.join(filePaths)
@@ -373,6 +457,14 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     filePath = self.archetypeText.text
     fileExtension = os.path.splitext(filePath)[1]
     isNrrd = fileExtension.lower() == ".nhdr" or fileExtension.lower() == ".nrrd"
+    # the directory is listed once instead of checking each candidate file name on disk
+    directoryPath = os.path.dirname(filePath)
+    try:
+      fileNamesInDirectory = stack_discovery.fileNamesInDirectory(directoryPath or ".")
+    except OSError:
+      fileNamesInDirectory = set()
+    def fileExists(path):
+      return os.path.dirname(path) == directoryPath and os.path.basename(path) in fileNamesInDirectory
     if filePath.find('%') == -1 and not isNrrd:
       # start searching for the first number before the file extension (the file extension itself
       # can contain numbers that should be ignored, such as .jp2)
@@ -391,7 +483,7 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         formatString = "%d"
       archetypeFormat = filePath[:numberStartIndex] + formatString + filePath[numberEndIndex+1:]
       candidateStartNumber = int(filePath[numberStartIndex:numberEndIndex+1])
-      while os.path.exists(archetypeFormat % candidateStartNumber):
+      while fileExists(archetypeFormat % candidateStartNumber):
         candidateStartNumber -= 1
       self.archetypeStartNumber = candidateStartNumber + 1
     else:
@@ -401,7 +493,7 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     if "%" in archetypeFormat:
       while True:
         filePath = archetypeFormat % fileIndex
-        if os.path.exists(filePath):
+        if fileExists(filePath):
           filePaths.append(filePath)
         else:
           if fileIndex != 0:
@@ -465,12 +557,23 @@ class ImageStacksWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
     try:
       slicer.app.pauseRender()
-      outputNode = self.logic.loadVolume(self.currentNode(), progressCallback=self.onProgress)
-      self.setCurrentNode(outputNode)
+      # the histogram for 8-bit conversion is collected while slices are read
+      histogram = intensity.StreamingHistogram() if self.convert8bitCheckBox.checked else None
+      if self.writeToFileCheckBox.checked:
+        outputFilePath = self.outputFilePathEdit.currentPath
+        if not outputFilePath:
+          raise ValueError("Select the file to write the volume to.")
+        self.outputFilePathEdit.addCurrentPathToHistory()
+        proxyFactor = [1, 2, 4, 0][self.fileLoadComboBox.currentIndex]
+        outputNode = self.logic.loadVolumeThroughFile(outputFilePath, progressCallback=self.onProgress, proxyFactor=proxyFactor, histogram=histogram)
+      else:
+        outputNode = self.logic.loadVolume(self.currentNode(), progressCallback=self.onProgress, histogram=histogram)
+      if outputNode:
+        self.setCurrentNode(outputNode)
 
       # Apply 8-bit conversion if requested
-      if self.convert8bitCheckBox.checked:
-        outputNode = self.logic.convertTo8Bit(outputNode, progressCallback=self.onProgress)
+      if outputNode and self.convert8bitCheckBox.checked:
+        outputNode = self.logic.convertTo8Bit(outputNode, progressCallback=self.onProgress, histogram=histogram)
         self.setCurrentNode(outputNode)
 
       qt.QApplication.restoreOverrideCursor()
@@ -561,41 +664,21 @@ class ImageStacksFileDialog:
   @staticmethod
   def pathsFromMimeData(mimeData):
     filesToAdd = []
-    #acceptedFileExtensions = ['jpg', 'jpeg', 'tif', 'tiff', 'png', 'bmp', 'jp2', 'nrrd', 'nhdr']
-    acceptedFileExtensions = ['jpg', 'jpeg', 'tif', 'tiff', 'png', 'bmp', 'jp2']
     if mimeData.hasFormat('text/uri-list'):
       urls = mimeData.urls()
+      droppedFiles = []
       for url in urls:
         localPath = url.toLocalFile() # convert QUrl to local path
-        pathInfo = qt.QFileInfo()
-        pathInfo.setFile(localPath) # information about the path
-        if pathInfo.isDir(): # if it is a directory we add the files to the dialog
-          directory = qt.QDir(localPath)
-          nameFilters = ['*.'+ext for ext in acceptedFileExtensions]
-          filenamesInFolder = directory.entryList(nameFilters, qt.QDir.Files, qt.QDir.Name)
-          for filenameInFolder in filenamesInFolder:
-            filesToAdd.append(directory.absoluteFilePath(filenameInFolder))
+        if os.path.isdir(localPath): # if it is a directory we add the files to the dialog
+          filesToAdd.extend(stack_discovery.scanDirectory(localPath))
+        elif stack_discovery.isSliceFileName(os.path.basename(localPath)):
+          droppedFiles.append(localPath)
         else:
-          ext = pathInfo.suffix().lower()
-          if ext in acceptedFileExtensions:
-            filesToAdd.append(localPath)
-
-    # Filter out files that are known to cause complications
-    # Currently, there is only one rule, but it is expected that more filtering rules will be added in the future.
-    filteredFilesToAdd = []
-    for filePath in filesToAdd:
-      fileName = qt.QFileInfo(filePath).fileName()
-
-      # Ignore cone-beam image in Bruker Skyscan folder
-      # such as `left_side_damaged__rec_spr.bmp`
-      if fileName.endswith("spr.bmp"):
-        # skip this file
-        logging.debug(f"Skipping {filePath} - it looks like a Bruker Skyscan cone-beam image, not an image slice")
-        continue
-
-      filteredFilesToAdd.append(filePath)
-
-    return filteredFilesToAdd
+          # Cone-beam images in Bruker Skyscan folders, such as `left_side_damaged__rec_spr.bmp`,
+          # and files of other types are not added
+          logging.debug(f"Skipping {localPath} - it does not look like an image slice")
+      filesToAdd.extend(sorted(droppedFiles, key=stack_discovery.naturalSortKey))
+    return filesToAdd
 
   def dropEvent(self):
     slicer.util.selectModule('ImageStacks')
@@ -625,6 +708,10 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
     ScriptedLoadableModuleLogic.__init__(self)
     self._filePaths = []
     self.originalVolumeDimensions = [0, 0, 0]
+    # Numbering gaps, duplicate numbers and inconsistent slices found in filePaths (see stack_discovery)
+    self.stackProblems = []
+    # Number of slice headers compared with the first slice when filePaths is set
+    self.numberOfSampledHeaders = 16
     self.originalVolumeIJKToRAS = numpy.diag([-1.0, -1.0, 1.0, 1.0])
     self.originalVolumeRecommendedSpacing = [0.0, 0.0, 0.0]
     self.originalVolumeVoxelDataType = numpy.dtype('uint8')
@@ -638,6 +725,20 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
     # but image coordinate system in files is always LPS, therefore we invert the
     # sign of the first two axes when we compute image extents.
     self.outputVolumeBounds = None
+    # Number of threads decoding slices in loadVolume, 0 selects it from the number of CPU cores
+    self.numberOfReadThreads = 0
+    self.downsamplingMethod = downsample.AVERAGE # valid values: average (block mean), nearest (striding)
+    # Decode only the in-plane region of interest of each slice where the file format allows it
+    self.partialReads = True
+    # Output slices held in memory when writing the volume to a file with writeVolumeToFile
+    self.sliceWindowSize = 32
+    self.lastReadStatistics = None
+    self._nrrdSliceReader = None
+    self._nrrdSliceReaderModifiedTime = None
+    # Intensity window of convertTo8Bit
+    self.lowerPercentile = 1.0
+    self.upperPercentile = 99.0
+    self.percentileRangeExpansion = 0.1
 
   @staticmethod
   def humanizeByteCount(byteCount):
@@ -669,6 +770,10 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
 
     self._filePaths = filePaths
     self.originalVolumeDimensions = [0, 0, 0]
+    self.stackProblems = []
+    if self._nrrdSliceReader is not None:
+      self._nrrdSliceReader.close()
+      self._nrrdSliceReader = None
     self.originalVolumeRecommendedSpacing = [0.0, 0.0, 0.0]
 
     if not self._filePaths:
@@ -691,16 +796,22 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
         self.originalVolumeRecommendedSpacing = reader.GetSpacing()
 
     else:
-        image = reader.Execute()
-        sliceArray = sitk.GetArrayFromImage(image)
+        # only the header of the first slice is read
+        reader.ReadImageInformation()
+        size = reader.GetSize()
 
-        self.originalVolumeDimensions = [sliceArray.shape[1], sliceArray.shape[0], len(filePaths)]
-        self.originalVolumeNumberOfScalarComponents = sliceArray.shape[2] if len(sliceArray.shape) == 3 else 1
-        self.originalVolumeVoxelDataType = numpy.dtype(sliceArray.dtype)
+        self.originalVolumeDimensions = [size[0], size[1], len(filePaths)]
+        self.originalVolumeNumberOfScalarComponents = reader.GetNumberOfComponents()
+        pixelType=reader.GetPixelID()
+        self.originalVolumeVoxelDataType = sitk.GetArrayFromImage(sitk.Image(1,1,1,pixelType)).dtype
 
-        firstSliceSpacing = image.GetSpacing()
+        firstSliceSpacing = reader.GetSpacing()
         self.originalVolumeRecommendedSpacing = [firstSliceSpacing[1], firstSliceSpacing[0], 0.0]
 
+        self.stackProblems = stack_discovery.stackProblems(self._filePaths, self.numberOfSampledHeaders)
+        for problem in self.stackProblems:
+          logging.warning(problem)
+
   def setOriginalVolumeSpacing(self, spacing):
     # Volume is in LPS, therefore we invert the first two axes
     self.originalVolumeIJKToRAS = numpy.diag([-spacing[0], -spacing[1], spacing[2], 1.0])
@@ -744,102 +855,19 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
     numberOfScalarComponents = 1 if self.outputGrayscale else self.originalVolumeNumberOfScalarComponents
     return ijkToRAS, extent, numberOfScalarComponents
 
-  def loadVolume(self, outputNode=None, progressCallback=None):
+  def loadVolume(self, outputNode=None, progressCallback=None, histogram=None):
     """
     Load the files in paths to outputNode.
-    TODO: currently downsample is done with nearest neighbor filtering
-    (i.e. skip slices and take every other row/column).
-    It would be better to do a high order spline or other
-    method, but there is no convenient streaming option for these.
-    One option will be do to a box filter by averaging adjacent
-    slices/row/columns which should be easy in numpy
-    and give good results for a pixel aligned 50% scale operation.
+    Downsampling for half and preview quality averages the blocks of voxels
+    (box filter), or takes every other row/column/slice if downsamplingMethod is 'nearest'.
+    If a StreamingHistogram is given, the slices are added to it as they are read.
     """
 
-    ijkToRAS, extent, numberOfScalarComponents = self.outputVolumeGeometry()
-    outputSpacing = [numpy.linalg.norm(ijkToRAS[0:3,i]) for i in range(3)]
-    originalVolumeSpacing = [numpy.linalg.norm(self.originalVolumeIJKToRAS[0:3, i]) for i in range(3)]
-
-    validSpacing = all([spacingComponent > 0 for spacingComponent in originalVolumeSpacing])
-    if not validSpacing:
-      raise ValueError("Invalid original volume spacing. All values must be greater than 0.")
-
-    stepSize = [int(outputSpacing[i] / originalVolumeSpacing[i]) for i in range(3)]
-
-    filePath = self._filePaths[0]
-    fileExtension = os.path.splitext(filePath)[1]
-    isNrrd = fileExtension.lower() == ".nhdr" or fileExtension.lower() == ".nrrd"
-    if isNrrd:
-      paths = ([filePath] * self.originalVolumeDimensions[2])
-    else:
-      paths = self._filePaths
-
-    # Keep every stepSize[2]'th slice
-    paths = paths[::stepSize[2]]
-
-    if self.reverseSliceOrder:
-      paths.reverse()
-
-    volumeArray = None
-    sliceIndex = 0
-    firstArrayFullShape = None
-
-    for inputSliceIndex, path in enumerate(paths):
-
-      if progressCallback:
-        toContinue = progressCallback(inputSliceIndex/len(paths))
-        if not toContinue:
-          raise ValueError("User requested cancel")
-
-      if inputSliceIndex < extent[4] or inputSliceIndex > extent[5]:
-        # out of selected bounds
-        continue
-
-      if isNrrd:
-        sliceArray = self.loadNrrdSlice(path, inputSliceIndex * stepSize[2])
-      else:
-        reader = sitk.ImageFileReader()
-        reader.SetFileName(path)
-        image = reader.Execute()
-
-        sliceArray = sitk.GetArrayFromImage(image)
-
-      if len(sliceArray.shape) == 3 and self.outputGrayscale:
-        # We convert to grayscale by simply taking the first component, which is appropriate for cases when grayscale image is stored as R=G=B,
-        # but to convert real RGB images it could better to compute the mean or luminance.
-        sliceArray = sliceArray[:,:,0]
-      currentArrayFullShape = sliceArray.shape
-      if firstArrayFullShape is None:
-        firstArrayFullShape = currentArrayFullShape
-      if volumeArray is None:
-        shape = [extent[5]-extent[4]+1, extent[3]-extent[2]+1, extent[1]-extent[0]+1]
-        if len(sliceArray.shape) == 3:
-          shape.append(sliceArray.shape[2])
-        volumeArray = numpy.zeros(shape, dtype=sliceArray.dtype)
-      if len(sliceArray.shape) == 3:
-        # vector volume
-        sliceArray = sliceArray[
-          extent[2]*stepSize[1]:(extent[3]+1)*stepSize[1]:stepSize[1],
-          extent[0]*stepSize[0]:(extent[1]+1)*stepSize[0]:stepSize[0], :]
-      else:
-        # grayscale volume
-        sliceArray = sliceArray[
-                     extent[2] * stepSize[1]:(extent[3] + 1) * stepSize[1]:stepSize[1],
-                     extent[0] * stepSize[0]:(extent[1] + 1) * stepSize[0]:stepSize[0]]
-
-      if (sliceIndex > 0) and (volumeArray[sliceIndex].shape != sliceArray.shape):
-        logging.debug("After downsampling, {} size is {} x {}\n\n{} size is {} x {} ({} scalar components)".format(
-          paths[0], volumeArray[0].shape[0], volumeArray[0].shape[1],
-          path, sliceArray.shape[0], sliceArray.shape[1],
-          sliceArray.shape[2] if len(sliceArray.shape)==3 else 1))
-        message = "There are multiple datasets in the folder. Please select a single file as a sample or specify a pattern.\nDetails:\n"
-        message += f"{paths[0]} size is {firstArrayFullShape[0]} x {firstArrayFullShape[1]} ({firstArrayFullShape[2] if len(firstArrayFullShape)==3 else 1} scalar components)\n\n"
-        message += f"{path} size is {currentArrayFullShape[0]} x {currentArrayFullShape[1]} ({currentArrayFullShape[2] if len(currentArrayFullShape)==3 else 1} scalar components)"
-        raise ValueError(message)
-
-      volumeArray[sliceIndex] = sliceArray
-      sliceIndex += 1
+    volumeArray, ijkToRAS, paths = self.readVolumeArray(progressCallback, histogram)
+    return self.updateVolumeNode(outputNode, volumeArray, ijkToRAS, os.path.splitext(os.path.basename(paths[0]))[0])
 
+  def updateVolumeNode(self, outputNode, volumeArray, ijkToRAS, name):
+    """Set the voxels and geometry of outputNode, or of a new volume node called name if outputNode is None"""
     newVolume = False
     if not outputNode:
       newVolume = True
@@ -847,9 +875,6 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
         outputNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
       else:
         outputNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode")
-      path = paths[0]
-      fileName = os.path.basename(path)
-      name = os.path.splitext(fileName)[0]
       outputNode.SetName(name)
 
     # Check if output volume is the correct type
@@ -875,238 +900,251 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
     slicer.util.setSliceViewerLayers(background=outputNode, fit=True)
     return outputNode
 
-  def loadNrrdSlice(self, filename, sliceIndex):
-
-    try:
-      import nrrd
-    except ImportError:
-      slicer.util.pip_install("pynrrd")
-      import nrrd
-
-    from nrrd.types import IndexOrder, NRRDFieldMap, NRRDFieldType, NRRDHeader
-    from typing import Optional, IO, List
-    import nptyping as npt
-    from nrrd import NRRDError
-    from nrrd.reader import _NRRD_REQUIRED_FIELDS, _determine_datatype, _READ_CHUNKSIZE
-    import zlib
-    import numpy as np
-    import os
-    import io
-    import bz2
-
-    def read_data(header: NRRDHeader, fh: Optional[IO] = None, filename: Optional[str] = None,
-                  index_order: IndexOrder = 'F', extract_slice_range: Optional[list[int]] = None) -> npt.NDArray:
-        """Read data from file into :class:`numpy.ndarray`
-
-        The two parameters :obj:`fh` and :obj:`filename` are optional depending on the parameters but it never hurts to
-        specify both. The file handle (:obj:`fh`) is necessary if the header is attached with the NRRD data. However, if
-        the NRRD data is detached from the header, then the :obj:`filename` parameter is required to obtain the absolute
-        path to the data file.
-
-        See :ref:`background/how-to-use:reading nrrd files` for more information on reading NRRD files.
-
-        Parameters
-        ----------
-        header : :class:`dict` (:class:`str`, :obj:`Object`)
-            Parsed fields/values obtained from :meth:`read_header` function
-        fh : file-object, optional
-            File object pointing to first byte of data. Only necessary if data is attached to header.
-        filename : :class:`str`, optional
-            Filename of the header file. Only necessary if data is detached from the header. This is used to get the
-            absolute data path.
-        index_order : {'C', 'F'}, optional
-            Specifies the index order of the resulting data array. Either 'C' (C-order) where the dimensions are ordered
-            from slowest-varying to fastest-varying (e.g. (z, y, x)), or 'F' (Fortran-order) where the dimensions are
-            ordered from fastest-varying to slowest-varying (e.g. (x, y, z)).
-
-        Returns
-        -------
-        data : :class:`numpy.ndarray`
-            Data read from NRRD file
-
-        See Also
-        --------
-        :meth:`read`, :meth:`read_header`
-        """
-
-        if index_order not in ['F', 'C']:
-            raise NRRDError('Invalid index order')
-
-        # Check that the required fields are in the header
-        for field in _NRRD_REQUIRED_FIELDS:
-            if field not in header:
-                raise NRRDError(f'Header is missing required field: {field}')
-
-        if header['dimension'] != len(header['sizes']):
-            raise NRRDError(f'Number of elements in sizes does not match dimension. Dimension: {header["dimension"]}, '
-                            f'len(sizes): {len(header["sizes"])}')
-
-        # Determine the data type from the header
-        dtype = _determine_datatype(header)
-
-        # Determine the byte skip, line skip and the data file
-        # These all can be written with or without the space according to the NRRD spec, so we check them both
-        line_skip = header.get('lineskip', header.get('line skip', 0))
-        byte_skip = header.get('byteskip', header.get('byte skip', 0))
-        data_filename = header.get('datafile', header.get('data file', None))
-
-        # If the data file is separate from the header file, then open the data file to read from that instead
-        if data_filename is not None:
-            # If the pathname is relative, then append the current directory from the filename
-            if not os.path.isabs(data_filename):
-                if filename is None:
-                    raise NRRDError('Filename parameter must be specified when a relative data file path is given')
-
-                data_filename = os.path.join(os.path.dirname(filename), data_filename)
-
-            # Override the fh parameter with the data filename
-            # Note that this is opened without a "with" block, thus it must be closed manually in all circumstances
-            fh = open(data_filename, 'rb')
-
-        # Get the total number of data points by multiplying the size of each dimension together
-        total_data_points = header['sizes'].prod(dtype=np.int64)
-
-        # Skip the number of lines requested when line_skip >= 0
-        # Irrespective of the NRRD file having attached/detached header
-        # Lines are skipped before getting to the beginning of the data
-        if line_skip >= 0:
-            for _ in range(line_skip):
-                fh.readline()
-        else:
-            # Must close the file because if the file was opened above from detached filename, there is no "with" block to
-            # close it for us
-            fh.close()
-
-            raise NRRDError('Invalid lineskip, allowed values are greater than or equal to 0')
-
-        extract = extract_slice_range is not None
-        if extract:
-            frame_item_count = header['sizes'][0] * header['sizes'][1]
-            byte_offset_for_extract = int(extract_slice_range[0]) * int(frame_item_count) * int(dtype.itemsize)
-            extract_item_count = (extract_slice_range[1] - extract_slice_range[0]) * frame_item_count
-        else:
-            byte_offset_for_extract = 0
-            extract_item_count = total_data_points
-            # dtype.itemsize
-
-        # Skip the requested number of bytes or seek backward, and then parse the data using NumPy
-        if byte_skip < -1:
-            # Must close the file because if the file was opened above from detached filename, there is no "with" block to
-            # close it for us
-            fh.close()
-            raise NRRDError('Invalid byteskip, allowed values are greater than or equal to -1')
-        elif byte_skip >= 0:
-            fh.seek(byte_skip + byte_offset_for_extract, os.SEEK_CUR)
-        elif byte_skip == -1 and header['encoding'] not in ['gzip', 'gz', 'bzip2', 'bz2']:
-            fh.seek(-dtype.itemsize * total_data_points + byte_offset_for_extract, os.SEEK_END)
-        else:
-            # The only case left should be: byte_skip == -1 and header['encoding'] == 'gzip'
-            byte_skip = -dtype.itemsize * total_data_points + byte_offset_for_extract
-
-        # If a compression encoding is used, then byte skip AFTER decompressing
-        if header['encoding'] == 'raw':
-            if isinstance(fh, io.BytesIO):
-                raw_data = bytearray(fh.read(extract_item_count * dtype.itemsize))
-                data = np.frombuffer(raw_data, dtype)
-            else:
-                data = np.fromfile(fh, dtype, count = extract_item_count)
-        elif header['encoding'] in ['ASCII', 'ascii', 'text', 'txt']:
-
-            if extract:
-                # Must close the file because if the file was opened above from detached filename, there is no "with" block to
-                # close it for us
-                fh.close()
-
-                raise NRRDError(f'Slice extraction is not supported for ASCII data')
-
-            if isinstance(fh, io.BytesIO):
-                data = np.fromstring(fh.read(), dtype, sep=' ')
-            else:
-                data = np.fromfile(fh, dtype, sep=' ')
-        else:
-            # Handle compressed data now
-
-            if extract:
-                # Must close the file because if the file was opened above from detached filename, there is no "with" block to
-                # close it for us
-                fh.close()
-
-                raise NRRDError(f'Slice extraction is not supported for compressed data')
-
-            # Construct the decompression object based on encoding
-            if header['encoding'] in ['gzip', 'gz']:
-                decompobj = zlib.decompressobj(zlib.MAX_WBITS | 16)
-            elif header['encoding'] in ['bzip2', 'bz2']:
-                decompobj = bz2.BZ2Decompressor()
-            else:
-                # Must close the file because if the file was opened above from detached filename, there is no "with" block
-                # to close it for us
-                fh.close()
 
-                raise NRRDError(f'Unsupported encoding: {header["encoding"]}')
-
-            # Loop through the file and read a chunk at a time (see _READ_CHUNKSIZE why it is read in chunks)
-            decompressed_data = bytearray()
-
-            # Read all the remaining data from the file
-            # Obtain the length of the compressed data since we will be using it repeatedly, more efficient
-            compressed_data = fh.read()
-            compressed_data_len = len(compressed_data)
-            start_index = 0
-
-            # Loop through data and decompress it chunk by chunk
-            while start_index < compressed_data_len:
-                # Calculate the end index = start index plus chunk size
-                # Set to the string length to read the remaining chunk at the end
-                end_index = min(start_index + _READ_CHUNKSIZE, compressed_data_len)
-
-                # Decompress and append data
-                decompressed_data += decompobj.decompress(compressed_data[start_index:end_index])
-
-                # Update start index
-                start_index = end_index
+  def sliceReader(self):
+    """
+    Prepare reading the output volume one slice at a time.
+    For half and preview quality each output voxel is the mean of the block of input voxels it covers,
+    unless downsamplingMethod is 'nearest'. Input slices are added to a per output slice accumulator
+    as they are decoded, so the full resolution volume is never held in memory.
+    If partialReads is set, only the in-plane window of the region of interest is decoded from
+    TIFF files and raw NRRD files (see region_reader), other files are cropped after decoding.
+    Returns readSlice(outputSliceIndex), which returns the output slice, the shape of its input slices
+    and the number of bytes decoded, the output slice indices within the region of interest,
+    the IJK to RAS matrix of the output and the path of each output slice.
+    """
 
-            # Delete the compressed data since we do not need it anymore
-            # This could potentially be using a lot of memory
-            del compressed_data
+    ijkToRAS, extent, numberOfScalarComponents = self.outputVolumeGeometry()
+    outputSpacing = [numpy.linalg.norm(ijkToRAS[0:3,i]) for i in range(3)]
+    originalVolumeSpacing = [numpy.linalg.norm(self.originalVolumeIJKToRAS[0:3, i]) for i in range(3)]
 
-            # Byte skip is applied AFTER the decompression. Skip first x bytes of the decompressed data and parse it using
-            # NumPy
-            data = np.frombuffer(decompressed_data[byte_skip:], dtype)
+    validSpacing = all([spacingComponent > 0 for spacingComponent in originalVolumeSpacing])
+    if not validSpacing:
+      raise ValueError("Invalid original volume spacing. All values must be greater than 0.")
 
-        # Close the file, even if opened using "with" block, closing it manually does not hurt
-        fh.close()
+    stepSize = [int(outputSpacing[i] / originalVolumeSpacing[i]) for i in range(3)]
+    # Slices between the ones kept by slice skip are not read, so only the quality factor is averaged along the slice axis,
+    # over the kept slices
+    averaging = self.downsamplingMethod == downsample.AVERAGE
+    keptSliceStep = 1 + self.sliceSkip
+    slicesPerOutputSlice = stepSize[2] // keptSliceStep if averaging else 1
+    if stepSize == [1, 1, 1] and slicesPerOutputSlice == 1:
+      # full quality: each output slice is a decoded slice, nothing to average
+      averaging = False
 
-        if extract_item_count != data.size:
-            raise NRRDError(f'Size of the data does not equal the product of all the dimensions: '
-                            f'{total_data_points}-{data.size}={total_data_points - data.size}')
+    filePath = self._filePaths[0]
+    fileExtension = os.path.splitext(filePath)[1]
+    isNrrd = fileExtension.lower() == ".nhdr" or fileExtension.lower() == ".nrrd"
+    numberOfInputSlices = self.originalVolumeDimensions[2] if isNrrd else len(self._filePaths)
 
-        # In the NRRD header, the fields are specified in Fortran order, i.e, the first index is the one that changes
-        # fastest and last index changes slowest. This needs to be taken into consideration since numpy uses C-order
-        # indexing.
+    # Keep every stepSize[2]'th slice
+    firstInputSlices = list(range(numberOfInputSlices))[::stepSize[2]]
 
-        # The array shape from NRRD (x,y,z) needs to be reversed as numpy expects (z,y,x).
-        sizes = [header['sizes'][0], header['sizes'][1], extract_slice_range[1]-extract_slice_range[0]]
-        data = np.reshape(data, tuple(sizes[::-1]))
+    if self.reverseSliceOrder:
+      firstInputSlices.reverse()
+    paths = [filePath if isNrrd else self._filePaths[inputSliceIndex] for inputSliceIndex in firstInputSlices]
+    # opened here, as slices are decoded on several threads
+    nrrdReader = self.nrrdSliceReader(filePath) if isNrrd else None
+
+    # In-plane window of the input slices covered by the output extent
+    rowRange = (extent[2] * stepSize[1], (extent[3] + 1) * stepSize[1])
+    columnRange = (extent[0] * stepSize[0], (extent[1] + 1) * stepSize[0])
+
+    def decodeSlice(inputSliceIndex):
+      """Returns the window of the input slice, the shape of the whole slice and the number of bytes decoded"""
+      if not self.partialReads:
+        if isNrrd:
+          sliceArray = nrrdReader.readSlice(inputSliceIndex)
+        else:
+          reader = sitk.ImageFileReader()
+          reader.SetFileName(self._filePaths[inputSliceIndex])
+          image = reader.Execute()
+
+          sliceArray = sitk.GetArrayFromImage(image)
+        fullShape = sliceArray.shape
+        decodedByteCount = sliceArray.nbytes
+        sliceArray = downsample.cropSlice(sliceArray, extent, stepSize)
+      elif isNrrd:
+        sliceArray, fullShape, decodedByteCount = nrrdReader.readSliceRegion(inputSliceIndex, rowRange, columnRange)
+      else:
+        sliceArray, fullShape, decodedByteCount = region_reader.readSliceRegion(self._filePaths[inputSliceIndex], rowRange, columnRange)
 
-        # Transpose data to enable Fortran indexing if requested.
-        if index_order == 'F':
-            data = data.T
+      if len(sliceArray.shape) == 3 and self.outputGrayscale:
+        # We convert to grayscale by simply taking the first component, which is appropriate for cases when grayscale image is stored as R=G=B,
+        # but to convert real RGB images it could better to compute the mean or luminance.
+        sliceArray = sliceArray[:,:,0]
+      return sliceArray, fullShape, decodedByteCount
+
+    def readSlice(outputSliceIndex):
+      """Returns the output slice, the shape of the input slices and the number of bytes decoded"""
+      firstInputSlice = firstInputSlices[outputSliceIndex]
+      inputSlices = range(firstInputSlice, min(firstInputSlice + slicesPerOutputSlice * keptSliceStep, numberOfInputSlices), keptSliceStep)
+      accumulator = None
+      decodedByteCount = 0
+      for inputSliceIndex in inputSlices:
+        sliceArray, fullShape, byteCount = decodeSlice(inputSliceIndex)
+        decodedByteCount += byteCount
+        if not averaging:
+          return sliceArray[::stepSize[1], ::stepSize[0]], fullShape, decodedByteCount
+        outputShape = (sliceArray.shape[0] // stepSize[1], sliceArray.shape[1] // stepSize[0]) + sliceArray.shape[2:]
+        if accumulator is None:
+          accumulator = downsample.BlockMeanAccumulator(outputShape, sliceArray.dtype, stepSize)
+        elif accumulator.outputShape != outputShape:
+          # slice of a different dataset, the size mismatch is reported by the caller
+          return sliceArray[::stepSize[1], ::stepSize[0]], fullShape, decodedByteCount
+        accumulator.add(sliceArray)
+      return accumulator.mean(), fullShape, decodedByteCount
+
+    # Slices within the selected bounds
+    outputSliceIndices = [outputSliceIndex for outputSliceIndex in range(len(paths)) if extent[4] <= outputSliceIndex <= extent[5]]
+    return readSlice, outputSliceIndices, ijkToRAS, paths
+
+  def readSlices(self, readSlice, outputSliceIndices, paths, allocateOutput, progressCallback=None, sliceCompletedCallback=None, maxQueuedSlices=0):
+    """
+    Read the output slices from sliceReader, decoding slices on numberOfReadThreads worker threads.
+    The first slice is read here, then allocateOutput(shape, dtype) is called with the shape of the
+    output volume and returns a function that maps a slice position (index in outputSliceIndices)
+    to the array the slice is written to. sliceCompletedCallback(position) is called in slice order
+    from this thread once a slice is written. Throughput is logged and kept in lastReadStatistics.
+    """
+    firstSliceArray, firstArrayFullShape, firstByteCount = readSlice(outputSliceIndices[0])
+    shape = [len(outputSliceIndices), firstSliceArray.shape[0], firstSliceArray.shape[1]]
+    if len(firstSliceArray.shape) == 3:
+      shape.append(firstSliceArray.shape[2])
+    sliceBuffer = allocateOutput(shape, firstSliceArray.dtype)
+    sliceBuffer(0)[...] = firstSliceArray
+    if sliceCompletedCallback:
+      sliceCompletedCallback(0)
+
+    def readSliceIntoVolume(position):
+      outputSliceIndex = outputSliceIndices[position]
+      sliceArray, currentArrayFullShape, decodedByteCount = readSlice(outputSliceIndex)
+      path = paths[outputSliceIndex]
+      if firstSliceArray.shape != sliceArray.shape:
+        logging.debug("After downsampling, {} size is {} x {}\n\n{} size is {} x {} ({} scalar components)".format(
+          paths[0], firstSliceArray.shape[0], firstSliceArray.shape[1],
+          path, sliceArray.shape[0], sliceArray.shape[1],
+          sliceArray.shape[2] if len(sliceArray.shape)==3 else 1))
+        message = "There are multiple datasets in the folder. Please select a single file as a sample or specify a pattern.\nDetails:\n"
+        message += f"{paths[0]} size is {firstArrayFullShape[0]} x {firstArrayFullShape[1]} ({firstArrayFullShape[2] if len(firstArrayFullShape)==3 else 1} scalar components)\n\n"
+        message += f"{path} size is {currentArrayFullShape[0]} x {currentArrayFullShape[1]} ({currentArrayFullShape[2] if len(currentArrayFullShape)==3 else 1} scalar components)"
+        raise ValueError(message)
+      sliceBuffer(position)[...] = sliceArray
+      return decodedByteCount
+
+    self.lastReadStatistics = slice_reader.readSlicesInParallel(readSliceIntoVolume, range(1, len(outputSliceIndices)),
+      numberOfThreads=self.numberOfReadThreads, progressCallback=progressCallback,
+      completedCallback=sliceCompletedCallback, maxQueuedSlices=maxQueuedSlices)
+    self.lastReadStatistics["slices"] += 1
+    self.lastReadStatistics["bytes"] += firstByteCount
+    self.lastReadStatistics.update(slice_reader.throughput(self.lastReadStatistics))
+    downsampled = self.downsamplingMethod == downsample.AVERAGE and self.outputQuality != 'full'
+    slice_reader.logStatistics(self.lastReadStatistics, "Read and downsampled" if downsampled else "Read")
+    return self.lastReadStatistics
+
+  def readVolumeArray(self, progressCallback=None, histogram=None):
+    """
+    Read the selected slices into a new array, adding them to histogram (StreamingHistogram) if given.
+    Returns the volume array (slice, row, column[, component]), the IJK to RAS matrix and the slice paths.
+    """
+    readSlice, outputSliceIndices, ijkToRAS, paths = self.sliceReader()
+    volumeArray = None
+    def allocateOutput(shape, dtype):
+      nonlocal volumeArray
+      volumeArray = numpy.zeros(shape, dtype=dtype)
+      return volumeArray.__getitem__
+    sliceCompleted = (lambda position: histogram.add(volumeArray[position])) if histogram is not None else None
+    self.readSlices(readSlice, outputSliceIndices, paths, allocateOutput, progressCallback, sliceCompletedCallback=sliceCompleted)
+    return volumeArray, ijkToRAS, paths
+
+  def writeVolumeToFile(self, outputFilePath, progressCallback=None, proxyFactor=0, histogram=None):
+    """
+    Stream the selected slices to a raw NRRD file without holding the volume in memory.
+    Slices are written through a memory map in windows of sliceWindowSize slices, so memory use is
+    bounded by about 2 * sliceWindowSize output slices plus the slices being decoded.
+    If proxyFactor > 1, a copy downsampled by block averaging with that factor is built while writing.
+    If a StreamingHistogram is given, the slices are added to it as they are written.
+    Returns the proxy array (None if not requested) and its IJK to RAS matrix, and the slice paths.
+    """
+    readSlice, outputSliceIndices, ijkToRAS, paths = self.sliceReader()
+    writer = None
+    proxy = None
+    def allocateOutput(shape, dtype):
+      nonlocal writer, proxy
+      writer = volume_file.NrrdSliceWriter(outputFilePath, shape, dtype, ijkToRAS, self.sliceWindowSize)
+      if proxyFactor > 1:
+        proxy = downsample.VolumeBlockMean(shape, dtype, proxyFactor)
+      return writer.sliceBuffer
+    def sliceCompleted(position):
+      if proxy is not None:
+        proxy.add(writer.sliceBuffer(position))
+      if histogram is not None:
+        histogram.add(writer.sliceBuffer(position))
+      writer.commitSlice(position)
+
+    # slices being decoded use the ring buffer of the writer, so there cannot be more than a window of them
+    try:
+      self.readSlices(readSlice, outputSliceIndices, paths, allocateOutput, progressCallback,
+        sliceCompletedCallback=sliceCompleted, maxQueuedSlices=max(1, min(self.sliceWindowSize, len(outputSliceIndices))))
+    finally:
+      if writer:
+        writer.close()
+    self.lastReadStatistics["bufferBytes"] = writer.bufferByteCount
+    logging.info(f"Wrote {outputFilePath} using {writer.bufferByteCount / 1024**2:.1f} MB of slice buffers")
+
+    if proxy is None:
+      return None, None, paths
+    proxyIJKToRAS = numpy.dot(ijkToRAS, numpy.diag([proxyFactor, proxyFactor, proxyFactor, 1.0]))
+    return proxy.result(), proxyIJKToRAS, paths
+
+  def loadVolumeThroughFile(self, outputFilePath, progressCallback=None, proxyFactor=1, histogram=None):
+    """
+    Import the volume by streaming it to outputFilePath (see writeVolumeToFile), then load it into the scene:
+    the file itself if proxyFactor is 1, a copy downsampled by proxyFactor if it is larger,
+    nothing if it is 0. Returns the loaded volume node or None.
+    """
+    proxyArray, proxyIJKToRAS, paths = self.writeVolumeToFile(outputFilePath, progressCallback, proxyFactor, histogram)
+    if proxyFactor == 0:
+      return None
+    if proxyFactor == 1:
+      outputNode = slicer.util.loadVolume(outputFilePath)
+      slicer.util.setSliceViewerLayers(background=outputNode, fit=True)
+      return outputNode
+    name = os.path.splitext(os.path.basename(outputFilePath))[0] + f" proxy x{proxyFactor}"
+    return self.updateVolumeNode(None, proxyArray, proxyIJKToRAS, name)
+
+  def nrrdSliceReader(self, filename):
+    """
+    Slice reader of a NRRD file. The header is parsed once and the reader is kept
+    for the following slices, until another file is used or the file is modified.
+    """
+    modifiedTime = os.path.getmtime(filename)
+    if self._nrrdSliceReader is not None:
+      if self._nrrdSliceReader.filePath == filename and self._nrrdSliceReaderModifiedTime == modifiedTime:
+        return self._nrrdSliceReader
+      self._nrrdSliceReader.close()
+      self._nrrdSliceReader = None
 
-        return data
+    try:
+      import nrrd
+    except ImportError:
+      slicer.util.pip_install("pynrrd")
+      import nrrd
 
-    import nrrd
-    with open(filename, 'rb') as fh:
-        header = nrrd.read_header(fh)
-        sliceArray = read_data(header, fh, filename, index_order = "C", extract_slice_range = [sliceIndex, sliceIndex + 1])
-        sliceArray = sliceArray.squeeze()
+    self._nrrdSliceReader = volume_file.NrrdSliceReader(filename)
+    self._nrrdSliceReaderModifiedTime = modifiedTime
+    return self._nrrdSliceReader
 
-    return sliceArray
+  def loadNrrdSlice(self, filename, sliceIndex):
+    return self.nrrdSliceReader(filename).readSlice(sliceIndex)
 
-  def convertTo8Bit(self, volumeNode, progressCallback=None):
+  def convertTo8Bit(self, volumeNode, progressCallback=None, histogram=None):
     """
-    Convert a volume to 8-bit unsigned char using VTK's optimized intensity rescaling.
+    Convert a volume to 8-bit unsigned char using percentile-based intensity rescaling.
     This method operates on the output volume created by loadVolume().
+    The intensity window is taken between lowerPercentile and upperPercentile of the histogram and widened
+    by percentileRangeExpansion of its width on both sides (the defaults match VTK's AutoRange).
+    The volume is processed a few slices at a time, so the conversion only needs memory for the 8-bit copy.
 
     Parameters
     ----------
@@ -1114,6 +1152,8 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
         The volume node to convert
     progressCallback : callable, optional
         Callback function for progress updates
+    histogram : StreamingHistogram, optional
+        Histogram collected while the volume was read (see loadVolume). It is computed here if not given.
 
     Returns
     -------
@@ -1136,42 +1176,21 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
       logging.info("Volume is already 8-bit, no conversion needed")
       return volumeNode
 
-    if progressCallback:
-      progressCallback(0.1)
-
-    # Use vtkImageHistogramStatistics for optimal intensity thresholds
-    # This avoids saturation and provides robust threshold values automatically
-    histogramStatistics = vtk.vtkImageHistogramStatistics()
-    histogramStatistics.SetInputData(volumeNode.GetImageData())
-    histogramStatistics.Update()
-
-    # Get optimal threshold values using VTK's AutoRange
-    lowerValue = histogramStatistics.GetAutoRange()[0]
-    upperValue = histogramStatistics.GetAutoRange()[1]
+    if histogram is None or not histogram.valid or histogram.numberOfValues == 0:
+      histogram = intensity.histogramOfArray(volumeArray)
 
     if progressCallback:
-      progressCallback(0.3)
-
-    # Rescale intensities to 0-255 range
-    volumeArray = numpy.clip(volumeArray, lowerValue, upperValue)
-
-    # Prevent division by zero if lowerValue == upperValue (e.g., constant image)
-    if numpy.isclose(upperValue, lowerValue):
-      volumeArray = numpy.zeros_like(volumeArray)
-    else:
-      volumeArray = ((volumeArray - lowerValue) / (upperValue - lowerValue) * 255.0)
+      progressCallback(0.1)
 
-    if progressCallback:
-      progressCallback(0.6)
+    lowerValue, upperValue = histogram.autoRange(self.lowerPercentile, self.upperPercentile, self.percentileRangeExpansion)
 
-    # Cast to 8-bit unsigned char
-    volumeArray = volumeArray.astype(numpy.uint8)
-
-    if progressCallback:
-      progressCallback(0.8)
+    # Rescale intensities to 0-255 range, a chunk of slices at a time
+    outputArray = intensity.rescaleTo8Bit(volumeArray, lowerValue, upperValue,
+      progressCallback=(lambda fraction: progressCallback(0.1 + 0.8 * fraction)) if progressCallback else None)
+    del volumeArray
 
     # Update the volume node with converted data
-    slicer.util.updateVolumeFromArray(volumeNode, volumeArray)
+    slicer.util.updateVolumeFromArray(volumeNode, outputArray)
 
     # Update display node to reflect the new scalar range
     displayNode = volumeNode.GetDisplayNode()
@@ -1182,7 +1201,8 @@ class ImageStacksLogic(ScriptedLoadableModuleLogic):
     if progressCallback:
       progressCallback(1.0)
 
-    logging.info(f"Volume converted to 8-bit using VTK AutoRange: intensity range [{lowerValue:.2f}, {upperValue:.2f}] mapped to [0, 255]")
+    logging.info(f"Volume converted to 8-bit using the {self.lowerPercentile:g}-{self.upperPercentile:g} percentile range:"
+      f" intensity range [{lowerValue:.2f}, {upperValue:.2f}] mapped to [0, 255]")
 
     return volumeNode
 
@@ -1204,6 +1224,20 @@ class ImageStacksTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_ImageStacks1()
+    self.setUp()
+    self.test_ImageStacksParallelRead()
+    self.setUp()
+    self.test_ImageStacksBoxFilter()
+    self.setUp()
+    self.test_ImageStacksRegionRead()
+    self.setUp()
+    self.test_ImageStacksStreamToFile()
+    self.setUp()
+    self.test_ImageStacksNrrdSlices()
+    self.setUp()
+    self.test_ImageStacks8BitConversion()
+    self.setUp()
+    self.test_ImageStacksStackDiscovery()
 
   def test_ImageStacks1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -1243,3 +1277,454 @@ class ImageStacksTest(ScriptedLoadableModuleTest):
     qt.QTimer.singleShot(25000, thread.join)
 
     self.delayDisplay('Test passed!')
+
+  def writeTestStack(self, directoryPath, numberOfSlices=40, shape=(300, 200), dtype=numpy.uint16):
+    """Write a synthetic stack of tif files and return the file paths and the expected volume array"""
+    rng = numpy.random.default_rng(0)
+    volumeArray = rng.integers(0, numpy.iinfo(dtype).max, size=(numberOfSlices,)+shape, dtype=dtype)
+    paths = []
+    for sliceIndex in range(numberOfSlices):
+      path = os.path.join(directoryPath, f"slice_{sliceIndex:04d}.tif")
+      sitk.WriteImage(sitk.GetImageFromArray(volumeArray[sliceIndex]), path)
+      paths.append(path)
+    return paths, volumeArray
+
+  def test_ImageStacksParallelRead(self):
+    """ Read a synthetic stack sequentially and with several threads, check that the slices
+    land in the right place and that cancelling stops the read.
+    """
+    import tempfile
+    self.delayDisplay("Starting the parallel read test")
+
+    with tempfile.TemporaryDirectory() as directoryPath:
+      paths, expectedArray = self.writeTestStack(directoryPath)
+      logic = ImageStacksLogic()
+      logic.filePaths = paths
+      logic.setOriginalVolumeSpacing([1.0, 1.0, 1.0])
+      logic.outputQuality = 'full'
+
+      throughput = {}
+      for numberOfThreads in [1, 4]:
+        logic.numberOfReadThreads = numberOfThreads
+        volumeArray, ijkToRAS, _ = logic.readVolumeArray()
+        numpy.testing.assert_array_equal(volumeArray, expectedArray)
+        self.assertEqual(logic.lastReadStatistics["slices"], len(paths))
+        self.assertEqual(logic.lastReadStatistics["bytes"], expectedArray.nbytes)
+        throughput[numberOfThreads] = logic.lastReadStatistics["megabytesPerSecond"]
+      logging.info(f"Read throughput: 1 thread {throughput[1]:.1f} MB/s, 4 threads {throughput[4]:.1f} MB/s")
+
+      logic.reverseSliceOrder = True
+      volumeArray, _, _ = logic.readVolumeArray()
+      numpy.testing.assert_array_equal(volumeArray, expectedArray[::-1])
+      logic.reverseSliceOrder = False
+
+      logic.outputQuality = 'half'
+      logic.downsamplingMethod = 'nearest'
+      volumeArray, _, _ = logic.readVolumeArray()
+      numpy.testing.assert_array_equal(volumeArray, expectedArray[::2, ::2, ::2])
+
+      progressValues = []
+      def cancelAfterFiveSlices(progress):
+        progressValues.append(progress)
+        return len(progressValues) < 5
+      with self.assertRaises(ValueError):
+        logic.readVolumeArray(progressCallback=cancelAfterFiveSlices)
+      self.assertEqual(progressValues, sorted(progressValues))
+
+    self.delayDisplay('Test passed!')
+
+  def test_ImageStacksBoxFilter(self):
+    """ Compare block average and nearest neighbor downsampling on a stack with one voxel
+    thick structures, against the block mean of the full resolution volume.
+    """
+    import tempfile
+    import time
+    self.delayDisplay("Starting the box filter test")
+
+    with tempfile.TemporaryDirectory() as directoryPath:
+      paths, volumeArray = self.writeTestStack(directoryPath, numberOfSlices=64, shape=(256, 256), dtype=numpy.uint8)
+      # smooth background with thin bright planes that striding skips
+      grid = numpy.indices(volumeArray.shape).sum(axis=0)
+      volumeArray[:] = (grid % 64) + volumeArray // 16
+      volumeArray[:, 65::8, :] = 255
+      volumeArray[33::4, :, :] = 255
+      for sliceIndex, path in enumerate(paths):
+        sitk.WriteImage(sitk.GetImageFromArray(volumeArray[sliceIndex]), path)
+
+      logic = ImageStacksLogic()
+      logic.filePaths = paths
+      logic.setOriginalVolumeSpacing([1.0, 1.0, 1.0])
+      for quality, factor in [('half', 2), ('preview', 4)]:
+        logic.outputQuality = quality
+        shape = [size // factor for size in volumeArray.shape]
+        blocks = volumeArray[:shape[0]*factor, :shape[1]*factor, :shape[2]*factor].reshape(shape[0], factor, shape[1], factor, shape[2], factor)
+        expected = blocks.mean(axis=(1, 3, 5))
+        errors = {}
+        for method in ['average', 'nearest']:
+          logic.downsamplingMethod = method
+          startTime = time.time()
+          outputArray, _, _ = logic.readVolumeArray()
+          readTime = time.time() - startTime
+          errors[method] = numpy.sqrt(numpy.mean((outputArray - expected)**2))
+          logging.info(f"{quality} quality, {method}: {readTime:.3f} s, RMS error from block mean {errors[method]:.2f}")
+        self.assertLess(errors['average'], 0.5)
+        self.assertLess(errors['average'], errors['nearest'] / 10)
+
+      # region of interest in half quality, blocks are aligned with the full volume
+      logic.outputQuality = 'half'
+      logic.downsamplingMethod = 'average'
+      logic.outputVolumeBounds = [-60, -20, -100, -40, 10, 40]
+      ijkToRAS, extent, _ = logic.outputVolumeGeometry()
+      outputArray, _, _ = logic.readVolumeArray()
+      full = volumeArray.astype(float)
+      for k, j, i in [(0, 0, 0), (3, 5, 7)]:
+        z, y, x = 2*(extent[4]+k), 2*(extent[2]+j), 2*(extent[0]+i)
+        self.assertEqual(outputArray[k, j, i], numpy.rint(full[z:z+2, y:y+2, x:x+2].mean()))
+
+      # with slice skip, only the kept slices are averaged
+      logic.outputVolumeBounds = None
+      logic.sliceSkip = 1
+      outputArray, _, _ = logic.readVolumeArray()
+      kept = full[::2]
+      shape = (kept.shape[0] // 2, full.shape[1] // 2, full.shape[2] // 2)
+      expected = numpy.rint(kept[:shape[0]*2, :shape[1]*2, :shape[2]*2].reshape(shape[0], 2, shape[1], 2, shape[2], 2).mean(axis=(1, 3, 5)))
+      numpy.testing.assert_array_equal(outputArray, expected)
+
+      # full quality slices are used as decoded, without block mean
+      logic.sliceSkip = 0
+      logic.outputQuality = 'full'
+      blockMeanAccumulator = downsample.BlockMeanAccumulator
+      accumulators = []
+      downsample.BlockMeanAccumulator = lambda *args: accumulators.append(args) or blockMeanAccumulator(*args)
+      try:
+        outputArray, _, _ = logic.readVolumeArray()
+      finally:
+        downsample.BlockMeanAccumulator = blockMeanAccumulator
+      self.assertEqual(accumulators, [])
+      numpy.testing.assert_array_equal(outputArray, volumeArray)
+
+    self.delayDisplay('Test passed!')
+
+  def test_ImageStacksRegionRead(self):
+    """ Import a small region of interest from a stack of large slices, decoding only the region
+    (deflate compressed TIFF, raw NRRD) or whole slices cropped afterwards, and compare the timings.
+    """
+    import tempfile
+    import time
+    self.delayDisplay("Starting the region read test")
+
+    with tempfile.TemporaryDirectory() as directoryPath:
+      numberOfSlices, shape = 16, (2048, 2048)
+      rng = numpy.random.default_rng(0)
+      volumeArray = rng.integers(0, 4096, size=(numberOfSlices,) + shape, dtype=numpy.uint16)
+      tiffPaths = []
+      for sliceIndex in range(numberOfSlices):
+        writer = sitk.ImageFileWriter()
+        writer.SetFileName(os.path.join(directoryPath, f"slice_{sliceIndex:04d}.tif"))
+        writer.SetUseCompression(True)
+        writer.SetCompressor("Deflate")
+        writer.Execute(sitk.GetImageFromArray(volumeArray[sliceIndex]))
+        tiffPaths.append(writer.GetFileName())
+      nrrdPath = os.path.join(directoryPath, "volume.nrrd")
+      sitk.WriteImage(sitk.GetImageFromArray(volumeArray), nrrdPath)
+      self.assertIsNotNone(region_reader.TiffLayout.fromFile(tiffPaths[0]))
+
+      logic = ImageStacksLogic()
+      for description, paths in [("deflate TIFF", tiffPaths), ("raw NRRD", [nrrdPath])]:
+        logic.filePaths = paths
+        logic.setOriginalVolumeSpacing([1.0, 1.0, 1.0])
+        logic.outputQuality = 'full'
+        logic.outputVolumeBounds = [-1100, -1000, -600, -500, 0, numberOfSlices]
+        ijkToRAS, extent, _ = logic.outputVolumeGeometry()
+        expectedArray = volumeArray[extent[4]:extent[5]+1, extent[2]:extent[3]+1, extent[0]:extent[1]+1]
+        readTimes = {}
+        decodedBytes = {}
+        for partialReads in [True, False]:
+          logic.partialReads = partialReads
+          startTime = time.time()
+          outputArray, _, _ = logic.readVolumeArray()
+          readTimes[partialReads] = time.time() - startTime
+          decodedBytes[partialReads] = logic.lastReadStatistics["bytes"]
+          numpy.testing.assert_array_equal(outputArray, expectedArray)
+        logging.info(f"{description}, {expectedArray.shape[2]} x {expectedArray.shape[1]} region of {shape[1]} x {shape[0]} slices:"
+          f" region read {readTimes[True]:.3f} s ({decodedBytes[True] / 1024**2:.1f} MB decoded),"
+          f" full slices {readTimes[False]:.3f} s ({decodedBytes[False] / 1024**2:.1f} MB decoded)")
+        self.assertEqual(decodedBytes[False], volumeArray.nbytes)
+        self.assertLess(decodedBytes[True], volumeArray.nbytes / 4)
+
+        # preview quality of the same region, blocks are aligned with the full volume
+        logic.outputQuality = 'preview'
+        _, extent, _ = logic.outputVolumeGeometry()
+        logic.partialReads = True
+        partialArray, _, _ = logic.readVolumeArray()
+        logic.partialReads = False
+        fullArray, _, _ = logic.readVolumeArray()
+        numpy.testing.assert_array_equal(partialArray, fullArray)
+      logic.filePaths = []
+
+      # formats without region access fall back to decoding whole slices
+      pngPaths = []
+      for sliceIndex in range(4):
+        pngPaths.append(os.path.join(directoryPath, f"slice_{sliceIndex:04d}.png"))
+        sitk.WriteImage(sitk.GetImageFromArray(volumeArray[sliceIndex, :512, :512]), pngPaths[-1])
+      regionArray, fullShape, decodedByteCount = region_reader.readSliceRegion(pngPaths[1], (100, 150), (500, 600))
+      numpy.testing.assert_array_equal(regionArray, volumeArray[1, 100:150, 500:512])
+      self.assertEqual(fullShape, (512, 512))
+      self.assertEqual(decodedByteCount, 512 * 512 * 2)
+
+    self.delayDisplay('Test passed!')
+
+  def test_ImageStacksStreamToFile(self):
+    """ Stream a stack to a NRRD file with a small slice window and compare the file, the proxy
+    and the peak memory with reading the volume in memory.
+    """
+    import tempfile
+    import tracemalloc
+    try:
+      import nrrd
+    except ImportError:
+      slicer.util.pip_install("pynrrd")
+      import nrrd
+    self.delayDisplay("Starting the streaming import test")
+
+    with tempfile.TemporaryDirectory() as directoryPath:
+      paths, _ = self.writeTestStack(directoryPath, numberOfSlices=128, shape=(256, 256))
+      logic = ImageStacksLogic()
+      logic.filePaths = paths
+      logic.setOriginalVolumeSpacing([0.5, 0.5, 0.25])
+      logic.outputQuality = 'full'
+      logic.numberOfReadThreads = 4
+      logic.sliceWindowSize = 4
+
+      tracemalloc.start()
+      volumeArray, ijkToRAS, _ = logic.readVolumeArray()
+      inMemoryPeak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+
+      outputFilePath = os.path.join(directoryPath, "streamed.nrrd")
+      tracemalloc.start()
+      proxyArray, proxyIJKToRAS, _ = logic.writeVolumeToFile(outputFilePath, proxyFactor=4)
+      streamingPeak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      logging.info(f"Peak memory for a {volumeArray.nbytes / 1024**2:.1f} MB volume: in memory {inMemoryPeak / 1024**2:.1f} MB,"
+        f" streaming with a {logic.sliceWindowSize} slice window {streamingPeak / 1024**2:.1f} MB")
+      self.assertLess(streamingPeak, volumeArray.nbytes / 4)
+
+      fileArray, header = nrrd.read(outputFilePath, index_order='C')
+      numpy.testing.assert_array_equal(fileArray, volumeArray)
+      numpy.testing.assert_allclose(header['space directions'], numpy.diag([0.5, 0.5, 0.25]))
+      numpy.testing.assert_allclose(header['space origin'], numpy.dot(numpy.diag([-1, -1, 1]), ijkToRAS[0:3, 3]))
+
+      blocks = volumeArray.reshape(32, 4, 64, 4, 64, 4).astype(float)
+      numpy.testing.assert_array_equal(proxyArray, numpy.rint(blocks.mean(axis=(1, 3, 5))))
+      numpy.testing.assert_allclose(proxyIJKToRAS[0:3, 0:3], numpy.diag([-2.0, -2.0, 1.0]))
+
+      # region of interest and downsampling are applied while streaming
+      logic.outputQuality = 'half'
+      logic.outputVolumeBounds = [-40, -10, -50, -20, 2, 6]
+      volumeArray, _, _ = logic.readVolumeArray()
+      logic.writeVolumeToFile(outputFilePath)
+      fileArray, header = nrrd.read(outputFilePath, index_order='C')
+      numpy.testing.assert_array_equal(fileArray, volumeArray)
+
+    self.delayDisplay('Test passed!')
+
+  def test_ImageStacksNrrdSlices(self):
+    """ Read slices of raw, gzip and bzip2 NRRD files in order, in reverse and from several threads,
+    and import a region of interest from a NRRD file.
+    """
+    import tempfile
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+      import nrrd
+    except ImportError:
+      slicer.util.pip_install("pynrrd")
+      import nrrd
+    self.delayDisplay("Starting the NRRD slice test")
+
+    rng = numpy.random.default_rng(1)
+    volumeArray = rng.integers(0, 1000, size=(60, 80, 70), dtype=numpy.int16)
+    with tempfile.TemporaryDirectory() as directoryPath:
+      for encoding in ['raw', 'gzip', 'bzip2']:
+        filePath = os.path.join(directoryPath, f"volume_{encoding}.nrrd")
+        nrrd.write(filePath, volumeArray, {'encoding': encoding}, index_order='C')
+        with volume_file.NrrdSliceReader(filePath, cachedSlices=4, checkpointInterval=8) as reader:
+          self.assertEqual(reader.numberOfSlices, volumeArray.shape[0])
+          startTime = time.time()
+          for sliceIndex in range(reader.numberOfSlices):
+            numpy.testing.assert_array_equal(reader.readSlice(sliceIndex), volumeArray[sliceIndex])
+          forwardTime = time.time() - startTime
+          startTime = time.time()
+          for sliceIndex in reversed(range(reader.numberOfSlices)):
+            numpy.testing.assert_array_equal(reader.readSlice(sliceIndex), volumeArray[sliceIndex])
+          reverseTime = time.time() - startTime
+          with ThreadPoolExecutor(4) as executor:
+            slices = list(executor.map(reader.readSlice, range(0, reader.numberOfSlices, 3)))
+          numpy.testing.assert_array_equal(numpy.array(slices), volumeArray[::3])
+        logging.info(f"{encoding} NRRD, {volumeArray.shape[0]} slices: forward {1000*forwardTime:.1f} ms, reverse {1000*reverseTime:.1f} ms")
+
+      # voxel type and byte order come from the header type and endian fields
+      for nrrdType, endian, dtype in [('unsigned short', 'big', '>u2'), ('float', 'little', '<f4'), ('uchar', 'big', 'u1')]:
+        headerPath = os.path.join(directoryPath, "typed.nhdr")
+        with open(headerPath, 'w') as headerFile:
+          headerFile.write(f"NRRD0004\ntype: {nrrdType}\ndimension: 3\nsizes: 70 80 2\nendian: {endian}\nencoding: raw\ndata file: typed.raw\n\n")
+        typedArray = volumeArray[:2].astype(dtype)
+        typedArray.tofile(os.path.join(directoryPath, "typed.raw"))
+        with volume_file.NrrdSliceReader(headerPath) as reader:
+          self.assertEqual(reader.dtype, numpy.dtype(dtype))
+          numpy.testing.assert_array_equal(reader.readSlice(1), typedArray[1])
+
+      # the header is parsed once per file, slices of a region of interest are read from the same reader
+      filePath = os.path.join(directoryPath, "volume_gzip.nrrd")
+      logic = ImageStacksLogic()
+      logic.filePaths = [filePath]
+      logic.setOriginalVolumeSpacing([1.0, 1.0, 1.0])
+      logic.outputQuality = 'full'
+      logic.outputVolumeBounds = [-30, -10, -50, -20, 20, 40]
+      self.assertIs(logic.nrrdSliceReader(filePath), logic.nrrdSliceReader(filePath))
+      outputArray, ijkToRAS, _ = logic.readVolumeArray()
+      _, extent, _ = logic.outputVolumeGeometry()
+      numpy.testing.assert_array_equal(outputArray,
+        volumeArray[extent[4]:extent[5]+1, extent[2]:extent[3]+1, extent[0]:extent[1]+1])
+      # releases the file
+      logic.filePaths = []
+
+    self.delayDisplay('Test passed!')
+
+  def test_ImageStacks8BitConversion(self):
+    """ Compare the streaming histogram and chunked 8-bit rescaling with VTK AutoRange and
+    whole-array rescaling, including peak memory on a 100 MB volume.
+    """
+    import tempfile
+    import tracemalloc
+    from vtk.util import numpy_support
+    self.delayDisplay("Starting the 8-bit conversion test")
+
+    rng = numpy.random.default_rng(2)
+    volumeArray = numpy.clip(rng.normal(20000, 3000, size=(200, 512, 512)), 0, 65535).astype(numpy.uint16)
+
+    # same window as vtkImageHistogramStatistics::GetAutoRange
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(volumeArray.shape[2], volumeArray.shape[1], volumeArray.shape[0])
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(volumeArray.ravel()))
+    histogramStatistics = vtk.vtkImageHistogramStatistics()
+    histogramStatistics.SetInputData(imageData)
+    histogramStatistics.Update()
+    histogram = intensity.histogramOfArray(volumeArray)
+    lowerValue, upperValue = histogram.autoRange()
+    numpy.testing.assert_allclose((lowerValue, upperValue), histogramStatistics.GetAutoRange(), atol=2.0)
+    numpy.testing.assert_allclose(histogram.percentile(50), numpy.percentile(volumeArray, 50), atol=1.0)
+    del imageData, histogramStatistics
+
+    # previous implementation: clip, scale and cast the whole array
+    tracemalloc.start()
+    expected = numpy.clip(volumeArray, lowerValue, upperValue)
+    expected = ((expected - lowerValue) / (upperValue - lowerValue) * 255.0)
+    expected = expected.astype(numpy.uint8)
+    wholeArrayPeak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    histogram = intensity.histogramOfArray(volumeArray)
+    outputArray = intensity.rescaleTo8Bit(volumeArray, *histogram.autoRange())
+    chunkedPeak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    logging.info(f"8-bit conversion of a {volumeArray.nbytes / 1024**2:.0f} MB volume, peak memory besides the input:"
+      f" whole array {wholeArrayPeak / 1024**2:.0f} MB, chunked {chunkedPeak / 1024**2:.0f} MB")
+    numpy.testing.assert_array_equal(outputArray, expected)
+    self.assertLess(chunkedPeak, 1.2 * outputArray.nbytes)
+
+    # user selected percentiles, signed and floating point volumes
+    lowerValue, upperValue = histogram.autoRange(5, 95, 0)
+    numpy.testing.assert_allclose((lowerValue, upperValue), numpy.percentile(volumeArray, [5, 95]), atol=1.0)
+    for dtype in [numpy.int16, numpy.float32]:
+      signedArray = (volumeArray[:20].astype(numpy.float64) - 20000).astype(dtype)
+      histogram = intensity.histogramOfArray(signedArray)
+      lowerValue, upperValue = histogram.autoRange(5, 95, 0)
+      numpy.testing.assert_allclose((lowerValue, upperValue), numpy.percentile(signedArray, [5, 95]), atol=1.0)
+      clipped = numpy.clip(signedArray, lowerValue, upperValue).astype(numpy.float64)
+      numpy.testing.assert_array_equal(intensity.rescaleTo8Bit(signedArray, lowerValue, upperValue),
+        ((clipped - lowerValue) / (upperValue - lowerValue) * 255.0).astype(numpy.uint8))
+
+    # histogram collected while slices are read
+    with tempfile.TemporaryDirectory() as directoryPath:
+      paths, stackArray = self.writeTestStack(directoryPath, numberOfSlices=20)
+      logic = ImageStacksLogic()
+      logic.filePaths = paths
+      logic.setOriginalVolumeSpacing([1.0, 1.0, 1.0])
+      logic.outputQuality = 'full'
+      histogram = intensity.StreamingHistogram()
+      logic.readVolumeArray(histogram=histogram)
+      numpy.testing.assert_array_equal(histogram.counts, intensity.histogramOfArray(stackArray).counts)
+
+    self.delayDisplay('Test passed!')
+
+  def test_ImageStacksStackDiscovery(self):
+    """ Scan a directory of 50000 slice files, check the natural order and the numbering gaps
+    and duplicates, then the sampled header checks on a small stack.
+    """
+    import tempfile
+    import time
+    self.delayDisplay("Starting the stack discovery test")
+
+    with tempfile.TemporaryDirectory() as directoryPath:
+      numberOfFiles = 50000
+      missingNumbers = set(range(1000, 1003)) | {20000}
+      # file names are not zero padded, so alphabetical order is not the slice order
+      expectedFileNames = [f"scan_{number}.tif" for number in range(numberOfFiles) if number not in missingNumbers]
+      for fileName in expectedFileNames + ["scan_00042.tif", "scan_rec_spr.bmp", "scan.log"]:
+        open(os.path.join(directoryPath, fileName), 'wb').close()
+      expectedFileNames.insert(expectedFileNames.index("scan_42.tif"), "scan_00042.tif")
+
+      startTime = time.time()
+      filePaths = stack_discovery.scanDirectory(directoryPath)
+      scanTime = time.time() - startTime
+      self.assertEqual([os.path.basename(filePath) for filePath in filePaths], expectedFileNames)
+      startTime = time.time()
+      gaps, duplicates = stack_discovery.numberingProblems(filePaths)
+      numberingTime = time.time() - startTime
+      self.assertEqual(gaps, [range(1000, 1003), range(20000, 20001)])
+      self.assertEqual(list(duplicates.keys()), [42])
+
+      # names where a number and a text fall at the same position are ordered without comparing them
+      mixedNames = ["scan2", "scan", "a1b2", "a1b", "2x", "Scan_10", "scan_9"]
+      self.assertEqual(sorted(mixedNames, key=stack_discovery.naturalSortKey),
+        ["2x", "a1b", "a1b2", "scan", "scan2", "scan_9", "Scan_10"])
+
+      # file by file queries, as populating the list from a file name pattern used to do
+      startTime = time.time()
+      fileNamesInDirectory = stack_discovery.fileNamesInDirectory(directoryPath)
+      foundBySet = sum(f"scan_{number}.tif" in fileNamesInDirectory for number in range(numberOfFiles))
+      setTime = time.time() - startTime
+      startTime = time.time()
+      foundByQuery = sum(os.path.exists(os.path.join(directoryPath, f"scan_{number}.tif")) for number in range(numberOfFiles))
+      queryTime = time.time() - startTime
+      self.assertEqual(foundBySet, foundByQuery)
+      logging.info(f"{len(filePaths)} files: scan and natural sort {scanTime:.3f} s, gap and duplicate detection {numberingTime:.3f} s,"
+        f" pattern matching on one directory listing {setTime:.3f} s instead of {queryTime:.3f} s with one query per file")
+
+      # stack of numbered slices with two datasets mixed in and a gap every other slice
+      stackPath = os.path.join(directoryPath, "stack")
+      os.mkdir(stackPath)
+      paths, volumeArray = self.writeTestStack(stackPath, numberOfSlices=20, shape=(30, 20))
+      self.assertEqual(stack_discovery.inconsistentSlices(paths), [])
+      sitk.WriteImage(sitk.GetImageFromArray(volumeArray[-1, :10].astype(numpy.uint8)), paths[-1])
+      inconsistent = stack_discovery.inconsistentSlices(paths, numberOfSamples=4)
+      self.assertEqual(inconsistent, [(paths[-1], (20, 10, 1, "8-bit unsigned integer"))])
+
+      logic = ImageStacksLogic()
+      logic.filePaths = paths[::2]
+      self.assertEqual(logic.originalVolumeDimensions, [20, 30, 10])
+      self.assertEqual(logic.originalVolumeVoxelDataType, numpy.uint16)
+      self.assertEqual(logic.stackProblems, [])
+      logic.filePaths = paths[:5] + paths[6:]
+      self.assertEqual(len(logic.stackProblems), 2)
+      self.assertTrue(logic.stackProblems[0].startswith("Missing slice numbers (1): 5"))
+      self.assertIn("slice_0019.tif (20 x 10 x 1 8-bit unsigned integer)", logic.stackProblems[1])
+      # with every other slice saved, only the numbers on that step are missing
+      logic.filePaths = paths[0:8:2] + paths[14::2]
+      self.assertEqual(stack_discovery.numberingProblems(logic.filePaths)[0], [range(8, 14, 2)])
+      self.assertTrue(logic.stackProblems[0].startswith("Missing slice numbers (3): 8-12 every 2"))
+
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,81 @@
+import numpy
+
+# Downsampling methods of ImageStacksLogic.downsamplingMethod
+AVERAGE = 'average'
+NEAREST = 'nearest'
+
+def accumulatorType(dtype):
+  """Sums of up to 64 voxels of 8 or 16 bit integers are exact in float32, anything larger uses float64"""
+  dtype = numpy.dtype(dtype)
+  if dtype.kind in 'iub' and dtype.itemsize <= 2:
+    return numpy.float32
+  return numpy.float64
+
+def cropSlice(sliceArray, extent, factors):
+  """In-plane region of a full resolution slice covered by output extent, for (column, row) downsampling factors"""
+  return sliceArray[extent[2]*factors[1]:(extent[3]+1)*factors[1], extent[0]*factors[0]:(extent[1]+1)*factors[0]]
+
+def stridedSlice(sliceArray, extent, factors):
+  """Nearest neighbor downsampling: first voxel of each block"""
+  return cropSlice(sliceArray, extent, factors)[::factors[1], ::factors[0]]
+
+class BlockMeanAccumulator:
+  """
+  Block mean of a group of slices, computed while the slices are read.
+  Each slice added is reduced to the sums of its factors[1] x factors[0] in-plane blocks
+  and added to the running total, so only one full resolution slice is held at a time.
+  """
+  def __init__(self, outputShape, dtype, factors):
+    """
+    outputShape: (rows, columns[, components]) of the downsampled slice
+    dtype: voxel type of the input and output slices
+    factors: (column, row) in-plane downsampling factors
+    """
+    self.outputShape = tuple(outputShape)
+    self.dtype = numpy.dtype(dtype)
+    self.factors = factors
+    self.sum = numpy.zeros(self.outputShape, dtype=accumulatorType(self.dtype))
+    self.numberOfSlices = 0
+
+  def add(self, sliceArray):
+    """Add a slice already cropped to the output region (see cropSlice)"""
+    rows, columns = self.outputShape[0], self.outputShape[1]
+    blocks = sliceArray[:rows*self.factors[1], :columns*self.factors[0]]
+    blocks = blocks.reshape((rows, self.factors[1], columns, self.factors[0]) + sliceArray.shape[2:])
+    self.sum += blocks.sum(axis=(1, 3), dtype=self.sum.dtype)
+    self.numberOfSlices += 1
+
+  def mean(self):
+    """Mean of the blocks, rounded to the nearest value for integer voxel types"""
+    mean = self.sum / (self.numberOfSlices * self.factors[0] * self.factors[1])
+    if self.dtype.kind in 'iub':
+      numpy.rint(mean, out=mean)
+    return mean.astype(self.dtype)
+
+class VolumeBlockMean:
+  """
+  Block mean of a volume by the same factor along all axes, computed from its slices added in order.
+  Incomplete blocks at the far edges are dropped, as for the downsampled output extent.
+  """
+  def __init__(self, shape, dtype, factor):
+    """shape: (slices, rows, columns[, components]) of the input volume"""
+    self.factor = factor
+    self.outputShape = (shape[0] // factor, shape[1] // factor, shape[2] // factor) + tuple(shape[3:])
+    self.output = numpy.zeros(self.outputShape, dtype=dtype)
+    self.accumulator = None
+    self.numberOfSlicesAdded = 0
+
+  def add(self, sliceArray):
+    outputSliceIndex = self.numberOfSlicesAdded // self.factor
+    self.numberOfSlicesAdded += 1
+    if outputSliceIndex >= self.outputShape[0]:
+      return
+    if self.accumulator is None:
+      self.accumulator = BlockMeanAccumulator(self.outputShape[1:], self.output.dtype, (self.factor, self.factor))
+    self.accumulator.add(sliceArray)
+    if self.accumulator.numberOfSlices == self.factor:
+      self.output[outputSliceIndex] = self.accumulator.mean()
+      self.accumulator = None
+
+  def result(self):
+    return self.output
@@ -0,0 +1,135 @@
+import numpy
+
+# Slices processed at a time when computing histograms and rescaling volumes already in memory
+CHUNK_SLICES = 16
+
+def isExactType(dtype):
+  """Voxel types with one histogram bin per value"""
+  dtype = numpy.dtype(dtype)
+  return dtype.kind in 'iub' and dtype.itemsize <= 2
+
+class StreamingHistogram:
+  """
+  Histogram of voxel values, built from chunks of a volume (e.g. one slice at a time while it is read).
+  8 and 16 bit integer volumes get one bin per value, so percentiles are exact. Other voxel types need
+  the value range up front and use numberOfBins equal bins; without it the histogram stays invalid.
+  The voxel type is taken from the first chunk added if not given.
+  """
+  # Values counted at a time
+  BLOCK_SIZE = 2**20
+
+  def __init__(self, dtype=None, valueRange=None, numberOfBins=65536):
+    self.dtype = None
+    self.valueRange = valueRange
+    self.numberOfBins = numberOfBins
+    self.counts = None
+    self.valid = False
+    if dtype is not None:
+      self._initialize(numpy.dtype(dtype))
+
+  def _initialize(self, dtype):
+    self.dtype = dtype
+    if isExactType(dtype):
+      info = numpy.iinfo(dtype)
+      self.origin = int(info.min)
+      self.binWidth = 1
+      self.counts = numpy.zeros(int(info.max) - int(info.min) + 1, dtype=numpy.int64)
+      self.valid = True
+    elif self.valueRange is not None:
+      self.origin = float(self.valueRange[0])
+      self.binWidth = (float(self.valueRange[1]) - self.origin) / self.numberOfBins or 1.0
+      self.counts = numpy.zeros(self.numberOfBins, dtype=numpy.int64)
+      self.valid = True
+
+  def add(self, chunk):
+    if self.dtype is None:
+      self._initialize(chunk.dtype)
+    if not self.valid:
+      return
+    values = chunk.ravel()
+    # bincount converts its input to intp, so large chunks are counted in blocks
+    for start in range(0, len(values), self.BLOCK_SIZE):
+      block = values[start:start+self.BLOCK_SIZE]
+      if self.binWidth == 1 and self.origin == 0:
+        binIndices = block
+      elif self.binWidth == 1:
+        binIndices = block.astype(numpy.int32) - self.origin
+      else:
+        binIndices = numpy.clip((block - self.origin) / self.binWidth, 0, self.numberOfBins - 1).astype(numpy.intp)
+      self.counts += numpy.bincount(binIndices, minlength=len(self.counts))
+
+  @property
+  def numberOfValues(self):
+    return int(self.counts.sum())
+
+  def binValue(self, binIndex):
+    return self.origin + binIndex * self.binWidth
+
+  def range(self):
+    """Smallest and largest value (bin) in the histogram"""
+    nonEmpty = numpy.flatnonzero(self.counts)
+    return self.binValue(nonEmpty[0]), self.binValue(nonEmpty[-1])
+
+  def percentile(self, percent):
+    """Lowest value (bin) with at least percent % of the values at or below it"""
+    cumulativeCounts = numpy.cumsum(self.counts)
+    target = max(1, percent / 100.0 * cumulativeCounts[-1])
+    return self.binValue(int(numpy.searchsorted(cumulativeCounts, target)))
+
+  def autoRange(self, lowerPercentile=1.0, upperPercentile=99.0, expansionFactor=0.1):
+    """
+    Intensity window between two percentiles, widened by expansionFactor times its width on both sides
+    and limited to the range of values, as in vtkImageHistogramStatistics::GetAutoRange.
+    """
+    lowerValue = self.percentile(lowerPercentile)
+    upperValue = self.percentile(upperPercentile)
+    expansion = (upperValue - lowerValue) * expansionFactor
+    minimum, maximum = self.range()
+    return max(lowerValue - expansion, minimum), min(upperValue + expansion, maximum)
+
+def histogramOfArray(volumeArray, chunkSlices=CHUNK_SLICES):
+  """StreamingHistogram of a volume array, computed chunkSlices slices at a time"""
+  valueRange = None
+  if not isExactType(volumeArray.dtype):
+    minimum, maximum = numpy.inf, -numpy.inf
+    for start in range(0, volumeArray.shape[0], chunkSlices):
+      chunk = volumeArray[start:start+chunkSlices]
+      minimum, maximum = min(minimum, chunk.min()), max(maximum, chunk.max())
+    valueRange = (minimum, maximum)
+  histogram = StreamingHistogram(volumeArray.dtype, valueRange)
+  for start in range(0, volumeArray.shape[0], chunkSlices):
+    histogram.add(volumeArray[start:start+chunkSlices])
+  return histogram
+
+def rescaleTo8Bit(volumeArray, lowerValue, upperValue, chunkSlices=CHUNK_SLICES, progressCallback=None):
+  """
+  Map [lowerValue, upperValue] linearly to [0, 255] (values outside are clipped, fractions truncated)
+  into a new uint8 array, chunkSlices slices at a time. 8 and 16 bit volumes go through a lookup table.
+  progressCallback is called with the fraction done after each chunk.
+  """
+  outputArray = numpy.empty(volumeArray.shape, dtype=numpy.uint8)
+  constant = numpy.isclose(upperValue, lowerValue)
+
+  def rescale(values):
+    if constant:
+      return numpy.zeros(values.shape, dtype=numpy.uint8)
+    values = numpy.clip(values, lowerValue, upperValue).astype(numpy.float64)
+    return ((values - lowerValue) / (upperValue - lowerValue) * 255.0).astype(numpy.uint8)
+
+  lookupTable = None
+  if isExactType(volumeArray.dtype):
+    info = numpy.iinfo(volumeArray.dtype)
+    lookupTable = rescale(numpy.arange(int(info.min), int(info.max) + 1))
+  for start in range(0, volumeArray.shape[0], chunkSlices):
+    chunk = volumeArray[start:start+chunkSlices]
+    if lookupTable is None:
+      outputArray[start:start+chunkSlices] = rescale(chunk)
+    else:
+      # indices are converted to intp, so the table is applied one slice at a time
+      for sliceIndex, sliceArray in enumerate(chunk, start):
+        if info.min != 0:
+          sliceArray = sliceArray.astype(numpy.int32) - int(info.min)
+        numpy.take(lookupTable, sliceArray, out=outputArray[sliceIndex])
+    if progressCallback:
+      progressCallback(min(1.0, (start + chunkSlices) / volumeArray.shape[0]))
+  return outputArray
@@ -0,0 +1,225 @@
+import os
+import struct
+import zlib
+
+import numpy
+import SimpleITK as sitk
+
+TIFF_EXTENSIONS = ['.tif', '.tiff']
+
+# TIFF compression schemes decoded here: none, Adobe deflate and the older deflate code
+TIFF_COMPRESSION_NONE = 1
+TIFF_COMPRESSION_DEFLATE = [8, 32946]
+
+# numpy type codes of the TIFF field types that can hold the tags read here
+_TIFF_FIELD_TYPES = {1: 'u1', 3: 'u2', 4: 'u4', 6: 'i1', 8: 'i2', 9: 'i4', 13: 'u4', 16: 'u8', 17: 'i8', 18: 'u8'}
+
+# TIFF tags used to locate and decode the image data
+_TIFF_TAGS = {
+  256: 'ImageWidth', 257: 'ImageLength', 258: 'BitsPerSample', 259: 'Compression',
+  262: 'PhotometricInterpretation', 273: 'StripOffsets', 277: 'SamplesPerPixel', 278: 'RowsPerStrip',
+  279: 'StripByteCounts', 284: 'PlanarConfiguration', 317: 'Predictor', 322: 'TileWidth',
+  323: 'TileLength', 324: 'TileOffsets', 325: 'TileByteCounts', 339: 'SampleFormat',
+  }
+
+def clipRange(valueRange, size):
+  return max(0, min(valueRange[0], size)), max(0, min(valueRange[1], size))
+
+def readSliceRegion(filePath, rowRange, columnRange):
+  """
+  Decode the rows [rowRange[0], rowRange[1]) and columns [columnRange[0], columnRange[1]) of a 2D image
+  file; the window is clipped to the image. Strip and tile organized TIFF files that are uncompressed
+  or deflate compressed are read directly, decoding only the strips or tiles that overlap the window
+  (uncompressed strips only the rows of the window). Other files are read with SimpleITK, which
+  streams the window from formats that support it and otherwise decodes the image and crops it.
+  Returns the region array (rows, columns[, components]), the shape of the full image
+  and the number of bytes decoded.
+  """
+  if os.path.splitext(filePath)[1].lower() in TIFF_EXTENSIONS:
+    layout = TiffLayout.fromFile(filePath)
+    if layout is not None:
+      return layout.readRegion(rowRange, columnRange)
+  return readSliceRegionWithSimpleITK(filePath, rowRange, columnRange)
+
+def readSliceRegionWithSimpleITK(filePath, rowRange, columnRange):
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(filePath)
+  reader.ReadImageInformation()
+  size = reader.GetSize()
+  numberOfComponents = reader.GetNumberOfComponents()
+  fullShape = (size[1], size[0]) + ((numberOfComponents,) if numberOfComponents > 1 else ())
+  rowRange = clipRange(rowRange, size[1])
+  columnRange = clipRange(columnRange, size[0])
+  # 2D files may be reported as a single slice volume
+  extractIndex = [columnRange[0], rowRange[0]] + [0] * (len(size) - 2)
+  extractSize = [columnRange[1] - columnRange[0], rowRange[1] - rowRange[0]] + [1] * (len(size) - 2)
+  reader.SetExtractIndex(extractIndex)
+  reader.SetExtractSize(extractSize)
+  regionArray = sitk.GetArrayFromImage(reader.Execute())
+  if len(size) > 2:
+    regionArray = regionArray.reshape(regionArray.shape[len(size) - 2:])
+  decodedByteCount = int(numpy.prod(fullShape)) * regionArray.dtype.itemsize
+  return regionArray, fullShape, decodedByteCount
+
+class TiffLayout:
+  """
+  Location and encoding of the strips or tiles of the first image of a TIFF (or BigTIFF) file,
+  read from its header. fromFile returns None for files that readRegion cannot decode
+  (other compressions, palette or YCbCr images, separate sample planes, bit depths below 8).
+  """
+  def __init__(self, filePath, byteOrder, tags):
+    self.filePath = filePath
+    samplesPerPixel = int(tags.get('SamplesPerPixel', [1])[0])
+    self.columns = int(tags['ImageWidth'][0])
+    self.rows = int(tags['ImageLength'][0])
+    self.shape = (self.rows, self.columns) + ((samplesPerPixel,) if samplesPerPixel > 1 else ())
+    self.samplesPerPixel = samplesPerPixel
+    self.compression = int(tags.get('Compression', [TIFF_COMPRESSION_NONE])[0])
+    self.predictor = int(tags.get('Predictor', [1])[0])
+    bitsPerSample = int(tags.get('BitsPerSample', [1])[0])
+    sampleFormat = int(tags.get('SampleFormat', [1])[0])
+    self.fileDtype = numpy.dtype(byteOrder + {1: 'u', 2: 'i', 3: 'f'}[sampleFormat] + str(bitsPerSample // 8))
+    self.dtype = self.fileDtype.newbyteorder('=')
+    self.tiled = 'TileOffsets' in tags
+    if self.tiled:
+      self.segmentRows = int(tags['TileLength'][0])
+      self.segmentColumns = int(tags['TileWidth'][0])
+      self.offsets = tags['TileOffsets']
+      self.byteCounts = tags['TileByteCounts']
+    else:
+      self.segmentRows = min(int(tags.get('RowsPerStrip', [self.rows])[0]), self.rows)
+      self.segmentColumns = self.columns
+      self.offsets = tags['StripOffsets']
+      self.byteCounts = tags['StripByteCounts']
+    self.segmentsAcross = -(-self.columns // self.segmentColumns)
+    self.rowByteCount = self.segmentColumns * samplesPerPixel * self.dtype.itemsize
+
+  @staticmethod
+  def fromFile(filePath):
+    try:
+      with open(filePath, 'rb') as tiffFile:
+        byteOrder, tags = TiffLayout._readTags(tiffFile)
+    except (OSError, ValueError, struct.error):
+      return None
+    if byteOrder is None or not TiffLayout._isSupported(tags):
+      return None
+    return TiffLayout(filePath, byteOrder, tags)
+
+  @staticmethod
+  def _readTags(tiffFile):
+    """Byte order ('<' or '>') and the tags of _TIFF_TAGS of the first image, (None, None) if not a TIFF file"""
+    header = tiffFile.read(16)
+    byteOrder = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if byteOrder is None:
+      return None, None
+    version = struct.unpack(byteOrder + 'H', header[2:4])[0]
+    if version == 42:
+      ifdOffset = struct.unpack(byteOrder + 'I', header[4:8])[0]
+      entryCountFormat, offsetFormat = 'H', 'I'
+    elif version == 43:
+      ifdOffset = struct.unpack(byteOrder + 'Q', header[8:16])[0]
+      entryCountFormat, offsetFormat = 'Q', 'Q'
+    else:
+      return None, None
+    tiffFile.seek(ifdOffset)
+    # an entry is the tag, the field type, the number of values and the values or their offset
+    offsetSize = struct.calcsize(offsetFormat)
+    entrySize = 4 + 2 * offsetSize
+    numberOfEntries = struct.unpack(byteOrder + entryCountFormat, tiffFile.read(struct.calcsize(entryCountFormat)))[0]
+    entries = tiffFile.read(numberOfEntries * entrySize)
+    tags = {}
+    for entryIndex in range(numberOfEntries):
+      entry = entries[entryIndex * entrySize:(entryIndex + 1) * entrySize]
+      tag, fieldType = struct.unpack(byteOrder + 'HH', entry[:4])
+      if tag not in _TIFF_TAGS or fieldType not in _TIFF_FIELD_TYPES:
+        continue
+      count = struct.unpack(byteOrder + offsetFormat, entry[4:4 + offsetSize])[0]
+      valueDtype = numpy.dtype(byteOrder + _TIFF_FIELD_TYPES[fieldType])
+      valueBytes = entry[4 + offsetSize:]
+      if count * valueDtype.itemsize > offsetSize:
+        tiffFile.seek(struct.unpack(byteOrder + offsetFormat, valueBytes)[0])
+        valueBytes = tiffFile.read(count * valueDtype.itemsize)
+      tags[_TIFF_TAGS[tag]] = numpy.frombuffer(valueBytes, dtype=valueDtype, count=count).astype(numpy.int64)
+    return byteOrder, tags
+
+  @staticmethod
+  def _isSupported(tags):
+    if 'ImageWidth' not in tags or 'ImageLength' not in tags:
+      return False
+    if not ('StripOffsets' in tags and 'StripByteCounts' in tags) and not ('TileOffsets' in tags and 'TileByteCounts' in tags):
+      return False
+    compression = int(tags.get('Compression', [TIFF_COMPRESSION_NONE])[0])
+    if compression != TIFF_COMPRESSION_NONE and compression not in TIFF_COMPRESSION_DEFLATE:
+      return False
+    # only grayscale (black is zero) and RGB images are decoded as stored
+    if int(tags.get('PhotometricInterpretation', [1])[0]) not in [1, 2]:
+      return False
+    if int(tags.get('SamplesPerPixel', [1])[0]) > 1 and int(tags.get('PlanarConfiguration', [1])[0]) != 1:
+      return False
+    bitsPerSample = set(int(bits) for bits in tags.get('BitsPerSample', [1]))
+    sampleFormat = set(int(sampleFormat) for sampleFormat in tags.get('SampleFormat', [1]))
+    if len(bitsPerSample) != 1 or len(sampleFormat) != 1:
+      return False
+    bitsPerSample, sampleFormat = bitsPerSample.pop(), sampleFormat.pop()
+    if sampleFormat == 3:
+      validBits = [32, 64]
+    elif sampleFormat in [1, 2]:
+      validBits = [8, 16, 32, 64]
+    else:
+      return False
+    # horizontal differencing is supported for integers, floating point prediction is not
+    predictor = int(tags.get('Predictor', [1])[0])
+    return bitsPerSample in validBits and (predictor == 1 or (predictor == 2 and sampleFormat != 3))
+
+  def readRegion(self, rowRange, columnRange):
+    """Same as readSliceRegion, for this file"""
+    rowRange = clipRange(rowRange, self.rows)
+    columnRange = clipRange(columnRange, self.columns)
+    regionArray = numpy.empty((rowRange[1] - rowRange[0], columnRange[1] - columnRange[0]) + self.shape[2:], dtype=self.dtype)
+    decodedByteCount = 0
+    firstSegmentRow = rowRange[0] // self.segmentRows
+    lastSegmentRow = (rowRange[1] - 1) // self.segmentRows
+    firstSegmentColumn = columnRange[0] // self.segmentColumns
+    lastSegmentColumn = (columnRange[1] - 1) // self.segmentColumns
+    with open(self.filePath, 'rb') as tiffFile:
+      for segmentRow in range(firstSegmentRow, lastSegmentRow + 1):
+        segmentRowStart = segmentRow * self.segmentRows
+        # rows of the segment within the region
+        rowStart = max(rowRange[0], segmentRowStart)
+        rowStop = min(rowRange[1], segmentRowStart + self.segmentRows)
+        for segmentColumn in range(firstSegmentColumn, lastSegmentColumn + 1):
+          segmentColumnStart = segmentColumn * self.segmentColumns
+          columnStart = max(columnRange[0], segmentColumnStart)
+          columnStop = min(columnRange[1], segmentColumnStart + self.segmentColumns)
+          segment, firstDecodedRow = self._decodeSegment(tiffFile, segmentRow * self.segmentsAcross + segmentColumn,
+            rowStart - segmentRowStart, rowStop - segmentRowStart)
+          decodedByteCount += segment.nbytes
+          segmentFirstRow = segmentRowStart + firstDecodedRow
+          regionArray[rowStart - rowRange[0]:rowStop - rowRange[0], columnStart - columnRange[0]:columnStop - columnRange[0]] = \
+            segment[rowStart - segmentFirstRow:rowStop - segmentFirstRow, columnStart - segmentColumnStart:columnStop - segmentColumnStart]
+    return regionArray, self.shape, decodedByteCount
+
+  def _decodeSegment(self, tiffFile, segmentIndex, firstRow, stopRow):
+    """
+    Decode rows [firstRow, stopRow) of a strip or tile, as an array of (rows, segmentColumns[, samples]).
+    Uncompressed segments are read from firstRow only, compressed ones are decoded from their first row.
+    Returns the array and the segment row of its first row.
+    """
+    offset = int(self.offsets[segmentIndex])
+    if self.compression == TIFF_COMPRESSION_NONE:
+      tiffFile.seek(offset + firstRow * self.rowByteCount)
+      data = tiffFile.read((stopRow - firstRow) * self.rowByteCount)
+      rowOffset = firstRow
+    else:
+      tiffFile.seek(offset)
+      # only the rows up to the last one needed are decompressed
+      data = zlib.decompressobj().decompress(tiffFile.read(int(self.byteCounts[segmentIndex])), stopRow * self.rowByteCount)
+      rowOffset = 0
+    numberOfRows = len(data) // self.rowByteCount
+    segment = numpy.frombuffer(data, dtype=self.fileDtype, count=numberOfRows * self.rowByteCount // self.dtype.itemsize)
+    segment = segment.reshape((numberOfRows, self.segmentColumns) + self.shape[2:]).astype(self.dtype, copy=False)
+    if self.predictor == 2:
+      # horizontal differencing: each sample is stored as the difference from the previous one in the row,
+      # so rows can be decoded independently
+      segment = numpy.cumsum(segment, axis=1, dtype=self.dtype)
+    return segment, rowOffset
@@ -0,0 +1,79 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+# Decoding more slices at once than this rarely helps: image stacks are usually read from a
+# single disk and the decoders become I/O bound.
+MAX_DEFAULT_THREADS = 8
+
+def defaultNumberOfThreads():
+  return max(1, min(MAX_DEFAULT_THREADS, os.cpu_count() or 1))
+
+def readSlicesInParallel(readSlice, sliceIndices, numberOfThreads=0, progressCallback=None, completedCallback=None, maxQueuedSlices=0):
+  """
+  Call readSlice(sliceIndex) for every index on a bounded pool of worker threads.
+  readSlice decodes one slice, writes it into its place in the preallocated output
+  and returns the number of bytes it decoded. Results are collected in input order,
+  so the first error is reported for the lowest slice index, as a sequential read would.
+
+  At most maxQueuedSlices (default 2 * numberOfThreads) slices are queued or being read at a
+  time, which bounds the work lost on cancel and the number of slice buffers in use.
+  completedCallback(sliceIndex) is called from the calling thread in input order, once the
+  slice is read and before any slice more than maxQueuedSlices further on is started.
+  progressCallback is called from the calling thread with the fraction completed;
+  if it returns False, queued slices are dropped and ValueError("User requested cancel")
+  is raised once the running ones have finished.
+
+  Returns a dictionary with the number of slices and bytes read, the elapsed time
+  and the derived slices/s and MB/s.
+  """
+  sliceIndices = list(sliceIndices)
+  numberOfThreads = numberOfThreads if numberOfThreads > 0 else defaultNumberOfThreads()
+  maxQueuedSlices = maxQueuedSlices if maxQueuedSlices > 0 else 2 * numberOfThreads
+  statistics = {"slices": 0, "bytes": 0, "seconds": 0.0, "threads": numberOfThreads}
+  cancelled = threading.Event()
+
+  def readUnlessCancelled(sliceIndex):
+    if cancelled.is_set():
+      return 0
+    return readSlice(sliceIndex)
+
+  startTime = time.perf_counter()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfThreads, thread_name_prefix="SliceReader") as executor:
+    pending = collections.deque()
+    nextSlice = 0
+    try:
+      for completed in range(len(sliceIndices)):
+        while nextSlice < len(sliceIndices) and len(pending) < maxQueuedSlices:
+          pending.append(executor.submit(readUnlessCancelled, sliceIndices[nextSlice]))
+          nextSlice += 1
+        if progressCallback:
+          toContinue = progressCallback(completed / len(sliceIndices))
+          if not toContinue:
+            raise ValueError("User requested cancel")
+        statistics["bytes"] += pending.popleft().result()
+        statistics["slices"] += 1
+        if completedCallback:
+          completedCallback(sliceIndices[completed])
+    except BaseException:
+      cancelled.set()
+      for future in pending:
+        future.cancel()
+      raise
+  statistics["seconds"] = time.perf_counter() - startTime
+  statistics.update(throughput(statistics))
+  return statistics
+
+def throughput(statistics):
+  seconds = max(statistics["seconds"], 1e-9)
+  return {
+    "slicesPerSecond": statistics["slices"] / seconds,
+    "megabytesPerSecond": statistics["bytes"] / seconds / 1024**2,
+    }
+
+def logStatistics(statistics, description="Read"):
+  logging.info(f"{description} {statistics['slices']} slices ({statistics['bytes'] / 1024**2:.1f} MB) in {statistics['seconds']:.2f} s"
+    f" using {statistics['threads']} threads: {statistics['slicesPerSecond']:.1f} slices/s, {statistics['megabytesPerSecond']:.1f} MB/s")
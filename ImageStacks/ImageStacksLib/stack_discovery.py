@@ -0,0 +1,131 @@
+import collections
+import concurrent.futures
+import os
+import re
+
+import numpy
+import SimpleITK as sitk
+
+from . import slice_reader
+
+# Extensions of the files read as individual slices
+SLICE_FILE_EXTENSIONS = ['jpg', 'jpeg', 'tif', 'tiff', 'png', 'bmp', 'jp2']
+
+_NUMBER_PATTERN = re.compile(r'(\d+)')
+
+def naturalSortKey(filePath):
+  """Sort key that orders the numbers in file names by value (slice_2.tif before slice_10.tif), ignoring case"""
+  parts = _NUMBER_PATTERN.split(filePath)
+  # parts are tagged (0, number) or (1, text), so a number is never compared with a text. The name itself
+  # comes last, tagged to sort before any part: a name is placed before the longer names it starts
+  # (scan before scan2), and names that only differ by zero padding or case are ordered by the name
+  key = [(0, int(part)) if index % 2 else (1, part.lower()) for index, part in enumerate(parts) if part]
+  return key + [(-1, filePath)]
+
+def isSliceFileName(fileName, extensions=SLICE_FILE_EXTENSIONS):
+  if os.path.splitext(fileName)[1][1:].lower() not in extensions:
+    return False
+  # Ignore cone-beam image in Bruker Skyscan folder
+  # such as `left_side_damaged__rec_spr.bmp`
+  if fileName.endswith("spr.bmp"):
+    return False
+  return True
+
+def fileNamesInDirectory(directoryPath):
+  """Names of the files in a directory, listed by a single os.scandir call"""
+  with os.scandir(directoryPath) as entries:
+    return {entry.name for entry in entries if entry.is_file()}
+
+def scanDirectory(directoryPath, extensions=SLICE_FILE_EXTENSIONS):
+  """
+  Paths of the slice files in a directory, in natural order.
+  The file types come from the directory listing (os.scandir), so no file is queried on its own,
+  which matters for directories of thousands of slices on network shares.
+  """
+  with os.scandir(directoryPath) as entries:
+    fileNames = [entry.name for entry in entries if isSliceFileName(entry.name, extensions) and entry.is_file()]
+  fileNames.sort(key=naturalSortKey)
+  return [os.path.join(directoryPath, fileName) for fileName in fileNames]
+
+def sliceNumber(filePath):
+  """Last number in the file name, ignoring the extension (which can contain digits, such as .jp2), None if there is none"""
+  numbers = _NUMBER_PATTERN.findall(os.path.splitext(os.path.basename(filePath))[0])
+  return int(numbers[-1]) if numbers else None
+
+def numberingProblems(filePaths):
+  """
+  Gaps and duplicates in the slice numbers of the files. The numbering step is the most common
+  difference between consecutive numbers, so stacks saved with every Nth slice have no gaps, and
+  only the numbers on that step are missing from a gap.
+  Returns the list of gaps as ranges of the missing numbers and a dictionary of
+  numbers found in several files (e.g. slice_7.tif and slice_007.tif) to these files.
+  """
+  filePathsByNumber = collections.defaultdict(list)
+  for filePath in filePaths:
+    number = sliceNumber(filePath)
+    if number is not None:
+      filePathsByNumber[number].append(filePath)
+  duplicates = {number: paths for number, paths in filePathsByNumber.items() if len(paths) > 1}
+  numbers = numpy.array(sorted(filePathsByNumber))
+  if len(numbers) < 2:
+    return [], duplicates
+  differences = numpy.diff(numbers)
+  values, counts = numpy.unique(differences, return_counts=True)
+  step = int(values[numpy.argmax(counts)])
+  gaps = [range(int(numbers[index]) + step, int(numbers[index + 1]), step) for index in numpy.flatnonzero(differences > step)]
+  return gaps, duplicates
+
+def sliceHeader(filePath):
+  """Columns, rows, number of components and pixel type of a slice, read from the file header only"""
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(filePath)
+  reader.ReadImageInformation()
+  size = reader.GetSize()
+  return size[0], size[1], reader.GetNumberOfComponents(), sitk.GetPixelIDValueAsString(reader.GetPixelID())
+
+def describeHeader(header):
+  columns, rows, numberOfComponents, pixelType = header
+  return f"{columns} x {rows} x {numberOfComponents} {pixelType}"
+
+def inconsistentSlices(filePaths, numberOfSamples=16, numberOfThreads=0):
+  """
+  Compare the headers of numberOfSamples slices spread over the stack (always including the first and
+  the last) with the header of the first slice. Headers are read on a few threads, as reading them is
+  dominated by file system latency. Returns the list of (file path, header) of the slices that differ.
+  """
+  if len(filePaths) < 2:
+    return []
+  sampleIndices = numpy.unique(numpy.linspace(0, len(filePaths) - 1, max(2, numberOfSamples)).round().astype(int))
+  samplePaths = [filePaths[index] for index in sampleIndices]
+  numberOfThreads = numberOfThreads if numberOfThreads > 0 else slice_reader.defaultNumberOfThreads()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(numberOfThreads, len(samplePaths))) as executor:
+    headers = list(executor.map(sliceHeader, samplePaths))
+  return [(path, header) for path, header in zip(samplePaths, headers) if header != headers[0]]
+
+def stackProblems(filePaths, numberOfSamples=16, maximumNumberOfItems=5):
+  """
+  Human readable descriptions of the numbering gaps, duplicate slice numbers and sampled slices
+  whose size or voxel type differ from the first slice. Each list is shortened to maximumNumberOfItems.
+  """
+  def shortened(items):
+    if len(items) <= maximumNumberOfItems:
+      return ", ".join(items)
+    return ", ".join(items[:maximumNumberOfItems]) + f" and {len(items) - maximumNumberOfItems} more"
+
+  problems = []
+  gaps, duplicates = numberingProblems(filePaths)
+  if gaps:
+    def describeGap(gap):
+      if len(gap) == 1:
+        return str(gap[0])
+      return f"{gap[0]}-{gap[-1]}" + (f" every {gap.step}" if gap.step > 1 else "")
+    missingCount = sum(len(gap) for gap in gaps)
+    problems.append(f"Missing slice numbers ({missingCount}): " + shortened([describeGap(gap) for gap in gaps]))
+  if duplicates:
+    problems.append(f"Slice numbers used by several files ({len(duplicates)}): " + shortened(
+      [f"{number} ({', '.join(os.path.basename(path) for path in paths)})" for number, paths in sorted(duplicates.items())]))
+  inconsistent = inconsistentSlices(filePaths, numberOfSamples)
+  if inconsistent:
+    problems.append(f"Slices different from the first one ({describeHeader(sliceHeader(filePaths[0]))}): " + shortened(
+      [f"{os.path.basename(path)} ({describeHeader(header)})" for path, header in inconsistent]))
+  return problems
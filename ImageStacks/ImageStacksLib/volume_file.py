@@ -0,0 +1,297 @@
+import bz2
+import collections
+import os
+import threading
+import zlib
+
+import numpy
+
+NRRD_TYPES = {
+  'int8': 'int8', 'uint8': 'uint8', 'int16': 'int16', 'uint16': 'uint16',
+  'int32': 'int32', 'uint32': 'uint32', 'int64': 'int64', 'uint64': 'uint64',
+  'float32': 'float', 'float64': 'double',
+  }
+
+# numpy type of each NRRD type name and its aliases
+NRRD_NUMPY_TYPES = {}
+for numpyType, nrrdNames in [
+  ('i1', ['signed char', 'int8', 'int8_t']),
+  ('u1', ['uchar', 'unsigned char', 'uint8', 'uint8_t']),
+  ('i2', ['short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t']),
+  ('u2', ['ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t']),
+  ('i4', ['int', 'signed int', 'int32', 'int32_t']),
+  ('u4', ['uint', 'unsigned int', 'uint32', 'uint32_t']),
+  ('i8', ['longlong', 'long long', 'long long int', 'signed long long', 'signed long long int', 'int64', 'int64_t']),
+  ('u8', ['ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t']),
+  ('f4', ['float']),
+  ('f8', ['double']),
+  ]:
+  for nrrdName in nrrdNames:
+    NRRD_NUMPY_TYPES[nrrdName] = numpyType
+
+def nrrdDataType(header):
+  """numpy type of the data of a NRRD file, from the type and endian fields of its header"""
+  nrrdType = str(header['type']).strip().lower()
+  if nrrdType not in NRRD_NUMPY_TYPES:
+    raise ValueError(f"NRRD type {header['type']} is not supported")
+  numpyType = NRRD_NUMPY_TYPES[nrrdType]
+  if numpyType[1] != '1':
+    endian = str(header.get('endian', 'little')).strip().lower()
+    if endian not in ('little', 'big'):
+      raise ValueError(f"NRRD endian {header.get('endian')} is not supported")
+    numpyType = ('<' if endian == 'little' else '>') + numpyType
+  return numpy.dtype(numpyType)
+
+def nrrdHeader(shape, dtype, ijkToRAS):
+  """
+  Header of an attached raw NRRD file for a volume array of shape (slices, rows, columns[, components])
+  with the given 4x4 IJK to RAS matrix. The data that follows is written in little endian.
+  """
+  dtype = numpy.dtype(dtype)
+  if dtype.name not in NRRD_TYPES:
+    raise ValueError(f"Voxel type {dtype} cannot be written to NRRD")
+  # NRRD files written by Slicer use LPS coordinates
+  ijkToLPS = numpy.dot(numpy.diag([-1.0, -1.0, 1.0, 1.0]), ijkToRAS)
+  directions = " ".join("({:.17g},{:.17g},{:.17g})".format(*ijkToLPS[0:3, axis]) for axis in range(3))
+  sizes = [shape[2], shape[1], shape[0]]
+  kinds = "domain domain domain"
+  if len(shape) == 4:
+    sizes.insert(0, shape[3])
+    directions = "none " + directions
+    kinds = "vector " + kinds
+  lines = [
+    "NRRD0004",
+    "# Complete NRRD file format specification at:",
+    "# http://teem.sourceforge.net/nrrd/format.html",
+    f"type: {NRRD_TYPES[dtype.name]}",
+    f"dimension: {len(sizes)}",
+    "space: left-posterior-superior",
+    "sizes: " + " ".join(str(size) for size in sizes),
+    f"space directions: {directions}",
+    f"kinds: {kinds}",
+    "endian: little",
+    "encoding: raw",
+    "space origin: ({:.17g},{:.17g},{:.17g})".format(*ijkToLPS[0:3, 3]),
+    ]
+  return ("\n".join(lines) + "\n\n").encode("ascii")
+
+class NrrdSliceWriter:
+  """
+  Writes a volume to an attached raw NRRD file one slice at a time, in slice order.
+  Slices are first placed in a ring of sliceWindowSize buffers (see sliceBuffer), then copied into
+  a memory map of the current window of the file, which is flushed and released when the window
+  is complete. At most 2 * sliceWindowSize slices are held in memory.
+  """
+  def __init__(self, filePath, shape, dtype, ijkToRAS, sliceWindowSize=32):
+    self.filePath = filePath
+    self.shape = tuple(shape)
+    self.dtype = numpy.dtype(dtype).newbyteorder('<')
+    self.sliceWindowSize = max(1, min(sliceWindowSize, self.shape[0]))
+    self.sliceShape = self.shape[1:]
+    self.sliceByteCount = int(numpy.prod(self.sliceShape)) * self.dtype.itemsize
+    header = nrrdHeader(self.shape, self.dtype, ijkToRAS)
+    self.dataOffset = len(header)
+    with open(filePath, 'wb') as outputFile:
+      outputFile.write(header)
+      # allocate the whole file up front (sparse where the file system allows it)
+      outputFile.truncate(self.dataOffset + self.shape[0] * self.sliceByteCount)
+    self.ring = numpy.empty((self.sliceWindowSize,) + self.sliceShape, dtype=self.dtype)
+    self.window = None
+    self.windowStart = 0
+    self.numberOfSlicesWritten = 0
+
+  @property
+  def bufferByteCount(self):
+    """Memory used for slice buffers: the ring and the mapped window"""
+    return 2 * self.sliceWindowSize * self.sliceByteCount
+
+  def sliceBuffer(self, sliceIndex):
+    """Array the slice must be written to before calling commitSlice"""
+    return self.ring[sliceIndex % self.sliceWindowSize]
+
+  def commitSlice(self, sliceIndex):
+    """Write a slice from its buffer to the file. Slices must be committed in order."""
+    if sliceIndex != self.numberOfSlicesWritten:
+      raise ValueError(f"Slice {sliceIndex} committed out of order, expected slice {self.numberOfSlicesWritten}")
+    if self.window is None:
+      self.windowStart = sliceIndex
+      windowSize = min(self.sliceWindowSize, self.shape[0] - sliceIndex)
+      self.window = numpy.memmap(self.filePath, dtype=self.dtype, mode='r+',
+        offset=self.dataOffset + sliceIndex * self.sliceByteCount, shape=(windowSize,) + self.sliceShape)
+    self.window[sliceIndex - self.windowStart] = self.sliceBuffer(sliceIndex)
+    self.numberOfSlicesWritten += 1
+    if self.numberOfSlicesWritten - self.windowStart == self.window.shape[0]:
+      self.releaseWindow()
+
+  def releaseWindow(self):
+    if self.window is not None:
+      self.window.flush()
+      self.window = None
+
+  def close(self):
+    self.releaseWindow()
+    self.ring = None
+
+class NrrdSliceReader:
+  """
+  Random access to the slices (last axis) of a NRRD file, with the header parsed once.
+  Raw data is memory mapped, so reading a slice only touches that slice.
+  gzip and bzip2 data is decompressed by a cursor moving forward through the file. Decoded slices
+  are kept in a small cache so slightly out of order requests (e.g. from several reader threads)
+  do not restart decompression. For gzip, the decompressor state is saved every checkpointInterval
+  slices while reading, so going back only decompresses from the nearest checkpoint.
+  bzip2 decompressors cannot be copied, going back restarts from the beginning of the data.
+  Reading is thread safe.
+  """
+  # Compressed bytes read at a time; also bounds the size of a checkpoint
+  COMPRESSED_CHUNK_SIZE = 64 * 1024
+
+  def __init__(self, filePath, cachedSlices=8, checkpointInterval=16):
+    import nrrd
+    self.filePath = filePath
+    with open(filePath, 'rb') as headerFile:
+      self.header = nrrd.read_header(headerFile)
+      dataOffset = headerFile.tell()
+    sizes = [int(size) for size in self.header['sizes']]
+    self.dtype = nrrdDataType(self.header)
+    # numpy shape of one slice, e.g. (rows, columns) or (rows, columns, components)
+    self.sliceShape = tuple(sizes[-2::-1])
+    self.numberOfSlices = sizes[-1]
+    self.sliceByteCount = int(numpy.prod(self.sliceShape)) * self.dtype.itemsize
+    dataByteCount = self.numberOfSlices * self.sliceByteCount
+
+    self.dataFilePath = filePath
+    dataFileName = self.header.get('datafile', self.header.get('data file', None))
+    if dataFileName is not None:
+      if not isinstance(dataFileName, str):
+        raise ValueError(f"{filePath}: slice access is not supported for data split over several files")
+      if not os.path.isabs(dataFileName):
+        dataFileName = os.path.join(os.path.dirname(filePath), dataFileName)
+      self.dataFilePath = dataFileName
+      dataOffset = 0
+    lineSkip = self.header.get('lineskip', self.header.get('line skip', 0))
+    byteSkip = self.header.get('byteskip', self.header.get('byte skip', 0))
+    with open(self.dataFilePath, 'rb') as dataFile:
+      dataFile.seek(dataOffset)
+      for _ in range(lineSkip):
+        dataFile.readline()
+      dataOffset = dataFile.tell()
+
+    self.encoding = self.header['encoding']
+    self.lock = threading.Lock()
+    if self.encoding == 'raw':
+      if byteSkip == -1:
+        dataOffset = os.path.getsize(self.dataFilePath) - dataByteCount
+      else:
+        dataOffset += byteSkip
+      self.data = numpy.memmap(self.dataFilePath, dtype=self.dtype, mode='r', offset=dataOffset,
+        shape=(self.numberOfSlices,) + self.sliceShape)
+    elif self.encoding in ['gzip', 'gz', 'bzip2', 'bz2']:
+      if byteSkip == -1:
+        raise ValueError(f"{filePath}: slice access is not supported for compressed data with byte skip -1")
+      self.data = None
+      self.compressedDataOffset = dataOffset
+      # byte skip of compressed data applies to the decompressed bytes
+      self.decompressedDataOffset = byteSkip
+      self.cachedSlices = max(1, cachedSlices)
+      self.checkpointInterval = max(1, checkpointInterval)
+      self.cache = collections.OrderedDict()
+      self.checkpoints = {}
+      self.compressedFile = open(self.dataFilePath, 'rb')
+      self._restartDecompression()
+    else:
+      raise ValueError(f"{filePath}: slice access is not supported for {self.encoding} encoding")
+
+  def readSlice(self, sliceIndex):
+    """Copy of one slice as a numpy array of sliceShape"""
+    if not 0 <= sliceIndex < self.numberOfSlices:
+      raise IndexError(f"Slice {sliceIndex} is out of range, {self.filePath} has {self.numberOfSlices} slices")
+    if self.data is not None:
+      return numpy.array(self.data[sliceIndex])
+    with self.lock:
+      if sliceIndex in self.cache:
+        return self.cache[sliceIndex]
+      if sliceIndex < self.nextSlice:
+        self._seekBack(sliceIndex)
+      while True:
+        sliceArray = self._decompressNextSlice()
+        if self.nextSlice - 1 == sliceIndex:
+          return sliceArray
+
+  def readSliceRegion(self, sliceIndex, rowRange, columnRange):
+    """
+    Copy of the rows [rowRange[0], rowRange[1]) and columns [columnRange[0], columnRange[1]) of a slice,
+    clipped to the slice. Raw data is read through the memory map, so only the pages holding the window
+    are touched; compressed slices are decoded whole and cropped.
+    Returns the region array, the slice shape and the number of bytes decoded, as region_reader.readSliceRegion.
+    """
+    rows = slice(*rowRange)
+    columns = slice(*columnRange)
+    if self.data is not None:
+      if not 0 <= sliceIndex < self.numberOfSlices:
+        raise IndexError(f"Slice {sliceIndex} is out of range, {self.filePath} has {self.numberOfSlices} slices")
+      regionArray = numpy.array(self.data[sliceIndex, rows, columns])
+      return regionArray, self.sliceShape, regionArray.nbytes
+    return numpy.array(self.readSlice(sliceIndex)[rows, columns]), self.sliceShape, self.sliceByteCount
+
+  def close(self):
+    if self.data is not None:
+      self.data = None
+    else:
+      self.compressedFile.close()
+      self.cache.clear()
+      self.checkpoints.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+  def _restartDecompression(self):
+    if self.encoding in ['gzip', 'gz']:
+      self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    else:
+      self.decompressor = bz2.BZ2Decompressor()
+    self.compressedFile.seek(self.compressedDataOffset)
+    self.nextSlice = 0
+    self._decompress(self.decompressedDataOffset)
+
+  def _seekBack(self, sliceIndex):
+    checkpointSlices = [checkpointSlice for checkpointSlice in self.checkpoints if checkpointSlice <= sliceIndex]
+    if not checkpointSlices:
+      self._restartDecompression()
+      return
+    self.nextSlice = max(checkpointSlices)
+    compressedOffset, decompressor = self.checkpoints[self.nextSlice]
+    self.compressedFile.seek(compressedOffset)
+    self.decompressor = decompressor.copy()
+
+  def _decompress(self, byteCount):
+    """Next byteCount decompressed bytes, only asking the decompressor for what is needed"""
+    output = bytearray()
+    isZlib = self.encoding in ['gzip', 'gz']
+    while len(output) < byteCount:
+      if isZlib and self.decompressor.unconsumed_tail:
+        compressed = self.decompressor.unconsumed_tail
+      elif isZlib or self.decompressor.needs_input:
+        compressed = self.compressedFile.read(self.COMPRESSED_CHUNK_SIZE)
+        if not compressed:
+          raise ValueError(f"{self.filePath}: compressed data ends before slice {self.nextSlice}")
+      else:
+        compressed = b''
+      output += self.decompressor.decompress(compressed, byteCount - len(output))
+    return output
+
+  def _decompressNextSlice(self):
+    if self.encoding in ['gzip', 'gz'] and self.nextSlice % self.checkpointInterval == 0 and self.nextSlice not in self.checkpoints:
+      self.checkpoints[self.nextSlice] = (self.compressedFile.tell(), self.decompressor.copy())
+    sliceArray = numpy.frombuffer(self._decompress(self.sliceByteCount), dtype=self.dtype).reshape(self.sliceShape)
+    # the same array may be returned to several callers from the cache
+    sliceArray.flags.writeable = False
+    self.cache[self.nextSlice] = sliceArray
+    self.cache.move_to_end(self.nextSlice)
+    while len(self.cache) > self.cachedSlices:
+      self.cache.popitem(last=False)
+    self.nextSlice += 1
+    return sliceArray
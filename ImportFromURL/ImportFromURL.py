@@ -8,6 +8,7 @@ import fnmatch
 import re
 import csv
 import SampleData
+from ImportFromURLLib import url_queue
 #
 # ImportFromURL
 #
@@ -95,9 +96,46 @@ class ImportFromURLWidget(ScriptedLoadableModuleWidget):
     self.ImportButton.enabled = False
     parametersFormLayout.addRow(self.ImportButton)
 
+    #
+    # Batch import area
+    #
+    batchCollapsibleButton = ctk.ctkCollapsibleButton()
+    batchCollapsibleButton.text = "Batch Import"
+    self.layout.addWidget(batchCollapsibleButton)
+    batchFormLayout = qt.QFormLayout(batchCollapsibleButton)
+
+    self.BatchURLText = qt.QPlainTextEdit()
+    self.BatchURLText.setToolTip("Paste the URLs to import, one per line. File and node names are taken from the URLs.")
+    batchFormLayout.addRow("URLs: ", self.BatchURLText)
+
+    self.ParallelDownloadsSpinBox = qt.QSpinBox()
+    self.ParallelDownloadsSpinBox.setRange(1, 16)
+    self.ParallelDownloadsSpinBox.value = 4
+    self.ParallelDownloadsSpinBox.setToolTip("Number of files downloaded at the same time")
+    batchFormLayout.addRow("Parallel downloads: ", self.ParallelDownloadsSpinBox)
+
+    self.UseCacheCheckBox = qt.QCheckBox()
+    self.UseCacheCheckBox.checked = True
+    self.UseCacheCheckBox.setToolTip("Load URLs that were already downloaded from their copy in the Slicer cache folder")
+    batchFormLayout.addRow("Use downloaded copies: ", self.UseCacheCheckBox)
+
+    self.BatchImportButton = qt.QPushButton("Import all")
+    self.BatchImportButton.toolTip = "Download the URLs concurrently and load each file as soon as it is downloaded"
+    self.BatchImportButton.enabled = False
+    batchFormLayout.addRow(self.BatchImportButton)
+
+    self.BatchStatusTable = qt.QTableWidget()
+    self.BatchStatusTable.setColumnCount(3)
+    self.BatchStatusTable.setHorizontalHeaderLabels(["Node", "Status", "Details"])
+    self.BatchStatusTable.horizontalHeader().setStretchLastSection(True)
+    self.BatchStatusTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    batchFormLayout.addRow(self.BatchStatusTable)
+
     # Connections
     self.InputURLText.connect('textChanged(const QString &)', self.onEnterURL)
     self.ImportButton.connect('clicked(bool)', self.onImport)
+    self.BatchURLText.connect('textChanged()', self.onEnterBatchURLs)
+    self.BatchImportButton.connect('clicked(bool)', self.onBatchImport)
 
   def onEnterURL(self):
     url = self.InputURLText.text
@@ -116,6 +154,35 @@ class ImportFromURLWidget(ScriptedLoadableModuleWidget):
     except:
       logging.debug('Could not import data. Please confirm that the URL and file name is valid.')
 
+  def onEnterBatchURLs(self):
+    self.BatchImportButton.enabled = bool(self.batchURLs())
+
+  def batchURLs(self):
+    return [line.strip() for line in self.BatchURLText.toPlainText().splitlines() if line.strip()]
+
+  def onBatchImport(self):
+    logic = ImportFromURLLogic()
+    urls = self.batchURLs()
+    self.BatchStatusTable.setRowCount(len(urls))
+    rows = {}
+
+    def updateStatus(item):
+      if item not in rows:
+        rows[item] = len(rows)
+      row = rows[item]
+      for column, text in enumerate([item.nodeName, item.status, item.message or item.url]):
+        self.BatchStatusTable.setItem(row, column, qt.QTableWidgetItem(text))
+
+    self.BatchImportButton.enabled = False
+    try:
+      items = logic.importURLs(urls, statusCallback=updateStatus, maxWorkers=self.ParallelDownloadsSpinBox.value,
+        useCache=self.UseCacheCheckBox.checked)
+    finally:
+      self.BatchImportButton.enabled = True
+    failedCount = sum(item.status == url_queue.FAILED for item in items)
+    if failedCount:
+      slicer.util.warningDisplay(f"{failedCount} of {len(items)} URLs could not be imported, see the Details column.")
+
 
 class ImportFromURLLogic(ScriptedLoadableModuleLogic):
   """This class should implement all the actual
@@ -127,37 +194,9 @@ class ImportFromURLLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
   def runImport(self, url, fileNames, nodeNames):
-    loadFileProperties={}
-    filename, extension = os.path.splitext(fileNames)
-    if(extension in ['.zip']):
-      fileTypes = 'ZipFile'
-    elif(extension in ['.mrb'] ):
-      fileTypes = 'SceneFile'
-    elif(extension in ['.dcm', '.nrrd', '.nii', '.mhd', '.mha', '.hdr', '.img', '.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff']):
-      if '.seg' in filename:
-        fileTypes = 'SegmentationFile'
-      else:
-        fileTypes = 'VolumeFile'
-        if '-label' in filename:
-          loadFileProperties["labelmap"] = True
-    elif(extension == '.gz'):
-      subfilename, subextension = os.path.splitext(filename)
-      if subextension == '.nii':
-        if '.seg' in filename:
-          fileTypes = 'SegmentationFile'
-        else:
-          fileTypes = 'VolumeFile'
-          if '-label' in filename:
-            loadFileProperties["labelmap"] = True
-        fileTypes = 'VolumeFile'
-      else:
-        logging.debug('Could not download data. Not a supported file type.')
-    elif(extension in ['.vtk', '.vtp', '.obj', '.ply', '.stl'] ):
-      fileTypes = 'ModelFile'
-    elif(extension in ['.fcsv', '.json'] ):
-      fileTypes = 'MarkupsFile'
-    else:
-      logging.debug('Could not download data. Not a supported file type.')
+    fileTypes, loadFileProperties = url_queue.fileTypeForFileName(fileNames)
+    if fileTypes is None:
+      raise ValueError(f'Not a supported file type: {fileNames}')
 
     sampleDataLogic = SampleData.SampleDataLogic()
     url=self.processUrl(url)
@@ -175,6 +214,38 @@ class ImportFromURLLogic(ScriptedLoadableModuleLogic):
     elif fileTypes == 'VolumeFile':
       self.autoRenderVolume(loadedNodes[0])
 
+  def importURLs(self, urls, statusCallback=None, maxWorkers=4, useCache=True, cacheFolder=None, loadFunction=None):
+    """
+    Import a list of URLs: files are downloaded concurrently, or loaded from their copy in the cache folder
+    if they were downloaded before, and loaded into the scene as each download completes.
+    statusCallback(item) is called with the url_queue.ImportItem of a URL each time its status changes.
+    Returns the items, with their status and loaded nodes.
+    """
+    if cacheFolder is None:
+      cacheFolder = os.path.join(slicer.app.cachePath, 'ImportFromURL')
+    items = [url_queue.ImportItem(url, self.processUrl(url)) for url in urls]
+    importQueue = url_queue.URLImportQueue(cacheFolder, maxWorkers=maxWorkers, useCache=useCache)
+    return importQueue.run(items, loadFunction or self.loadDownloadedFile, statusCallback, slicer.app.processEvents)
+
+  def loadDownloadedFile(self, item):
+    """Load the downloaded file of an import item into the scene, returns the loaded nodes"""
+    fileType, loadFileProperties = url_queue.fileTypeForFileName(item.fileName)
+    if fileType is None:
+      raise ValueError('Not a supported file type')
+    if fileType == 'ZipFile':
+      outputFolder = os.path.join(os.path.dirname(item.path), item.nodeName)
+      slicer.util.extractArchive(item.path, outputFolder)
+      item.path = outputFolder
+      return []
+    if fileType == 'SceneFile':
+      slicer.util.loadScene(item.path)
+      return []
+    loadFileProperties["name"] = item.nodeName
+    node = slicer.util.loadNodeFromFile(item.path, fileType, loadFileProperties)
+    if fileType == 'VolumeFile':
+      self.autoRenderVolume(node)
+    return [node]
+
   def processUrl(self, url):
     # Apply DropBox and GitHub specific URL fixes if needed
     if "www.dropbox.com" in url:
@@ -249,6 +320,8 @@ class ImportFromURLTest(ScriptedLoadableModuleTest):
       """
     self.setUp()
     self.test_ImportFromURL1()
+    self.setUp()
+    self.test_ImportFromURLBatchImport()
 
   def test_ImportFromURL1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -295,3 +368,122 @@ class ImportFromURLTest(ScriptedLoadableModuleTest):
     self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
     self.delayDisplay('Test passed')
+
+  def test_ImportFromURLBatchImport(self):
+    """ Batch import of URLs from a local server that adds latency to each request: downloads are concurrent,
+    a URL listed twice is downloaded once, files are loaded on the main thread as they complete, failures are
+    reported per item, and a second import of the same URLs is served from the download cache.
+    """
+    import http.server
+    import shutil
+    import tempfile
+    import threading
+    import time
+    self.delayDisplay("Starting the batch import test")
+
+    latency = 0.1
+    fileCount = 8
+    requestCounts = {}
+    state = {"active": 0, "peakActive": 0}
+    lock = threading.Lock()
+
+    class LandmarkHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        with lock:
+          requestCounts[self.path] = requestCounts.get(self.path, 0) + 1
+          state["active"] += 1
+          state["peakActive"] = max(state["peakActive"], state["active"])
+        time.sleep(latency)
+        with lock:
+          state["active"] -= 1
+        name = os.path.basename(self.path)
+        if not name.startswith("landmarks"):
+          self.send_error(404)
+          return
+        body = f"# Markups fiducial file version = 4.11\n# CoordinateSystem = LPS\n0,{len(name)},0,0\n".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), LandmarkHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    baseUrl = f"http://127.0.0.1:{server.server_address[1]}"
+    cacheFolder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, cacheFolder, True)
+
+    urls = [f"{baseUrl}/landmarks{index}.fcsv" for index in range(fileCount)]
+    batchUrls = urls + [urls[0], f"{baseUrl}/missing.fcsv", f"{baseUrl}/landmarks.unknown"]
+    mainThread = threading.current_thread()
+    loadThreads = []
+    statusChanges = {}
+
+    def loadFile(item):
+      loadThreads.append(threading.current_thread())
+      with open(item.path) as file:
+        self.assertIn(f"0,{len(item.fileName)},0,0", file.read())
+      return logic.loadDownloadedFile(item)
+
+    def recordStatus(item):
+      statusChanges.setdefault(item.url, []).append(item.status)
+
+    logic = ImportFromURLLogic()
+    startTime = time.perf_counter()
+    items = logic.importURLs(batchUrls, statusCallback=recordStatus, maxWorkers=1, useCache=False,
+      cacheFolder=cacheFolder, loadFunction=loadFile)
+    sequentialTime = time.perf_counter() - startTime
+    self.assertEqual(state["peakActive"], 1)
+
+    startTime = time.perf_counter()
+    requestCounts.clear()
+    statusChanges.clear()
+    del loadThreads[:]
+    state["peakActive"] = 0
+    items = logic.importURLs(batchUrls, statusCallback=recordStatus, maxWorkers=4, useCache=False,
+      cacheFolder=cacheFolder, loadFunction=loadFile)
+    parallelTime = time.perf_counter() - startTime
+    logging.info(f"Batch import of {len(batchUrls)} URLs: {sequentialTime:.2f}s with 1 download at a time, "
+      f"{parallelTime:.2f}s with 4")
+    # downloads overlap, up to the number of workers
+    self.assertGreater(state["peakActive"], 1)
+    self.assertLessEqual(state["peakActive"], 4)
+
+    # each URL requested once except the unsupported one, all loads on the main thread
+    self.assertEqual(set(requestCounts.values()), {1})
+    self.assertEqual(len(requestCounts), fileCount + 1)
+    self.assertNotIn("/landmarks.unknown", requestCounts)
+    self.assertEqual(len(loadThreads), fileCount + 1)
+    self.assertTrue(all(thread is mainThread for thread in loadThreads))
+    statuses = [item.status for item in items]
+    self.assertEqual(statuses, [url_queue.LOADED] * (fileCount + 1) + [url_queue.FAILED] * 2)
+    self.assertTrue(all(len(item.nodes) == 1 for item in items[:fileCount + 1]))
+    self.assertIn("404", items[-2].message)
+    self.assertIn("Not a supported file type", items[-1].message)
+    self.assertEqual(statusChanges[urls[1]], [url_queue.QUEUED, url_queue.DOWNLOADING, url_queue.DOWNLOADED,
+      url_queue.LOADED])
+    self.assertEqual(statusChanges[batchUrls[-1]], [url_queue.FAILED])
+
+    # single imports of unsupported types are rejected before downloading too
+    requestCounts.clear()
+    with self.assertRaises(ValueError):
+      logic.runImport(batchUrls[-1], "landmarks.unknown", "landmarks")
+    self.assertEqual(requestCounts, {})
+
+    # second import: everything that was downloaded is loaded from the cache without any request
+    requestCounts.clear()
+    statusChanges.clear()
+    startTime = time.perf_counter()
+    items = logic.importURLs(urls, statusCallback=recordStatus, cacheFolder=cacheFolder, loadFunction=loadFile)
+    cachedTime = time.perf_counter() - startTime
+    logging.info(f"Batch import of {len(urls)} cached URLs: {cachedTime:.3f}s")
+    self.assertEqual(requestCounts, {})
+    self.assertEqual([item.status for item in items], [url_queue.LOADED] * fileCount)
+    self.assertEqual(statusChanges[urls[1]], [url_queue.QUEUED, url_queue.CACHED, url_queue.LOADED])
+
+    self.delayDisplay('Test passed')
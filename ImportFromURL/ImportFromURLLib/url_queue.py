@@ -0,0 +1,200 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import urllib.request
+
+# Status of the items of a batch import, in the order they go through
+QUEUED = "Queued"
+DOWNLOADING = "Downloading"
+DOWNLOADED = "Downloaded"
+CACHED = "Cached"
+LOADED = "Loaded"
+FAILED = "Failed"
+
+def fileNameFromUrl(url):
+  """File name at the end of the path of a URL, without query"""
+  return os.path.basename(url).split('?')[0]
+
+def fileTypeForFileName(fileName):
+  """
+  Slicer file type and load properties of a file from its extension, file type is None if it is not supported
+  """
+  loadFileProperties = {}
+  fileType = None
+  filename, extension = os.path.splitext(fileName)
+  if extension in ['.zip']:
+    fileType = 'ZipFile'
+  elif extension in ['.mrb']:
+    fileType = 'SceneFile'
+  elif extension in ['.dcm', '.nrrd', '.nii', '.mhd', '.mha', '.hdr', '.img', '.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff']:
+    if '.seg' in filename:
+      fileType = 'SegmentationFile'
+    else:
+      fileType = 'VolumeFile'
+      if '-label' in filename:
+        loadFileProperties["labelmap"] = True
+  elif extension == '.gz':
+    subfilename, subextension = os.path.splitext(filename)
+    if subextension == '.nii':
+      if '.seg' in filename:
+        fileType = 'SegmentationFile'
+      else:
+        fileType = 'VolumeFile'
+        if '-label' in filename:
+          loadFileProperties["labelmap"] = True
+  elif extension in ['.vtk', '.vtp', '.obj', '.ply', '.stl']:
+    fileType = 'ModelFile'
+  elif extension in ['.fcsv', '.json']:
+    fileType = 'MarkupsFile'
+  return fileType, loadFileProperties
+
+class ImportItem:
+  """A URL of a batch import and its progress"""
+  def __init__(self, url, downloadUrl=None, fileName=None, nodeName=None):
+    self.url = url
+    self.downloadUrl = downloadUrl or url
+    self.fileName = fileName or fileNameFromUrl(url)
+    self.nodeName = nodeName or self.fileName.split('.')[0]
+    self.status = QUEUED
+    self.message = ""
+    self.path = None
+    self.nodes = []
+
+class DownloadCache:
+  """
+  Downloaded files stored by content in cacheFolder/<SHA-256>/<file name>, with an index of the content of each URL,
+  so that a URL imported again is loaded from disk and identical files from different URLs are stored once.
+  """
+  def __init__(self, cacheFolder):
+    self.cacheFolder = cacheFolder
+    self.indexPath = os.path.join(cacheFolder, "index.json")
+    self.lock = threading.Lock()
+    os.makedirs(cacheFolder, exist_ok=True)
+    self.index = {}
+    if os.path.exists(self.indexPath):
+      try:
+        with open(self.indexPath) as indexFile:
+          self.index = json.load(indexFile)
+      except (OSError, ValueError):
+        self.index = {}
+
+  def get(self, url, fileName):
+    """Path of the cached copy of a URL, None if it was not downloaded"""
+    with self.lock:
+      entry = self.index.get(url)
+    if entry is None:
+      return None
+    path = os.path.join(self.cacheFolder, entry["sha256"], fileName)
+    if not os.path.exists(path):
+      # same content under another file name, or removed
+      contentPath = os.path.join(self.cacheFolder, entry["sha256"], entry["fileName"])
+      if not os.path.exists(contentPath):
+        return None
+      shutil.copyfile(contentPath, path)
+    return path
+
+  def add(self, url, fileName, temporaryPath, sha256):
+    """Move a downloaded file into the cache, returns its path there"""
+    folderPath = os.path.join(self.cacheFolder, sha256)
+    os.makedirs(folderPath, exist_ok=True)
+    path = os.path.join(folderPath, fileName)
+    os.replace(temporaryPath, path)
+    with self.lock:
+      self.index[url] = {"sha256": sha256, "fileName": fileName}
+    return path
+
+  def save(self):
+    with self.lock:
+      index = dict(self.index)
+    temporaryPath = self.indexPath + ".tmp"
+    with open(temporaryPath, "w") as indexFile:
+      json.dump(index, indexFile)
+    os.replace(temporaryPath, self.indexPath)
+
+class URLImportQueue:
+  """
+  Batch import of URLs: files are downloaded concurrently on up to maxWorkers threads into a DownloadCache
+  (a URL that appears several times is downloaded once), and each file is loaded by loadFunction on the calling
+  thread as soon as its download completes, while statusCallback reports the status of each item. Items whose
+  file type is not supported (see fileTypeForFileName) fail without being downloaded.
+  """
+  def __init__(self, cacheFolder, maxWorkers=4, timeout=60, useCache=True):
+    self.cache = DownloadCache(cacheFolder)
+    self.maxWorkers = maxWorkers
+    self.timeout = timeout
+    self.useCache = useCache
+    self.events = queue.Queue()
+
+  def download(self, item):
+    """Download the file of an item (on a worker thread), returns its path and whether it was in the cache"""
+    if self.useCache:
+      path = self.cache.get(item.downloadUrl, item.fileName)
+      if path is not None:
+        return path, True
+    self.events.put((item, DOWNLOADING))
+    temporaryPath = os.path.join(self.cache.cacheFolder, f"download-{threading.get_ident()}-{id(item)}.tmp")
+    contentHash = hashlib.sha256()
+    try:
+      with urllib.request.urlopen(item.downloadUrl, timeout=self.timeout) as response, open(temporaryPath, "wb") as file:
+        while True:
+          data = response.read(1024 * 1024)
+          if not data:
+            break
+          contentHash.update(data)
+          file.write(data)
+    except BaseException:
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+      raise
+    return self.cache.add(item.downloadUrl, item.fileName, temporaryPath, contentHash.hexdigest()), False
+
+  def run(self, items, loadFunction, statusCallback=None, processEvents=None):
+    """
+    Download and load all items. loadFunction(item) returns the nodes loaded from item.path, it is called on the
+    calling thread, as are statusCallback(item) after each change of status and processEvents() while waiting.
+    """
+    def setStatus(item, status, message=""):
+      item.status = status
+      item.message = message
+      if statusCallback:
+        statusCallback(item)
+
+    itemsByUrl = {}
+    for item in items:
+      if fileTypeForFileName(item.fileName)[0] is None:
+        setStatus(item, FAILED, f"Not a supported file type: {item.fileName}")
+        continue
+      setStatus(item, QUEUED)
+      itemsByUrl.setdefault(item.downloadUrl, []).append(item)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+      futures = {executor.submit(self.download, urlItems[0]): urlItems for urlItems in itemsByUrl.values()}
+      while futures:
+        done, _ = concurrent.futures.wait(futures, timeout=0.05, return_when=concurrent.futures.FIRST_COMPLETED)
+        while not self.events.empty():
+          item, status = self.events.get()
+          for urlItem in itemsByUrl[item.downloadUrl]:
+            setStatus(urlItem, status)
+        for future in done:
+          urlItems = futures.pop(future)
+          try:
+            path, fromCache = future.result()
+          except Exception as e:
+            for item in urlItems:
+              setStatus(item, FAILED, f"Download failed: {e}")
+            continue
+          for item in urlItems:
+            item.path = path
+            setStatus(item, CACHED if fromCache else DOWNLOADED, path)
+            try:
+              item.nodes = loadFunction(item)
+              setStatus(item, LOADED)
+            except Exception as e:
+              setStatus(item, FAILED, f"Could not load {item.fileName}: {e}")
+        if processEvents:
+          processEvents()
+    self.cache.save()
+    return items
@@ -1,10 +1,11 @@
 import time
+import logging
 import json
 import os
 import sys
 import warnings
 from collections import OrderedDict
-from typing import Optional
+from typing import Dict, Optional
 
 import webbrowser
 import requests
@@ -15,6 +16,9 @@ import qt
 import slicer
 from slicer.ScriptedLoadableModule import *
 
+from MorphoSourceImportLib.query_cache import QueryCache
+from MorphoSourceImportLib.worker_client import MorphoSourceWorker
+
 try:
     from importlib.metadata import version
 except ImportError:
@@ -28,6 +32,9 @@ warnings.filterwarnings("ignore", "DataFrame.applymap has been deprecated")
 
 morphosourceVersion = "1.1.0"
 
+# Prefix of the JSON progress snapshots printed by download_items.py (download_progress.PROGRESS_PREFIX)
+downloadProgressPrefix = "DOWNLOAD_PROGRESS "
+
 
 def is_correct_version_installed(package, desired_version):
     try:
@@ -155,7 +162,8 @@ class ClickableLabel(qt.QLabel):
 
 class MSQuery:
     def __init__(self, query: str, media_type: str, taxonomy_gbif: str,
-                 openDownloadsOnly: bool, media_tag: str = None, per_page: int = 20):
+                 openDownloadsOnly: bool, media_tag: str = None, per_page: int = 20,
+                 cache: Optional[QueryCache] = None):
         # Attempt to import pandas, and install if not present
         try:
             import pandas as pd
@@ -167,7 +175,7 @@ class MSQuery:
         try:
             import morphosource as ms
             from morphosource import search_media, get_media, DownloadVisibility
-            from morphosource.search import SearchResults
+            from morphosource.search import Media, SearchResults
             from morphosource.exceptions import MetadataMissingError
 
             # Check if MorphoSource is installed and at the correct version
@@ -189,7 +197,7 @@ class MSQuery:
 
             import morphosource as ms
             from morphosource import search_media, get_media, DownloadVisibility
-            from morphosource.search import SearchResults
+            from morphosource.search import Media, SearchResults
             from morphosource.exceptions import MetadataMissingError
 
             # Close the installation dialog
@@ -203,7 +211,9 @@ class MSQuery:
         self.ms = ms
         self.get_media = get_media
         self.search_media = search_media
+        self.Media = Media
         self.SearchResults = SearchResults
+        self.cache = cache  # QueryCache of the pages and thumbnails kept between sessions, if any
 
         self.query = query
         self.taxonomy_gbif = taxonomy_gbif
@@ -230,13 +240,14 @@ class MSQuery:
         start_time = time.time()  # Start timing
         # Check if the page has already been fetched
         if page not in self.pages:
-            search_results = self.search_media(query=self.query,
-                                               taxonomy_gbif=self.taxonomy_gbif,
-                                               media_type=self.media_type,
-                                               visibility=self.visibility,
-                                               media_tag=self.media_tag,
-                                               per_page=self.per_page,
-                                               page=page)
+            # the search results and file sizes of the page, from the cache of the previous sessions if available
+            if self.cache is not None:
+                page_data = self.cache.page(self.query_parameters(page), lambda: self.fetch_page(page))
+            else:
+                page_data = self.fetch_page(page)
+            search_results = self.SearchResults([self.Media(data) for data in page_data['items']],
+                                                page_data['facets'], page_data['pages'])
+            file_sizes = page_data['sizes']
 
             if self.total_pages is None and self.total_count is None:
                 self.total_pages = int(search_results.pages['total_pages'])
@@ -247,17 +258,10 @@ class MSQuery:
 
             thumbnail_urls, web_urls = self.get_urls_for_page(search_results)
 
-            # run_search method took 9.65217113494873 seconds to execute w/ calculate_file_sizes
-            file_sizes, successful_indices = self.calculate_file_sizes(search_results)
-
-            # Filter search_results.items to include only successful media items
-            search_results.items = [search_results.items[i] for i in successful_indices]
-
-            # Filter thumbnail_urls and web_urls to include only successful media items
-            thumbnail_urls = [thumbnail_urls[i] for i in successful_indices]
-            web_urls = [web_urls[i] for i in successful_indices]
-
-            thumbnails = download_thumbnails(thumbnail_urls)  # parallel requests to api, 6 workers
+            if self.cache is not None:
+                thumbnails = self.cache.thumbnails(thumbnail_urls)  # only changed thumbnails are downloaded
+            else:
+                thumbnails = download_thumbnails(thumbnail_urls)  # parallel requests to api, 6 workers
 
             # Store the search results in the ordered dictionary
             self.pages[page] = {'search_results': search_results,
@@ -279,6 +283,30 @@ class MSQuery:
         elapsed_time = end_time - start_time
         print(f"run_search method took {elapsed_time} seconds to execute.")
 
+    def query_parameters(self, page: int) -> dict:
+        return {'query': self.query, 'taxonomy_gbif': self.taxonomy_gbif, 'media_type': self.media_type,
+                'visibility': str(self.visibility), 'media_tag': self.media_tag, 'per_page': self.per_page,
+                'page': page}
+
+    def fetch_page(self, page: int) -> dict:
+        """Search results of a page with the file size of each media, leaving out the media without file metadata"""
+        search_results = self.search_media(query=self.query,
+                                           taxonomy_gbif=self.taxonomy_gbif,
+                                           media_type=self.media_type,
+                                           visibility=self.visibility,
+                                           media_tag=self.media_tag,
+                                           per_page=self.per_page,
+                                           page=page)
+
+        # run_search method took 9.65217113494873 seconds to execute w/ calculate_file_sizes
+        file_sizes, successful_indices = self.calculate_file_sizes(search_results)
+
+        # Keep only successful media items
+        return {'items': [search_results.items[i].data for i in successful_indices],
+                'facets': search_results.facets,
+                'pages': search_results.pages,
+                'sizes': file_sizes}
+
     def get_file_size(self, media):
         try:
             size_mb = (media.get_file_metadata().file_size / 1024) / 1024
@@ -420,7 +448,7 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
         self.event_filter = None
         self.startSearchButton = None
         self.all_pages = None
-        self.searchProcess = None
+        self.searchRequestId = None  # ID of the search export request of the MorphoSource worker
         self.searchProgressBar = None
         self.downloadInProgress = None
         self.total_downloads = None
@@ -438,6 +466,8 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
         self.nextPageButton = None
         self.previousPageButton = None
         self.resultsTable = None
+        self.cacheStatusLabel = None
+        self.clearCacheButton = None
         self.submitQueryButton = None
         self.openDatasetsCheckbox = None
         self.ctImageSeriesRadioButton = None
@@ -447,7 +477,7 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
         self.elementInput = None
         self.usageCategoryCheckboxes = None
 
-        self.downloadProcess = None  # Add this line to store the subprocess reference
+        self.downloadRequestId = None  # ID of the download request of the MorphoSource worker
         self.logic = MorphoSourceImportLogic()
 
     def setup(self) -> None:
@@ -550,6 +580,16 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
         self.pageNavigationLayout.addWidget(self.nextPageButton)
         self.layout.addLayout(self.pageNavigationLayout)
 
+        # Hit rates of the cache of search pages and thumbnails
+        self.cacheStatusLabel = qt.QLabel("")
+        self.clearCacheButton = qt.QPushButton("Clear Cache")
+        self.clearCacheButton.setToolTip("Remove the search pages and thumbnails kept from previous searches.")
+        self.clearCacheButton.connect('clicked(bool)', self.onClearCache)
+        cacheLayout = qt.QHBoxLayout()
+        cacheLayout.addWidget(self.cacheStatusLabel, 1)
+        cacheLayout.addWidget(self.clearCacheButton)
+        self.layout.addLayout(cacheLayout)
+
         # Disable the previous page button initially
         self.previousPageButton.setEnabled(False)
 
@@ -658,6 +698,27 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
           savedDownloadFolder = slicer.mrmlScene.GetRootDirectory()
         self.downloadFolderPathInput.text = savedDownloadFolder
 
+        # Connections per file and download rate limit
+        downloadOptionsCollapsibleButton = ctk.ctkCollapsibleButton()
+        downloadOptionsCollapsibleButton.text = "Download Options"
+        downloadOptionsCollapsibleButton.collapsed = True
+        self.layout.addWidget(downloadOptionsCollapsibleButton)
+        downloadOptionsLayout = qt.QFormLayout(downloadOptionsCollapsibleButton)
+
+        self.segmentWorkersSpinBox = qt.QSpinBox()
+        self.segmentWorkersSpinBox.setRange(1, 16)
+        self.segmentWorkersSpinBox.setValue(int(self.logic.loadSetting('segmentWorkers', 4)))
+        self.segmentWorkersSpinBox.setToolTip("Large files are downloaded in segments over this many connections at the same time.")
+        downloadOptionsLayout.addRow("Connections per file:", self.segmentWorkersSpinBox)
+
+        self.maxDownloadRateSpinBox = qt.QDoubleSpinBox()
+        self.maxDownloadRateSpinBox.setRange(0, 10000)
+        self.maxDownloadRateSpinBox.setSuffix(" MB/s")
+        self.maxDownloadRateSpinBox.setSpecialValueText("No limit")
+        self.maxDownloadRateSpinBox.setValue(float(self.logic.loadSetting('maxDownloadRate', 0)))
+        self.maxDownloadRateSpinBox.setToolTip("Total download rate of all files, to leave bandwidth to other applications.")
+        downloadOptionsLayout.addRow("Download rate limit:", self.maxDownloadRateSpinBox)
+
         # Add download button below the table
         self.downloadButton = qt.QPushButton("Download Checked Items")
         self.downloadButton.clicked.connect(self.downloadCheckedItems)
@@ -677,7 +738,7 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
         slicer.util.mainWindow().installEventFilter(self.event_filter)
 
     def cleanup(self) -> None:
-        pass
+        self.logic.stopWorkers()
 
     def set_title(self) -> None:  # Unused: Not within slicer style guidelines
         moduleNameLabel = qt.QLabel("MorphoSource Import")
@@ -811,6 +872,7 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
             self.updateResultsTable(page_one_results_df,
                                     self.logic.msq.pages[1]['thumbnails'],
                                     self.logic.msq.pages[1]['web_urls'])
+            self.updateCacheStatus()
 
             self.startSearchButton.setEnabled(True)
 
@@ -820,6 +882,13 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
 
             return
 
+    def updateCacheStatus(self):
+        self.cacheStatusLabel.setText(self.logic.getQueryCache().statistics_text())
+
+    def onClearCache(self):
+        self.logic.clearQueryCache()
+        self.cacheStatusLabel.setText("Cache cleared")
+
     def startSearchProcess(self):
         # Prepare query dictionary
         selectedDataType = None
@@ -842,70 +911,57 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
             'download_folder': self.logic.download_folder
         }
 
-        self.searchProcess = qt.QProcess()
-        self.searchProcess.readyReadStandardOutput.connect(self.onSearchProcessReadyRead)
-        self.searchProcess.errorOccurred.connect(self.onSearchProcessError)
-
-        # Prepare the command to start the download process
-        command = sys.executable
-        scriptPath = getResourceScriptPath('download_csv.py')
-
-        query_json_dict = json.dumps(queryDictionary)  # Convert config to JSON string
-        args = [scriptPath, query_json_dict]
-
         self.startSearch()
-        # Start the download process
-        self.searchProcess.start(command, args)
+        # Export the results in the search worker process, which runs alongside a download
+        self.searchRequestId = self.logic.getWorker('search').submit('export_search', queryDictionary,
+                                                                     self.onSearchOutputLine, self.onSearchFinished)
 
         # Assume progressBar is a member of the class and is a QProgressBar
         self.searchProgressBar = slicer.util.createProgressDialog()
+        self.searchProgressBar.canceled.connect(self.cancelSearch)
 
     def startSearch(self):
         # Call this method when the download starts
         self.SearchInProgress = True
+        self.startSearchButton.setEnabled(False)
 
-    def onSearchProcessReadyRead(self):
-        # Read the standard output of the search process
-        output = self.searchProcess.readAllStandardOutput().data().decode("utf-8")
-
-        # Split the output by newlines to get individual lines
-        lines = output.split('\n')
+    def cancelSearch(self):
+        if self.searchRequestId is not None:
+            self.logic.getWorker('search').cancel(self.searchRequestId)
 
-        # Iterate through each line
-        for line in lines:
-            if line.startswith("PROGRESS:"):
-                # Extract the progress value after the "PROGRESS:" prefix
-                try:
-                    progress_value = float(line.split(':')[1])
-                    self.updateSearchProgressBar(progress_value)
-                except ValueError as e:
-                    # Handle any errors during conversion
-                    print(f"Error converting progress to float: {e}")
-
-            elif line.startswith("{"):  # Assuming JSON data starts with '{'
-                self.all_pages = json.loads(line)
-                # Process the final data
-            else:
-                print('output:', line)
+    def onSearchOutputLine(self, line):
+        # Lines printed by the export of the search results
+        if line.startswith("PROGRESS:"):
+            # Extract the progress value after the "PROGRESS:" prefix
+            try:
+                progress_value = float(line.split(':')[1])
+                self.updateSearchProgressBar(progress_value)
+            except ValueError as e:
+                # Handle any errors during conversion
+                print(f"Error converting progress to float: {e}")
+
+        elif line.startswith("{"):  # Assuming JSON data starts with '{'
+            self.all_pages = json.loads(line)
+            # Process the final data
+        else:
+            print('output:', line)
+
+    def onSearchFinished(self, result, error):
+        self.SearchInProgress = False
+        self.searchRequestId = None
+        self.startSearchButton.setEnabled(True)
+        if self.searchProgressBar:
+            self.searchProgressBar.close()
+            self.searchProgressBar = None
+        if error:
+            print(f"Error exporting the search results: {error}")
+        else:
+            print(f"Search results exported to {result}")
 
     def updateSearchProgressBar(self, value):
         # Update the progress bar in the Slicer GUI
         self.searchProgressBar.setValue(value)
 
-    def onSearchProcessError(self, error):
-        if error == qt.QProcess.FailedToStart:
-            print("Process failed to start.")
-        elif error == qt.QProcess.Crashed:
-            print("Process crashed.")
-        elif error == qt.QProcess.Timedout:
-            print("Process timeout.")
-        elif error == qt.QProcess.WriteError:
-            print("Process write error.")
-        elif error == qt.QProcess.ReadError:
-            print("Process read error.")
-        else:
-            print("An unknown error occurred.")
-
     def updateResultsTable(self, df, thumbnails, web_urls):
         currentPage = self.logic.msq.current_page
         checkedItems = self.logic.msq.pages.get(currentPage, {}).get('checked_items', [])
@@ -1077,6 +1133,7 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
             # Update the results table with the new data
             self.updateResultsTable(results_df, self.logic.msq.pages[page_number]['thumbnails'],
                                     self.logic.msq.pages[page_number]['web_urls'])
+            self.updateCacheStatus()
 
             # Check if total_pages is available and update the pageNumberEdit
             if self.logic.msq and self.logic.msq.total_pages is not None:
@@ -1171,7 +1228,11 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
 
         _config_dict = {'usage_statement': intendedUseStatement, 'usage_categories': checkedCategories,
                         'api_key': self.apiKeyInput.text, 'checked_items': self.logic.msq.get_all_checked_items(),
-                        'download_folder': self.logic.download_folder}
+                        'download_folder': self.logic.download_folder,
+                        'segment_workers': self.segmentWorkersSpinBox.value,
+                        'max_download_rate': self.maxDownloadRateSpinBox.value}
+        self.logic.saveSetting('segmentWorkers', self.segmentWorkersSpinBox.value)
+        self.logic.saveSetting('maxDownloadRate', self.maxDownloadRateSpinBox.value)
 
         # Create a new list for items to be downloaded after checking for existing files
         itemsToDownload = []
@@ -1222,24 +1283,11 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
         # Disable buttons
         self.disableButtons()
 
-        # Initialize QProcess
-        self.downloadProcess = qt.QProcess()
-
-        self.downloadProcess.started.connect(self.onDownloadStarted)
-        self.downloadProcess.readyReadStandardOutput.connect(self.onDownloadOutput)
-        self.downloadProcess.readyReadStandardError.connect(self.onDownloadError)
-        self.downloadProcess.finished.connect(self.onDownloadFinished)
-
-        # Prepare the command to start the download process
-        command = sys.executable
-        scriptPath = getResourceScriptPath('download_items.py')
-
-        config_json_dict = json.dumps(_config_dict)  # Convert config to JSON string
-        args = [scriptPath, config_json_dict]
-
         self.startDownload()
-        # Start the download process
-        self.downloadProcess.start(command, args)
+        # Download in the download worker process
+        self.downloadRequestId = self.logic.getWorker('download').submit('download', _config_dict,
+                                                                         self.onDownloadOutputLine, self.onDownloadFinished)
+        self.onDownloadStarted()
 
         # Show progress bar and update UI
         self.progressBar.setVisible(True)
@@ -1259,9 +1307,9 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
         self.downloadButton.setEnabled(True)
 
     def onDownloadStarted(self):
-        print("Download process started.")
+        print("Download started.")
 
-    def updateProgressBar(self, progress, downloaded_mb=None, total_mb=None):
+    def updateProgressBar(self, progress, downloaded_mb=None, total_mb=None, rate_mb=None, eta_seconds=None):
         # Convert floating-point progress to an integer percentage
         percentage = int(float(progress))
         self.progressBar.setValue(percentage)
@@ -1271,42 +1319,48 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
             progress_text = f"{percentage}% ({downloaded_mb:.2f} MB / {total_mb:.2f} MB)"
         else:
             progress_text = f"{percentage}%"
+        if rate_mb:
+            progress_text += f" {rate_mb:.1f} MB/s"
+        if eta_seconds:
+            progress_text += f", {int(eta_seconds) // 60}:{int(eta_seconds) % 60:02d} left"
 
         self.progressBar.setFormat(progress_text)
 
-    def onDownloadOutput(self):
-        output = self.downloadProcess.readAllStandardOutput().data().decode("utf-8", errors='ignore').strip()
-        output_lines = output.split('\n')
-
-        for line in output_lines:
-            if "Download Progress" in line:
-                # Extract the progress value and update the progress bar for each line
-                progress_parts = line.split(',')
-                progress_value = progress_parts[0].split(': ')[1].strip().rstrip('%')
-                downloaded_mb = float(progress_parts[1].strip().split(' ')[0])
-                total_mb = float(progress_parts[1].strip().split(' ')[3])
-
-                self.updateProgressBar(progress_value, downloaded_mb, total_mb)
+    def updateDownloadProgress(self, snapshot):
+        """Show a progress snapshot of the download process (see download_progress.ProgressAggregator)"""
+        self.updateProgressBar(snapshot["fraction"] * 100, snapshot["downloaded_bytes"] / 1024**2,
+                               snapshot["total_bytes"] / 1024**2, snapshot["bytes_per_second"] / 1024**2,
+                               snapshot["eta_seconds"])
 
-            elif "Completed" in line:
-                print(line)
+    def onDownloadOutputLine(self, line):
+        # Lines printed by the download
+        line = line.strip()
+        if line.startswith(downloadProgressPrefix):
+            try:
+                snapshot = json.loads(line[len(downloadProgressPrefix):])
+            except ValueError:
+                return
+            self.updateDownloadProgress(snapshot)
 
-            elif "[Debug]" in line:
-                print(line)
+        elif "Size Progress" in line:
+            self.progressBar.setFormat(f"Finding file sizes: {line.split(': ', 1)[1]}")
 
-            else:
-                continue
+        elif "Completed" in line or "Terminated" in line:
+            print(line)
 
-    def onDownloadError(self):
-        error = self.downloadProcess.readAllStandardError().data().decode("utf-8").strip()
-        print("Download Error:", error)
+        elif "[Debug]" in line:
+            print(line)
 
-    def onDownloadFinished(self, exitCode):
-        # Handle completion of the download process
+    def onDownloadFinished(self, result, error):
+        # Handle completion of the download request
         self.progressBar.setVisible(False)
         self.enableButtons()
         self.downloadInProgress = False
-        print(f"Download process finished with exit code {exitCode}")
+        self.downloadRequestId = None
+        if error:
+            print(f"Download Error: {error}")
+        else:
+            print(f"Download finished, {result} items downloaded")
 
     def startDownload(self):
         # Call this method when the download starts
@@ -1315,7 +1369,8 @@ class MorphoSourceImportWidget(ScriptedLoadableModuleWidget):
     def terminateDownload(self):
         # Implement this method to terminate the download
         self.downloadInProgress = False
-        self.downloadProcess.terminate()
+        if self.downloadRequestId is not None:
+            self.logic.getWorker('download').cancel(self.downloadRequestId)
 
     def load_dependencies(self):
         # Attempt to import pandas, and install if not present
@@ -1374,6 +1429,8 @@ class MorphoSourceImportLogic(ScriptedLoadableModuleLogic):
         self.download_folder = None
         self.api_key = None
         self.msq: Optional[MSQuery] = None
+        self.cache: Optional[QueryCache] = None  # created on first use, see getQueryCache
+        self.workers: Dict[str, MorphoSourceWorker] = {}  # started on first use, see getWorker
 
         # self.api_key = None
         self.openDatasetsOnly = False
@@ -1387,9 +1444,37 @@ class MorphoSourceImportLogic(ScriptedLoadableModuleLogic):
         Run the query using the data dictionary
         """
 
+        cache = self.getQueryCache()
+        cache.reset_statistics()
         self.msq = MSQuery(query=dictionary['query'], media_type=dictionary['mediaType'],
                            taxonomy_gbif=dictionary['taxon'],
-                           openDownloadsOnly=self.openDatasetsOnly, media_tag=dictionary['mediaTag'])
+                           openDownloadsOnly=self.openDatasetsOnly, media_tag=dictionary['mediaTag'],
+                           cache=cache)
+
+    def getQueryCache(self) -> QueryCache:
+        """
+        Cache of the search pages and thumbnails in the Slicer cache folder, shared by the queries of all sessions
+        """
+        if self.cache is None:
+            self.cache = QueryCache(os.path.join(slicer.app.cachePath, 'MorphoSourceImport'))
+        return self.cache
+
+    def clearQueryCache(self) -> None:
+        self.getQueryCache().clear()
+
+    def getWorker(self, name: str = 'download') -> MorphoSourceWorker:
+        """
+        Worker process of the requests of a kind, started once per session. A worker serves its requests one at a
+        time, so the search exports ('search') have their own worker and do not wait for a download ('download').
+        """
+        if name not in self.workers:
+            self.workers[name] = MorphoSourceWorker(getResourceScriptPath('morphosource_worker.py'))
+        self.workers[name].start()
+        return self.workers[name]
+
+    def stopWorkers(self) -> None:
+        for worker in self.workers.values():
+            worker.stop()
 
     def runQueryForPage(self, page_number) -> None:
         # Ensure the MSQuery object exists and has performed the initial query
@@ -1425,3 +1510,916 @@ class MorphoSourceImportLogic(ScriptedLoadableModuleLogic):
     def loadSetting(self, settingName, defaultValue):
         settings = qt.QSettings()
         return settings.value(f'MorphoSourceImport/{settingName}', defaultValue)
+
+
+class MorphoSourceImportTest(ScriptedLoadableModuleTest):
+    """
+    This is the test case for your scripted module.
+    Uses ScriptedLoadableModuleTest base class, available at:
+    https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
+    """
+
+    def setUp(self):
+        """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+        """
+        slicer.mrmlScene.Clear(0)
+        resourcesPath = os.path.dirname(getResourceScriptPath('media_sizes.py'))
+        if resourcesPath not in sys.path:
+            sys.path.append(resourcesPath)
+
+    def runTest(self):
+        """Run as few or as many tests as needed here.
+        """
+        self.setUp()
+        self.test_MorphoSourceImportSizeDiscovery()
+        self.setUp()
+        self.test_MorphoSourceImportSegmentedDownload()
+        self.setUp()
+        self.test_MorphoSourceImportProgressAggregation()
+        self.setUp()
+        self.test_MorphoSourceImportSearchExport()
+        self.setUp()
+        self.test_MorphoSourceImportQueryCache()
+        self.setUp()
+        self.test_MorphoSourceImportWorker()
+        self.setUp()
+        self.test_MorphoSourceImportWorkerClient()
+
+    def startMockServer(self, handlerClass):
+        """Serve handlerClass requests on a local port from a background thread, returns the server and its base URL"""
+        import http.server
+        import threading
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handlerClass)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+    def test_MorphoSourceImportSizeDiscovery(self):
+        """ File sizes of a cart found with concurrent HEAD requests on kept-alive connections, with retries
+        of transient errors and a cache per media ID, against a local server that adds latency to each request.
+        """
+        import http.server
+        import tempfile
+        import threading
+        import media_sizes
+        self.delayDisplay("Starting the size discovery test")
+
+        latency = 0.02
+        state = {"connections": 0, "failures": {}, "active": 0, "peakActive": 0, "version": 1}
+        lock = threading.Lock()
+
+        class MediaHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive
+
+            def setup(self):
+                super().setup()
+                with lock:
+                    state["connections"] += 1
+
+            def do_HEAD(self):
+                with lock:
+                    state["active"] += 1
+                    state["peakActive"] = max(state["peakActive"], state["active"])
+                time.sleep(latency)
+                with lock:
+                    state["active"] -= 1
+                mediaId = int(self.path.rsplit("/", 1)[1])
+                with lock:
+                    # media IDs divisible by 7 fail twice with a transient error before succeeding, 13 always fails
+                    failures = state["failures"].get(mediaId, 0)
+                    state["failures"][mediaId] = failures + 1
+                if mediaId == 13 or (mediaId % 7 == 0 and failures < 2):
+                    self.send_response(503 if mediaId != 13 else 404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(mediaId * 1000))
+                self.send_header("ETag", f'"{mediaId}-{state["version"]}"')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server, baseUrl = self.startMockServer(MediaHandler)
+        mediaIds = list(range(1, 61))
+
+        def urlForMedia(mediaId):
+            return f"{baseUrl}/media/{mediaId}"
+
+        # previous behavior: one HEAD request at a time on a new connection
+        startTime = time.perf_counter()
+        for mediaId in range(100, 120):
+            requests.head(urlForMedia(mediaId))
+        sequentialSecondsPerMedia = (time.perf_counter() - startTime) / 20
+        state["connections"] = 0
+        state["peakActive"] = 0
+
+        with tempfile.TemporaryDirectory() as folderPath:
+            cachePath = os.path.join(folderPath, "sizes.json")
+            progress = []
+            discovery = media_sizes.SizeDiscovery(urlForMedia, max_workers=8, backoff=0.01,
+                                                  cache=media_sizes.MediaSizeCache(cachePath))
+            startTime = time.perf_counter()
+            sizes, errors = discovery.sizes(mediaIds, lambda found, total: progress.append(found))
+            concurrentSeconds = time.perf_counter() - startTime
+            logging.info(f"Sizes of {len(mediaIds)} media: {concurrentSeconds:.2f} s concurrently,"
+                         f" {sequentialSecondsPerMedia * len(mediaIds):.2f} s estimated one at a time")
+
+            self.assertEqual(list(sizes), mediaIds)
+            self.assertEqual(sizes[14], 14000)
+            self.assertEqual(sizes[13], 0)
+            self.assertEqual(list(errors), [13])
+            self.assertEqual(progress[-1], len(mediaIds))
+            self.assertEqual(sum(sizes.values()), sum(mediaId * 1000 for mediaId in mediaIds if mediaId != 13))
+            # retried media were requested 3 times, the permanent error only once
+            self.assertEqual(state["failures"][7], 3)
+            self.assertEqual(state["failures"][13], 1)
+            # connections are reused across requests and limited by the pool
+            self.assertLessEqual(state["connections"], 8)
+            # requests overlap, up to the number of workers
+            self.assertGreater(state["peakActive"], 1)
+            self.assertLessEqual(state["peakActive"], 8)
+
+            # sizes come from the cache file in the next session, only the missing ones are requested
+            requestCount = discovery.request_count
+            discovery = media_sizes.SizeDiscovery(urlForMedia, backoff=0.01, cache=media_sizes.MediaSizeCache(cachePath))
+            sizes, errors = discovery.sizes(mediaIds)
+            self.assertEqual(discovery.request_count, 1)
+            self.assertEqual(sizes[60], 60000)
+            self.assertLess(discovery.request_count, requestCount)
+            # with the validator of each file, to resume only downloads of unchanged files
+            self.assertEqual(discovery.validators[60], '"60-1"')
+            self.assertNotIn(13, discovery.validators)
+
+            # a file that changed is requested again and its cache entry replaced
+            state["version"] = 2
+            self.assertEqual(discovery.refresh(60), (60000, '"60-2"'))
+            self.assertEqual(media_sizes.MediaSizeCache(cachePath).get(60), (60000, '"60-2"'))
+
+        self.delayDisplay('Test passed')
+
+    def test_MorphoSourceImportSegmentedDownload(self):
+        """ Downloads in byte-range segments over several connections from a local server with limited bandwidth
+        per connection: speed-up, dropped connections, stopping and resuming with checksums, servers without
+        range support and the global rate limit.
+        """
+        import http.server
+        import tempfile
+        import threading
+        import numpy as np
+        import segmented_download
+        self.delayDisplay("Starting the segmented download test")
+
+        data = np.random.default_rng(0).integers(0, 256, 3 * 1024 * 1024, dtype=np.uint8).tobytes()
+        state = {"servedBytes": 0, "generation": 0, "rangeSupport": True, "dropAfter": 0, "droppedOffsets": set(),
+                 "content": data, "etag": '"v1"', "active": 0, "peakActive": 0}
+        lock = threading.Lock()
+
+        def resetServedBytes():
+            # responses still being sent for a stopped download are not counted
+            with lock:
+                state["servedBytes"] = 0
+                state["generation"] += 1
+
+        class FileHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with lock:
+                    state["active"] += 1
+                    state["peakActive"] = max(state["peakActive"], state["active"])
+                try:
+                    self.sendContent()
+                finally:
+                    with lock:
+                        state["active"] -= 1
+
+            def sendContent(self):
+                generation = state["generation"]
+                content = state["content"]
+                start, end = 0, len(content) - 1
+                rangeHeader = self.headers.get("Range")
+                ifRange = self.headers.get("If-Range")
+                if rangeHeader and state["rangeSupport"] and ifRange in (None, state["etag"]):
+                    first, last = rangeHeader.split("=", 1)[1].split("-")
+                    start, end = int(first), min(int(last), len(content) - 1)
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", state["etag"])
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                body = content[start:end + 1]
+                with lock:
+                    # the first response starting at each offset is cut after dropAfter bytes
+                    if state["dropAfter"] and start not in state["droppedOffsets"]:
+                        state["droppedOffsets"].add(start)
+                        body = body[:state["dropAfter"]]
+                        self.close_connection = True
+                try:
+                    for pieceStart in range(0, len(body), 64 * 1024):
+                        time.sleep(0.004)  # about 16 MB/s per connection
+                        piece = body[pieceStart:pieceStart + 64 * 1024]
+                        self.wfile.write(piece)
+                        with lock:
+                            if generation == state["generation"]:
+                                state["servedBytes"] += len(piece)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        server, baseUrl = self.startMockServer(FileHandler)
+        url = f"{baseUrl}/media_1.zip"
+
+        def downloadedData(path):
+            with open(path, 'rb') as file:
+                return file.read()
+
+        with tempfile.TemporaryDirectory() as folderPath:
+            # segments are fetched on up to max_connections connections at the same time
+            seconds = {}
+            peakConnections = {}
+            for connections in [1, 4]:
+                path = os.path.join(folderPath, f"download{connections}.zip")
+                state["peakActive"] = 0
+                startTime = time.perf_counter()
+                download = segmented_download.SegmentedDownload(url, path, len(data), segment_size=512 * 1024, max_connections=connections)
+                self.assertEqual(download.run(), len(data))
+                seconds[connections] = time.perf_counter() - startTime
+                self.assertEqual(downloadedData(path), data)
+                self.assertFalse(os.path.exists(download.state_path))
+                peakConnections[connections] = state["peakActive"]
+            self.assertEqual(peakConnections[1], 1)
+            self.assertGreater(peakConnections[4], 1)
+            self.assertLessEqual(peakConnections[4], 4)
+            logging.info(f"Download of {len(data) / 1024**2:.0f} MB: {seconds[1]:.2f} s on 1 connection, {seconds[4]:.2f} s on 4")
+
+            # connections closed before the end of a segment are resumed from where they stopped
+            state["dropAfter"] = 100 * 1024
+            resetServedBytes()
+            path = os.path.join(folderPath, "dropped.zip")
+            segmented_download.SegmentedDownload(url, path, len(data), segment_size=512 * 1024, backoff=0.01).run()
+            self.assertEqual(downloadedData(path), data)
+            self.assertEqual(state["servedBytes"], len(data))
+            state["dropAfter"] = 0
+
+            # a stopped download keeps its state; the next one fetches only the missing bytes and
+            # downloads again the segments whose bytes on disk no longer match their checksum
+            path = os.path.join(folderPath, "resumed.zip")
+            stopEvent = threading.Event()
+            progress = []
+
+            def stopAfterOneMegabyte(downloadedBytes, totalBytes):
+                progress.append(downloadedBytes)
+                if downloadedBytes >= 1024 * 1024:
+                    stopEvent.set()
+
+            download = segmented_download.SegmentedDownload(url, path, len(data), segment_size=256 * 1024, max_connections=2,
+                                                            progress_callback=stopAfterOneMegabyte, stop_event=stopEvent)
+            with self.assertRaises(RuntimeError):
+                download.run()
+            self.assertTrue(os.path.exists(download.state_path))
+            downloadedBefore = download.downloaded_bytes
+            self.assertGreaterEqual(downloadedBefore, 1024 * 1024)
+            # the progress of concurrent segments never goes back
+            self.assertEqual(progress, sorted(progress))
+            self.assertEqual(progress[-1], downloadedBefore)
+            with open(path, 'r+b') as file:
+                file.write(b"corrupted")
+            resetServedBytes()
+            download = segmented_download.SegmentedDownload(url, path, len(data), segment_size=256 * 1024, max_connections=2)
+            download.run()
+            self.assertEqual(downloadedData(path), data)
+            self.assertEqual(state["servedBytes"], len(data) - downloadedBefore + 256 * 1024)
+
+            # partial file of a previous download without state file: its bytes are kept
+            path = os.path.join(folderPath, "prefix.zip")
+            with open(path, 'wb') as file:
+                file.write(data[:700000])
+            resetServedBytes()
+            segmented_download.SegmentedDownload(url, path, len(data), segment_size=512 * 1024).run()
+            self.assertEqual(downloadedData(path), data)
+            self.assertEqual(state["servedBytes"], len(data) - 700000)
+
+            # a file resized to the total before any state was written (worker killed in between) is not a prefix:
+            # the state file is written first, and a full size file without state is downloaded again
+            path = os.path.join(folderPath, "preallocated.zip")
+            with open(path, 'wb') as file:
+                file.truncate(len(data))
+            resetServedBytes()
+            self.assertEqual(segmented_download.SegmentedDownload(url, path, len(data), segment_size=512 * 1024).run(), len(data))
+            self.assertEqual(downloadedData(path), data)
+            path = os.path.join(folderPath, "killed.zip")
+            stopEvent = threading.Event()
+            stopEvent.set()
+            download = segmented_download.SegmentedDownload(url, path, len(data), segment_size=512 * 1024, stop_event=stopEvent)
+            with self.assertRaises(RuntimeError):
+                download.run()
+            self.assertEqual(os.path.getsize(path), len(data))
+            self.assertTrue(os.path.exists(download.state_path))
+
+            # a file that changed on the server since the download was stopped is not resumed with the new bytes:
+            # the validator sent as If-Range, or the total of the Content-Range without validator, shows the change
+            newData = data[:1000000] + bytes(100) + data[1000000:]
+            for validator in ['"v1"', None]:
+                path = os.path.join(folderPath, f"changed{validator is None}.zip")
+                stopEvent = threading.Event()
+                download = segmented_download.SegmentedDownload(url, path, len(data), segment_size=256 * 1024, validator=validator,
+                                                                progress_callback=stopAfterOneMegabyte, stop_event=stopEvent)
+                with self.assertRaises(RuntimeError):
+                    download.run()
+                self.assertTrue(os.path.exists(download.state_path))
+                state["content"], state["etag"] = newData, '"v2"'
+                download = segmented_download.SegmentedDownload(url, path, len(data), segment_size=256 * 1024, validator=validator)
+                with self.assertRaises(segmented_download.RemoteFileChangedError):
+                    download.run()
+                self.assertFalse(os.path.exists(download.state_path))
+                self.assertFalse(os.path.exists(path))
+                # downloaded again with the new size and validator
+                segmented_download.SegmentedDownload(url, path, len(newData), segment_size=256 * 1024, validator='"v2"').run()
+                self.assertEqual(downloadedData(path), newData)
+                state["content"], state["etag"] = data, '"v1"'
+
+            # servers that ignore ranges send the whole file in one stream
+            state["rangeSupport"] = False
+            path = os.path.join(folderPath, "norange.zip")
+            segmented_download.SegmentedDownload(url, path, len(data), segment_size=512 * 1024).run()
+            self.assertEqual(downloadedData(path), data)
+            state["rangeSupport"] = True
+
+            # the rate limit is shared by all downloads
+            rateLimiter = segmented_download.RateLimiter(4 * 1024 * 1024)
+            startTime = time.perf_counter()
+            downloads = [segmented_download.SegmentedDownload(url, os.path.join(folderPath, f"limited{index}.zip"), len(data),
+                                                              segment_size=512 * 1024, rate_limiter=rateLimiter) for index in range(2)]
+            threads = [threading.Thread(target=download.run) for download in downloads]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertGreater(time.perf_counter() - startTime, 2 * len(data) / (4 * 1024 * 1024) - 0.5)
+            self.assertEqual(downloadedData(downloads[1].path), data)
+
+        # reads grow on fast connections and shrink on slow ones
+        chunkSize = segmented_download.AdaptiveChunkSize()
+        for repeat in range(10):
+            chunkSize.update(chunkSize.size, 0.001)
+        self.assertEqual(chunkSize.size, chunkSize.maximum)
+        for repeat in range(20):
+            chunkSize.update(chunkSize.size, 10.0)
+        self.assertEqual(chunkSize.size, chunkSize.minimum)
+
+        self.delayDisplay('Test passed')
+
+    def test_MorphoSourceImportProgressAggregation(self):
+        """ Progress of many concurrent download workers: the totals are exact and the number of
+        progress messages depends on the duration, not on the number of updates.
+        """
+        import threading
+        import download_progress
+        self.delayDisplay("Starting the progress aggregation test")
+
+        workerCount = 32
+        updatesPerWorker = 2000
+        chunkBytes = 1000
+        snapshots = []
+        aggregator = download_progress.ProgressAggregator(workerCount * updatesPerWorker * chunkBytes, workerCount,
+                                                          interval=0.05, publish_func=snapshots.append)
+
+        def worker(index):
+            # half of the workers report totals as SegmentedDownload does, the others increments
+            counter = aggregator.counter(index, updatesPerWorker * chunkBytes)
+            for update in range(updatesPerWorker):
+                if index % 2:
+                    counter.set((update + 1) * chunkBytes)
+                else:
+                    counter.add(chunkBytes)
+                if update % 10 == 0:
+                    time.sleep(0.001)
+            counter.finish()
+
+        startTime = time.perf_counter()
+        with aggregator:
+            threads = [threading.Thread(target=worker, args=(index,)) for index in range(workerCount)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        seconds = time.perf_counter() - startTime
+        logging.info(f"{workerCount * updatesPerWorker} progress updates in {seconds:.2f} s, {len(snapshots)} messages")
+
+        final = snapshots[-1]
+        self.assertEqual(final["downloaded_bytes"], final["total_bytes"])
+        self.assertEqual(final["fraction"], 1.0)
+        self.assertEqual(final["completed_items"], workerCount)
+        self.assertEqual(final["eta_seconds"], 0.0)
+        self.assertEqual(aggregator.published_count, len(snapshots))
+        # one message per interval, far fewer than the updates
+        self.assertLess(len(snapshots), workerCount * updatesPerWorker / 100)
+        downloaded = [snapshot["downloaded_bytes"] for snapshot in snapshots]
+        self.assertEqual(downloaded, sorted(downloaded))
+        self.assertTrue(all(snapshot["bytes_per_second"] >= 0 for snapshot in snapshots))
+
+        # snapshots go through the process output as single JSON lines
+        line = download_progress.format_progress_line(final)
+        self.assertTrue(line.startswith(downloadProgressPrefix))
+        self.assertNotIn("\n", line)
+        self.assertEqual(download_progress.parse_progress_line(line), final)
+        self.assertIsNone(download_progress.parse_progress_line("Size Progress: 1 of 2"))
+
+        # rate and ETA from the bytes of the last rate_window seconds
+        aggregator = download_progress.ProgressAggregator(10 * 1024**2, 1, publish_func=snapshots.append)
+        counter = aggregator.counter("media")
+        aggregator.start_time = time.monotonic()
+        self.assertIsNone(aggregator.snapshot()["eta_seconds"])
+        counter.set(1024**2)
+        time.sleep(0.1)
+        counter.set(2 * 1024**2)
+        snapshot = aggregator.snapshot()
+        self.assertGreater(snapshot["bytes_per_second"], 0)
+        self.assertAlmostEqual(snapshot["eta_seconds"], 8 * 1024**2 / snapshot["bytes_per_second"])
+
+        self.delayDisplay('Test passed')
+
+    def test_MorphoSourceImportSearchExport(self):
+        """ Export of the records of a query to CSV from a local stub of the MorphoSource search API with latency
+        per request: page order, columns added by later pages, retried pages, bounded read-ahead and the rate
+        limit, compared with the previous export that concatenated all the pages and flattened each cell.
+        """
+        import http.server
+        import tempfile
+        import threading
+        import urllib.parse
+        import pandas as pd
+        import search_export
+        self.delayDisplay("Starting the search export test")
+
+        perPage = 100
+        totalPages = 40
+        latency = 0.02
+        state = {"requests": {}, "written": 0, "maximumAhead": 0, "active": 0, "peakActive": 0}
+        lock = threading.Lock()
+
+        def record(index):
+            data = {"id": [f"{index:06d}"], "title": [f"Specimen {index}, \"skull\""], "media_type": ["Mesh"],
+                    "taxonomy": ["Mammalia", "Primates"] if index % 3 else [], "visibility": ["open"],
+                    "file_size": index * 10, "description": None}
+            if index >= 25 * perPage:
+                data["part"] = [f"part {index % 5}"]  # column of the later pages only
+            return data
+
+        class SearchHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with lock:
+                    state["active"] += 1
+                    state["peakActive"] = max(state["peakActive"], state["active"])
+                time.sleep(latency)
+                with lock:
+                    state["active"] -= 1
+                parameters = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                page = int(parameters["page"][0])
+                with lock:
+                    attempts = state["requests"].get(page, 0)
+                    state["requests"][page] = attempts + 1
+                    state["maximumAhead"] = max(state["maximumAhead"], page - state["written"])
+                if page == 7 and attempts == 0:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start = (page - 1) * perPage
+                body = json.dumps({"response": {"media": [record(index) for index in range(start, start + perPage)],
+                                                "pages": {"total_pages": totalPages, "total_count": totalPages * perPage}}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server, baseUrl = self.startMockServer(SearchHandler)
+        session = requests.Session()
+
+        def fetchPage(page):
+            response = session.get(f"{baseUrl}/api/media", params={"page": page, "per_page": perPage})
+            response.raise_for_status()
+            return response.json()["response"]["media"]
+
+        def pageWritten(page, total):
+            with lock:
+                state["written"] = page
+
+        # previous export: all the pages in memory, concatenated and flattened cell by cell
+        pages = [[record(index) for index in range((page - 1) * perPage, page * perPage)] for page in range(1, totalPages + 1)]
+        with tempfile.TemporaryDirectory() as folderPath:
+            expectedPath = os.path.join(folderPath, "expected.csv")
+            startTime = time.perf_counter()
+            frames = []
+            for page, records in enumerate(pages, 1):
+                frame = pd.DataFrame(records)
+                frame.index = range((page - 1) * perPage, (page - 1) * perPage + len(frame))
+                frames.append(frame.map(unlist_cell) if hasattr(frame, "map") else frame.applymap(unlist_cell))
+            pd.concat(frames).to_csv(expectedPath, index=True)
+            cellSeconds = time.perf_counter() - startTime
+            startTime = time.perf_counter()
+            path = os.path.join(folderPath, "local.csv")
+            search_export.SearchResultExport(lambda page: pages[page - 1], totalPages, path, per_page=perPage,
+                                             max_workers=1, requests_per_second=0).run()
+            columnSeconds = time.perf_counter() - startTime
+            logging.info(f"Flattening and writing {totalPages * perPage} records: {cellSeconds:.2f} s by cell,"
+                         f" {columnSeconds:.2f} s by column")
+            expected = pd.read_csv(expectedPath, index_col=0, dtype=str, keep_default_na=False)
+            self.assertTrue(pd.read_csv(path, index_col=0, dtype=str, keep_default_na=False).equals(expected))
+
+            seconds = {}
+            for workers in [1, 6]:
+                path = os.path.join(folderPath, f"export{workers}.csv")
+                state["requests"] = {}
+                state["written"] = 0
+                state["maximumAhead"] = 0
+                state["peakActive"] = 0
+                export = search_export.SearchResultExport(fetchPage, totalPages, path, per_page=perPage, max_workers=workers,
+                                                          requests_per_second=200, max_pending_pages=8, backoff=0.01,
+                                                          progress_callback=pageWritten)
+                startTime = time.perf_counter()
+                self.assertEqual(export.run(), totalPages * perPage)
+                seconds[workers] = time.perf_counter() - startTime
+
+                # same file as the previous export, rows in page order
+                self.assertEqual(export.failed_pages, [])
+                self.assertEqual(state["requests"][7], 2)
+                self.assertLessEqual(state["maximumAhead"], 8)
+                # pages are requested on up to max_workers connections at the same time
+                self.assertLessEqual(state["peakActive"], workers)
+                exported = pd.read_csv(path, index_col=0, dtype=str, keep_default_na=False)
+                self.assertEqual(list(exported.index), [str(index) for index in range(totalPages * perPage)])
+                self.assertTrue(exported.equals(expected))
+                self.assertEqual(exported.loc["1", "taxonomy"], "Mammalia ; Primates")
+                self.assertEqual(exported.loc["3", "taxonomy"], "")
+                self.assertEqual(exported.loc["2600", "part"], "part 0")
+                self.assertEqual(exported.loc["1", "part"], "")
+            logging.info(f"Export of {totalPages} pages: {seconds[1]:.2f} s with 1 worker, {seconds[6]:.2f} s with 6")
+            self.assertGreater(state["peakActive"], 1)
+            # at most 200 requests per second
+            self.assertGreater(seconds[6], (totalPages + 1) / 200 - 0.05)
+
+            # pages that keep failing, on request or decoding errors, are skipped and the file is marked incomplete
+            def failingFetchPage(page):
+                if page == 3:
+                    raise requests.exceptions.ConnectionError("unreachable")
+                if page == 4:
+                    raise json.JSONDecodeError("truncated response", "{", 1)
+                return pages[page - 1]
+
+            path = os.path.join(folderPath, "failed.csv")
+            export = search_export.SearchResultExport(failingFetchPage, 5, path, per_page=perPage, retries=2, backoff=0.01)
+            self.assertEqual(export.run(), 3 * perPage)
+            self.assertEqual(export.failed_pages, [3, 4])
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(export.path, os.path.join(folderPath, "failed" + search_export.INCOMPLETE_SUFFIX + ".csv"))
+            self.assertEqual(len(pd.read_csv(export.path)), 3 * perPage)
+
+            # other errors stop the export and remove the partial file
+            def brokenFetchPage(page):
+                if page == 3:
+                    raise KeyError("items")
+                return pages[page - 1]
+
+            path = os.path.join(folderPath, "broken.csv")
+            export = search_export.SearchResultExport(brokenFetchPage, 5, path, per_page=perPage, retries=2, backoff=0.01)
+            with self.assertRaises(KeyError):
+                export.run()
+            self.assertFalse(os.path.exists(path))
+
+            # a stopped export requests no more pages and removes its file
+            stopEvent = threading.Event()
+            requestedPages = []
+
+            def stoppedFetchPage(page):
+                requestedPages.append(page)
+                return pages[page - 1]
+
+            def stopAfterPage3(page, total):
+                if page == 3:
+                    stopEvent.set()
+
+            path = os.path.join(folderPath, "stopped.csv")
+            export = search_export.SearchResultExport(stoppedFetchPage, totalPages, path, per_page=perPage, max_workers=2,
+                                                      requests_per_second=0, max_pending_pages=4,
+                                                      progress_callback=stopAfterPage3, stop_event=stopEvent)
+            with self.assertRaises(RuntimeError):
+                export.run()
+            self.assertFalse(os.path.exists(path))
+            self.assertLessEqual(max(requestedPages), 3 + 4)
+
+        self.delayDisplay('Test passed')
+
+    def test_MorphoSourceImportQueryCache(self):
+        """ Cold and warm loads of a results page (search page and thumbnails) from a local mock server with latency
+        per request, through the on-disk cache: hits in a new session, conditional revalidation of old thumbnails,
+        content-addressed storage and expiry of search pages.
+        """
+        import http.server
+        import tempfile
+        import threading
+        import urllib.parse
+        from MorphoSourceImportLib.query_cache import QueryCache
+        self.delayDisplay("Starting the query cache test")
+
+        perPage = 20
+        latency = 0.02
+        state = {"pageRequests": 0, "thumbnailDownloads": 0, "notModified": 0, "versions": {}}
+        lock = threading.Lock()
+
+        def thumbnailContent(index):
+            # every other media shares the same image
+            return (f"image {index if index % 2 else 0} version {state['versions'].get(index, 0)}" * 200).encode()
+
+        class MockHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(latency)
+                url = urllib.parse.urlparse(self.path)
+                if url.path == "/api/media":
+                    with lock:
+                        state["pageRequests"] += 1
+                    page = int(urllib.parse.parse_qs(url.query)["page"][0])
+                    media = [{"id": [str(index)], "file_thumbnail_url": [f"/thumbnails/{index}.png"]}
+                             for index in range((page - 1) * perPage, page * perPage)]
+                    self.sendBody(json.dumps({"media": media, "pages": {"total_pages": 5, "total_count": 5 * perPage}}).encode())
+                    return
+                index = int(url.path.rsplit("/", 1)[1].split(".")[0])
+                content = thumbnailContent(index)
+                etag = f'"{hash(content)}"'
+                if self.headers.get("If-None-Match") == etag:
+                    with lock:
+                        state["notModified"] += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                with lock:
+                    state["thumbnailDownloads"] += 1
+                self.sendBody(content, {"ETag": etag, "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+
+            def sendBody(self, body, headers=None):
+                self.send_response(200)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server, baseUrl = self.startMockServer(MockHandler)
+
+        def loadResultsPage(cache, page):
+            parameters = {"query": "skull", "media_type": "Mesh", "per_page": perPage, "page": page}
+
+            def fetchPage():
+                response = cache.session.get(f"{baseUrl}/api/media", params={"page": page})
+                response.raise_for_status()
+                return response.json()
+
+            data = cache.page(parameters, fetchPage)
+            return data, cache.thumbnails([baseUrl + media["file_thumbnail_url"][0] for media in data["media"]])
+
+        with tempfile.TemporaryDirectory() as folderPath:
+            startTime = time.perf_counter()
+            data, thumbnails = loadResultsPage(QueryCache(folderPath), 1)
+            coldSeconds = time.perf_counter() - startTime
+            self.assertEqual(thumbnails[3], thumbnailContent(3))
+            self.assertEqual(state["pageRequests"], 1)
+            self.assertEqual(state["thumbnailDownloads"], perPage)
+            # identical images are stored once
+            self.assertEqual(len(os.listdir(os.path.join(folderPath, "thumbnails"))), perPage // 2 + 1)
+
+            # next session: no request at all
+            cache = QueryCache(folderPath)
+            startTime = time.perf_counter()
+            warmData, warmThumbnails = loadResultsPage(cache, 1)
+            warmSeconds = time.perf_counter() - startTime
+            logging.info(f"Results page of {perPage} media: {coldSeconds:.3f} s cold, {warmSeconds:.3f} s from the cache")
+            self.assertEqual(warmData, data)
+            self.assertEqual(warmThumbnails, thumbnails)
+            self.assertEqual(state["pageRequests"], 1)
+            self.assertEqual(state["thumbnailDownloads"], perPage)
+            self.assertEqual(cache.statistics_text(), f"Cache: 1 of 1 pages, {perPage} of {perPage} thumbnails (0 revalidated)")
+
+            # old thumbnails are revalidated, only the changed one is downloaded again
+            state["versions"][5] = 1
+            cache = QueryCache(folderPath, thumbnail_max_age=0)
+            warmData, warmThumbnails = loadResultsPage(cache, 1)
+            self.assertEqual(state["notModified"], perPage - 1)
+            self.assertEqual(state["thumbnailDownloads"], perPage + 1)
+            self.assertEqual(warmThumbnails[5], thumbnailContent(5))
+            self.assertEqual(cache.statistics["thumbnail_revalidated"], perPage - 1)
+            self.assertEqual(cache.statistics["thumbnail_misses"], 1)
+
+            # expired search pages are requested again, other pages are cached separately
+            cache = QueryCache(folderPath, page_max_age=0)
+            loadResultsPage(cache, 1)
+            self.assertEqual(state["pageRequests"], 2)
+            cache = QueryCache(folderPath)
+            loadResultsPage(cache, 2)
+            loadResultsPage(cache, 2)
+            self.assertEqual(state["pageRequests"], 3)
+            self.assertEqual((cache.statistics["page_hits"], cache.statistics["page_misses"]), (1, 1))
+
+            cache.clear()
+            self.assertEqual(os.listdir(os.path.join(folderPath, "thumbnails")), [])
+            self.assertIsNone(cache.get_page({"query": "skull", "media_type": "Mesh", "per_page": perPage, "page": 2}))
+
+        self.delayDisplay('Test passed')
+
+    def test_MorphoSourceImportWorker(self):
+        """ Requests to the long-lived worker process compared with a new process per request as the widget used
+        to run: the interpreter start-up and imports are paid once. Also checks that requests are answered in order
+        with their output and errors, and that the worker answers pings while it is busy.
+        """
+        import http.server
+        import queue
+        import subprocess
+        import threading
+        self.delayDisplay("Starting the worker test")
+
+        latency = 0.01
+
+        class MediaHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                mediaId = int(self.path.rsplit("/", 1)[1])
+                time.sleep(1.0 if mediaId == 0 else latency)
+                self.send_response(200)
+                self.send_header("Content-Length", str(mediaId * 1000))
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server, baseUrl = self.startMockServer(MediaHandler)
+        urls = {str(mediaId): f"{baseUrl}/media/{mediaId}" for mediaId in range(1, 11)}
+        scriptPath = getResourceScriptPath('morphosource_worker.py')
+        resourcesPath = os.path.dirname(scriptPath)
+
+        # previous approach: a new interpreter per request, importing the modules before sending requests
+        script = ("import json, sys, pandas, requests\n"
+                  f"sys.path.insert(0, {resourcesPath!r})\n"
+                  "from media_sizes import SizeDiscovery\n"
+                  "urls = json.loads(sys.argv[1])\n"
+                  "print(json.dumps(SizeDiscovery(urls.get).sizes(list(urls))[0]))\n")
+        processSeconds = []
+        for repeat in range(3):
+            startTime = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", script, json.dumps(urls)], capture_output=True, text=True, check=True).stdout
+            processSeconds.append(time.perf_counter() - startTime)
+            self.assertEqual(json.loads(output)["3"], 3000)
+
+        startTime = time.perf_counter()
+        process = subprocess.Popen([sys.executable, scriptPath], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        self.addCleanup(process.wait, 10)
+        self.addCleanup(process.stdin.close)
+        messages = queue.Queue()
+        threading.Thread(target=lambda: [messages.put(json.loads(line)) for line in process.stdout], daemon=True).start()
+
+        def send(message):
+            process.stdin.write(json.dumps(message) + "\n")
+            process.stdin.flush()
+
+        def nextMessage():
+            return messages.get(timeout=30)
+
+        ready = nextMessage()
+        startupSeconds = time.perf_counter() - startTime
+        self.assertEqual(ready["type"], "ready")
+        # the modules that need morphosource are only missing outside of Slicer
+        self.assertLessEqual(set(ready["errors"]), {"download_items", "download_csv"})
+
+        workerSeconds = []
+        for requestId in range(1, 4):
+            startTime = time.perf_counter()
+            send({"id": requestId, "command": "sizes", "arguments": {"urls": urls}})
+            message = nextMessage()
+            workerSeconds.append(time.perf_counter() - startTime)
+            self.assertEqual((message["id"], message["type"], message["error"]), (requestId, "finished", None))
+            self.assertEqual(message["result"]["sizes"]["3"], 3000)
+        logging.info(f"Size requests: {min(processSeconds):.3f} s with a new process each, {min(workerSeconds):.3f} s with the worker"
+                     f" (started once in {startupSeconds:.3f} s)")
+        # all served by the process started once, which imported the modules once
+        send({"id": 4, "command": "ping"})
+        self.assertEqual(nextMessage()["result"], process.pid)
+        self.assertTrue(messages.empty())
+
+        # requests are served in order; pings are answered while a request is running
+        send({"id": 10, "command": "sizes", "arguments": {"urls": {"0": f"{baseUrl}/media/0"}}})
+        send({"id": 11, "command": "unknown"})
+        send({"id": 12, "command": "ping"})
+        replies = [nextMessage() for index in range(3)]
+        self.assertEqual([reply["id"] for reply in replies], [12, 10, 11])
+        self.assertEqual(replies[0]["result"], process.pid)
+        self.assertIsNone(replies[1]["error"])
+        self.assertEqual(replies[2]["error"], "Unknown command unknown")
+
+        # a request cancelled before it starts is not run
+        send({"id": 20, "command": "sizes", "arguments": {"urls": {"0": f"{baseUrl}/media/0"}}})
+        send({"id": 21, "command": "sizes", "arguments": {"urls": urls}})
+        send({"id": 21, "command": "cancel"})
+        replies = [nextMessage() for index in range(2)]
+        self.assertEqual([reply["id"] for reply in replies], [20, 21])
+        self.assertEqual(replies[1]["error"], "Request cancelled")
+
+        self.delayDisplay('Test passed')
+
+    def test_MorphoSourceImportWorkerClient(self):
+        """ Requests through the client of the worker process as the widget sends them: results on the main thread,
+        cancelled requests, search exports that do not wait for a download, and the pending requests of a worker
+        that stopped.
+        """
+        import http.server
+        import threading
+        self.delayDisplay("Starting the worker client test")
+
+        # the size of media 0 is only sent once the test releases it
+        release = threading.Event()
+
+        class MediaHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                mediaId = int(self.path.rsplit("/", 1)[1])
+                if mediaId == 0:
+                    release.wait(30)
+                self.send_response(200)
+                self.send_header("Content-Length", str(mediaId * 1000))
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server, baseUrl = self.startMockServer(MediaHandler)
+        blockedUrls = {"0": f"{baseUrl}/media/0"}
+        urls = {str(mediaId): f"{baseUrl}/media/{mediaId}" for mediaId in range(1, 6)}
+        logic = MorphoSourceImportLogic()
+        self.addCleanup(logic.stopWorkers)
+        self.addCleanup(release.set)
+        results = {}
+
+        def submit(worker, arguments):
+            requestId = worker.submit("sizes", arguments, None,
+                                      lambda result, error: results.__setitem__(requestId, (result, error)))
+            return requestId
+
+        def waitFor(requestId):
+            for repeat in range(3000):
+                if requestId in results:
+                    return results[requestId]
+                slicer.app.processEvents()
+                time.sleep(0.01)
+            self.fail(f"Request {requestId} did not finish")
+
+        # one worker per kind of request, kept for the session
+        downloadWorker = logic.getWorker('download')
+        searchWorker = logic.getWorker('search')
+        self.assertIsNot(downloadWorker, searchWorker)
+        self.assertIs(logic.getWorker('download'), downloadWorker)
+
+        # a request of the search worker is answered while the download worker is busy
+        blockedId = submit(downloadWorker, {"urls": blockedUrls})
+        queuedId = submit(downloadWorker, {"urls": urls})
+        downloadWorker.cancel(queuedId)
+        result, error = waitFor(submit(searchWorker, {"urls": urls}))
+        self.assertIsNone(error)
+        self.assertEqual(result["sizes"]["3"], 3000)
+        self.assertNotIn(blockedId, results)
+
+        # then the blocked request finishes and the cancelled one is not run
+        release.set()
+        self.assertEqual(waitFor(blockedId), ({"sizes": {"0": 0}, "errors": {}}, None))
+        self.assertEqual(waitFor(queuedId), (None, "Request cancelled"))
+
+        # the requests of a worker that stops finish with an error, the next request starts a new worker
+        release.clear()
+        blockedId = submit(downloadWorker, {"urls": blockedUrls})
+        downloadWorker.process.kill()
+        result, error = waitFor(blockedId)
+        self.assertIsNone(result)
+        self.assertIn("MorphoSource worker stopped", error)
+        release.set()
+        self.assertIsNone(waitFor(submit(logic.getWorker('download'), {"urls": urls}))[1])
+
+        self.delayDisplay('Test passed')
@@ -0,0 +1,184 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import requests
+
+
+def _write_json(path, data):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as json_file:
+        json.dump(data, json_file)
+    os.replace(temporary_path, path)
+
+
+class QueryCache:
+    """
+    On-disk cache of MorphoSource search pages and thumbnails, kept between Slicer sessions in folder_path.
+
+    Search pages are stored by a hash of their query parameters and reused for page_max_age seconds.
+    Thumbnails are stored once per content (the file name is the SHA-256 of the image), with an index by URL
+    holding their ETag and Last-Modified headers: for thumbnail_max_age seconds they are used without any
+    request, then revalidated with a conditional request that only downloads the image again if it changed.
+    Hits, revalidations and misses are counted in statistics.
+    """
+
+    def __init__(self, folder_path, page_max_age=24 * 60 * 60, thumbnail_max_age=7 * 24 * 60 * 60, session=None,
+                 max_workers=6, timeout=30):
+        self.folder_path = folder_path
+        self.pages_path = os.path.join(folder_path, "pages")
+        self.thumbnails_path = os.path.join(folder_path, "thumbnails")
+        self.thumbnail_index_path = os.path.join(folder_path, "thumbnails.json")
+        self.page_max_age = page_max_age
+        self.thumbnail_max_age = thumbnail_max_age
+        self.session = session if session is not None else requests.Session()
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        os.makedirs(self.pages_path, exist_ok=True)
+        os.makedirs(self.thumbnails_path, exist_ok=True)
+        self.thumbnail_index = {}
+        if os.path.exists(self.thumbnail_index_path):
+            try:
+                with open(self.thumbnail_index_path) as index_file:
+                    self.thumbnail_index = json.load(index_file)
+            except (OSError, ValueError):
+                self.thumbnail_index = {}
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        with self.lock:
+            self.statistics = {"page_hits": 0, "page_misses": 0,
+                               "thumbnail_hits": 0, "thumbnail_revalidated": 0, "thumbnail_misses": 0}
+
+    def statistics_text(self):
+        """Hit rates of the searches since the statistics were reset, for display"""
+        with self.lock:
+            statistics = dict(self.statistics)
+        pages = statistics["page_hits"] + statistics["page_misses"]
+        thumbnails = statistics["thumbnail_hits"] + statistics["thumbnail_revalidated"] + statistics["thumbnail_misses"]
+        if pages + thumbnails == 0:
+            return "Cache: no requests"
+        return (f"Cache: {statistics['page_hits']} of {pages} pages, "
+                f"{statistics['thumbnail_hits'] + statistics['thumbnail_revalidated']} of {thumbnails} thumbnails "
+                f"({statistics['thumbnail_revalidated']} revalidated)")
+
+    def count(self, name):
+        with self.lock:
+            self.statistics[name] += 1
+
+    def clear(self):
+        """Remove all the cached pages and thumbnails"""
+        with self.lock:
+            shutil.rmtree(self.folder_path, ignore_errors=True)
+            os.makedirs(self.pages_path, exist_ok=True)
+            os.makedirs(self.thumbnails_path, exist_ok=True)
+            self.thumbnail_index = {}
+
+    #
+    # Search pages
+    #
+
+    def page_path(self, query_parameters):
+        key = hashlib.sha256(json.dumps(query_parameters, sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self.pages_path, key + ".json")
+
+    def get_page(self, query_parameters):
+        """Cached data of a search page, None if it is not cached or too old"""
+        path = self.page_path(query_parameters)
+        try:
+            with open(path) as page_file:
+                entry = json.load(page_file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["time"] > self.page_max_age:
+            return None
+        return entry["data"]
+
+    def set_page(self, query_parameters, data):
+        """Store the data of a search page, which must be JSON serializable"""
+        _write_json(self.page_path(query_parameters), {"time": time.time(), "data": data})
+
+    def page(self, query_parameters, fetch_page):
+        """Data of a search page, from the cache or from fetch_page() which is then cached"""
+        data = self.get_page(query_parameters)
+        if data is not None:
+            self.count("page_hits")
+            return data
+        self.count("page_misses")
+        data = fetch_page()
+        self.set_page(query_parameters, data)
+        return data
+
+    #
+    # Thumbnails
+    #
+
+    def thumbnail(self, url):
+        """Image of a thumbnail, None if it could not be downloaded"""
+        if not url:
+            return None
+        with self.lock:
+            entry = self.thumbnail_index.get(url)
+        content = None
+        if entry is not None:
+            content = self._read_thumbnail(entry["sha256"])
+            if content is not None and time.time() - entry["time"] <= self.thumbnail_max_age:
+                self.count("thumbnail_hits")
+                return content
+        headers = {}
+        if content is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and content is not None:
+                self.count("thumbnail_revalidated")
+                self._index_thumbnail(url, entry["sha256"], response.headers.get("ETag", entry.get("etag")),
+                                      response.headers.get("Last-Modified", entry.get("last_modified")))
+                return content
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching the thumbnail from {url}: {e}")
+            return content
+        self.count("thumbnail_misses")
+        content = response.content
+        sha256 = hashlib.sha256(content).hexdigest()
+        path = os.path.join(self.thumbnails_path, sha256)
+        if not os.path.exists(path):
+            temporary_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as thumbnail_file:
+                thumbnail_file.write(content)
+            os.replace(temporary_path, path)
+        self._index_thumbnail(url, sha256, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return content
+
+    def thumbnails(self, urls):
+        """Images of the thumbnails of urls, in the same order, fetched concurrently when not cached"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            thumbnails = list(executor.map(self.thumbnail, urls))
+        self.save_thumbnail_index()
+        return thumbnails
+
+    def save_thumbnail_index(self):
+        with self.lock:
+            index = dict(self.thumbnail_index)
+        _write_json(self.thumbnail_index_path, index)
+
+    def _read_thumbnail(self, sha256):
+        try:
+            with open(os.path.join(self.thumbnails_path, sha256), "rb") as thumbnail_file:
+                return thumbnail_file.read()
+        except OSError:
+            return None
+
+    def _index_thumbnail(self, url, sha256, etag, last_modified):
+        with self.lock:
+            self.thumbnail_index[url] = {"sha256": sha256, "etag": etag, "last_modified": last_modified,
+                                         "time": time.time()}
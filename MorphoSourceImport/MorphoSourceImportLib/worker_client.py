@@ -0,0 +1,104 @@
+import json
+import sys
+
+import qt
+
+
+class MorphoSourceWorker:
+    """
+    Client of the worker process of Resources/morphosource_worker.py, started on the first request and kept for
+    the rest of the session. Requests are sent as JSON lines; the lines the worker prints while serving a request
+    are passed to its output_callback(line) and its result to finished_callback(result, error) on the main thread.
+    If the worker process stops, its pending requests finish with an error and the next request starts a new one.
+    """
+
+    def __init__(self, script_path, executable=None):
+        self.script_path = script_path
+        self.executable = executable or sys.executable
+        self.process = None
+        self.buffer = ""
+        self.next_id = 1
+        self.requests = {}  # callbacks by request ID
+        self.ready = False
+        self.startup_seconds = None
+        self.import_errors = {}
+
+    def is_running(self):
+        return self.process is not None and self.process.state() != qt.QProcess.NotRunning
+
+    def start(self):
+        if self.is_running():
+            return
+        self.buffer = ""
+        self.ready = False
+        self.process = qt.QProcess()
+        self.process.readyReadStandardOutput.connect(self.on_ready_read)
+        self.process.readyReadStandardError.connect(self.on_ready_read_error)
+        self.process.finished.connect(self.on_finished)
+        self.process.start(self.executable, [self.script_path])
+
+    def stop(self):
+        """Close the worker: it stops its current request and exits"""
+        if not self.is_running():
+            return
+        self.process.closeWriteChannel()
+        if not self.process.waitForFinished(5000):
+            self.process.kill()
+
+    def submit(self, command, arguments=None, output_callback=None, finished_callback=None):
+        """Queue a request, returns its ID"""
+        self.start()
+        request_id = self.next_id
+        self.next_id += 1
+        self.requests[request_id] = (output_callback, finished_callback)
+        self.write({"id": request_id, "command": command, "arguments": arguments})
+        return request_id
+
+    def cancel(self, request_id):
+        if self.is_running():
+            self.write({"id": request_id, "command": "cancel"})
+
+    def write(self, message):
+        self.process.write((json.dumps(message) + "\n").encode())
+
+    def on_ready_read(self):
+        # output may end in the middle of a line, which is kept until the rest is read
+        output = self.buffer + self.process.readAllStandardOutput().data().decode("utf-8", errors="ignore")
+        lines = output.split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                print(line)
+                continue
+            self.dispatch(message)
+
+    def dispatch(self, message):
+        if message["type"] == "ready":
+            self.ready = True
+            self.startup_seconds = message["seconds"]
+            self.import_errors = message["errors"]
+            return
+        output_callback, finished_callback = self.requests.get(message["id"], (None, None))
+        if message["type"] == "output":
+            if output_callback:
+                output_callback(message["line"])
+            elif message["line"].strip():
+                print(message["line"])
+        elif message["type"] == "finished":
+            self.requests.pop(message["id"], None)
+            if finished_callback:
+                finished_callback(message["result"], message["error"])
+
+    def on_ready_read_error(self):
+        error = self.process.readAllStandardError().data().decode("utf-8", errors="ignore").strip()
+        if error:
+            print("MorphoSource worker:", error)
+
+    def on_finished(self, exitCode=None, exitStatus=None):
+        requests = self.requests
+        self.requests = {}
+        for output_callback, finished_callback in requests.values():
+            if finished_callback:
+                finished_callback(None, f"MorphoSource worker stopped with exit code {exitCode}")
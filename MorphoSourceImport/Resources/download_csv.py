@@ -3,46 +3,31 @@ import datetime
 import json
 import sys
 import os
+import threading
 import requests
 
-from collections import OrderedDict
-
-from threading import Lock
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
-
-import pandas as pd
-
 import slicer
 import morphosource as ms
 from morphosource import search_media, DownloadVisibility
 from morphosource.search import SearchResults
 
-
-def unlist_cell(cell):
-    """If the cell is a list, return the items separated by semicolons.
-    If the cell is empty or None, return an empty string. Otherwise, return the cell unchanged."""
-    if isinstance(cell, list):
-        return " ; ".join(map(str, cell))
-    elif cell is None or cell == []:
-        return ""
-    return cell
+from search_export import SearchResultExport
 
 
 class DownloadMSRecords:
     def __init__(self, query: str, media_type: str, taxonomy_gbif: str, path: str,
-                 openDownloadsOnly: bool, media_tag: str = None, per_page: int = 100):
+                 openDownloadsOnly: bool, media_tag: str = None, per_page: int = 100,
+                 stop_event: threading.Event = None):
 
         self.completed_pages = 0  # Initialize the counter
-
-        self.lock = Lock()  # Initialize a lock for thread-safe operations
+        self.max_workers = 6  # pages fetched at the same time
+        self.requests_per_second = 10  # limit of the requests sent to the MorphoSource API
+        self.stop_event = stop_event  # set to stop the export
 
         self.ms = ms
         self.search_media = search_media
         self.SearchResults = SearchResults
 
-        self.pd = pd
-
         self.path = path
 
         self.query = query
@@ -57,22 +42,12 @@ class DownloadMSRecords:
         else:
             self.visibility = DownloadVisibility.RESTRICTED
 
-        self.pages = OrderedDict()
         self.total_count = None
         self.total_pages = None
         self.first_record = None
 
         self.runFirstQuery()
 
-    def get_urls_for_page(self, search_results):
-        thumbnail_urls = []
-        web_urls = []
-        for media in search_results.items:
-            thumbnail_urls.append(media.get_thumbnail_url())
-            web_urls.append(media.get_website_url())
-
-        return thumbnail_urls, web_urls
-
     def runFirstQuery(self):
         print(f'Running First Query', flush=True)
         self.first_record = self.search_media(query=self.query,
@@ -87,96 +62,27 @@ class DownloadMSRecords:
 
         print(f'First Query Done.', flush=True)
 
-    def get_dataframe_with_updated_index(self, page_number, search_result):
-        """
-        Updates the index of the current DataFrame based on the page number
-        and the number of records per page.
-        """
-        # Calculate the start index for the current page
-        start_index = (page_number - 1) * self.per_page
-
-        # Extracting the 'data' dictionaries from each item in search_results
-        search_results_data = [item.data for item in search_result.items]
-
-        # Converting the list of dictionaries to a pandas DataFrame
-        search_results_df = pd.DataFrame(search_results_data)
-
-        # Update the DataFrame index to reflect the current page
-        search_results_df.index = range(start_index, start_index + len(search_results_df))
-
-        # Apply the unlist_cell function to each cell in the DataFrame
-        search_results_df = search_results_df.applymap(unlist_cell)
-
-        return search_results_df
-
-    def download_and_save_page(self, page):
-        print(f'Downloading Page {page}', flush=True)
-        retry_count = 0
-        max_retries = 5  # Set the maximum number of retries
-
-        while retry_count < max_retries:
-            try:
-                search_result = self.search_media(query=self.query,
-                                                  taxonomy_gbif=self.taxonomy_gbif,
-                                                  media_type=self.media_type,
-                                                  visibility=self.visibility,
-                                                  media_tag=self.media_tag,
-                                                  per_page=self.per_page,
-                                                  page=page)
-
-                # Get the thumbnail and web URLs for the current page
-                thumbnail_urls, web_urls = self.get_urls_for_page(search_result)
-
-                with self.lock:
-                    # Store the search results in the ordered dictionary
-                    self.pages[page] = {'search_results': search_result,
-                                        'thumbnail_urls': thumbnail_urls,
-                                        'web_urls': web_urls,
-                                        'search_results_df': self.get_dataframe_with_updated_index(page, search_result)}
-
-                    # Increment the completed pages counter
-                    self.completed_pages += 1
-
-                # Calculate and print the progress
-                progress = (self.completed_pages / self.total_pages) * 100
-                print(f"PROGRESS:{progress}", flush=True)
-                break  # Exit the retry loop on successful download
-            except requests.exceptions.RequestException as e:
-                print(f"Error in Page Download: {e}", flush=True)
-                retry_count += 1  # Increment the retry counter
-
-        if retry_count == max_retries:
-            print(f"Failed to download Page {page} after {max_retries} attempts.", flush=True)
-
-    def download_all_pages(self):
-        print(f"Starting ThreadPoolExecutor", flush=True)
-        with ThreadPoolExecutor(max_workers=6) as executor:
-            # Create a list of futures
-            futures = [executor.submit(self.download_and_save_page, page) for page in range(1, self.total_pages + 1)]
-
-            # Optionally, you can process results as they are completed
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error in Page Download: {e}", flush=True)
+    def fetch_page_records(self, page):
+        """Record dictionaries of a page of the query results"""
+        search_result = self.search_media(query=self.query,
+                                          taxonomy_gbif=self.taxonomy_gbif,
+                                          media_type=self.media_type,
+                                          visibility=self.visibility,
+                                          media_tag=self.media_tag,
+                                          per_page=self.per_page,
+                                          page=page)
+        return [item.data for item in search_result.items]
+
+    def print_progress(self, completed_pages, total_pages):
+        self.completed_pages = completed_pages
+        progress = (completed_pages / total_pages) * 100
+        print(f"PROGRESS:{progress}", flush=True)
 
     def format_for_filename(self, text):
         """Format the text to be suitable for use in a filename."""
         return text.replace(" ", "_").replace("/", "_").replace("\\", "_")
 
-    def combine_and_save_dataframes(self):
-        # Initialize an empty list to store individual DataFrames
-        all_dfs = []
-
-        # Sort the keys of the pages dictionary and iterate in sorted order
-        for page_number in sorted(self.pages.keys(), key=int):
-            # Append the DataFrame for each page to the list
-            all_dfs.append(self.pages[page_number]['search_results_df'])
-
-        # Concatenate all DataFrames into a single DataFrame
-        combined_df = pd.concat(all_dfs, ignore_index=False)
-
+    def output_path(self):
         # Format search query and taxonomy for filename
         formatted_query = self.format_for_filename(self.query)
 
@@ -191,14 +97,36 @@ class DownloadMSRecords:
             formatted_taxonomy = self.format_for_filename(self.taxonomy_gbif)
             filename = f"{formatted_query}_{formatted_taxonomy}_{timestamp}.csv"
 
-        # Define the file path for saving the DataFrame
-        save_path = os.path.join(self.path, filename)
-
-        # Save the DataFrame to a CSV file
-        combined_df.to_csv(save_path, index=True)
-
-        print(f"Combined DataFrame saved to {save_path}")
+        return os.path.join(self.path, filename)
 
+    def export_csv(self):
+        """
+        Write all the pages of the query results to a CSV file in the download folder, fetching them
+        concurrently and appending them in page order (see search_export.SearchResultExport).
+        Returns the path of the file, which name ends with search_export.INCOMPLETE_SUFFIX if pages are missing.
+        """
+        save_path = self.output_path()
+        export = SearchResultExport(self.fetch_page_records, self.total_pages, save_path, per_page=self.per_page,
+                                    first_page_records=[item.data for item in self.first_record.items],
+                                    max_workers=self.max_workers, requests_per_second=self.requests_per_second,
+                                    progress_callback=self.print_progress, stop_event=self.stop_event)
+        export.run()
+        if export.failed_pages:
+            print(f"Pages missing from the results: {export.failed_pages}, written to {export.path}", flush=True)
+        return export.path
+
+
+def export_query_results(query_dict, stop_event=None):
+    """
+    Export all the results of a query of the widget to a CSV file, returns the path of the file.
+    Setting stop_event stops the export (see search_export.SearchResultExport).
+    """
+    searchObj = DownloadMSRecords(query=query_dict['query'], media_type=query_dict['mediaType'],
+                                  taxonomy_gbif=query_dict['taxon'],
+                                  openDownloadsOnly=query_dict['visibility'],
+                                  media_tag=query_dict['mediaTag'],
+                                  path=query_dict['download_folder'], stop_event=stop_event)
+    return searchObj.export_csv()
 
 if __name__ == "__main__":
 
@@ -209,12 +137,6 @@ if __name__ == "__main__":
     query_dict = json.loads(query_dict)
 
     try:
-        searchObj = DownloadMSRecords(query=query_dict['query'], media_type=query_dict['mediaType'],
-                                      taxonomy_gbif=query_dict['taxon'],
-                                      openDownloadsOnly=query_dict['visibility'],
-                                      media_tag=query_dict['mediaTag'],
-                                      path=query_dict['download_folder'])
-        searchObj.download_all_pages()
-        searchObj.combine_and_save_dataframes()
+        export_query_results(query_dict)
     except Exception as e:
         print(f"Error initializing searchObj: {e}")
\ No newline at end of file
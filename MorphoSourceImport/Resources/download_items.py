@@ -12,6 +12,13 @@ from typing import Optional
 from morphosource import DownloadConfig
 from morphosource.download import download_media_bundle, get_download_media_zip_url
 
+from download_progress import ProgressAggregator
+from media_sizes import MediaSizeCache, SizeDiscovery, create_session
+from segmented_download import RateLimiter, RemoteFileChangedError, SegmentedDownload
+
+# File in the download folder where the sizes of the media files are kept between downloads
+SIZE_CACHE_FILENAME = ".morphosource_sizes.json"
+
 
 def file_exists_and_size(path):
     """Check if a file exists and return its size."""
@@ -20,35 +27,35 @@ def file_exists_and_size(path):
     return 0
 
 
-def download_file(url, path, api_key, chunk_size, progress_update_func, total_bytes, media_id, existing_file_size=0):
-    headers = {"Authorization": api_key}
-    if existing_file_size > 0:
-        headers['Range'] = f'bytes={existing_file_size}-'
-
-    download_response = requests.get(url, headers=headers, stream=True)
-
-    # Check HTTP response status code
-    if download_response.status_code in [200, 206]:
-        downloaded_bytes = existing_file_size
-        with open(path, 'ab' if existing_file_size > 0 else 'wb') as fd:
-            for chunk in download_response.iter_content(chunk_size=chunk_size):
-                fd.write(chunk)
-                downloaded_bytes += len(chunk)
-                progress_update_func(media_id, downloaded_bytes, total_bytes)
-
-        # After the download loop, do a final check and update progress to 100%
-        # if the downloaded size matches or exceeds the expected total size.
-        final_file_size = file_exists_and_size(path)
-        if final_file_size >= total_bytes:
-            progress_update_func(media_id, final_file_size, total_bytes)
-    else:
-        # Handle error or unexpected status code
-        print(f"Error during download: Unexpected status code {download_response.status_code} for media ID {media_id}")
+def download_file(url, path, session, api_key, total_bytes, progress_update_func, media_id, segment_workers=4,
+                  rate_limiter=None, stop_event=None, validator=None, refresh_size_func=None):
+    """
+    Download a media file in byte-range segments fetched concurrently, resuming a previous partial download
+    (see segmented_download.SegmentedDownload). If the file changed on the server since its size was found,
+    refresh_size_func(media_id) returns its new size and validator and the download starts over.
+    Raises an exception if the download does not complete.
+    """
+    def run(total_bytes, validator):
+        download = SegmentedDownload(url, path, total_bytes, session=session, headers={"Authorization": api_key},
+                                     max_connections=segment_workers, rate_limiter=rate_limiter, stop_event=stop_event,
+                                     validator=validator,
+                                     progress_callback=lambda downloaded_bytes, total: progress_update_func(
+                                         media_id, downloaded_bytes, total_bytes))
+        download.run()
+
+    try:
+        run(total_bytes, validator)
+    except RemoteFileChangedError as e:
+        if refresh_size_func is None:
+            raise
+        print(f"[Debug] Media ID: {media_id}, {e}, downloading it again", flush=True)
+        run(*refresh_size_func(media_id))
 
 
 class MSDownload:
-    def __init__(self, config_dict: dict):
+    def __init__(self, config_dict: dict, stop_event: Optional[threading.Event] = None):
         self.sizes = None
+        self.size_discovery = None  # SizeDiscovery of the sizes and validators of the files
         self.total_size = None
         self.config_dict = config_dict
         self.DownloadConfig = DownloadConfig  # to be set when items are to be downloaded
@@ -60,25 +67,39 @@ class MSDownload:
         self.items_to_download = None
         self.total_items = None
         self.completed_downloads = None
-        self.download_progress = {}  # Dictionary to track progress of each download
+        self.progress = None  # ProgressAggregator of the current download
+        self.progress_interval = 0.5  # seconds between progress messages
         self.completed_chunks = None
         self.total_mb = None
         self.chunk_size = (1 * 1024) * 1024
+        self.size_workers = 8  # concurrent HEAD requests for the file sizes
+        self.download_workers = 2  # files downloaded at the same time
+        self.segment_workers = int(config_dict.get('segment_workers', 4))  # connections per file
+        # download rate limit shared by all files and connections, in MB/s (0 for no limit)
+        self.rate_limiter = RateLimiter(float(config_dict.get('max_download_rate', 0)) * 1024 * 1024)
+        self.session = create_session(max(self.size_workers, self.download_workers * self.segment_workers))
+        self.stop_event = stop_event or threading.Event()  # set to stop the downloads, which can be resumed later
 
         self.configure_download()
 
     def calculate_total_size(self):
-
-        sizes = {}
-        total_size = 0
-        for media_id in self.items_to_download:
-            url = self.get_download_media_zip_url(media_id=media_id,
-                                                  download_config=self.current_download_config)
-            response = requests.head(url, headers={"Authorization": self.current_download_config.api_key})
-            size = int(response.headers.get('content-length', 0))
-            total_size += size
-            sizes[media_id] = size
-        return total_size, sizes
+        """
+        Sizes of the files to download, from HEAD requests sent concurrently over the keep-alive session
+        (see media_sizes.SizeDiscovery) and cached per media ID in the download folder.
+        """
+        def url_for_media(media_id):
+            return self.get_download_media_zip_url(media_id=media_id, download_config=self.current_download_config)
+
+        def print_progress(number_of_sizes, number_of_media):
+            print(f"Size Progress: {number_of_sizes} of {number_of_media}", flush=True)
+
+        cache = MediaSizeCache(os.path.join(self.download_folder, SIZE_CACHE_FILENAME))
+        self.size_discovery = SizeDiscovery(url_for_media, headers={"Authorization": self.current_download_config.api_key},
+                                            max_workers=self.size_workers, cache=cache, session=self.session)
+        sizes, errors = self.size_discovery.sizes(self.items_to_download, print_progress)
+        for media_id, error in errors.items():
+            print(f"[Debug] Media ID: {media_id}, size request failed: {error}", flush=True)
+        return sum(sizes.values()), sizes
 
     def configure_download(self):
         self.current_download_config = self.DownloadConfig(api_key=self.config_dict['api_key'],
@@ -91,67 +112,71 @@ class MSDownload:
         self.total_size, self.sizes = self.calculate_total_size()
         self.total_mb = self.total_size / (1024 * 1024)  # Convert total size to megabytes
 
+    def refresh_size(self, media_id):
+        """New size and validator of a media whose file changed on the server, also counted in the progress"""
+        size, validator = self.size_discovery.refresh(media_id)
+        self.progress.total_bytes += size - self.sizes[media_id]
+        self.progress.counter(media_id).total_bytes = size
+        self.sizes[media_id] = size
+        return size, validator
+
     def update_progress(self, media_id, downloaded_bytes, total_bytes):
-        with threading.Lock():
-            self.download_progress[media_id] = downloaded_bytes
-
-        total_downloaded_bytes = sum(self.download_progress.values())
-        total_progress = total_downloaded_bytes / self.total_size  # self.total_size should be the sum of all file sizes
-        total_downloaded_mb = total_downloaded_bytes / (1024 * 1024)
-
-        # Diagnostic print statements
-        # print(f"[Debug] Media ID: {media_id}, Downloaded Bytes: {downloaded_bytes}, Total Bytes: {total_bytes}")
-        # print(f"[Debug] Total Downloaded Bytes: {total_downloaded_bytes}, Total Size: {self.total_size}")
-        # print(f"[Debug] Total Progress: {total_progress * 100:.2f}%")
-        # print(f"[Debug] Total Downloaded MB: {total_downloaded_mb:.2f} MB "
-        #       f"of {self.total_mb:.2f} MB downloaded", flush=True)
-        print(f"Download Progress: {total_progress * 100:.3f}%, {total_downloaded_mb:.3f} MB "
-              f"of {self.total_mb:.2f} MB downloaded", flush=True)
+        """
+        Called by the download threads of a media file, one at a time: only updates the counter of that file,
+        the overall progress is published every progress_interval seconds by self.progress
+        """
+        self.progress.counter(media_id, total_bytes).set(downloaded_bytes)
+
+    def on_download_done(self, media_id, future):
+        if not future.cancelled() and future.exception() is None:
+            self.progress.counter(media_id).finish()
 
     def downloadItems(self):
         self.completed_downloads = 0
         download_completed_successfully = False
 
-        self.download_progress = {media_id: 0 for media_id in self.items_to_download}  # Initialize progress
+        self.progress = ProgressAggregator(self.total_size, len(self.items_to_download), self.progress_interval)
+        for media_id in self.items_to_download:
+            self.progress.counter(media_id, self.sizes[media_id])
 
         start_time = time.time()
 
+        futures = {}
         try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-                futures = []
+            with self.progress, concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers) as executor:
                 for media_id in self.items_to_download:
                     partial_filename = f"partial_media_{media_id}.zip"
                     full_file_path = os.path.join(self.download_folder, partial_filename)
-                    existing_file_size = file_exists_and_size(full_file_path)
                     download_url = self.get_download_media_zip_url(media_id=media_id,
                                                                    download_config=self.current_download_config)
-                    futures.append(executor.submit(download_file, download_url, full_file_path,
-                                                   self.current_download_config.api_key, self.chunk_size,
-                                                   self.update_progress, self.total_size, media_id, existing_file_size))
-                    self.completed_downloads += 1
-                concurrent.futures.wait(futures)
+                    futures[media_id] = executor.submit(download_file, download_url, full_file_path, self.session,
+                                                        self.current_download_config.api_key, self.sizes[media_id],
+                                                        self.update_progress, media_id, self.segment_workers,
+                                                        self.rate_limiter, self.stop_event,
+                                                        self.size_discovery.validators.get(media_id),
+                                                        self.refresh_size)
+                    futures[media_id].add_done_callback(lambda future, media_id=media_id: self.on_download_done(media_id, future))
+                concurrent.futures.wait(futures.values())
 
             download_completed_successfully = True
         except Exception as e:
             print(f"Error during download: {e}", flush=True)
 
-        for media_id in self.items_to_download:
+        for media_id, future in futures.items():
             partial_filename = f"partial_media_{media_id}.zip"
             full_partial_path = os.path.join(self.download_folder, partial_filename)
 
-            if abs(file_exists_and_size(full_partial_path) - self.sizes[media_id]) <= 2:
-                # if ((file_exists_and_size(full_partial_path) == self.sizes[media_id]) or
-                #         (file_exists_and_size(full_partial_path) + 1 == self.sizes[media_id]) or
-                #         (file_exists_and_size(full_partial_path) - 1 == self.sizes[media_id])):
+            if future.done() and future.exception() is None:
                 print(f"[Debug] Media ID: {media_id}, Downloaded Bytes: {file_exists_and_size(full_partial_path)}, "
                       f"Total Bytes: {self.sizes[media_id]}")
                 final_filename = f"media_{media_id}.zip"
                 full_final_path = os.path.join(self.download_folder, final_filename)
-                os.rename(full_partial_path, full_final_path)
+                os.replace(full_partial_path, full_final_path)
+                self.completed_downloads += 1
             else:
-                print(f"[Debug] Media ID: {media_id}, size mismatch")
-                print(f"[Debug] Media ID: {media_id}, Downloaded Bytes: {file_exists_and_size(full_partial_path)}, "
-                      f"Total Bytes: {self.sizes[media_id]}")
+                error = future.exception() if future.done() else "not finished"
+                print(f"[Debug] Media ID: {media_id}, download failed: {error}")
+                download_completed_successfully = False
 
         end_time = time.time()
         duration = end_time - start_time
@@ -159,6 +184,7 @@ class MSDownload:
         print(
             f"{status_message} downloading {self.completed_downloads} of {len(self.items_to_download)} items in {duration:.2f} seconds.",
             flush=True)
+        return self.completed_downloads
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import collections
+import json
+import threading
+import time
+
+# Prefix of the progress lines printed by the download script, followed by a JSON snapshot
+PROGRESS_PREFIX = "DOWNLOAD_PROGRESS "
+
+
+def format_progress_line(snapshot):
+    return PROGRESS_PREFIX + json.dumps(snapshot)
+
+
+def parse_progress_line(line):
+    """Snapshot of a progress line, None if the line is not one"""
+    if not line.startswith(PROGRESS_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(PROGRESS_PREFIX):])
+    except ValueError:
+        return None
+
+
+def print_progress(snapshot):
+    print(format_progress_line(snapshot), flush=True)
+
+
+class ProgressCounter:
+    """Bytes downloaded by one worker (a file download), updated from any of its threads"""
+
+    def __init__(self, total_bytes=0):
+        self.total_bytes = total_bytes
+        self.downloaded_bytes = 0
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def set(self, downloaded_bytes):
+        with self.lock:
+            self.downloaded_bytes = downloaded_bytes
+
+    def add(self, byte_count):
+        with self.lock:
+            self.downloaded_bytes += byte_count
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+
+
+class ProgressAggregator:
+    """
+    Overall progress of concurrent downloads. Each worker updates its own ProgressCounter, which only costs an
+    uncontended lock; a background thread sums the counters every interval seconds and passes a snapshot to
+    publish_func (by default a DOWNLOAD_PROGRESS line on stdout), so the number of progress messages does
+    not depend on the number of workers or on the read size. The rate is averaged over the last rate_window
+    seconds and the ETA derived from it.
+
+    Snapshots are dictionaries with downloaded_bytes, total_bytes, fraction, bytes_per_second, eta_seconds
+    (None while the rate is unknown), completed_items, total_items and elapsed_seconds.
+    """
+
+    def __init__(self, total_bytes, total_items=0, interval=0.5, rate_window=5.0, publish_func=print_progress):
+        self.total_bytes = total_bytes
+        self.total_items = total_items
+        self.interval = interval
+        self.rate_window = rate_window
+        self.publish_func = publish_func
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+        self.history = collections.deque()
+        self.start_time = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.published_count = 0
+
+    def counter(self, key, total_bytes=0):
+        """Counter of a worker, created on first use"""
+        with self.counters_lock:
+            if key not in self.counters:
+                self.counters[key] = ProgressCounter(total_bytes)
+            return self.counters[key]
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.counters_lock:
+            counters = list(self.counters.values())
+        downloaded_bytes = 0
+        completed_items = 0
+        for counter in counters:
+            with counter.lock:
+                downloaded_bytes += counter.downloaded_bytes
+                completed_items += counter.finished
+        self.history.append((now, downloaded_bytes))
+        while len(self.history) > 2 and now - self.history[1][0] >= self.rate_window:
+            self.history.popleft()
+        first_time, first_bytes = self.history[0]
+        bytes_per_second = (downloaded_bytes - first_bytes) / (now - first_time) if now > first_time else 0.0
+        remaining_bytes = max(0, self.total_bytes - downloaded_bytes)
+        if remaining_bytes == 0:
+            eta_seconds = 0.0
+        elif bytes_per_second > 0:
+            eta_seconds = remaining_bytes / bytes_per_second
+        else:
+            eta_seconds = None
+        return {
+            "downloaded_bytes": downloaded_bytes,
+            "total_bytes": self.total_bytes,
+            "fraction": min(1.0, downloaded_bytes / self.total_bytes) if self.total_bytes > 0 else 0.0,
+            "bytes_per_second": bytes_per_second,
+            "eta_seconds": eta_seconds,
+            "completed_items": completed_items,
+            "total_items": self.total_items,
+            "elapsed_seconds": now - self.start_time if self.start_time is not None else 0.0,
+        }
+
+    def publish(self):
+        self.publish_func(self.snapshot())
+        self.published_count += 1
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop publishing, after a last snapshot with the final totals"""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.publish()
+
+    def _run(self):
+        self.publish()
+        while not self.stop_event.wait(self.interval):
+            self.publish()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,162 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Responses that are worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def create_session(pool_size=8):
+    """Session whose keep-alive connection pool holds pool_size connections per host, shared by all worker threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def response_validator(response):
+    """ETag of a response, or its Last-Modified date if it has no ETag, None if it has neither"""
+    return response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+
+class MediaSizeCache:
+    """
+    File sizes by media ID, each with the validator (ETag or Last-Modified) of the file it was found for.
+    Sizes are kept in memory and, if path is set, in a JSON file so that the next download of the same items
+    does not query them again. Entries older than max_age seconds are ignored, and the entry of a file found to
+    have changed on the server is replaced (see segmented_download.RemoteFileChangedError).
+    """
+
+    def __init__(self, path=None, max_age=24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, media_id):
+        """Size and validator of the file of a media, None if they are not cached"""
+        with self.lock:
+            entry = self.entries.get(str(media_id))
+        if entry is None or time.time() - entry["time"] > self.max_age:
+            return None
+        return entry["size"], entry.get("validator")
+
+    def set(self, media_id, size, validator=None):
+        with self.lock:
+            self.entries[str(media_id)] = {"size": size, "validator": validator, "time": time.time()}
+
+    def remove(self, media_id):
+        with self.lock:
+            self.entries.pop(str(media_id), None)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entries = dict(self.entries)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(temporary_path, self.path)
+
+
+class SizeDiscovery:
+    """
+    Sizes of the files of a list of media, from the content-length of HEAD requests sent on up to
+    max_workers threads over a shared keep-alive session. Requests that fail with a connection error,
+    a timeout or a status in RETRY_STATUS_CODES are retried up to retries times, waiting backoff * 2^attempt
+    seconds (or the Retry-After delay of the response) in between. The validator of each file is kept in
+    validators, to resume its download only if it did not change.
+    """
+
+    def __init__(self, url_for_media, headers=None, max_workers=8, retries=3, backoff=0.5, timeout=30,
+                 cache=None, session=None):
+        """url_for_media(media_id) returns the download URL of a media, it is called on the worker threads."""
+        self.url_for_media = url_for_media
+        self.headers = headers or {}
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache if cache is not None else MediaSizeCache()
+        self.session = session if session is not None else create_session(max_workers)
+        self.validators = {}
+        self.request_count = 0
+        self.request_count_lock = threading.Lock()
+
+    def head_size(self, media_id):
+        """
+        Size and validator of the file of a media, the size is 0 if the server does not send its content-length
+        and the validator None if the server sends neither an ETag nor a Last-Modified date
+        """
+        url = self.url_for_media(media_id)
+        for attempt in range(self.retries + 1):
+            with self.request_count_lock:
+                self.request_count += 1
+            try:
+                response = self.session.head(url, headers=self.headers, timeout=self.timeout, allow_redirects=True)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                retry_after = response.headers.get("Retry-After", "")
+                time.sleep(float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt)
+                continue
+            response.raise_for_status()
+            return int(response.headers.get("content-length", 0)), response_validator(response)
+
+    def sizes(self, media_ids, progress_callback=None):
+        """
+        Sizes of the files of media_ids, from the cache when available. Returns the sizes by media ID
+        (0 for the media whose size could not be found) and the error message of these media.
+        progress_callback(number_of_sizes_found, number_of_media) is called as sizes come in.
+        """
+        sizes = {}
+        errors = {}
+        missing = []
+        for media_id in media_ids:
+            entry = self.cache.get(media_id)
+            if entry is None:
+                missing.append(media_id)
+            else:
+                sizes[media_id], self.validators[media_id] = entry
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                futures = {executor.submit(self.head_size, media_id): media_id for media_id in missing}
+                for future in concurrent.futures.as_completed(futures):
+                    media_id = futures[future]
+                    try:
+                        sizes[media_id], self.validators[media_id] = future.result()
+                        if sizes[media_id] > 0:
+                            self.cache.set(media_id, sizes[media_id], self.validators[media_id])
+                    except Exception as e:
+                        sizes[media_id] = 0
+                        errors[media_id] = str(e)
+                    if progress_callback:
+                        progress_callback(len(sizes), len(media_ids))
+            self.cache.save()
+        return {media_id: sizes[media_id] for media_id in media_ids}, errors
+
+    def refresh(self, media_id):
+        """Size and validator of a media requested again, after its file changed on the server"""
+        size, self.validators[media_id] = self.head_size(media_id)
+        if size > 0:
+            self.cache.set(media_id, size, self.validators[media_id])
+        else:
+            self.cache.remove(media_id)
+        self.cache.save()
+        return size, self.validators[media_id]
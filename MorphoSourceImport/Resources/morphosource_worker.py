@@ -0,0 +1,156 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+# The worker is started once per Slicer session and serves the requests of the MorphoSourceImport widget,
+# so the interpreter start-up and the imports of pandas and morphosource happen once instead of per request.
+#
+# Requests are JSON lines on stdin: {"id": 1, "command": "download", "arguments": {...}}, and
+# {"command": "cancel", "id": 1} stops a request. Replies are JSON lines on stdout:
+#   {"id": null, "type": "ready", "seconds": ..., "errors": {...}}  once the modules are imported
+#   {"id": 1, "type": "output", "line": "..."}                      for each line printed while serving request 1
+#   {"id": 1, "type": "finished", "result": ..., "error": null}     when request 1 is done
+# Requests run one at a time in the order received; "ping" and "cancel" are answered right away. The widget
+# starts one worker for the downloads and another for the search exports, so that they run at the same time.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_sizes(arguments, stop_event):
+    """File sizes of the media of arguments["urls"] (URL by media ID), see media_sizes.SizeDiscovery"""
+    from media_sizes import SizeDiscovery
+    urls = arguments["urls"]
+    discovery = SizeDiscovery(urls.get, headers=arguments.get("headers"), max_workers=arguments.get("max_workers", 8))
+    sizes, errors = discovery.sizes(list(urls))
+    return {"sizes": sizes, "errors": errors}
+
+
+def run_download(arguments, stop_event):
+    """Download the items of a download configuration of the widget, returns the number of files downloaded"""
+    from download_items import MSDownload
+    return MSDownload(arguments, stop_event=stop_event).downloadItems()
+
+
+def run_export_search(arguments, stop_event):
+    """Export the results of a query of the widget to CSV, returns the path of the file"""
+    from download_csv import export_query_results
+    return export_query_results(arguments, stop_event)
+
+
+COMMANDS = {
+    "sizes": run_sizes,
+    "download": run_download,
+    "export_search": run_export_search,
+}
+
+# Modules imported at start-up, so that the first request does not wait for them
+PRELOADED_MODULES = ["requests", "pandas", "media_sizes", "segmented_download", "download_items", "download_csv"]
+
+
+class RequestOutput:
+    """Replacement of sys.stdout that sends the lines printed while serving a request as output messages"""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.buffer = ""
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.buffer += text
+            lines = self.buffer.split("\n")
+            self.buffer = lines.pop()
+        for line in lines:
+            self.worker.send({"id": self.worker.current_id, "type": "output", "line": line})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Worker:
+    def __init__(self, input_stream, output_stream):
+        self.input_stream = input_stream
+        self.output_stream = output_stream
+        self.output_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.stop_events = {}
+        self.current_id = None
+
+    def send(self, message):
+        with self.output_lock:
+            self.output_stream.write(json.dumps(message) + "\n")
+            self.output_stream.flush()
+
+    def preload_modules(self):
+        errors = {}
+        for name in PRELOADED_MODULES:
+            try:
+                __import__(name)
+            except Exception as e:
+                errors[name] = str(e)
+        return errors
+
+    def read_requests(self):
+        for line in self.input_stream:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            command = message.get("command")
+            if command == "ping":
+                self.send({"id": message.get("id"), "type": "finished", "result": os.getpid(), "error": None})
+            elif command == "cancel":
+                stop_event = self.stop_events.get(message.get("id"))
+                if stop_event is not None:
+                    stop_event.set()
+            else:
+                self.stop_events[message.get("id")] = threading.Event()
+                self.requests.put(message)
+        # stdin closed: the widget is gone, stop after the current request
+        for stop_event in list(self.stop_events.values()):
+            stop_event.set()
+        self.requests.put(None)
+
+    def serve(self, message):
+        request_id = message.get("id")
+        stop_event = self.stop_events[request_id]
+        result = None
+        error = None
+        self.current_id = request_id
+        try:
+            if stop_event.is_set():
+                error = "Request cancelled"
+            elif message.get("command") not in COMMANDS:
+                error = f"Unknown command {message.get('command')}"
+            else:
+                result = COMMANDS[message["command"]](message.get("arguments") or {}, stop_event)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            sys.stdout.flush()
+            self.current_id = None
+            del self.stop_events[request_id]
+        self.send({"id": request_id, "type": "finished", "result": result, "error": error})
+
+    def run(self):
+        start_time = time.perf_counter()
+        errors = self.preload_modules()
+        self.send({"id": None, "type": "ready", "seconds": time.perf_counter() - start_time, "errors": errors})
+        threading.Thread(target=self.read_requests, daemon=True).start()
+        while True:
+            message = self.requests.get()
+            if message is None:
+                break
+            self.serve(message)
+
+
+if __name__ == "__main__":
+    worker = Worker(sys.stdin, sys.stdout)
+    sys.stdout = RequestOutput(worker)
+    worker.run()
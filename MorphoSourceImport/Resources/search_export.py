@@ -0,0 +1,167 @@
+import concurrent.futures
+import csv
+import os
+import threading
+import time
+
+import requests
+
+from segmented_download import RateLimiter
+
+# Separator of the values of the list cells of the MorphoSource records in the CSV file
+LIST_SEPARATOR = " ; "
+
+# Added to the name of the CSV files that miss the records of pages that could not be fetched
+INCOMPLETE_SUFFIX = "_incomplete"
+
+
+def flatten_columns(records):
+    """
+    Columns of a page of MorphoSource records as lists by column name, in order of first appearance. List cells
+    are joined with LIST_SEPARATOR and missing values are empty strings. Cells are converted one column at a
+    time, without building a DataFrame: most are lists of one string, taken as is.
+    """
+    names = dict.fromkeys(name for record in records for name in record)
+    columns = {}
+    for name in names:
+        columns[name] = [("" if value is None else value) if type(value) is not list else
+                         value[0] if len(value) == 1 and type(value[0]) is str else
+                         LIST_SEPARATOR.join(map(str, value))
+                         for value in [record.get(name) for record in records]]
+    return columns
+
+
+class SearchResultExport:
+    """
+    Export of the records of a paged search to a CSV file. Pages are fetched on up to max_workers threads,
+    at most requests_per_second requests per second overall, with at most max_pending_pages pages fetched
+    ahead of the writer. Each page is flattened (see flatten_columns) and appended to the file as soon as
+    the pages before it are written, so the rows are in page order and the memory used does not depend on
+    the number of records. The first column is the index of the records; the next are those of the first page
+    followed by the new columns of the later pages, as pandas.concat would order them. If later pages add
+    columns, the file is rewritten once at the end.
+
+    Pages that still fail after retries attempts (request errors, or responses that cannot be decoded) are
+    skipped and listed in failed_pages, and INCOMPLETE_SUFFIX is added to the file name, which path is updated
+    to. Setting stop_event stops the export: no more pages are requested, the partial file is removed and run
+    raises RuntimeError. The partial file is also removed if any other error stops the export.
+    """
+
+    def __init__(self, fetch_page, total_pages, path, per_page=100, first_page_records=None, max_workers=6,
+                 requests_per_second=10, max_pending_pages=None, retries=5, backoff=1.0, progress_callback=None,
+                 stop_event=None):
+        """
+        fetch_page(page) returns the list of record dictionaries of a page (numbered from 1), it is called
+        on the worker threads. progress_callback(number_of_pages_done, total_pages) is called by the writer.
+        """
+        self.fetch_page = fetch_page
+        self.total_pages = total_pages
+        self.path = path
+        self.per_page = per_page
+        self.first_page_records = first_page_records
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second, burst_seconds=1.0)
+        self.max_pending_pages = max_pending_pages or 2 * max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.progress_callback = progress_callback
+        self.stop_event = stop_event or threading.Event()
+        self.columns = []
+        self.header_columns = []
+        self.failed_pages = []
+        self.row_count = 0
+
+    def fetch(self, page):
+        """Records of a page, retrying after request and decoding errors, None if they all failed"""
+        if page == 1 and self.first_page_records is not None:
+            return self.first_page_records
+        for attempt in range(self.retries):
+            self.rate_limiter.acquire(1)
+            if self.stop_event.is_set():
+                return None
+            try:
+                return self.fetch_page(page)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Error in Page Download: {e}", flush=True)
+                if attempt < self.retries - 1:
+                    time.sleep(self.backoff * 2 ** attempt)
+        return None
+
+    def write_page(self, writer, page, records):
+        if records is None:
+            print(f"Failed to download Page {page} after {self.retries} attempts.", flush=True)
+            self.failed_pages.append(page)
+            return
+        columns = flatten_columns(records)
+        known_columns = set(self.columns)
+        self.columns += [name for name in columns if name not in known_columns]
+        if not self.header_columns and self.columns:
+            self.header_columns = list(self.columns)
+            writer.writerow([""] + self.header_columns)
+        start_index = (page - 1) * self.per_page
+        empty_column = [""] * len(records)
+        writer.writerows(zip(range(start_index, start_index + len(records)),
+                             *[columns.get(name, empty_column) for name in self.columns]))
+        self.row_count += len(records)
+
+    def run(self):
+        """Write the CSV file, returns the number of rows"""
+        try:
+            self.write_pages()
+        except BaseException:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            raise
+        if self.columns != self.header_columns:
+            self.rewrite_header()
+        if self.failed_pages:
+            root, extension = os.path.splitext(self.path)
+            incomplete_path = root + INCOMPLETE_SUFFIX + extension
+            os.replace(self.path, incomplete_path)
+            self.path = incomplete_path
+        return self.row_count
+
+    def write_pages(self):
+        """Fetch the pages and write them in order to the file, raises RuntimeError if the export is stopped"""
+        self.columns = []
+        self.header_columns = []
+        self.failed_pages = []
+        self.row_count = 0
+        fetched = {}
+        next_page_to_write = 1
+        next_page_to_fetch = 1
+        with open(self.path, 'w', newline='') as file, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            writer = csv.writer(file, lineterminator=os.linesep)
+            futures = {}
+            while next_page_to_write <= self.total_pages and not self.stop_event.is_set():
+                while (next_page_to_fetch <= self.total_pages and
+                       next_page_to_fetch - next_page_to_write < self.max_pending_pages):
+                    futures[executor.submit(self.fetch, next_page_to_fetch)] = next_page_to_fetch
+                    next_page_to_fetch += 1
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    fetched[futures.pop(future)] = future.result()
+                while next_page_to_write in fetched and not self.stop_event.is_set():
+                    self.write_page(writer, next_page_to_write, fetched.pop(next_page_to_write))
+                    if self.progress_callback:
+                        self.progress_callback(next_page_to_write, self.total_pages)
+                    next_page_to_write += 1
+            for future in futures:
+                future.cancel()
+        if next_page_to_write <= self.total_pages:
+            # stopped before the last page
+            raise RuntimeError("Export stopped")
+
+    def rewrite_header(self):
+        """Write the header with all the columns, and pad the rows written before the last columns were found"""
+        temporary_path = self.path + ".tmp"
+        with open(self.path, newline='') as source, open(temporary_path, 'w', newline='') as destination:
+            reader = csv.reader(source)
+            writer = csv.writer(destination, lineterminator=os.linesep)
+            next(reader)
+            writer.writerow([""] + self.columns)
+            row_length = len(self.columns) + 1
+            for row in reader:
+                writer.writerow(row + [""] * (row_length - len(row)))
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,339 @@
+import concurrent.futures
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+import requests
+import urllib3
+
+# Large files are split in segments of this size, fetched on separate connections
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)$")
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the downloads of a session: on average at most bytes_per_second are
+    read, with bursts of up to burst_seconds of data. No limit if bytes_per_second is 0 or None.
+    """
+
+    def __init__(self, bytes_per_second=None, burst_seconds=0.5):
+        self.bytes_per_second = bytes_per_second
+        self.burst_seconds = burst_seconds
+        self.lock = threading.Lock()
+        self.available = 0.0
+        self.updated = time.monotonic()
+
+    def acquire(self, byte_count):
+        """Account for byte_count bytes read, sleeping as long as needed to stay within the rate"""
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.bytes_per_second * self.burst_seconds,
+                                 self.available + (now - self.updated) * self.bytes_per_second)
+            self.updated = now
+            self.available -= byte_count
+            wait = -self.available / self.bytes_per_second if self.available < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveChunkSize:
+    """
+    Size of the reads from a connection, adapted to its observed throughput so that each read takes about
+    target_seconds: small reads keep progress and cancellation responsive on slow links, large reads
+    reduce the per-read overhead on fast ones.
+    """
+
+    def __init__(self, initial=256 * 1024, minimum=64 * 1024, maximum=8 * 1024 * 1024, target_seconds=0.25):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+
+    def update(self, byte_count, seconds):
+        if byte_count <= 0:
+            return
+        desired = byte_count / max(seconds, 1e-6) * self.target_seconds
+        # smoothed, rounded to whole multiples of the minimum size
+        size = (self.size + desired) / 2
+        self.size = int(min(self.maximum, max(self.minimum, size // self.minimum * self.minimum)))
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+class IncompleteSegmentError(Exception):
+    pass
+
+
+class RemoteFileChangedError(Exception):
+    """The file on the server no longer matches the size or validator the download was started with"""
+    pass
+
+
+class SegmentedDownload:
+    """
+    Download of a file of known size in byte-range segments fetched concurrently on up to max_connections
+    connections and written in place into the file, which is preallocated. The bytes written and the CRC-32
+    of each segment are kept in a state file next to the download (path + ".segments.json"), so an interrupted
+    download resumes where each segment stopped; the bytes already on disk are checked against their CRC-32
+    first and segments that do not match are downloaded again. A file left by a previous download without
+    state file is taken as a downloaded prefix. If the server does not honor range requests, the file is
+    downloaded in a single stream.
+
+    The validator (ETag or Last-Modified of the file, if known) is kept in the state file and sent as If-Range,
+    and the Content-Range of each response is checked against the requested range and total_bytes: if the file
+    changed on the server, RemoteFileChangedError is raised and the file and its state are removed, so that
+    bytes of two versions of the file are never mixed.
+    """
+
+    def __init__(self, url, path, total_bytes, session=None, headers=None, segment_size=DEFAULT_SEGMENT_SIZE,
+                 max_connections=4, rate_limiter=None, progress_callback=None, stop_event=None, retries=5,
+                 backoff=1.0, timeout=60, state_save_interval=1.0, validator=None):
+        """
+        progress_callback(downloaded_bytes, total_bytes) is called from the download threads, one call at a time
+        in the order of the updates, so that downloaded_bytes only goes back when the download starts over.
+        """
+        self.url = url
+        self.path = path
+        self.state_path = path + ".segments.json"
+        self.total_bytes = total_bytes
+        self.validator = validator
+        self.session = session if session is not None else requests.Session()
+        self.headers = headers or {}
+        self.segment_size = max(1, segment_size)
+        self.max_connections = max(1, max_connections)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.progress_callback = progress_callback
+        self.stop_event = stop_event or threading.Event()
+        self.abort_event = threading.Event()  # set when a segment fails, stops the others
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.state_save_interval = state_save_interval
+        self.lock = threading.Lock()
+        self.segments = []
+        self.downloaded_bytes = 0
+        self.last_state_save = 0.0
+
+    def run(self):
+        """Download the file, returns the number of bytes fetched from the server by this run"""
+        if self.total_bytes <= 0:
+            # unknown size: a single stream, started over each time
+            self.segments = [{"start": 0, "end": None, "written": 0, "crc": 0}]
+            with open(self.path, 'wb'):
+                pass
+            return self._download_segments()
+        self._load_state()
+        # the state is written before the file is resized, so a resized file is never taken for a downloaded prefix
+        self._save_state(force=True)
+        with open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b') as file:
+            file.truncate(self.total_bytes)
+        try:
+            try:
+                fetched_bytes = self._download_segments()
+            except RangeNotSupportedError:
+                self.abort_event.clear()
+                self.segments = [{"start": 0, "end": self.total_bytes, "written": 0, "crc": 0}]
+                self.downloaded_bytes = 0
+                fetched_bytes = self._download_segments(allow_full_response=True)
+        except RemoteFileChangedError:
+            # the bytes on disk belong to the previous version of the file
+            for path in [self.state_path, self.path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return fetched_bytes
+
+    def stopped(self):
+        return self.stop_event.is_set() or self.abort_event.is_set()
+
+    def _plan_segments(self):
+        return [{"start": start, "end": min(start + self.segment_size, self.total_bytes), "written": 0, "crc": 0}
+                for start in range(0, self.total_bytes, self.segment_size)]
+
+    def _load_state(self):
+        state = None
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                state = None
+        if (state is not None and state.get("total_bytes") == self.total_bytes
+                and state.get("validator") == self.validator and os.path.exists(self.path)):
+            self.segments = state["segments"]
+            self._verify_segments()
+        elif state is None and os.path.exists(self.path) and os.path.getsize(self.path) < self.total_bytes:
+            # file of a previous download that appended to it: its bytes are a downloaded prefix
+            existing_bytes = os.path.getsize(self.path)
+            self.segments = self._plan_segments()
+            for segment in self.segments:
+                segment["written"] = max(0, min(existing_bytes - segment["start"], segment["end"] - segment["start"]))
+            self._verify_segments(recompute=True)
+        else:
+            self.segments = self._plan_segments()
+        self.downloaded_bytes = sum(segment["written"] for segment in self.segments)
+
+    def _verify_segments(self, recompute=False):
+        """Check the bytes already written against their CRC-32 (or compute it), restart the segments that differ"""
+        with open(self.path, 'rb') as file:
+            for segment in self.segments:
+                if segment["written"] == 0:
+                    continue
+                file.seek(segment["start"])
+                crc = 0
+                remaining = segment["written"]
+                while remaining > 0:
+                    data = file.read(min(remaining, 8 * 1024 * 1024))
+                    if not data:
+                        break
+                    crc = zlib.crc32(data, crc)
+                    remaining -= len(data)
+                if remaining > 0 or (not recompute and crc != segment["crc"]):
+                    segment["written"] = 0
+                    segment["crc"] = 0
+                else:
+                    segment["crc"] = crc
+
+    def _save_state(self, force=False):
+        if self.total_bytes <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_state_save < self.state_save_interval:
+                return
+            self.last_state_save = now
+            state = {"total_bytes": self.total_bytes, "validator": self.validator,
+                     "segments": [dict(segment) for segment in self.segments]}
+            temporary_path = self.state_path + ".tmp"
+            with open(temporary_path, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(temporary_path, self.state_path)
+
+    def _download_segments(self, allow_full_response=False):
+        pending = [segment for segment in self.segments
+                   if segment["end"] is None or segment["written"] < segment["end"] - segment["start"]]
+        fetched_bytes = 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_connections, max(1, len(pending)))) as executor:
+                futures = [executor.submit(self._download_segment, segment, allow_full_response) for segment in pending]
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        fetched_bytes += future.result()
+                except BaseException:
+                    # stop the other segments where they are, their state is kept for the next run
+                    self.abort_event.set()
+                    raise
+        finally:
+            self._save_state(force=True)
+        return fetched_bytes
+
+    def _download_segment(self, segment, allow_full_response):
+        """Fetch the rest of a segment, retrying from where it stopped after connection errors"""
+        fetched_bytes = 0
+        chunk_size = AdaptiveChunkSize()
+        for attempt in range(self.retries + 1):
+            if self.stopped():
+                raise RuntimeError("Download stopped")
+            try:
+                fetched_bytes += self._fetch(segment, chunk_size, allow_full_response)
+                return fetched_bytes
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError, IncompleteSegmentError) as e:
+                if attempt == self.retries:
+                    raise
+                print(f"[Debug] Retrying bytes {segment['start'] + segment['written']}- of {os.path.basename(self.path)}: {e}", flush=True)
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _response_changed(self, response):
+        """Whether the validator of a response shows that the file differs from the one being downloaded"""
+        if not self.validator:
+            return False
+        if self.validator.startswith('"') or self.validator.startswith('W/'):
+            response_validator = response.headers.get("ETag")
+        else:
+            response_validator = response.headers.get("Last-Modified")
+        return response_validator is not None and response_validator != self.validator
+
+    def _check_content_range(self, response, offset, last):
+        """Last byte of a partial response, checked against the requested range and the size of the file"""
+        match = CONTENT_RANGE_PATTERN.match(response.headers.get("Content-Range", "").strip())
+        if match is None or int(match.group(1)) != offset or int(match.group(2)) < offset:
+            raise RangeNotSupportedError()
+        if match.group(3) != "*" and int(match.group(3)) != self.total_bytes:
+            raise RemoteFileChangedError(f"{os.path.basename(self.path)} is now {match.group(3)} bytes instead of {self.total_bytes}")
+        if int(match.group(2)) > last:
+            raise RangeNotSupportedError()
+        return int(match.group(2))
+
+    def _fetch(self, segment, chunk_size, allow_full_response):
+        offset = segment["start"] + segment["written"]
+        headers = dict(self.headers)
+        if segment["end"] is not None:
+            headers["Range"] = f"bytes={offset}-{segment['end'] - 1}"
+            if self.validator and not self.validator.startswith('W/'):
+                # the server sends the whole (new) file instead of the range if the file changed
+                headers["If-Range"] = self.validator
+        fetched_bytes = 0
+        with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if segment["end"] is not None and response.status_code == 200:
+                if self._response_changed(response):
+                    raise RemoteFileChangedError(f"{os.path.basename(self.path)} changed on the server")
+                content_length = response.headers.get("Content-Length")
+                if content_length is not None and content_length.isdigit() and int(content_length) != self.total_bytes:
+                    raise RemoteFileChangedError(f"{os.path.basename(self.path)} is now {content_length} bytes instead of {self.total_bytes}")
+                # range ignored: only usable as a whole file download
+                if not allow_full_response:
+                    raise RangeNotSupportedError()
+                with self.lock:
+                    self.downloaded_bytes -= segment["written"]
+                    segment["written"] = 0
+                    segment["crc"] = 0
+                offset = 0
+                last = self.total_bytes - 1
+            elif segment["end"] is not None:
+                if response.status_code != 206:
+                    response.raise_for_status()
+                    raise RangeNotSupportedError()
+                last = self._check_content_range(response, offset, segment["end"] - 1)
+            else:
+                response.raise_for_status()
+                last = None
+            # a connection closed early then ends the reads with the bytes received so far instead of
+            # raising and dropping them; the missing bytes are requested again from where it stopped
+            response.raw.enforce_content_length = False
+            with open(self.path, 'r+b') as file:
+                file.seek(offset)
+                while last is None or offset + fetched_bytes <= last:
+                    if self.stopped():
+                        raise RuntimeError("Download stopped")
+                    read_size = chunk_size.size if last is None else min(chunk_size.size, last + 1 - offset - fetched_bytes)
+                    read_start = time.perf_counter()
+                    data = response.raw.read(read_size, decode_content=True)
+                    chunk_size.update(len(data), time.perf_counter() - read_start)
+                    if not data:
+                        break
+                    self.rate_limiter.acquire(len(data))
+                    file.write(data)
+                    fetched_bytes += len(data)
+                    with self.lock:
+                        segment["written"] += len(data)
+                        segment["crc"] = zlib.crc32(data, segment["crc"])
+                        self.downloaded_bytes += len(data)
+                        # under the lock: a total reported by one thread is never followed by an older one
+                        if self.progress_callback:
+                            self.progress_callback(self.downloaded_bytes, self.total_bytes)
+                    self._save_state()
+        if segment["end"] is not None and segment["written"] < segment["end"] - segment["start"]:
+            raise IncompleteSegmentError(f"connection closed after {segment['written']} of {segment['end'] - segment['start']} bytes")
+        return fetched_bytes
@@ -7,10 +7,8 @@ import fnmatch
 import  numpy as np
 import random
 import math
-
-import CreateSemiLMPatches
-import re
-import csv
+import time
+from PlaceSemiLMPatchesLib import batch_patches
 #
 # PlaceSemiLMPatches
 #
@@ -103,6 +101,16 @@ class PlaceSemiLMPatchesWidget(ScriptedLoadableModuleWidget):
     self.sampleRate.value = 10
     self.sampleRate.setToolTip("Select sample rate for semi-landmark interpolation")
     parametersFormLayout.addRow("Sample rate for interpolation:", self.sampleRate)
+
+    #
+    # number of specimens processed at the same time
+    #
+    self.parallelSpecimensSpinBox = qt.QSpinBox()
+    self.parallelSpecimensSpinBox.minimum = 1
+    self.parallelSpecimensSpinBox.maximum = max(1, os.cpu_count() or 1)
+    self.parallelSpecimensSpinBox.value = self.parallelSpecimensSpinBox.maximum
+    self.parallelSpecimensSpinBox.setToolTip("Number of specimens processed at the same time, each in its own process")
+    parametersFormLayout.addRow("Parallel specimens:", self.parallelSpecimensSpinBox)
     #
     # Apply Button
     #
@@ -111,6 +119,10 @@ class PlaceSemiLMPatchesWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    self.statusLabel = qt.QLabel()
+    self.statusLabel.wordWrap = True
+    parametersFormLayout.addRow(self.statusLabel)
+
     # connections
     self.meshDirectory.connect('validInputChanged(bool)', self.onSelect)
     self.landmarkDirectory.connect('validInputChanged(bool)', self.onSelect)
@@ -127,8 +139,20 @@ class PlaceSemiLMPatchesWidget(ScriptedLoadableModuleWidget):
 
   def onApplyButton(self):
     logic = PlaceSemiLMPatchesLogic()
-    logic.run(self.meshDirectory.currentPath, self.landmarkDirectory.currentPath, self.gridFile.currentPath,
-      self.outputDirectory.currentPath, int(self.sampleRate.value))
+
+    def updateProgress(specimens):
+      finished = [specimen for specimen in specimens if specimen.status not in [batch_patches.PENDING, batch_patches.RUNNING]]
+      self.statusLabel.text = f"{len(finished)} of {len(specimens)} specimens processed"
+      slicer.app.processEvents()
+
+    self.applyButton.enabled = False
+    try:
+      specimens, reportFilePath, message = logic.run(self.meshDirectory.currentPath, self.landmarkDirectory.currentPath,
+        self.gridFile.currentPath, self.outputDirectory.currentPath, int(self.sampleRate.value),
+        self.parallelSpecimensSpinBox.value, updateProgress)
+    finally:
+      self.applyButton.enabled = True
+    self.statusLabel.text = f"{message}. Report: {reportFilePath}"
 
 #
 # PlaceSemiLMPatchesLogic
@@ -143,49 +167,39 @@ class PlaceSemiLMPatchesLogic(ScriptedLoadableModuleLogic):
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
-  def run(self, meshDirectory, lmDirectory, gridFileName, ouputDirectory, sampleRate):
+  def run(self, meshDirectory, lmDirectory, gridFileName, ouputDirectory, sampleRate, maximumParallelSpecimens=None,
+      progressCallback=None):
+    """
+    Place the semi-landmark patches of the grid on each mesh of meshDirectory that has a landmark file in
+    lmDirectory (see batch_patches.matchSpecimens), merged and written to ouputDirectory as
+    <mesh file name>_merged.fcsv. Specimens are processed from their files on up to maximumParallelSpecimens
+    worker processes (one per CPU core by default), without loading anything into the scene.
+    progressCallback(specimens) is called periodically, see batch_patches.runBatch.
+    Returns the specimens (batch_patches.Specimen), the report file path and a summary message.
+    """
     smoothingIterations = 75
     maximumProjectionDistance = .75
-    SLLogic=CreateSemiLMPatches.CreateSemiLMPatchesLogic()
-    gridVertices = []
-    with open(gridFileName) as gridFile:
-      gridReader = csv.reader(gridFile)
-      next(gridReader) # skip header
-      for row in gridReader:
-        gridVertices.append([int(row[0]),int(row[1]),int(row[2])])
-
-    for meshFileName in os.listdir(meshDirectory):
-      if(not meshFileName.startswith(".")):
-        print (meshFileName)
-        lmFileList = os.listdir(lmDirectory)
-        meshFilePath = os.path.join(meshDirectory, meshFileName)
-        regex = re.compile(r'\d+')
-        subjectID = [int(x) for x in regex.findall(meshFileName)][0]
-        for lmFileName in lmFileList:
-          if str(subjectID) in lmFileName:
-            meshNode =slicer.util.loadModel(meshFilePath)
-            smoothNormalArray = SLLogic.getSmoothNormals(meshNode,smoothingIterations)
-            lmFilePath = os.path.join(lmDirectory, lmFileName)
-            [success, landmarkNode] = slicer.util.loadMarkupsFiducialList(lmFilePath)
-            landmarkNumber=landmarkNode.GetNumberOfControlPoints()
-            for n in range(landmarkNumber):
-              landmarkNode.SetNthControlPointLabel(n, str(n+1))
-            for triangle in gridVertices:
-              newNode = SLLogic.applyPatch(meshNode, landmarkNode, triangle, sampleRate, smoothNormalArray, maximumProjectionDistance)
-            nodeList = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
-            mergedLandmarkNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', meshFileName+'_merged')
-            success = SLLogic.mergeList(nodeList, landmarkNode, meshNode, sampleRate, mergedLandmarkNode)
-            print("Number of merged landmark points", mergedLandmarkNode.GetNumberOfControlPoints())
-            if not success:
-              print("Something went wrong in CreateSemiLMPatchesLogic.merge")
-            #Set all landmarks to semilandmark type
-            landmarkTypeSemi=True
-            self.setAllLandmarksType(mergedLandmarkNode, landmarkTypeSemi)
-
-            outputFileName = meshFileName + '_merged.fcsv'
-            outputFilePath = os.path.join(ouputDirectory, outputFileName)
-            slicer.util.saveNode(mergedLandmarkNode, outputFilePath)
-            slicer.mrmlScene.Clear(0)
+    gridVertices = batch_patches.readGridTriangles(gridFileName)
+    pairs, unmatched = batch_patches.matchSpecimens(os.listdir(meshDirectory), os.listdir(lmDirectory))
+    specimens = []
+    for meshFileName, lmFileName in pairs:
+      outputFilePath = os.path.join(ouputDirectory, meshFileName + '_merged.fcsv')
+      specimens.append(batch_patches.Specimen(os.path.join(meshDirectory, meshFileName), os.path.join(lmDirectory, lmFileName), outputFilePath))
+    for meshFileName, reason in unmatched:
+      logging.warning(f"Skipping {meshFileName}: {reason}")
+      specimen = batch_patches.Specimen(os.path.join(meshDirectory, meshFileName), None, None)
+      specimen.status = batch_patches.FAILED
+      specimen.message = reason
+      specimens.append(specimen)
+
+    startTime = time.perf_counter()
+    batch_patches.runBatch(specimens, gridVertices, sampleRate, smoothingIterations, maximumProjectionDistance,
+      maximumParallelSpecimens, progressCallback=progressCallback)
+    message = batch_patches.summary(specimens, time.perf_counter() - startTime)
+    reportFilePath = os.path.join(ouputDirectory, 'semiLandmarkPatches_report.csv')
+    batch_patches.writeReport(specimens, reportFilePath)
+    logging.info(message)
+    return specimens, reportFilePath, message
 
   def setAllLandmarksType(self,landmarkNode, setToSemiType):
     landmarkDescription = "Semi"
@@ -280,6 +294,10 @@ class PlaceSemiLMPatchesTest(ScriptedLoadableModuleTest):
       """
     self.setUp()
     self.test_PlaceSemiLMPatches1()
+    self.setUp()
+    self.test_PlaceSemiLMPatchesBatch()
+    self.setUp()
+    self.test_PlaceSemiLMPatchesMatching()
 
   def test_PlaceSemiLMPatches1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -326,3 +344,195 @@ class PlaceSemiLMPatchesTest(ScriptedLoadableModuleTest):
     self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
     self.delayDisplay('Test passed')
+
+  def test_PlaceSemiLMPatchesMatching(self):
+    """ Meshes matched to the landmark files of their specimens: a landmark file whose name is a prefix of the
+    mesh names is not the landmark file of every specimen, the most specific candidate is taken, and a landmark
+    file is never given to two meshes.
+    """
+    self.delayDisplay("Starting the specimen matching test")
+    pairs, unmatched = batch_patches.matchSpecimens(["mouse_01.ply", "mouse_02.ply", "mouse_03.ply"],
+      ["mouse.fcsv", "mouse_01_lm.fcsv", "mouse_02_lm.fcsv"])
+    self.assertEqual(pairs, [("mouse_01.ply", "mouse_01_lm.fcsv"), ("mouse_02.ply", "mouse_02_lm.fcsv")])
+    self.assertEqual([meshFileName for meshFileName, reason in unmatched], ["mouse_03.ply"])
+
+    pairs, unmatched = batch_patches.matchSpecimens(["skull_1.ply", "skull_2.ply"], ["skull.fcsv"])
+    self.assertEqual(pairs, [])
+    self.assertEqual([meshFileName for meshFileName, reason in unmatched], ["skull_1.ply", "skull_2.ply"])
+
+    # the reverse prefix is kept when the numbers are the same
+    pairs, unmatched = batch_patches.matchSpecimens(["skull_12_surface.ply"], ["skull.fcsv", "skull_12.fcsv"])
+    self.assertEqual(pairs, [("skull_12_surface.ply", "skull_12.fcsv")])
+
+    # the landmark file goes to the mesh that it matches best
+    pairs, unmatched = batch_patches.matchSpecimens(["bat_1.ply", "bat_1_left.ply"], ["bat_1_left_lm.fcsv"])
+    self.assertEqual(pairs, [("bat_1_left.ply", "bat_1_left_lm.fcsv")])
+    self.assertEqual([meshFileName for meshFileName, reason in unmatched], ["bat_1.ply"])
+    pairs, unmatched = batch_patches.matchSpecimens(["Bat-1.ply", "bat_1.stl"], ["bat_1.fcsv"])
+    self.assertEqual(pairs, [])
+    self.assertEqual(len(unmatched), 2)
+
+    self.delayDisplay('Test passed')
+
+  def test_PlaceSemiLMPatchesBatch(self):
+    """ Batch of specimens with meshes and landmark files of different formats, named so that a numeric ID is
+    part of another (specimen 1 and 11): each mesh is matched to its own landmarks, the merged semi-landmarks
+    written by worker processes are those of the patch engine and of applyPatch and mergeList in the scene, and
+    the batch leaves the scene as it was.
+    """
+    import json
+    import shutil
+    import tempfile
+    from vtk.util import numpy_support
+    from CreateSemiLMPatchesLib import patch_engine
+    self.delayDisplay("Starting the batch semi-landmark patches test")
+
+    folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, folder, True)
+    meshDirectory, lmDirectory, outputDirectory = [os.path.join(folder, name) for name in ["meshes", "landmarks", "output"]]
+    for directory in [meshDirectory, lmDirectory, outputDirectory]:
+      os.makedirs(directory)
+
+    # icosahedron landmarks on bumpy spheres of different sizes, landmarks in RAS (fcsv) or LPS (json)
+    golden = (1 + math.sqrt(5)) / 2
+    vertices = np.array([[-1, golden, 0], [1, golden, 0], [-1, -golden, 0], [1, -golden, 0],
+      [0, -1, golden], [0, 1, golden], [0, -1, -golden], [0, 1, -golden],
+      [golden, 0, -1], [golden, 0, 1], [-golden, 0, -1], [-golden, 0, 1]]) / math.sqrt(1 + golden**2)
+    rotation = vtk.vtkTransform()
+    rotation.RotateWXYZ(20, 1, 2, 3)
+    vertices = np.array([rotation.TransformPoint(vertex) for vertex in vertices])
+    triangles = [[1, 12, 6], [1, 6, 2], [1, 2, 8], [1, 8, 11], [1, 11, 12], [2, 6, 10], [6, 12, 5],
+      [12, 11, 3], [11, 8, 7], [8, 2, 9], [4, 10, 5], [4, 5, 3], [4, 3, 7], [4, 7, 9], [4, 9, 10], [5, 10, 6],
+      [3, 5, 12], [7, 3, 11], [9, 7, 8], [10, 9, 2]]
+    gridFilePath = os.path.join(folder, "grid.csv")
+    with open(gridFilePath, "w") as gridFile:
+      gridFile.write("Vertice 1,Vertice 2,Vertice 3\n")
+      for triangle in triangles:
+        gridFile.write(",".join(str(vertex) for vertex in triangle) + "\n")
+
+    specimens = {"specimen_1.ply": ("specimen_1_landmarks.fcsv", 10), "specimen_11.ply": ("Specimen-11-LM.mrk.json", 12),
+      "Skull_012_surface.vtk": ("LM_12.fcsv", 14), "specimen_2.ply": ("specimen_2_landmarks.fcsv", 16),
+      "specimen_3.obj": ("specimen_3_landmarks.fcsv", 18)}
+    expectedLandmarks = {}
+    expectedMeshPoints = {}
+    for meshFileName, (lmFileName, radius) in specimens.items():
+      sphere = vtk.vtkSphereSource()
+      sphere.SetRadius(radius)
+      sphere.SetThetaResolution(150)
+      sphere.SetPhiResolution(150)
+      sphere.Update()
+      polydata = sphere.GetOutput()
+      points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+      points *= (1 + 0.05 * np.sin(3 * points[:, [0]] / radius) * np.cos(2 * points[:, [1]] / radius))
+      polydata.GetPoints().Modified()
+      expectedMeshPoints[meshFileName] = points.copy()
+      meshFilePath = os.path.join(meshDirectory, meshFileName)
+      if meshFileName.endswith(".obj"):
+        # written in RAS, with the comment that Slicer writes in OBJ files
+        rasPolydata = vtk.vtkPolyData()
+        rasPolydata.DeepCopy(polydata)
+        numpy_support.vtk_to_numpy(rasPolydata.GetPoints().GetData())[:, :2] *= -1
+        writer = vtk.vtkOBJWriter()
+        writer.SetFileName(meshFilePath)
+        writer.SetInputData(rasPolydata)
+        writer.Write()
+        with open(meshFilePath) as meshFile:
+          meshText = meshFile.read()
+        with open(meshFilePath, "w") as meshFile:
+          meshFile.write("# SPACE=RAS\n" + meshText)
+      else:
+        writer = vtk.vtkPLYWriter() if meshFileName.endswith(".ply") else vtk.vtkPolyDataWriter()
+        writer.SetFileName(meshFilePath)
+        writer.SetInputData(polydata)
+        writer.Write()
+      locator = vtk.vtkPointLocator()
+      locator.SetDataSet(polydata)
+      locator.BuildLocator()
+      landmarks = np.array([polydata.GetPoint(locator.FindClosestPoint(vertex * radius)) for vertex in vertices])
+      expectedLandmarks[meshFileName] = landmarks
+      lmFilePath = os.path.join(lmDirectory, lmFileName)
+      if lmFileName.endswith(".json"):
+        markup = {"markups": [{"type": "Fiducial", "coordinateSystem": "LPS",
+          "controlPoints": [{"label": str(index + 1), "position": list(point)} for index, point in enumerate(landmarks)]}]}
+        with open(lmFilePath, "w") as lmFile:
+          json.dump(markup, lmFile)
+      else:
+        with open(lmFilePath, "w") as lmFile:
+          lmFile.write("# Markups fiducial file version = 4.11\n# CoordinateSystem = RAS\n")
+          for index, point in enumerate(landmarks):
+            lmFile.write(f"{index + 1},{-point[0]},{-point[1]},{point[2]},0,0,0,1,1,1,0,{index + 1},,\n")
+    with open(os.path.join(meshDirectory, "unmatched_99.ply"), "w") as unmatchedFile:
+      unmatchedFile.write("not a mesh")
+
+    sceneNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "user landmarks")
+    sceneNodeCount = slicer.mrmlScene.GetNumberOfNodes()
+    logic = PlaceSemiLMPatchesLogic()
+    sampleRate = 10
+    startTime = time.perf_counter()
+    results, reportFilePath, message = logic.run(meshDirectory, lmDirectory, gridFilePath, outputDirectory, sampleRate,
+      maximumParallelSpecimens=1)
+    sequentialTime = time.perf_counter() - startTime
+    sequentialOutputs = {specimen.name: batch_patches.readLandmarks(specimen.outputPath)
+      for specimen in results if specimen.status == batch_patches.DONE}
+    sequentialProcessIds = {specimen.workerProcessId for specimen in results if specimen.status == batch_patches.DONE}
+    workerCount = max(2, os.cpu_count() or 1)
+    startTime = time.perf_counter()
+    results, reportFilePath, message = logic.run(meshDirectory, lmDirectory, gridFilePath, outputDirectory, sampleRate,
+      maximumParallelSpecimens=workerCount)
+    parallelTime = time.perf_counter() - startTime
+    logging.info(f"{len(specimens)} specimens: {sequentialTime:.2f} s with 1 process, {parallelTime:.2f} s with {workerCount} "
+      f"on {os.cpu_count()} cores. {message}")
+    for specimen in results:
+      logging.info(f"{specimen.name}: {specimen.status} {specimen.message} " +
+        ", ".join(f"{stage} {seconds:.3f} s" for stage, seconds in specimen.timings.items()))
+
+    # the scene is left as it was
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), sceneNodeCount)
+    self.assertIs(slicer.mrmlScene.GetNodeByID(sceneNode.GetID()), sceneNode)
+
+    statuses = {specimen.name: specimen.status for specimen in results}
+    self.assertEqual(statuses, {**{name: batch_patches.DONE for name in specimens}, "unmatched_99.ply": batch_patches.FAILED})
+    self.assertEqual({os.path.basename(specimen.landmarkPath) for specimen in results if specimen.landmarkPath},
+      {lmFileName for lmFileName, radius in specimens.values()})
+    self.assertTrue(os.path.exists(reportFilePath))
+
+    for specimen in results:
+      if specimen.status != batch_patches.DONE:
+        continue
+      output = batch_patches.readLandmarks(specimen.outputPath)
+      np.testing.assert_allclose(output, sequentialOutputs[specimen.name], atol=1e-5)
+      # same points as the patch engine on the specimen surface, all on the sphere of the specimen
+      surfacePolydata = batch_patches.readMesh(specimen.meshPath)
+      # in LPS whatever the file, to the precision of the text files
+      np.testing.assert_allclose(numpy_support.vtk_to_numpy(surfacePolydata.GetPoints().GetData()),
+        expectedMeshPoints[specimen.name], atol=1e-3)
+      engine = patch_engine.SemiLandmarkPatchEngine(surfacePolydata, patch_engine.smoothNormals(surfacePolydata, 75))
+      expected, edges = engine.mergedPatches(expectedLandmarks[specimen.name], np.array(triangles) - 1, sampleRate, .75)
+      self.assertEqual(specimen.semiLandmarkCount, len(expected))
+      np.testing.assert_allclose(output, expected, atol=1e-5)
+      radius = specimens[specimen.name][1]
+      self.assertLess(np.abs(np.linalg.norm(output, axis=1) / radius - 1).max(), 0.06)
+
+    # the specimens ran in worker processes, one at a time in the sequential run and in several at once here
+    self.assertEqual(len(sequentialProcessIds), 1)
+    self.assertNotIn(os.getpid(), sequentialProcessIds)
+    parallelProcessIds = {specimen.workerProcessId for specimen in results if specimen.status == batch_patches.DONE}
+    self.assertNotIn(os.getpid(), parallelProcessIds)
+    self.assertGreater(len(parallelProcessIds), 1)
+
+    # same points as applyPatch and mergeList of CreateSemiLMPatches place in the scene (RAS) for the specimen
+    import CreateSemiLMPatches
+    specimen = next(specimen for specimen in results if specimen.name == "specimen_2.ply")
+    meshNode = slicer.util.loadModel(specimen.meshPath)
+    landmarkNode = slicer.util.loadMarkups(specimen.landmarkPath)
+    patchLogic = CreateSemiLMPatches.CreateSemiLMPatchesLogic()
+    normalArray = patchLogic.getNormals(meshNode, 75)
+    nodeList = vtk.vtkCollection()
+    for triangle in triangles:
+      nodeList.AddItem(patchLogic.applyPatch(meshNode, landmarkNode, triangle, sampleRate, normalArray, .75))
+    mergedNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "specimen_2_mergedNode")
+    patchLogic.mergeList(nodeList, landmarkNode, meshNode, sampleRate, mergedNode, 75)
+    scenePoints = slicer.util.arrayFromMarkupsControlPoints(mergedNode) * [-1, -1, 1]
+    np.testing.assert_allclose(batch_patches.readLandmarks(specimen.outputPath), scenePoints, atol=1e-4)
+
+    self.delayDisplay('Test passed')
@@ -0,0 +1,359 @@
+import collections
+import concurrent.futures
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from CreateSemiLMPatchesLib import patch_engine
+
+# Status of a specimen in the batch report
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+REPORT_FIELDS = ["specimen", "status", "message", "meshFile", "landmarkFile", "outputFile", "semiLandmarks",
+  "readSeconds", "normalsSeconds", "patchesSeconds", "writeSeconds", "totalSeconds"]
+
+MESH_EXTENSIONS = ['.ply', '.stl', '.obj', '.vtk', '.vtp']
+LANDMARK_EXTENSIONS = ['.mrk.json', '.fcsv', '.json']
+
+
+def fileStem(fileName, extensions):
+  """File name without its extension when it is one of extensions, None otherwise"""
+  for extension in extensions:
+    if fileName.lower().endswith(extension):
+      return fileName[:-len(extension)]
+  return None
+
+
+def idTokens(stem):
+  """Lower case words and numbers of a file name, so that 'Skull_012-LM' and 'skull 012 lm' have the same tokens"""
+  return tuple((token.lstrip('0') or '0') if token.isdigit() else token
+    for token in re.findall(r'[a-z]+|\d+', stem.lower()))
+
+
+def matchSpecimens(meshFileNames, landmarkFileNames):
+  """
+  Pairs of mesh and landmark files of the same specimen. Files are indexed by the tokens of their names
+  (see idTokens), and a mesh is matched to the landmark files with:
+  - the same tokens, else
+  - tokens that start with those of the mesh ('skull_12' and 'skull_12_landmarks'), or the reverse with the same
+    numbers ('skull_12_surface' and 'skull_12'), else
+  - the same numbers ('12' in 'Skull_12_surface' and 'LM_12'),
+  taking the first rule that gives candidates, and of these the one that shares the most leading tokens with
+  the mesh. Numbers are compared whole, so specimen 1 is never matched to the landmarks of specimen 11, and a
+  landmark file without numbers never goes to a mesh with numbers by the reverse rule. A landmark file is
+  given to a single mesh, the one that it matches best.
+  Returns the list of (mesh, landmark) file name pairs, and the mesh file names without match with the reason.
+  """
+  landmarkTokens = {}
+  for fileName in sorted(landmarkFileNames):
+    stem = fileStem(fileName, LANDMARK_EXTENSIONS)
+    if stem is not None and not fileName.startswith('.'):
+      landmarkTokens[fileName] = idTokens(stem)
+
+  def numbers(tokens):
+    return [token for token in tokens if token.isdigit()]
+
+  rules = [
+    lambda meshTokens, tokens: tokens == meshTokens,
+    lambda meshTokens, tokens: tokens[:len(meshTokens)] == meshTokens or (
+      meshTokens[:len(tokens)] == tokens and numbers(tokens) == numbers(meshTokens)),
+    lambda meshTokens, tokens: numbers(tokens) == numbers(meshTokens),
+  ]
+
+  def sharedLeadingTokens(meshTokens, tokens):
+    count = 0
+    for meshToken, token in zip(meshTokens, tokens):
+      if meshToken != token:
+        break
+      count += 1
+    return count
+
+  # best landmark file of each mesh, with the rank of the match: first rule, then most shared leading tokens
+  matches = {}
+  unmatched = []
+  for meshFileName in sorted(meshFileNames):
+    stem = fileStem(meshFileName, MESH_EXTENSIONS)
+    if stem is None or meshFileName.startswith('.'):
+      continue
+    meshTokens = idTokens(stem)
+    reason = "no landmark file"
+    for ruleIndex, rule in enumerate(rules):
+      if rule is rules[2] and not numbers(meshTokens):
+        continue
+      candidates = [fileName for fileName, tokens in landmarkTokens.items() if tokens and rule(meshTokens, tokens)]
+      if not candidates:
+        continue
+      ranks = {fileName: (ruleIndex, -sharedLeadingTokens(meshTokens, landmarkTokens[fileName]),
+        abs(len(landmarkTokens[fileName]) - len(meshTokens))) for fileName in candidates}
+      bestRank = min(ranks.values())
+      best = [fileName for fileName in candidates if ranks[fileName] == bestRank]
+      if len(best) == 1:
+        matches[meshFileName] = (best[0], bestRank)
+      else:
+        reason = "several landmark files: " + ", ".join(best)
+      break
+    if meshFileName not in matches:
+      unmatched.append((meshFileName, reason))
+
+  # a landmark file matched by several meshes goes to the best match only
+  meshesOfLandmarkFile = collections.defaultdict(list)
+  for meshFileName, (landmarkFileName, rank) in matches.items():
+    meshesOfLandmarkFile[landmarkFileName].append(meshFileName)
+  pairs = []
+  for meshFileName, (landmarkFileName, rank) in matches.items():
+    rivals = [otherMesh for otherMesh in meshesOfLandmarkFile[landmarkFileName] if otherMesh != meshFileName]
+    betterOrEqual = [otherMesh for otherMesh in rivals if matches[otherMesh][1] <= rank]
+    if not betterOrEqual:
+      pairs.append((meshFileName, landmarkFileName))
+    else:
+      unmatched.append((meshFileName, f"landmark file {landmarkFileName} also matches " + ", ".join(betterOrEqual)))
+  return pairs, sorted(unmatched)
+
+
+def readGridTriangles(gridFileName):
+  """Triangles of landmark numbers (from 1) of a grid connectivity file, a CSV file with a header row"""
+  gridVertices = []
+  with open(gridFileName) as gridFile:
+    gridReader = csv.reader(gridFile)
+    next(gridReader) # skip header
+    for row in gridReader:
+      if row:
+        gridVertices.append([int(row[0]),int(row[1]),int(row[2])])
+  return gridVertices
+
+
+def coordinateSystemFromHeader(header):
+  """'RAS' or 'LPS' as written by Slicer in the header of a mesh file ('SPACE=RAS'), None if not found"""
+  match = re.search(r'SPACE=(RAS|LPS)', header or "", re.IGNORECASE)
+  return match.group(1).upper() if match else None
+
+
+def coordinateSystemFromFieldData(polydata):
+  """'RAS' or 'LPS' of the SPACE field data array that Slicer writes in .vtp files, None if not found"""
+  spaceArray = polydata.GetFieldData().GetAbstractArray("SPACE")
+  if spaceArray is None or spaceArray.GetNumberOfValues() == 0:
+    return None
+  value = str(spaceArray.GetVariantValue(0).ToString()).upper()
+  return value if value in ("RAS", "LPS") else None
+
+
+def readMesh(meshPath):
+  """
+  Surface of a mesh file in LPS coordinates. As Slicer's model loader, files are LPS unless they say SPACE=RAS:
+  in the header of .vtk and .stl files, the comments of .ply files, the comment of .obj files, or the SPACE
+  field data of .vtp files.
+  """
+  extension = os.path.splitext(meshPath)[1].lower()
+  readers = {'.ply': vtk.vtkPLYReader, '.stl': vtk.vtkSTLReader, '.obj': vtk.vtkOBJReader,
+    '.vtk': vtk.vtkPolyDataReader, '.vtp': vtk.vtkXMLPolyDataReader}
+  reader = readers[extension]()
+  reader.SetFileName(meshPath)
+  reader.Update()
+  polydata = reader.GetOutput()
+  if polydata.GetNumberOfPoints() == 0:
+    raise ValueError(f"No points in {meshPath}")
+  if extension == '.vtp':
+    coordinateSystem = coordinateSystemFromFieldData(polydata)
+  elif extension == '.ply':
+    comments = reader.GetComments()
+    coordinateSystem = coordinateSystemFromHeader(" ".join(comments.GetValue(index) for index in range(comments.GetNumberOfValues())))
+  elif extension == '.obj':
+    coordinateSystem = coordinateSystemFromHeader(reader.GetComment())
+  else:
+    # vtkSTLReader has a header from VTK 9.1
+    coordinateSystem = coordinateSystemFromHeader(reader.GetHeader() if hasattr(reader, 'GetHeader') else None)
+  if coordinateSystem == "RAS":
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    points[:, :2] *= -1
+    polydata.GetPoints().Modified()
+  return polydata
+
+
+def readLandmarks(landmarkPath):
+  """Control point positions of a .fcsv or .mrk.json markups file in LPS coordinates, an array (n, 3)"""
+  if landmarkPath.lower().endswith('.json'):
+    with open(landmarkPath) as landmarkFile:
+      markup = json.load(landmarkFile)["markups"][0]
+    positions = np.array([controlPoint["position"] for controlPoint in markup["controlPoints"]], dtype=float)
+    coordinateSystem = markup.get("coordinateSystem", "LPS")
+  else:
+    positions = []
+    # fcsv files without coordinate system are from Slicer versions that wrote RAS
+    coordinateSystem = "RAS"
+    with open(landmarkPath) as landmarkFile:
+      for row in csv.reader(landmarkFile):
+        if not row:
+          continue
+        if row[0].startswith('#'):
+          if "CoordinateSystem" in row[0]:
+            value = row[0].split('=')[-1].strip().upper()
+            coordinateSystem = {"0": "RAS", "1": "LPS"}.get(value, value)
+          continue
+        positions.append([float(value) for value in row[1:4]])
+    positions = np.array(positions, dtype=float).reshape(-1, 3)
+  if coordinateSystem == "RAS":
+    positions[:, :2] *= -1
+  return positions
+
+
+def writeSemiLandmarks(outputPath, points, nodeName, description="Semi"):
+  """Write points as a locked markups fiducial file in LPS coordinates, labeled as Slicer labels new points"""
+  temporaryPath = outputPath + ".tmp"
+  with open(temporaryPath, 'w', newline='') as outputFile:
+    outputFile.write("# Markups fiducial file version = 4.11\n")
+    outputFile.write("# CoordinateSystem = LPS\n")
+    outputFile.write("# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n")
+    writer = csv.writer(outputFile, lineterminator="\n")
+    writer.writerows([index + 1, f"{x:.9g}", f"{y:.9g}", f"{z:.9g}", 0, 0, 0, 1, 1, 1, 1,
+      f"{nodeName}-{index + 1}", description, ""] for index, (x, y, z) in enumerate(points))
+  os.replace(temporaryPath, outputPath)
+
+
+class Specimen:
+  """A mesh and its landmark file, with the batch status, timings and output that go into the report"""
+  def __init__(self, meshPath, landmarkPath, outputPath):
+    self.meshPath = meshPath
+    self.landmarkPath = landmarkPath
+    self.outputPath = outputPath
+    self.name = os.path.basename(meshPath)
+    self.status = PENDING
+    self.message = ""
+    self.semiLandmarkCount = 0
+    self.timings = {}
+    # process that placed the patches, not part of the report
+    self.workerProcessId = None
+
+  def reportRow(self):
+    row = {"specimen": self.name, "status": self.status, "message": self.message, "meshFile": self.meshPath,
+      "landmarkFile": self.landmarkPath or "", "outputFile": self.outputPath if self.status == DONE else "",
+      "semiLandmarks": self.semiLandmarkCount}
+    for stage in ["read", "normals", "patches", "write", "total"]:
+      row[stage + "Seconds"] = f"{self.timings[stage]:.3f}" if stage in self.timings else ""
+    return row
+
+
+def placeSpecimenPatches(meshPath, landmarkPath, outputPath, gridTriangles, sampleRate, smoothingIterations,
+    maximumProjectionDistance):
+  """
+  Merged semi-landmark patches of one specimen, from its files to its output file without the scene: the points
+  that applyPatch and mergeList of CreateSemiLMPatches place in the scene, in LPS coordinates (see
+  patch_engine.SemiLandmarkPatchEngine.mergedPatches). Runs in the worker processes: returns the number of
+  semi-landmarks and the time of each stage.
+  """
+  timings = {}
+  startTime = time.perf_counter()
+  surfacePolydata = readMesh(meshPath)
+  landmarkPoints = readLandmarks(landmarkPath)
+  triangles = np.array(gridTriangles, dtype=int).reshape(-1, 3) - 1
+  if len(triangles) and (triangles.min() < 0 or triangles.max() >= len(landmarkPoints)):
+    raise ValueError(f"The grid uses landmark {triangles.max() + 1} but {landmarkPath} has {len(landmarkPoints)} landmarks")
+  timings["read"] = time.perf_counter() - startTime
+  startTime = time.perf_counter()
+  normalArray = patch_engine.smoothNormals(surfacePolydata, smoothingIterations)
+  timings["normals"] = time.perf_counter() - startTime
+  startTime = time.perf_counter()
+  engine = patch_engine.SemiLandmarkPatchEngine(surfacePolydata, normalArray)
+  mergedPoints, edges = engine.mergedPatches(landmarkPoints, triangles, sampleRate, maximumProjectionDistance)
+  timings["patches"] = time.perf_counter() - startTime
+  startTime = time.perf_counter()
+  nodeName = os.path.splitext(os.path.basename(outputPath))[0]
+  writeSemiLandmarks(outputPath, mergedPoints, nodeName)
+  timings["write"] = time.perf_counter() - startTime
+  return len(mergedPoints), timings
+
+
+def _timedPlaceSpecimenPatches(arguments):
+  startTime = time.perf_counter()
+  count, timings = placeSpecimenPatches(*arguments)
+  timings["total"] = time.perf_counter() - startTime
+  return count, timings, os.getpid()
+
+
+def runBatch(specimens, gridTriangles, sampleRate, smoothingIterations=75, maximumProjectionDistance=.75,
+    maximumParallelSpecimens=None, useProcesses=True, progressCallback=None, pollInterval=0.1):
+  """
+  Place the semi-landmark patches of the specimens on up to maximumParallelSpecimens worker processes
+  (the number of CPU cores by default), or threads if not useProcesses. A specimen that raises an exception
+  is marked failed with the error message and the batch goes on. progressCallback(specimens) is called from
+  the calling thread every pollInterval seconds and when a specimen finishes; if it returns False, specimens
+  not started yet are cancelled and the batch ends once the running ones are done.
+  """
+  maximumParallelSpecimens = max(1, maximumParallelSpecimens or os.cpu_count() or 1)
+  pending = collections.deque(specimen for specimen in specimens if specimen.status == PENDING)
+  if useProcesses:
+    # spawn, as forking a process that runs Qt and VTK threads is not safe
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(maximumParallelSpecimens, max(1, len(pending))),
+      mp_context=multiprocessing.get_context("spawn"))
+  else:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=maximumParallelSpecimens,
+      thread_name_prefix="SemiLandmarkPatches")
+  running = {}
+  cancelled = False
+  with executor:
+    while pending or running:
+      # a few specimens queued ahead of the workers, so that they are never idle
+      while pending and not cancelled and len(running) < 2 * maximumParallelSpecimens:
+        specimen = pending.popleft()
+        specimen.status = RUNNING
+        arguments = (specimen.meshPath, specimen.landmarkPath, specimen.outputPath, gridTriangles, sampleRate,
+          smoothingIterations, maximumProjectionDistance)
+        try:
+          running[executor.submit(_timedPlaceSpecimenPatches, arguments)] = specimen
+        except concurrent.futures.BrokenExecutor as error:
+          # a worker process died: the specimens that were not started cannot be processed
+          for specimen in [specimen] + list(pending):
+            specimen.status = FAILED
+            specimen.message = str(error)
+          pending.clear()
+      if not running:
+        break
+      finished, _ = concurrent.futures.wait(running, timeout=pollInterval,
+        return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in finished:
+        specimen = running.pop(future)
+        if future.cancelled():
+          specimen.status = CANCELLED
+          continue
+        error = future.exception()
+        if error is None:
+          specimen.semiLandmarkCount, specimen.timings, specimen.workerProcessId = future.result()
+          specimen.status = DONE
+        else:
+          specimen.status = FAILED
+          specimen.message = str(error) or error.__class__.__name__
+          logging.error(f"Semi-landmark patches of {specimen.meshPath} failed: {specimen.message}")
+      if progressCallback and progressCallback(specimens) is False and not cancelled:
+        cancelled = True
+        for specimen in pending:
+          specimen.status = CANCELLED
+        pending.clear()
+        for future in running:
+          future.cancel()
+  return specimens
+
+
+def writeReport(specimens, reportFilePath):
+  """Write the status, timings and output file of each specimen to a CSV file"""
+  with open(reportFilePath, 'w', newline='') as reportFile:
+    writer = csv.DictWriter(reportFile, fieldnames=REPORT_FIELDS)
+    writer.writeheader()
+    for specimen in specimens:
+      writer.writerow(specimen.reportRow())
+
+
+def summary(specimens, elapsedSeconds):
+  counts = collections.Counter(specimen.status for specimen in specimens)
+  return (f"{counts[DONE]} of {len(specimens)} specimens done in {elapsedSeconds:.1f} s"
+    f" ({counts[DONE] / max(elapsedSeconds, 1e-9):.2f} specimens/s), {counts[FAILED]} failed, {counts[CANCELLED]} cancelled")
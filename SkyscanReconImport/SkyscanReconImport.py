@@ -3,7 +3,10 @@ import glob
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import time
 import numpy as np
+import SimpleITK as sitk
+from SkyscanReconImportLib import batch_import, pyramid_writer
 
 
 #
@@ -161,6 +164,45 @@ class SkyscanReconImportWidget(ScriptedLoadableModuleWidget):
         self.downsampleRatioGroup.setLayout(self.downsampleRatioLayout)
         self.batchModeTabLayout.addWidget(self.downsampleRatioGroup)
 
+        # Number of specimens imported at the same time and the memory they may use together
+        self.concurrencyGroup = qt.QGroupBox("Parallel Import")
+        self.concurrencyLayout = qt.QFormLayout()
+        self.parallelSpecimensSpinBox = qt.QSpinBox()
+        self.parallelSpecimensSpinBox.minimum = 1
+        self.parallelSpecimensSpinBox.maximum = 16
+        self.parallelSpecimensSpinBox.value = 2
+        self.parallelSpecimensSpinBox.setToolTip("Number of specimens read and written at the same time.")
+        self.concurrencyLayout.addRow("Specimens at a time:", self.parallelSpecimensSpinBox)
+        self.memoryBudgetSpinBox = qt.QDoubleSpinBox()
+        self.memoryBudgetSpinBox.minimum = 0.5
+        self.memoryBudgetSpinBox.maximum = 4096
+        self.memoryBudgetSpinBox.suffix = " GB"
+        physicalMemory = batch_import.physicalMemoryBytes()
+        self.memoryBudgetSpinBox.value = round(physicalMemory / 2 / 1024**3, 1) if physicalMemory else 8.0
+        self.memoryBudgetSpinBox.setToolTip("Memory the specimens imported at the same time may use together."
+                                            " A specimen waits until enough memory is free; one larger than the budget is imported on its own.")
+        self.concurrencyLayout.addRow("Memory budget:", self.memoryBudgetSpinBox)
+        self.concurrencyGroup.setLayout(self.concurrencyLayout)
+        self.batchModeTabLayout.addWidget(self.concurrencyGroup)
+
+        # Compression and layout of the output files
+        self.outputFormatGroup = qt.QGroupBox("Output Format")
+        self.outputFormatLayout = qt.QFormLayout()
+        self.compressionLevelSpinBox = qt.QSpinBox()
+        self.compressionLevelSpinBox.minimum = 0
+        self.compressionLevelSpinBox.maximum = 9
+        self.compressionLevelSpinBox.value = 0
+        self.compressionLevelSpinBox.specialValueText = "None"
+        self.compressionLevelSpinBox.setToolTip("zlib compression level of the output files: 1 is the fastest, 9 the smallest."
+                                                " Uncompressed files are the fastest to write and to load.")
+        self.outputFormatLayout.addRow("Compression level:", self.compressionLevelSpinBox)
+        self.chunkedOutputCheckBox = qt.QCheckBox()
+        self.chunkedOutputCheckBox.setToolTip("Write all resolutions of a specimen to one OME-Zarr folder in the full resolution"
+                                              " output directory, in 64x64x64 chunks that can be read individually, instead of NRRD files.")
+        self.outputFormatLayout.addRow("Chunked (OME-Zarr):", self.chunkedOutputCheckBox)
+        self.outputFormatGroup.setLayout(self.outputFormatLayout)
+        self.batchModeTabLayout.addWidget(self.outputFormatGroup)
+
         # Start Batch Processing Button
         self.startBatchProcessingButton = qt.QPushButton("Start Batch Processing")
         self.startBatchProcessingButton.toolTip = "Start the batch processing with the specified settings."
@@ -250,28 +292,16 @@ class SkyscanReconImportWidget(ScriptedLoadableModuleWidget):
 
     @staticmethod
     def find_rec_log_files(main_folder):
-        log_files = []
-        # First pass to determine the total number of directories (optional for precise progress)
-        total_dirs = sum(len(dirs) for r, dirs, f in os.walk(main_folder))
+        # Folders are searched in a single pass, so the progress dialog only shows what was found so far
         progress = slicer.util.createProgressDialog(windowTitle="Searching Log Files",
-                                                    labelText="Searching for log files...", maximum=total_dirs)
-
-        dir_count = 0
-        for root, dirs, files in os.walk(main_folder):
-            if root.endswith('_Rec') or root.endswith('_rec'):
-                for log_file in glob.glob(os.path.join(root, '*_rec.log')):
-                    log_files.append(log_file)
-                    # Update progress dialog with the count of log files found
-                    progress.labelText = f"Found {len(log_files)} log file(s)..."
-                    slicer.app.processEvents()  # Process UI events to update the dialog text
-
-            dir_count += 1
-            progress.value = dir_count
-            slicer.app.processEvents()  # Process UI events to update the progress bar
+                                                    labelText="Searching for log files...", maximum=0)
 
-            if progress.wasCanceled:
-                break  # Allow cancellation of search
+        def updateProgress(folderCount, logFileCount):
+            progress.labelText = f"Found {logFileCount} log file(s) in {folderCount} folder(s)..."
+            slicer.app.processEvents()  # Process UI events to update the dialog and check for cancel
+            return not progress.wasCanceled  # Allow cancellation of search
 
+        log_files = batch_import.findRecLogFiles(main_folder, updateProgress)
         progress.close()
         return log_files
 
@@ -318,37 +348,40 @@ class SkyscanReconImportWidget(ScriptedLoadableModuleWidget):
 
         # Start batch processing
         self.startBatchProcessing(logFilesList=checkedLogFiles, fullResOutputPath=fullResOutputPath,
-                                  downsampledOutputPath=downsampledOutputPath, downsampleRatio=downsampleRatios)
+                                  downsampledOutputPath=downsampledOutputPath, downsampleRatio=downsampleRatios,
+                                  maximumParallelSpecimens=self.parallelSpecimensSpinBox.value,
+                                  memoryBudgetBytes=int(self.memoryBudgetSpinBox.value * 1024**3),
+                                  compressionLevel=self.compressionLevelSpinBox.value,
+                                  chunked=self.chunkedOutputCheckBox.checked)
 
     @staticmethod
-    def startBatchProcessing(logFilesList, fullResOutputPath, downsampledOutputPath, downsampleRatio):
+    def startBatchProcessing(logFilesList, fullResOutputPath, downsampledOutputPath, downsampleRatio,
+                             maximumParallelSpecimens=2, memoryBudgetBytes=None, compressionLevel=0, chunked=False):
         progress = slicer.util.createProgressDialog(windowTitle="Batch Processing",
                                                     labelText="Starting batch processing...", maximum=len(logFilesList))
         progress.setValue(0)  # Initialize progress at 0
         logic = SkyscanReconImportLogic()
 
-        for i, logFile in enumerate(logFilesList):
-            try:
-                progress.labelText = f"Processing {os.path.basename(logFile)} ({i + 1}/{len(logFilesList)})"
-                slicer.app.processEvents()  # Update the progress dialog to reflect the new label text
-
-                # Assuming 'logic.run' processes the log and 'logic.saveVolumes' saves the volumes
-                # Update these calls as necessary according to your actual logic's methods and parameters
-                logic.run(logFile, 'utf8')  # Placeholder for your processing logic
-                logic.saveVolumes(logic.prefix_list[i], fullResOutputPath,
-                                  downsampledOutputPath, downsampleRatio)  # Placeholder for saving logic
-
-            except Exception as e:
-                print(f"Error processing {logFile}: {e}")  # Print the error message
-
-            finally:
-                progress.setValue(i + 1)  # Update the progress value regardless of success or failure
-
-                if progress.wasCanceled:
-                    break  # Allow the user to cancel the operation
-
+        def updateProgress(specimens):
+            finished = [specimen for specimen in specimens if specimen.status not in [batch_import.PENDING, batch_import.RUNNING]]
+            running = [specimen.name for specimen in specimens if specimen.status == batch_import.RUNNING]
+            progress.labelText = f"Processing {', '.join(running)} ({len(finished)}/{len(specimens)} done)" if running else "Finishing..."
+            progress.setValue(len(finished))
+            slicer.app.processEvents()  # Update the progress dialog and check for cancel
+            return not progress.wasCanceled  # Allow the user to cancel the operation
+
+        specimens, reportFilePath, message = logic.batchImport(logFilesList, 'utf8', fullResOutputPath, downsampledOutputPath,
+                                                               downsampleRatio, maximumParallelSpecimens, memoryBudgetBytes,
+                                                               compressionLevel, chunked, progressCallback=updateProgress)
         progress.close()  # Close the progress dialog once processing is complete
 
+        failed = [specimen for specimen in specimens if specimen.status == batch_import.FAILED]
+        details = "\n".join(f"{specimen.name}: {specimen.message}" for specimen in failed)
+        if failed:
+            slicer.util.warningDisplay(f"{message}\nReport: {reportFilePath}", detailedText=details)
+        else:
+            slicer.util.infoDisplay(f"{message}\nReport: {reportFilePath}")
+
     def cleanup(self):
         pass
 
@@ -594,65 +627,86 @@ class SkyscanReconImportLogic(ScriptedLoadableModuleLogic):
         logging.info(f'Processing completed in {stopTime - startTime:.2f} seconds')
 
     @staticmethod
-    def saveVolumes(node_name, fullRespath, dsResPath, resolution):
+    def saveVolumes(node_name, fullRespath, dsResPath, resolution, compressionLevel=0, chunked=False):
+        """
+        Save a volume of the scene and its 1/2 and 1/4 resolution copies (resolution flags), computed by
+        box averaging, in one pass over its slices (see pyramid_writer.PyramidWriter), then remove it from
+        the scene. Files are NRRD, with zlib compressionLevel (0 for uncompressed), or a single OME-Zarr
+        folder in fullRespath if chunked. Returns the write statistics of each level.
+        """
         volumeNode = slicer.util.getNode(node_name)
-
-
-        # Save the full resolution volume
-        fullRespath = os.path.join(fullRespath, node_name + ".nrrd")
-        slicer.util.exportNode(volumeNode, fullRespath, {"useCompression": 0})
-
-        # Function to crop and save volume at specified resolution
-        def cropAndSave(downsampleRatio, suffix):
-            # Create a new ROI node and ensure it's not visible
-            roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
-            roiDisplayNode = roiNode.GetDisplayNode()
-            if roiDisplayNode:
-                roiDisplayNode.SetVisibility(False)  # Hide in 3D view
-
-            # Set the new markup ROI to the dimensions of the volume loaded
-            cropVolumeParameters = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLCropVolumeParametersNode")
-            cropVolumeParameters.SetInputVolumeNodeID(volumeNode.GetID())
-            cropVolumeParameters.SetROINodeID(roiNode.GetID())
-            slicer.modules.cropvolume.logic().SnapROIToVoxelGrid(cropVolumeParameters)
-            slicer.modules.cropvolume.logic().FitROIToInputVolume(cropVolumeParameters)
-            slicer.mrmlScene.RemoveNode(cropVolumeParameters)
-
-            # Set the cropping parameters
-            cropVolumeLogic = slicer.modules.cropvolume.logic()
-            cropVolumeParameterNode = slicer.vtkMRMLCropVolumeParametersNode()
-            cropVolumeParameterNode.SetIsotropicResampling(True)
-            cropVolumeParameterNode.SetSpacingScalingConst(downsampleRatio)
-            cropVolumeParameterNode.SetROINodeID(roiNode.GetID())
-            cropVolumeParameterNode.SetInputVolumeNodeID(volumeNode.GetID())
-
-            # Do the cropping
-            cropVolumeLogic.Apply(cropVolumeParameterNode)
-
-            # Create the cropped volume
-            croppedVolume = slicer.mrmlScene.GetNodeByID(cropVolumeParameterNode.GetOutputVolumeNodeID())
-
-            # Set export type to NRRD
-            if not croppedVolume.GetStorageNode():
-              croppedVolume.AddDefaultStorageNode()
-            croppedVolume.GetStorageNode().SetDefaultWriteFileExtension('nrrd')
-
-            # Save the downsampled volume
-            dsPath = os.path.join(dsResPath, f"{node_name}{suffix}.nrrd")
-            slicer.util.exportNode(croppedVolume, dsPath, {"useCompression": 0})
-
-            # Cleanup: Remove temporary nodes
-            slicer.mrmlScene.RemoveNode(croppedVolume)
-            slicer.mrmlScene.RemoveNode(roiNode)
-
-        # Check and create downsampled volumes based on resolution flags
-        if resolution[0]:  # If 1/2 resolution is selected
-            cropAndSave(2, "-ds2")
-        if resolution[1]:  # If 1/4 resolution is selected
-            cropAndSave(4, "-ds4")
+        volumeArray = slicer.util.arrayFromVolume(volumeNode)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+        downsampleRatios = [ratio for ratio, selected in zip([2, 4], resolution) if selected]
+
+        if chunked:
+            writer = pyramid_writer.PyramidWriter(volumeArray.shape, volumeArray.dtype, ijkToRAS, [1] + downsampleRatios,
+                                                  zarrPath=os.path.join(fullRespath, node_name + ".zarr"),
+                                                  compressionLevel=compressionLevel, name=node_name)
+        else:
+            filePaths = [os.path.join(fullRespath, node_name + ".nrrd")] + [
+                os.path.join(dsResPath, f"{node_name}-ds{ratio}.nrrd") for ratio in downsampleRatios]
+            writer = pyramid_writer.PyramidWriter(volumeArray.shape, volumeArray.dtype, ijkToRAS, [1] + downsampleRatios,
+                                                  nrrdFilePaths=filePaths, compressionLevel=compressionLevel)
+        try:
+            for sliceArray in volumeArray:
+                writer.addSlice(sliceArray)
+        except BaseException:
+            writer.discard()
+            raise
+        writer.close()
+        levelStatistics = writer.statistics()
+        logging.info(f"{node_name}: {pyramid_writer.describeStatistics(levelStatistics)}")
 
         # Cleanup: Remove the original volume node as it's no longer needed
         slicer.mrmlScene.RemoveNode(volumeNode)
+        return levelStatistics
+
+    def batchImport(self, logFiles, encodingType, fullResOutputPath, downsampledOutputPath, downsampleRatio,
+                    maximumParallelSpecimens=2, memoryBudgetBytes=None, compressionLevel=0, chunked=False,
+                    progressCallback=None):
+        """
+        Import the reconstructions of several log files and save them as NRRD volumes, as saveVolumes does,
+        without loading them into the scene. Each specimen is written while its slices are read, with
+        zlib compressionLevel (0 for uncompressed), to a chunked OME-Zarr folder if chunked (see batch_import.importSpecimen). Specimens are read and written on maximumParallelSpecimens worker
+        threads as long as their estimated memory use fits in memoryBudgetBytes together (see batch_import.runBatch).
+        Specimens that fail are skipped and reported. progressCallback(specimens) is called periodically from
+        this thread; returning False cancels the batch.
+        A CSV report with the status and timings of each specimen is written to fullResOutputPath.
+        Returns the specimens (batch_import.Specimen), the report file path and a summary message.
+        """
+        downsampleRatios = [ratio for ratio, selected in zip([2, 4], downsampleRatio) if selected]
+        batchStartTime = time.perf_counter()
+        specimens = []
+        for logFile in logFiles:
+            try:
+                imageLogFile = LogDataObject()
+                imageLogFile.ImportFromFile(logFile, encodingType)
+                if not imageLogFile.VerifyParameters():
+                    raise ValueError("Log file parameters not set")
+                if not self.isValidImageFileType(imageLogFile.FileType):
+                    raise ValueError(f"Invalid image type: {imageLogFile.FileType}")
+                specimen = batch_import.Specimen(logFile, imageLogFile)
+                specimen.estimateMemory(downsampleRatios, chunkSize=64 if chunked else 0)
+            except Exception as e:
+                specimen = batch_import.Specimen(logFile)
+                specimen.message = str(e)
+                logging.error(f"Import of {logFile} failed: {specimen.message}")
+            specimens.append(specimen)
+
+        def importSpecimen(specimen, cancelEvent):
+            batch_import.importSpecimen(specimen, fullResOutputPath, downsampledOutputPath, downsampleRatios, cancelEvent,
+                                        compressionLevel, chunked)
+
+        batch_import.runBatch(specimens, importSpecimen, maximumParallelSpecimens, memoryBudgetBytes, progressCallback)
+
+        reportFilePath = os.path.join(fullResOutputPath, time.strftime("SkyscanBatchReport-%Y%m%d-%H%M%S.csv"))
+        batch_import.writeReport(specimens, reportFilePath)
+        message = batch_import.summary(specimens, time.perf_counter() - batchStartTime)
+        logging.info(message)
+        return specimens, reportFilePath, message
 
 
 class SkyscanReconImportTest(ScriptedLoadableModuleTest):
@@ -672,6 +726,12 @@ class SkyscanReconImportTest(ScriptedLoadableModuleTest):
     """
         self.setUp()
         self.test_SkyscanReconImport1()
+        self.setUp()
+        self.test_SkyscanReconImportBatch()
+        self.setUp()
+        self.test_SkyscanReconImportBatchMatchesSingle()
+        self.setUp()
+        self.test_SkyscanReconImportPyramidWriter()
 
     def test_SkyscanReconImport1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -718,3 +778,214 @@ class SkyscanReconImportTest(ScriptedLoadableModuleTest):
         self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
         self.delayDisplay('Test passed')
+
+    def writeTestReconstruction(self, mainFolder, name, numberOfSlices=12, shape=(30, 40), rgb=False, logLines=None):
+        """Write the slices and log file of a synthetic reconstruction, returns the log file path and the volume array"""
+        reconstructionFolder = os.path.join(mainFolder, name, name + "_Rec")
+        os.makedirs(reconstructionFolder)
+        rng = np.random.default_rng(len(name))
+        volumeArray = rng.integers(0, 255, size=(numberOfSlices,) + shape + ((3,) if rgb else ()), dtype=np.uint8)
+        for sliceIndex in range(numberOfSlices):
+            image = sitk.GetImageFromArray(volumeArray[sliceIndex], isVector=rgb)
+            sitk.WriteImage(image, os.path.join(reconstructionFolder, f"{name}_rec{sliceIndex:08d}.png"))
+        if logLines is None:
+            logLines = ["[Reconstruction]", "Result File Type=PNG", f"Result Image Width (pixels)={shape[1]}",
+                        f"Result Image Height (pixels)={shape[0]}", f"Sections Count={numberOfSlices}",
+                        "Pixel Size (um)=25.000", f"Filename Prefix={name}_rec", "Filename Index Length=8",
+                        "First Section=0", f"Last Section={numberOfSlices - 1}"]
+        logFile = os.path.join(reconstructionFolder, name + "_rec.log")
+        with open(logFile, 'w') as logFileObject:
+            logFileObject.write("\n".join(logLines) + "\n")
+        return logFile, volumeArray
+
+    def test_SkyscanReconImportBatch(self):
+        """ Batch import of synthetic reconstructions on worker threads: log discovery, outputs,
+        memory budget, failed specimens and the status report.
+        """
+        import csv
+        import tempfile
+        import threading
+        self.delayDisplay("Starting the batch import test")
+
+        with tempfile.TemporaryDirectory() as mainFolder:
+            grayLogFile, grayArray = self.writeTestReconstruction(mainFolder, "gray")
+            rgbLogFile, rgbArray = self.writeTestReconstruction(mainFolder, "rgb", rgb=True)
+            missingLogFile, _ = self.writeTestReconstruction(mainFolder, "missing")
+            os.remove(os.path.join(os.path.dirname(missingLogFile), "missing_rec00000005.png"))
+            invalidLogFile, _ = self.writeTestReconstruction(mainFolder, "invalid", logLines=["Result File Type=PNG"])
+            # log files outside of reconstruction folders are not listed
+            os.makedirs(os.path.join(mainFolder, "other"))
+            open(os.path.join(mainFolder, "other", "other_rec.log"), 'w').close()
+
+            logFiles = batch_import.findRecLogFiles(mainFolder)
+            self.assertEqual(logFiles, [grayLogFile, invalidLogFile, missingLogFile, rgbLogFile])
+
+            outputFolder = os.path.join(mainFolder, "output")
+            os.makedirs(outputFolder)
+            logic = SkyscanReconImportLogic()
+            specimens, reportFilePath, message = logic.batchImport(logFiles, 'utf8', outputFolder, outputFolder, [True, True],
+                maximumParallelSpecimens=3)
+            logging.info(message)
+            self.assertEqual([specimen.status for specimen in specimens],
+                             [batch_import.DONE, batch_import.FAILED, batch_import.FAILED, batch_import.DONE])
+            self.assertIn("missing_rec00000005.png", specimens[2].message)
+
+            image = sitk.ReadImage(os.path.join(outputFolder, "gray_rec.nrrd"))
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(image), grayArray)
+            np.testing.assert_allclose(image.GetSpacing(), [0.025] * 3)
+            ijkToLPS = np.dot(np.diag([-1.0, -1.0, 1.0]), batch_import.SKYSCAN_IJK_TO_RAS_DIRECTIONS)
+            np.testing.assert_allclose(np.array(image.GetDirection()).reshape(3, 3), ijkToLPS)
+            downsampled = sitk.ReadImage(os.path.join(outputFolder, "gray_rec-ds4.nrrd"))
+            self.assertEqual(downsampled.GetSize(), (10, 7, 3))
+            np.testing.assert_allclose(downsampled.GetSpacing(), [0.1] * 3)
+            rgbImage = sitk.ReadImage(os.path.join(outputFolder, "rgb_rec.nrrd"))
+            luminance = 0.30 * rgbArray[..., 0] + 0.59 * rgbArray[..., 1] + 0.11 * rgbArray[..., 2]
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(rgbImage), luminance.astype(np.uint8))
+
+            with open(reportFilePath, newline='') as reportFile:
+                rows = list(csv.DictReader(reportFile))
+            self.assertEqual([row["status"] for row in rows], ["done", "failed", "failed", "done"])
+            self.assertEqual(rows[0]["outputFiles"].split(";"), [os.path.join(outputFolder, name) for name in
+                             ["gray_rec.nrrd", "gray_rec-ds2.nrrd", "gray_rec-ds4.nrrd"]])
+            self.assertTrue(rows[0]["levels"].startswith("full "))
+            # the specimen that failed at its sixth slice leaves no partial output
+            self.assertEqual(rows[2]["outputFiles"], "")
+            self.assertEqual(specimens[2].outputFiles, [])
+            self.assertEqual(sorted(name for name in os.listdir(outputFolder) if name.startswith("missing") or name.endswith(".partial")), [])
+
+        # specimens running at the same time are limited by their number and by the memory budget
+        for maximumParallelSpecimens, memoryBudgetBytes, expectedMaximumRunning in [(3, None, 3), (3, 250, 2), (3, 50, 1)]:
+            running = []
+            maximumRunning = 0
+            lock = threading.Lock()
+            def sleepingImport(specimen, cancelEvent):
+                nonlocal maximumRunning
+                with lock:
+                    running.append(specimen)
+                    maximumRunning = max(maximumRunning, len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(specimen)
+                if specimen.name == "failing.log":
+                    raise ValueError("Unreadable slice")
+            specimens = []
+            for name in ["a.log", "b.log", "failing.log", "c.log", "d.log", "e.log"]:
+                specimen = batch_import.Specimen(name)
+                specimen.status = batch_import.PENDING
+                specimen.memoryBytes = 100
+                specimens.append(specimen)
+            batch_import.runBatch(specimens, sleepingImport, maximumParallelSpecimens, memoryBudgetBytes, pollInterval=0.01)
+            self.assertEqual(maximumRunning, expectedMaximumRunning)
+            self.assertEqual([specimen.status for specimen in specimens].count(batch_import.DONE), 5)
+            self.assertEqual(specimens[2].message, "Unreadable slice")
+
+        with tempfile.TemporaryDirectory() as mainFolder:
+            grayLogFile, _ = self.writeTestReconstruction(mainFolder, "gray")
+            rgbLogFile, _ = self.writeTestReconstruction(mainFolder, "rgb", rgb=True)
+            # specimens imported concurrently, cancelled before the last ones start
+            def cancelAfterFirstPoll(specimens):
+                return False
+            specimens, _, _ = logic.batchImport([grayLogFile, rgbLogFile, grayLogFile], 'utf8', mainFolder, mainFolder, [False, False],
+                maximumParallelSpecimens=2, progressCallback=cancelAfterFirstPoll)
+            self.assertEqual(specimens[2].status, batch_import.CANCELLED)
+            self.assertTrue(all(specimen.status in [batch_import.DONE, batch_import.CANCELLED] for specimen in specimens))
+
+        self.delayDisplay('Test passed')
+
+    def test_SkyscanReconImportBatchMatchesSingle(self):
+        """ The batch import writes the same voxels and geometry as importing the specimen in the scene
+        """
+        import tempfile
+        self.delayDisplay("Starting the batch and single import comparison test")
+
+        with tempfile.TemporaryDirectory() as mainFolder:
+            logFile, volumeArray = self.writeTestReconstruction(mainFolder, "specimen")
+            logic = SkyscanReconImportLogic()
+            specimens, _, _ = logic.batchImport([logFile], 'utf8', mainFolder, mainFolder, [False, False])
+            self.assertEqual(specimens[0].status, batch_import.DONE)
+            batchNode = slicer.util.loadVolume(specimens[0].outputFiles[0])
+
+            self.assertTrue(logic.run(logFile, 'utf8'))
+            singleNode = slicer.util.getNode("specimen_rec")
+            np.testing.assert_array_equal(slicer.util.arrayFromVolume(batchNode), slicer.util.arrayFromVolume(singleNode))
+            batchIJKToRAS = vtk.vtkMatrix4x4()
+            batchNode.GetIJKToRASMatrix(batchIJKToRAS)
+            singleIJKToRAS = vtk.vtkMatrix4x4()
+            singleNode.GetIJKToRASMatrix(singleIJKToRAS)
+            np.testing.assert_allclose(slicer.util.arrayFromVTKMatrix(batchIJKToRAS), slicer.util.arrayFromVTKMatrix(singleIJKToRAS), atol=1e-6)
+
+        self.delayDisplay('Test passed')
+
+    def test_SkyscanReconImportPyramidWriter(self):
+        """ Full resolution and box averaged levels written in one pass to raw and compressed NRRD files
+        and to a chunked Zarr group, with their geometry and per level statistics.
+        """
+        import json
+        import tempfile
+        self.delayDisplay("Starting the pyramid writer test")
+
+        # smooth values, so that compression has an effect; sizes that are not multiples of the factors
+        shape = (37, 50, 45)
+        slices, rows, columns = np.meshgrid(*[np.arange(size) for size in shape], indexing='ij')
+        volumeArray = (1000 + 10 * slices + 3 * rows + columns).astype(np.uint16)
+        ijkToRAS = batch_import.skyscanIJKToRAS(0.025)
+        ijkToRAS[0:3, 3] = [1.0, 2.0, 3.0]
+
+        def blockMean(factor):
+            cropped = volumeArray[:shape[0] // factor * factor, :shape[1] // factor * factor, :shape[2] // factor * factor]
+            blocks = cropped.reshape(shape[0] // factor, factor, shape[1] // factor, factor, shape[2] // factor, factor)
+            return np.rint(blocks.mean(axis=(1, 3, 5))).astype(np.uint16)
+
+        with tempfile.TemporaryDirectory() as outputFolder:
+            fileSizes = {}
+            for compressionLevel in [0, 6]:
+                filePaths = [os.path.join(outputFolder, f"level{factor}-{compressionLevel}.nrrd") for factor in [1, 2, 4]]
+                writer = pyramid_writer.PyramidWriter(shape, volumeArray.dtype, ijkToRAS, [1, 2, 4], nrrdFilePaths=filePaths,
+                                                      compressionLevel=compressionLevel)
+                for sliceArray in volumeArray:
+                    writer.addSlice(sliceArray)
+                writer.close()
+                statistics = writer.statistics()
+                logging.info(pyramid_writer.describeStatistics(statistics))
+                self.assertEqual([level["shape"] for level in statistics], [shape, (18, 25, 22), (9, 12, 11)])
+                self.assertEqual(statistics[0]["rawBytes"], volumeArray.nbytes)
+                fileSizes[compressionLevel] = statistics[0]["fileBytes"]
+                for factor, filePath in zip([1, 2, 4], filePaths):
+                    image = sitk.ReadImage(filePath)
+                    np.testing.assert_array_equal(sitk.GetArrayFromImage(image), blockMean(factor))
+                    # LPS geometry of a downsampled level: the first voxel is centered on the first block
+                    levelIJKToRAS = pyramid_writer.levelIJKToRAS(ijkToRAS, factor)
+                    np.testing.assert_allclose(image.GetSpacing(), [0.025 * factor] * 3)
+                    np.testing.assert_allclose(image.GetOrigin(), levelIJKToRAS[0:3, 3] * [-1, -1, 1])
+                    np.testing.assert_allclose(levelIJKToRAS[0:3, 3], ijkToRAS[0:3, 3] + np.dot(ijkToRAS[0:3, 0:3], [(factor - 1) / 2] * 3))
+            self.assertLess(fileSizes[6], fileSizes[0] / 4)
+
+            # chunked output: any region is read from the chunks it overlaps
+            zarrPath = os.path.join(outputFolder, "specimen.zarr")
+            writer = pyramid_writer.PyramidWriter(shape, volumeArray.dtype, ijkToRAS, [1, 2], zarrPath=zarrPath,
+                                                  compressionLevel=1, chunkSize=16, name="specimen")
+            for sliceArray in volumeArray:
+                writer.addSlice(sliceArray)
+            writer.close()
+            with open(os.path.join(zarrPath, ".zattrs")) as attributesFile:
+                datasets = json.load(attributesFile)["multiscales"][0]["datasets"]
+            self.assertEqual([dataset["path"] for dataset in datasets], ["0", "1"])
+            np.testing.assert_allclose(datasets[1]["coordinateTransformations"][0]["scale"], [0.05] * 3)
+            with open(os.path.join(zarrPath, "0", ".zarray")) as metadataFile:
+                self.assertEqual(json.load(metadataFile)["chunks"], [16, 16, 16])
+            self.assertEqual(len([name for name in os.listdir(os.path.join(zarrPath, "0")) if not name.startswith(".")]), 3 * 4 * 3)
+            np.testing.assert_array_equal(pyramid_writer.readZarrRegion(os.path.join(zarrPath, "0"), (0, 0, 0), shape), volumeArray)
+            np.testing.assert_array_equal(pyramid_writer.readZarrRegion(os.path.join(zarrPath, "0"), (15, 20, 30), (33, 21, 45)),
+                                          volumeArray[15:33, 20:21, 30:45])
+            np.testing.assert_array_equal(pyramid_writer.readZarrRegion(os.path.join(zarrPath, "1"), (0, 0, 0), (18, 25, 22)), blockMean(2))
+
+            # an interrupted write leaves the previous outputs as they were, and no partial file
+            for outputPaths in [{"zarrPath": zarrPath}, {"nrrdFilePaths": [os.path.join(outputFolder, "level1-0.nrrd")]}]:
+                writer = pyramid_writer.PyramidWriter(shape, volumeArray.dtype, ijkToRAS, [1], **outputPaths)
+                writer.addSlice(np.zeros_like(volumeArray[0]))
+                writer.discard()
+            self.assertEqual([name for name in os.listdir(outputFolder) if name.endswith(pyramid_writer.PyramidWriter.PARTIAL_SUFFIX)], [])
+            np.testing.assert_array_equal(pyramid_writer.readZarrRegion(os.path.join(zarrPath, "0"), (0, 0, 0), shape), volumeArray)
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(outputFolder, "level1-0.nrrd"))), volumeArray)
+
+        self.delayDisplay('Test passed')
@@ -0,0 +1,306 @@
+import collections
+import concurrent.futures
+import csv
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from . import pyramid_writer
+
+# IJK to RAS axis directions of the imported volumes: the slices loaded in Slicer (LPS files, so
+# IJK to RAS is diag(-1, -1, 1)) with SkyscanReconImportLogic.applySkyscanTransform hardened
+SKYSCAN_IJK_TO_RAS_DIRECTIONS = np.array([[-1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, -1.0, 0.0]])
+
+# Status of a specimen in the batch report
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+REPORT_FIELDS = ["specimen", "status", "message", "logFile", "slices", "megabytes",
+                 "waitSeconds", "readSeconds", "writeSeconds", "totalSeconds", "levels", "outputFiles"]
+
+
+def findRecLogFiles(mainFolder, progressCallback=None):
+    """
+    Reconstruction log files (*_rec.log) in the *_Rec (or *_rec) folders under mainFolder, found in a single
+    directory walk that uses the file lists os.walk already has.
+    progressCallback(numberOfFoldersSearched, numberOfLogFilesFound) is called after each folder;
+    if it returns False the search stops and the log files found so far are returned.
+    """
+    logFiles = []
+    for numberOfFolders, (root, dirs, files) in enumerate(os.walk(mainFolder), start=1):
+        dirs.sort()
+        if root.endswith('_Rec') or root.endswith('_rec'):
+            logFiles.extend(os.path.join(root, fileName) for fileName in sorted(fnmatch.filter(files, '*_rec.log')))
+        if progressCallback and progressCallback(numberOfFolders, len(logFiles)) is False:
+            break
+    return logFiles
+
+
+def physicalMemoryBytes():
+    """Total physical memory, or None where it cannot be queried without extra packages"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+        memoryStatus = MemoryStatus()
+        memoryStatus.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(memoryStatus)):
+            return memoryStatus.ullTotalPhys
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+class Specimen:
+    """
+    One reconstruction of the batch: the slice files listed by its log (a LogDataObject) and the
+    import status, timings and output files that go into the batch report.
+    """
+
+    def __init__(self, logFile, imageLog=None):
+        """imageLog is None for log files that could not be read, which are reported as failed"""
+        self.logFile = logFile
+        self.name = os.path.basename(logFile)
+        self.slicePaths = []
+        self.sliceShape = None
+        self.spacing = None
+        self.status = PENDING if imageLog is not None else FAILED
+        self.message = ""
+        self.memoryBytes = 0
+        self.volumeBytes = 0
+        self.outputFiles = []
+        self.levelStatistics = []
+        self.timings = collections.OrderedDict([("wait", 0.0), ("read", 0.0), ("write", 0.0), ("total", 0.0)])
+        if imageLog is None:
+            return
+        self.name = imageLog.Prefix
+        inputDirectory = os.path.dirname(logFile)
+        indexLength = int(imageLog.IndexLength)
+        self.slicePaths = [
+            os.path.join(inputDirectory, f"{imageLog.Prefix}{str(index).zfill(indexLength)}.{imageLog.FileType}")
+            for index in range(int(imageLog.SequenceStart), int(imageLog.SequenceEnd) + 1)]
+        self.sliceShape = (int(imageLog.Y), int(imageLog.X))
+        self.spacing = float(imageLog.Resolution)
+
+    def estimateMemory(self, downsampleRatios, chunkSize=0):
+        """
+        Bytes needed to import the specimen, which is written while its slices are read: a few slices
+        for reading and converting RGB slices, the block sums of each downsampled level and, for chunked
+        output (chunkSize > 0), a layer of chunks of each level. The voxel type is read from the header of
+        the first slice; volumeBytes is the size of the full resolution volume.
+        """
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.slicePaths[0])
+        reader.ReadImageInformation()
+        voxelBytes = sitk.GetArrayFromImage(sitk.Image(1, 1, 1, reader.GetPixelID())).dtype.itemsize
+        sliceBytes = self.sliceShape[0] * self.sliceShape[1] * voxelBytes
+        self.volumeBytes = len(self.slicePaths) * sliceBytes
+        sumsBytes = sum(self.sliceShape[0] * self.sliceShape[1] * 8 // ratio**2 for ratio in downsampleRatios)
+        chunkLayerBytes = sum(chunkSize * sliceBytes // ratio**2 for ratio in [1] + list(downsampleRatios))
+        self.memoryBytes = 4 * reader.GetNumberOfComponents() * sliceBytes + sumsBytes + chunkLayerBytes
+        return self.memoryBytes
+
+    def reportRow(self):
+        return {
+            "specimen": self.name,
+            "status": self.status,
+            "message": self.message,
+            "logFile": self.logFile,
+            "slices": len(self.slicePaths),
+            "megabytes": f"{self.volumeBytes / 1024**2:.1f}",
+            "waitSeconds": f"{self.timings['wait']:.2f}",
+            "readSeconds": f"{self.timings['read']:.2f}",
+            "writeSeconds": f"{self.timings['write']:.2f}",
+            "totalSeconds": f"{self.timings['total']:.2f}",
+            "levels": pyramid_writer.describeStatistics(self.levelStatistics),
+            "outputFiles": ";".join(self.outputFiles),
+        }
+
+
+class MemoryBudget:
+    """
+    Bytes of memory shared by the specimens imported at the same time. A specimen starts only
+    if its estimate fits in what is left; one larger than the whole budget runs on its own.
+    """
+
+    def __init__(self, totalBytes):
+        self.totalBytes = totalBytes
+        self.usedBytes = 0
+
+    def reserve(self, byteCount, running):
+        """Reserve byteCount bytes if they fit, returns the number of bytes reserved or None"""
+        if running and self.usedBytes + byteCount > self.totalBytes:
+            return None
+        self.usedBytes += byteCount
+        return byteCount
+
+    def release(self, byteCount):
+        self.usedBytes -= byteCount
+
+
+def readSlice(specimen, slicePath):
+    """
+    Read a slice of a specimen as a (row, column) array. RGB(A) slices are converted to scalars
+    using luminance (0.30*R + 0.59*G + 0.11*B), as the single specimen import does.
+    """
+    if not os.path.exists(slicePath):
+        raise ValueError(f"Slice file {os.path.basename(slicePath)} is missing")
+    sliceArray = sitk.GetArrayFromImage(sitk.ReadImage(slicePath))
+    if sliceArray.ndim == 3:
+        luminance = 0.30 * sliceArray[:, :, 0] + 0.59 * sliceArray[:, :, 1] + 0.11 * sliceArray[:, :, 2]
+        sliceArray = luminance.astype(sliceArray.dtype)
+    if sliceArray.shape != specimen.sliceShape:
+        raise ValueError(f"{os.path.basename(slicePath)} is {sliceArray.shape[1]} x {sliceArray.shape[0]} pixels,"
+                         f" the log file specifies {specimen.sliceShape[1]} x {specimen.sliceShape[0]}")
+    return sliceArray
+
+
+def skyscanIJKToRAS(spacing):
+    """IJK to RAS matrix of an imported volume, origin at 0"""
+    ijkToRAS = np.eye(4)
+    ijkToRAS[0:3, 0:3] = SKYSCAN_IJK_TO_RAS_DIRECTIONS * spacing
+    return ijkToRAS
+
+
+def importSpecimen(specimen, fullResOutputPath, downsampledOutputPath, downsampleRatios, cancelEvent,
+                   compressionLevel=0, chunked=False, chunkSize=64):
+    """
+    Read the slices of a specimen one at a time and write the full resolution and downsampled volumes
+    in the same pass (see pyramid_writer.PyramidWriter). NRRD files are named after the file prefix,
+    with -ds2 and -ds4 suffixes for the downsampled ones; if chunked, all levels go to a single
+    Zarr group named after the prefix in fullResOutputPath. Outputs get their final names only once all
+    slices are written: if the import fails or is cancelled, the partial outputs are removed and
+    specimen.outputFiles stays empty.
+    Does not use the MRML scene, so several specimens can be imported on worker threads.
+    """
+    factors = [1] + list(downsampleRatios)
+    shape = (len(specimen.slicePaths),) + specimen.sliceShape
+    writer = None
+    try:
+        for slicePath in specimen.slicePaths:
+            if cancelEvent.is_set():
+                raise ValueError("User requested cancel")
+            startTime = time.perf_counter()
+            sliceArray = readSlice(specimen, slicePath)
+            specimen.timings["read"] += time.perf_counter() - startTime
+            startTime = time.perf_counter()
+            if writer is None:
+                if chunked:
+                    writer = pyramid_writer.PyramidWriter(
+                        shape, sliceArray.dtype, skyscanIJKToRAS(specimen.spacing), factors, compressionLevel=compressionLevel,
+                        zarrPath=os.path.join(fullResOutputPath, specimen.name + ".zarr"), chunkSize=chunkSize, name=specimen.name)
+                else:
+                    filePaths = [os.path.join(fullResOutputPath, specimen.name + ".nrrd")] + [
+                        os.path.join(downsampledOutputPath, f"{specimen.name}-ds{ratio}.nrrd") for ratio in downsampleRatios]
+                    writer = pyramid_writer.PyramidWriter(
+                        shape, sliceArray.dtype, skyscanIJKToRAS(specimen.spacing), factors, compressionLevel=compressionLevel,
+                        nrrdFilePaths=filePaths)
+            writer.addSlice(sliceArray)
+            specimen.timings["write"] += time.perf_counter() - startTime
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    if writer is None:
+        raise ValueError("The log file lists no slices")
+    startTime = time.perf_counter()
+    writer.close()
+    specimen.timings["write"] += time.perf_counter() - startTime
+    specimen.levelStatistics = writer.statistics()
+    specimen.outputFiles = writer.outputPaths if not chunked else [os.path.dirname(writer.outputPaths[0])]
+    logging.info(f"{specimen.name}: {pyramid_writer.describeStatistics(specimen.levelStatistics)}")
+
+
+def runBatch(specimens, importFunction, maximumParallelSpecimens=2, memoryBudgetBytes=None, progressCallback=None, pollInterval=0.1):
+    """
+    Import specimens concurrently: importFunction(specimen, cancelEvent) runs on up to maximumParallelSpecimens
+    worker threads, and a specimen starts only when its memoryBytes fit in memoryBudgetBytes next to the
+    specimens already running (specimens start in order). A specimen that raises an exception is marked
+    failed with the error message and the batch goes on. Specimens already marked failed are skipped.
+    progressCallback(specimens) is called from the calling thread every pollInterval seconds and when a
+    specimen finishes; if it returns False, specimens not started yet are cancelled and the batch ends
+    once the running ones have stopped.
+    """
+    budget = MemoryBudget(memoryBudgetBytes if memoryBudgetBytes else float('inf'))
+    cancelEvent = threading.Event()
+    pending = collections.deque(specimen for specimen in specimens if specimen.status == PENDING)
+    running = {}
+    batchStartTime = time.perf_counter()
+
+    def importAndTime(specimen):
+        startTime = time.perf_counter()
+        try:
+            importFunction(specimen, cancelEvent)
+        finally:
+            specimen.timings["total"] = time.perf_counter() - startTime
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, maximumParallelSpecimens),
+                                               thread_name_prefix="SpecimenImport") as executor:
+        while pending or running:
+            while pending and not cancelEvent.is_set() and len(running) < max(1, maximumParallelSpecimens):
+                reservedBytes = budget.reserve(pending[0].memoryBytes, running)
+                if reservedBytes is None:
+                    break
+                specimen = pending.popleft()
+                specimen.status = RUNNING
+                specimen.timings["wait"] = time.perf_counter() - batchStartTime
+                running[executor.submit(importAndTime, specimen)] = (specimen, reservedBytes)
+
+            if running:
+                finished, _ = concurrent.futures.wait(running, timeout=pollInterval,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+            else:
+                finished = []
+            for future in finished:
+                specimen, reservedBytes = running.pop(future)
+                budget.release(reservedBytes)
+                error = future.exception()
+                if error is None:
+                    specimen.status = DONE
+                elif cancelEvent.is_set():
+                    specimen.status = CANCELLED
+                    specimen.message = str(error)
+                else:
+                    specimen.status = FAILED
+                    specimen.message = str(error) or error.__class__.__name__
+                    logging.error(f"Import of {specimen.logFile} failed: {specimen.message}")
+
+            if progressCallback and progressCallback(specimens) is False and not cancelEvent.is_set():
+                cancelEvent.set()
+                for specimen in pending:
+                    specimen.status = CANCELLED
+                pending.clear()
+    return specimens
+
+
+def writeReport(specimens, reportFilePath):
+    """Write the status, timings and output files of each specimen to a CSV file"""
+    with open(reportFilePath, 'w', newline='') as reportFile:
+        writer = csv.DictWriter(reportFile, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for specimen in specimens:
+            writer.writerow(specimen.reportRow())
+
+
+def summary(specimens, elapsedSeconds):
+    counts = collections.Counter(specimen.status for specimen in specimens)
+    megabytes = sum(specimen.volumeBytes for specimen in specimens if specimen.status == DONE) / 1024**2
+    return (f"{counts[DONE]} of {len(specimens)} specimens imported ({megabytes:.0f} MB) in {elapsedSeconds:.1f} s"
+            f" ({megabytes / max(elapsedSeconds, 1e-9):.1f} MB/s), {counts[FAILED]} failed, {counts[CANCELLED]} cancelled")
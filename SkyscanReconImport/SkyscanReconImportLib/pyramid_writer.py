@@ -0,0 +1,343 @@
+import json
+import os
+import shutil
+import time
+import zlib
+
+import numpy as np
+
+# NRRD names of the voxel types that can be written
+NRRD_TYPES = {
+    'int8': 'int8', 'uint8': 'uint8', 'int16': 'int16', 'uint16': 'uint16',
+    'int32': 'int32', 'uint32': 'uint32', 'float32': 'float', 'float64': 'double',
+}
+
+
+def levelIJKToRAS(ijkToRAS, factor):
+    """
+    IJK to RAS matrix of a volume downsampled by averaging factor^3 blocks of voxels:
+    the spacing is multiplied by factor and the first voxel is centered on the first block.
+    """
+    blockToVoxel = np.diag([float(factor), float(factor), float(factor), 1.0])
+    blockToVoxel[0:3, 3] = (factor - 1) / 2.0
+    return np.dot(ijkToRAS, blockToVoxel)
+
+
+def levelShape(shape, factor):
+    """(slices, rows, columns) of a level; incomplete blocks at the far edges are dropped"""
+    levelShape = tuple(size // factor for size in shape)
+    if min(levelShape) == 0:
+        raise ValueError(f"Volume of {shape[2]} x {shape[1]} x {shape[0]} voxels is too small to be downsampled by {factor}")
+    return levelShape
+
+
+class NrrdLevelWriter:
+    """
+    Writes a volume to a NRRD file slice by slice, raw or gzip compressed with compressionLevel (1-9).
+    Keeps the time spent compressing and writing and the number of bytes before and after compression.
+    """
+
+    def __init__(self, filePath, shape, dtype, ijkToRAS, compressionLevel=0):
+        self.filePath = filePath
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        if self.dtype.name not in NRRD_TYPES:
+            raise ValueError(f"Voxel type {self.dtype} cannot be written to NRRD")
+        self.compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, zlib.MAX_WBITS | 16) if compressionLevel > 0 else None
+        self.rawBytes = 0
+        self.writtenBytes = 0
+        self.seconds = 0.0
+        # NRRD files written by Slicer use LPS coordinates
+        ijkToLPS = np.dot(np.diag([-1.0, -1.0, 1.0, 1.0]), ijkToRAS)
+        lines = [
+            "NRRD0004",
+            "# Complete NRRD file format specification at:",
+            "# http://teem.sourceforge.net/nrrd/format.html",
+            f"type: {NRRD_TYPES[self.dtype.name]}",
+            "dimension: 3",
+            "space: left-posterior-superior",
+            f"sizes: {self.shape[2]} {self.shape[1]} {self.shape[0]}",
+            "space directions: " + " ".join("({:.17g},{:.17g},{:.17g})".format(*ijkToLPS[0:3, axis]) for axis in range(3)),
+            "kinds: domain domain domain",
+            "endian: little",
+            f"encoding: {'gzip' if self.compressor else 'raw'}",
+            "space origin: ({:.17g},{:.17g},{:.17g})".format(*ijkToLPS[0:3, 3]),
+        ]
+        self.file = open(filePath, 'wb')
+        self._write(("\n".join(lines) + "\n\n").encode("ascii"))
+
+    def _write(self, data):
+        self.file.write(data)
+        self.writtenBytes += memoryview(data).nbytes
+
+    def writeSlice(self, sliceArray):
+        startTime = time.perf_counter()
+        data = np.ascontiguousarray(sliceArray, dtype=self.dtype).data
+        self.rawBytes += data.nbytes
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self._write(data)
+        self.seconds += time.perf_counter() - startTime
+
+    def close(self):
+        if self.file is None:
+            return
+        startTime = time.perf_counter()
+        if self.compressor:
+            self._write(self.compressor.flush())
+        self.file.close()
+        self.file = None
+        self.seconds += time.perf_counter() - startTime
+
+    @property
+    def fileBytes(self):
+        return self.writtenBytes
+
+
+class ZarrLevelWriter:
+    """
+    Writes a volume as a Zarr (version 2) array of chunkSize^3 chunks, compressed with zlib at
+    compressionLevel (raw if 0), so that any region can be read by decompressing only the chunks
+    it overlaps. Slices are buffered until a layer of chunks is complete.
+    """
+
+    def __init__(self, arrayPath, shape, dtype, ijkToRAS, compressionLevel=0, chunkSize=64):
+        self.filePath = arrayPath
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.compressionLevel = compressionLevel
+        self.chunks = tuple(min(chunkSize, size) for size in self.shape)
+        self.rawBytes = 0
+        self.seconds = 0.0
+        self.writtenBytes = 0
+        os.makedirs(arrayPath, exist_ok=True)
+        metadata = {
+            "zarr_format": 2,
+            "shape": list(self.shape),
+            "chunks": list(self.chunks),
+            "dtype": self.dtype.str,
+            "compressor": {"id": "zlib", "level": compressionLevel} if compressionLevel > 0 else None,
+            "fill_value": 0,
+            "order": "C",
+            "filters": None,
+            "dimension_separator": ".",
+        }
+        with open(os.path.join(arrayPath, ".zarray"), 'w') as metadataFile:
+            json.dump(metadata, metadataFile, indent=2)
+        with open(os.path.join(arrayPath, ".zattrs"), 'w') as attributesFile:
+            json.dump({"ijkToRAS": np.asarray(ijkToRAS).tolist()}, attributesFile, indent=2)
+        # a layer of chunks, padded to whole chunks as Zarr stores edge chunks
+        chunkCounts = [-(-size // chunk) for size, chunk in zip(self.shape, self.chunks)]
+        self.layer = np.zeros((self.chunks[0], chunkCounts[1] * self.chunks[1], chunkCounts[2] * self.chunks[2]), dtype=self.dtype)
+        self.chunkCounts = chunkCounts
+        self.numberOfSlicesWritten = 0
+
+    def writeSlice(self, sliceArray):
+        startTime = time.perf_counter()
+        layerSlice = self.numberOfSlicesWritten % self.chunks[0]
+        self.layer[layerSlice, :self.shape[1], :self.shape[2]] = sliceArray
+        self.rawBytes += sliceArray.size * self.dtype.itemsize
+        self.numberOfSlicesWritten += 1
+        if layerSlice == self.chunks[0] - 1 or self.numberOfSlicesWritten == self.shape[0]:
+            self._writeLayer()
+        self.seconds += time.perf_counter() - startTime
+
+    def _writeLayer(self):
+        layerIndex = (self.numberOfSlicesWritten - 1) // self.chunks[0]
+        if self.numberOfSlicesWritten % self.chunks[0]:
+            # last, incomplete layer: the slices after the volume are padding
+            self.layer[self.numberOfSlicesWritten % self.chunks[0]:] = 0
+        for rowIndex in range(self.chunkCounts[1]):
+            for columnIndex in range(self.chunkCounts[2]):
+                chunk = self.layer[:, rowIndex * self.chunks[1]:(rowIndex + 1) * self.chunks[1],
+                                   columnIndex * self.chunks[2]:(columnIndex + 1) * self.chunks[2]]
+                data = np.ascontiguousarray(chunk).tobytes()
+                if self.compressionLevel > 0:
+                    data = zlib.compress(data, self.compressionLevel)
+                with open(os.path.join(self.filePath, f"{layerIndex}.{rowIndex}.{columnIndex}"), 'wb') as chunkFile:
+                    chunkFile.write(data)
+                self.writtenBytes += len(data)
+
+    def close(self):
+        self.layer = None
+
+    @property
+    def fileBytes(self):
+        return self.writtenBytes
+
+
+def readZarrRegion(arrayPath, start, stop):
+    """
+    Read the region [start, stop) (slice, row, column) of a Zarr array written by ZarrLevelWriter,
+    decompressing only the chunks that overlap it.
+    """
+    with open(os.path.join(arrayPath, ".zarray")) as metadataFile:
+        metadata = json.load(metadataFile)
+    chunks = metadata["chunks"]
+    dtype = np.dtype(metadata["dtype"])
+    start = [max(0, value) for value in start]
+    stop = [min(value, size) for value, size in zip(stop, metadata["shape"])]
+    region = np.zeros([max(0, b - a) for a, b in zip(start, stop)], dtype=dtype)
+    chunkRanges = [range(a // chunk, (b - 1) // chunk + 1) for a, b, chunk in zip(start, stop, chunks)]
+    for chunkIndex in np.ndindex(*[len(chunkRange) for chunkRange in chunkRanges]):
+        chunkIndex = [chunkRange[index] for chunkRange, index in zip(chunkRanges, chunkIndex)]
+        with open(os.path.join(arrayPath, ".".join(str(index) for index in chunkIndex)), 'rb') as chunkFile:
+            data = chunkFile.read()
+        if metadata["compressor"]:
+            data = zlib.decompress(data)
+        chunk = np.frombuffer(data, dtype=dtype).reshape(chunks)
+        chunkStart = [index * size for index, size in zip(chunkIndex, chunks)]
+        source = tuple(slice(max(a, c) - c, min(b, c + size) - c) for a, b, c, size in zip(start, stop, chunkStart, chunks))
+        target = tuple(slice(max(a, c) - a, min(b, c + size) - a) for a, b, c, size in zip(start, stop, chunkStart, chunks))
+        region[target] = chunk[source]
+    return region
+
+
+def writeZarrGroup(zarrPath, name, levelPaths, levelFactors, ijkToRAS):
+    """Zarr group metadata of a pyramid, with OME-NGFF multiscales attributes (axes in millimeters)"""
+    os.makedirs(zarrPath, exist_ok=True)
+    with open(os.path.join(zarrPath, ".zgroup"), 'w') as groupFile:
+        json.dump({"zarr_format": 2}, groupFile)
+    spacing = [float(np.linalg.norm(ijkToRAS[0:3, axis])) for axis in [2, 1, 0]]
+    datasets = []
+    for path, factor in zip(levelPaths, levelFactors):
+        datasets.append({"path": path, "coordinateTransformations": [
+            {"type": "scale", "scale": [value * factor for value in spacing]},
+            {"type": "translation", "translation": [value * (factor - 1) / 2.0 for value in spacing]}]})
+    multiscales = [{
+        "version": "0.4",
+        "name": name,
+        "axes": [{"name": axis, "type": "space", "unit": "millimeter"} for axis in ["z", "y", "x"]],
+        "datasets": datasets,
+        "type": "mean",
+    }]
+    with open(os.path.join(zarrPath, ".zattrs"), 'w') as attributesFile:
+        json.dump({"multiscales": multiscales}, attributesFile, indent=2)
+
+
+class PyramidWriter:
+    """
+    Writes a volume and copies downsampled by box averaging (mean of factor^3 blocks of voxels) in a single
+    pass over its slices, which are added in order. Each downsampled level keeps the in-plane block sums
+    of the slices of its current block, so memory use does not depend on the number of slices.
+    Levels are written to NRRD files (nrrdFilePaths) or to the arrays of a Zarr group (zarrPath).
+    Outputs are written under temporary names (PARTIAL_SUFFIX) and only renamed to their final names by close(),
+    so an import that fails or is cancelled (see discard) never leaves a truncated file under a final name.
+    """
+    PARTIAL_SUFFIX = ".partial"
+
+    def __init__(self, shape, dtype, ijkToRAS, factors=(1,), nrrdFilePaths=None, zarrPath=None, compressionLevel=0, chunkSize=64, name=""):
+        """
+        shape: (slices, rows, columns) of the full resolution volume
+        factors: downsampling factor of each level, 1 for the full resolution
+        nrrdFilePaths: output file of each level, if written to NRRD
+        zarrPath: Zarr group the levels are written to (as arrays "0", "1", ...) otherwise
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.factors = list(factors)
+        self.levels = []
+        # final name -> temporary name of each output (the Zarr group, or the NRRD file of each level)
+        self.temporaryPaths = {}
+        if zarrPath:
+            self.temporaryPaths[zarrPath] = zarrPath + self.PARTIAL_SUFFIX
+            if os.path.exists(self.temporaryPaths[zarrPath]):
+                shutil.rmtree(self.temporaryPaths[zarrPath])
+        for levelIndex, factor in enumerate(self.factors):
+            shape = levelShape(self.shape, factor)
+            matrix = levelIJKToRAS(ijkToRAS, factor)
+            if zarrPath:
+                writer = ZarrLevelWriter(os.path.join(self.temporaryPaths[zarrPath], str(levelIndex)), shape, self.dtype, matrix, compressionLevel, chunkSize)
+                finalPath = os.path.join(zarrPath, str(levelIndex))
+            else:
+                finalPath = nrrdFilePaths[levelIndex]
+                self.temporaryPaths[finalPath] = finalPath + self.PARTIAL_SUFFIX
+                writer = NrrdLevelWriter(self.temporaryPaths[finalPath], shape, self.dtype, matrix, compressionLevel)
+            accumulatorType = np.int64 if self.dtype.kind in 'iub' else np.float64
+            sums = np.zeros(shape[1:], dtype=accumulatorType) if factor > 1 else None
+            self.levels.append({"factor": factor, "writer": writer, "path": finalPath, "sums": sums, "slicesInBlock": 0, "slicesWritten": 0})
+        if zarrPath:
+            writeZarrGroup(self.temporaryPaths[zarrPath], name, [str(levelIndex) for levelIndex in range(len(self.factors))], self.factors, ijkToRAS)
+        self.numberOfSlicesAdded = 0
+        self.downsamplingSeconds = 0.0
+
+    @property
+    def outputPaths(self):
+        """Final path of each level"""
+        return [level["path"] for level in self.levels]
+
+    def addSlice(self, sliceArray):
+        for level in self.levels:
+            factor = level["factor"]
+            writer = level["writer"]
+            if factor == 1:
+                writer.writeSlice(sliceArray)
+                continue
+            if level["slicesWritten"] == writer.shape[0]:
+                # slices of an incomplete block at the end of the volume
+                continue
+            startTime = time.perf_counter()
+            rows, columns = writer.shape[1], writer.shape[2]
+            # adding the factor^2 strided views of the slice is several times faster than summing a reshaped slice
+            for rowOffset in range(factor):
+                for columnOffset in range(factor):
+                    level["sums"] += sliceArray[rowOffset:rows * factor:factor, columnOffset:columns * factor:factor]
+            level["slicesInBlock"] += 1
+            self.downsamplingSeconds += time.perf_counter() - startTime
+            if level["slicesInBlock"] == factor:
+                mean = level["sums"] / factor**3
+                if self.dtype.kind in 'iub':
+                    np.rint(mean, out=mean)
+                writer.writeSlice(mean.astype(self.dtype))
+                level["sums"][:] = 0
+                level["slicesInBlock"] = 0
+                level["slicesWritten"] += 1
+        self.numberOfSlicesAdded += 1
+
+    def _closeWriters(self):
+        for level in self.levels:
+            level["writer"].close()
+
+    def close(self):
+        """Complete the outputs and give them their final names, replacing existing outputs"""
+        self._closeWriters()
+        for finalPath, temporaryPath in self.temporaryPaths.items():
+            if os.path.isdir(finalPath):
+                shutil.rmtree(finalPath)
+            os.replace(temporaryPath, finalPath)
+        self.temporaryPaths = {}
+
+    def discard(self):
+        """Stop writing and remove the incomplete outputs, existing outputs with the final names are left untouched"""
+        self._closeWriters()
+        for temporaryPath in self.temporaryPaths.values():
+            if os.path.isdir(temporaryPath):
+                shutil.rmtree(temporaryPath, ignore_errors=True)
+            elif os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+        self.temporaryPaths = {}
+
+    def statistics(self):
+        """Per level: factor, shape, output path, bytes before and after compression, seconds spent writing and MB/s"""
+        levelStatistics = []
+        for level in self.levels:
+            writer = level["writer"]
+            levelStatistics.append({
+                "factor": level["factor"],
+                "shape": writer.shape,
+                "path": level["path"],
+                "rawBytes": writer.rawBytes,
+                "fileBytes": writer.fileBytes,
+                "seconds": writer.seconds,
+                "megabytesPerSecond": writer.rawBytes / max(writer.seconds, 1e-9) / 1024**2,
+            })
+        return levelStatistics
+
+
+def describeStatistics(levelStatistics):
+    descriptions = []
+    for level in levelStatistics:
+        name = "full" if level["factor"] == 1 else f"ds{level['factor']}"
+        descriptions.append(f"{name} {level['rawBytes'] / 1024**2:.1f} MB -> {level['fileBytes'] / 1024**2:.1f} MB"
+                            f" in {level['seconds']:.2f} s ({level['megabytesPerSecond']:.1f} MB/s)")
+    return "; ".join(descriptions)